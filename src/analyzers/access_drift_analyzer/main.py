@@ -0,0 +1,89 @@
+# ./src/analyzers/access_drift_analyzer/main.py
+import os
+import functions_framework
+from google.cloud import bigquery
+from utils.bq_helpers import (
+    run_query_and_save_results, run_dml_query, resolve_snapshot_timestamp, resolve_previous_snapshot_timestamp
+)
+from utils.sql_helpers import access_source_sql, access_changes_sql
+from utils.instrumentation import instrument_invocation
+from utils.logging_handler import get_logger
+
+# --- 環境変数 ---
+BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
+BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
+SOURCE_TABLE_ID = os.getenv('SOURCE_TABLE_ID') # principal_access_list
+DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID') # access_changes
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID') # access_facts (オプション、設定時はUNNEST不要)
+# 比較する直前のスナップショットを探す日数
+SNAPSHOT_LOOKBACK_DAYS = int(os.getenv('SNAPSHOT_LOOKBACK_DAYS', '7'))
+
+# 1クエリあたりの最大スキャンバイト数を設定 (例: 10GB)
+# ドライランの見積もりがこれを超えるクエリは実行しない
+MAX_BYTES_BILLED = int(os.getenv('MAX_BYTES_BILLED', 10 * 1024 * 1024 * 1024))
+
+logger = get_logger(__name__)
+
+
+@functions_framework.cloud_event
+@instrument_invocation(logger)
+def analyze_access_drift(cloud_event):
+    """
+    連続する2つのスナップショットを比較し、追加・削除されたバインディング (リソース, プリンシパル, ロール) のみを
+    access_changes テーブルに書き込む。アラートやレビューは全履歴ではなくこの差分を参照する。
+    同じスナップショットで再実行した場合は、そのスナップショットの差分を書き直す。
+    """
+    logger.info("Starting access drift analysis...")
+
+    if not DESTINATION_TABLE_ID or not (ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID):
+        msg = "Missing required environment variables: DESTINATION_TABLE_ID and SOURCE_TABLE_ID (or ACCESS_FACTS_TABLE_ID) must be set."
+        logger.error(msg)
+        raise ValueError(msg) # Functionを失敗させる
+
+    # 分析対象のスナップショットを決定 (トリガーメッセージの snapshot_id、なければ最新)
+    snapshot_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}`"
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, snapshot_table_fqn)
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Skipping analysis.")
+        return
+
+    try:
+        previous_timestamp = resolve_previous_snapshot_timestamp(snapshot_table_fqn, snapshot_timestamp, SNAPSHOT_LOOKBACK_DAYS)
+        if not previous_timestamp:
+            # 最初のスナップショットは比較対象がないため、差分は記録しない (次回の比較の基準になる)
+            logger.info(f"No previous snapshot found before {snapshot_timestamp}. Nothing to compare.")
+            return
+        logger.info(f"Comparing snapshot {snapshot_timestamp} with {previous_timestamp}")
+
+        current_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, snapshot_timestamp)
+        previous_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, previous_timestamp)
+        snapshot_params = [
+            bigquery.ScalarQueryParameter("snapshot_timestamp", "STRING", snapshot_timestamp),
+            bigquery.ScalarQueryParameter("previous_snapshot_timestamp", "STRING", previous_timestamp),
+        ]
+
+        # 再実行に備えて、このスナップショットの差分を先に削除する (パーティション列での絞り込み)
+        run_dml_query(
+            f"DELETE FROM `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}` "
+            "WHERE assessment_timestamp = TIMESTAMP(@snapshot_timestamp)",
+            query_parameters=snapshot_params[:1]
+        )
+        stats = run_query_and_save_results(
+            query=access_changes_sql(current_source, previous_source),
+            destination_table_id=DESTINATION_TABLE_ID,
+            write_disposition="WRITE_APPEND",
+            max_bytes_billed=MAX_BYTES_BILLED,
+            query_parameters=snapshot_params
+        )
+        logger.info(
+            "Successfully completed access drift analysis.",
+            extra={"snapshot_timestamp": snapshot_timestamp, "previous_snapshot_timestamp": previous_timestamp, **(stats or {})}
+        )
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during access drift analysis: {e}", exc_info=True)
+        raise
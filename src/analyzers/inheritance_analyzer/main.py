@@ -1,7 +1,15 @@
 import os
+import json
+import datetime
 import functions_framework
 # 変更点: bigqueryライブラリの直接インポートは不要になり、ヘルパー関数をインポートする
-from utils.bq_helpers import run_query_and_save_results
+from utils.bq_helpers import (
+    submit_query_and_save_results, wait_for_query_jobs, run_dml_query, resolve_snapshot_timestamp,
+    lookup_analysis_cache, record_analysis_fingerprint, fetch_query_rows, load_rows_to_table
+)
+from utils.sql_helpers import access_source_sql
+from utils.resource_hierarchy import EffectiveAccessEngine, load_hierarchy_from_asset_inventory
+from utils.instrumentation import instrument_invocation
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -12,13 +20,30 @@ BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
 PRINCIPAL_TABLE_ID = os.getenv('PRINCIPAL_TABLE_ID')
 GROUP_TABLE_ID = os.getenv('GROUP_TABLE_ID')
+# 変更点: フラット化されたアクセスファクトテーブル (オプション)。ロールでクラスタ化されているため絞り込みが効く
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID')
+# 変更点: group-assessorが出力する推移閉包テーブル (オプション)。設定時は間接的なネストも検出する
+TRANSITIVE_GROUP_TABLE_ID = os.getenv('TRANSITIVE_GROUP_TABLE_ID')
+# 変更点: 分析結果のキャッシュ用フィンガープリントを保存するテーブル (オプション)
+ANALYSIS_CACHE_TABLE_ID = os.getenv('ANALYSIS_CACHE_TABLE_ID')
+# 変更点: 評価スコープ (例: ["organizations/123"])。設定時は Cloud Asset Inventory から階層を読み込み、
+# 継承されるリスクのある付与が実際に及ぶ子孫リソースの数を計算する
+ASSESSMENT_SCOPES = json.loads(os.getenv('ASSESSMENT_SCOPES', '[]'))
+
+# 継承によって広範囲に及ぶリスクのある付与 (組織・フォルダに付与された強いロール)
+EXCESSIVE_INHERITANCE_PREDICATE = """
+            (STARTS_WITH(a.resource_name, '//cloudresourcemanager.googleapis.com/organizations/')
+             OR STARTS_WITH(a.resource_name, '//cloudresourcemanager.googleapis.com/folders/'))
+            AND a.role IN ('roles/owner', 'roles/editor', 'roles/organization.admin')"""
 
 # 1クエリあたりの最大スキャンバイト数を設定 (例: 10GB)
-MAX_BYTES_BILLED = 10 * 1024 * 1024 * 1024
+# 変更点: analyzerごとの予算として環境変数で上書き可能にする。ドライランの見積もりがこれを超えるクエリは実行しない
+MAX_BYTES_BILLED = int(os.getenv('MAX_BYTES_BILLED', 10 * 1024 * 1024 * 1024))
 # ロガーを初期化
 logger = get_logger(__name__)
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def analyze_inheritance_risks(cloud_event):
     logger.info("Starting inheritance risk analysis...")
 
@@ -28,10 +53,22 @@ def analyze_inheritance_risks(cloud_event):
         logger.error(msg)
         raise ValueError(msg) # Functionを失敗させる
 
+    # 変更点: 分析対象のスナップショットを決定 (トリガーメッセージの snapshot_id、なければ最新)
+    snapshot_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or PRINCIPAL_TABLE_ID}`"
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, snapshot_table_fqn)
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Skipping analysis.")
+        return
+    logger.info(f"Analyzing snapshot: {snapshot_timestamp}")
+
     try:
         # --- テーブルの完全修飾名を定義 ---
         # 環境変数から読み込まれたテーブル名を使用
-        principal_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{PRINCIPAL_TABLE_ID}`"
+        access_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, PRINCIPAL_TABLE_ID, snapshot_timestamp)
         group_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{GROUP_TABLE_ID}`"
 
         # --- クエリ1: 過剰な継承の検出 ---
@@ -40,47 +77,119 @@ def analyze_inheritance_risks(cloud_event):
         SELECT
             CURRENT_TIMESTAMP() as assessment_timestamp,
             'EXCESSIVE_INHERITANCE' as risk_type,
-            TO_JSON_STRING(t) as details
-        FROM {principal_table_fqn} AS t, UNNEST(t.access_list) AS a
-        WHERE
-            (STARTS_WITH(a.resource_name, '//cloudresourcemanager.googleapis.com/organizations/')
-             OR STARTS_WITH(a.resource_name, '//cloudresourcemanager.googleapis.com/folders/'))
-            AND a.role IN ('roles/owner', 'roles/editor', 'roles/organization.admin')
+            TO_JSON_STRING(a) as details
+        FROM {access_source} AS a
+        WHERE{EXCESSIVE_INHERITANCE_PREDICATE}
         """
-        
-        # 変更点: ヘルパー関数を呼び出し、結果でテーブルを上書き(TRUNCATE)する
-        run_query_and_save_results(
-            query=query_excessive,
-            # 環境変数から読み込まれたテーブル名を使用
-            destination_table_id=DESTINATION_TABLE_ID,
-            write_disposition="WRITE_TRUNCATE",
-            max_bytes_billed=MAX_BYTES_BILLED
-        )
 
         # --- クエリ2: ネストしたグループの検出 ---
         logger.info("Analyzing nested groups...")
-        query_nested = f"""
-        SELECT
-            CURRENT_TIMESTAMP() as assessment_timestamp,
-            'NESTED_GROUP' as risk_type,
-            TO_JSON_STRING(t) as details
-        FROM {group_table_fqn} AS t
-        WHERE
-            t.member_type = 'GROUP'
-        """
-        
-        # 変更点: ヘルパー関数を呼び出し、結果をテーブルに追加(APPEND)する
-        run_query_and_save_results(
-            query=query_nested,
-            # 環境変数から読み込まれたテーブル名を使用
-            destination_table_id=DESTINATION_TABLE_ID,
-            write_disposition="WRITE_APPEND",
-            max_bytes_billed=MAX_BYTES_BILLED
+        if TRANSITIVE_GROUP_TABLE_ID:
+            # 推移閉包テーブルを使い、間接的にネストしたグループも深さと経路付きで検出する
+            transitive_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{TRANSITIVE_GROUP_TABLE_ID}`"
+            query_nested = f"""
+            SELECT
+                CURRENT_TIMESTAMP() as assessment_timestamp,
+                'NESTED_GROUP' as risk_type,
+                TO_JSON_STRING(t) as details
+            FROM {transitive_table_fqn} AS t
+            WHERE
+                t.member_type = 'GROUP'
+            """
+        else:
+            query_nested = f"""
+            SELECT
+                CURRENT_TIMESTAMP() as assessment_timestamp,
+                'NESTED_GROUP' as risk_type,
+                TO_JSON_STRING(t) as details
+            FROM {group_table_fqn} AS t
+            WHERE
+                t.member_type = 'GROUP'
+            """
+
+        # 変更点: ソーステーブルとクエリ・設定が前回の実行から変わっていなければ、スキャンせずに終了する
+        # 階層はテーブルではなく Cloud Asset Inventory から読み込むため、階層を使う場合はキャッシュしない
+        cache_hit, fingerprint = lookup_analysis_cache(
+            None if ASSESSMENT_SCOPES else ANALYSIS_CACHE_TABLE_ID, "analyze_inheritance_risks",
+            [
+                f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or PRINCIPAL_TABLE_ID}",
+                f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{TRANSITIVE_GROUP_TABLE_ID or GROUP_TABLE_ID}",
+            ],
+            query_excessive, query_nested
         )
+        if cache_hit:
+            logger.info("Source tables and configuration are unchanged since the last run. Skipping analysis.", extra={"cache_hit": True})
+            return
+
+        # 変更点: 2つのクエリは互いに独立しているため、並行して実行する
+        # 同じテーブルへの TRUNCATE と APPEND を並行させると順序が保証されないため、
+        # 先にテーブルを空にしてから (メタデータ操作のみで課金なし) 両方を APPEND で投入する
+        run_dml_query(f"TRUNCATE TABLE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}`")
+        jobs = {
+            "NESTED_GROUP": submit_query_and_save_results(
+                query=query_nested,
+                destination_table_id=DESTINATION_TABLE_ID,
+                write_disposition="WRITE_APPEND",
+                max_bytes_billed=MAX_BYTES_BILLED
+            ),
+        }
+        if ASSESSMENT_SCOPES:
+            # ネストしたグループのクエリを待つ間に、階層を使って継承の到達範囲を計算する
+            _write_inheritance_coverage(access_source)
+        else:
+            jobs["EXCESSIVE_INHERITANCE"] = submit_query_and_save_results(
+                query=query_excessive,
+                # 環境変数から読み込まれたテーブル名を使用
+                destination_table_id=DESTINATION_TABLE_ID,
+                write_disposition="WRITE_APPEND",
+                max_bytes_billed=MAX_BYTES_BILLED
+            )
+        results = wait_for_query_jobs(jobs)
+
+        failed = {name: result["error"] for name, result in results.items() if result["error"]}
+        if failed:
+            raise Exception(f"Inheritance analysis queries failed: {failed}")
 
+        record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, "analyze_inheritance_risks", fingerprint)
         logger.info("Successfully completed inheritance risk analysis.")
 
     except Exception as e:
         logger.error(f"An unexpected error occurred during inheritance analysis: {e}", exc_info=True)
         # 修正点: 'raise' は 'except' ブロックの内側に正しく配置されている (維持)
         raise
+
+
+def _write_inheritance_coverage(access_source: str):
+    """
+    リスクのある継承付与ごとに、リソース階層を下方向に伝播させて到達する子孫リソースの数を計算し、
+    EXCESSIVE_INHERITANCE として書き込む。
+    """
+    grants = fetch_query_rows(
+        f"""
+        SELECT DISTINCT a.principal_email, a.principal_type, a.resource_name, a.role
+        FROM {access_source} AS a
+        WHERE{EXCESSIVE_INHERITANCE_PREDICATE}
+        """,
+        max_bytes_billed=MAX_BYTES_BILLED
+    )
+    if not grants:
+        logger.info("No risky inherited grants found.")
+        return
+
+    hierarchy = load_hierarchy_from_asset_inventory(ASSESSMENT_SCOPES)
+    coverage = EffectiveAccessEngine(hierarchy, grants).coverage()
+    logger.info(
+        f"Computed inheritance coverage for {len(grants)} grants over {len(hierarchy)} hierarchy nodes.",
+        extra={"grants": len(grants), "hierarchy_nodes": len(hierarchy)}
+    )
+
+    current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    rows = [
+        {
+            "assessment_timestamp": current_timestamp,
+            "risk_type": "EXCESSIVE_INHERITANCE",
+            "details": json.dumps({**grant, **grant_coverage}),
+        }
+        for grant, grant_coverage in zip(grants, coverage)
+    ]
+    load_rows_to_table(rows, DESTINATION_TABLE_ID, write_disposition="WRITE_APPEND")
@@ -1,10 +1,15 @@
 # ./src/analyzers/overpermission_analyzer/main.py
 import os
+import json
+import datetime
 import functions_framework
-from google.cloud import recommender_v1, bigquery
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.api_core import exceptions as api_exceptions
 # 修正点: クラスではなく、グローバルインスタンスを直接インポート
-from utils.gcp_clients import bigquery_client, recommender_client
-import datetime
+from utils.gcp_clients import asset_client, recommender_client
+from utils.bq_helpers import load_rows_to_table, run_dml_query, copy_table
+from utils.instrumentation import instrument_invocation
+from utils.rate_limiter import call_api_pages
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -12,78 +17,182 @@ BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
 BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされたテーブル名を環境変数から読み込む
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: 評価スコープ (dispatcher と同じ形式、例: ["organizations/123", "folders/456", "projects/my-proj"])。
+# 組織・フォルダは配下のプロジェクトに展開し、プロジェクトごとに推奨を取得する
+ASSESSMENT_SCOPES = json.loads(os.getenv('ASSESSMENT_SCOPES', '[]'))
+# 後方互換: 単一の親リソース (ASSESSMENT_SCOPES 未設定時のみ使用)
 RECOMMENDER_PARENT = os.getenv('RECOMMENDER_PARENT')
+RECOMMENDER_LOCATION = os.getenv('RECOMMENDER_LOCATION', 'global')
+# 変更点: 並列数・ページサイズ・ロードジョブ1回あたりの行数
+# クォータ超過時の再試行とレート制限は utils.rate_limiter の共通設定 (API_MAX_RETRIES, API_QPS_LIMITS の "recommender") に従う
+RECOMMENDER_MAX_WORKERS = int(os.getenv('RECOMMENDER_MAX_WORKERS', '8'))
+RECOMMENDER_PAGE_SIZE = int(os.getenv('RECOMMENDER_PAGE_SIZE', '500'))
+LOAD_BATCH_SIZE = int(os.getenv('LOAD_BATCH_SIZE', '5000'))
+# 修正点: 結果を書き込むステージングテーブルの接尾辞 (<宛先>_staging)。成功時に宛先と入れ替えて削除する
+STAGING_TABLE_SUFFIX = "_staging"
+
+RECOMMENDER_ID = "google.iam.policy.Recommender"
+PROJECT_ASSET_TYPE = "cloudresourcemanager.googleapis.com/Project"
+# 親リソース単位でスキップするエラー (APIが無効、権限なし、プロジェクト削除済みなど)
+SKIPPABLE_ERRORS = (api_exceptions.PermissionDenied, api_exceptions.NotFound, api_exceptions.FailedPrecondition)
 
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
 # 修正点: インスタンスの初期化コードを削除 (gcp_clients.py からインポート)
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def analyze_overpermission(cloud_event):
     """
     IAM Recommender APIから過剰な権限の推奨を取得し、結果をBigQueryに書き込む。
+    変更点: 評価スコープ配下の全プロジェクトを対象に、親リソースごとの取得を並列に実行し、
+    結果をバッチごとにロードジョブで書き込む。
+    修正点: 結果はステージングテーブルに書き込み、全ての親リソースの取得が成功した場合のみ宛先テーブルと入れ替える。
+    推奨が0件でも宛先は洗い替える。一部の親リソースで取得に失敗した場合は、宛先を更新せずに失敗させる
+    (一部の結果で前回の結果全体を置き換えないため)。
     """
     # 修正点: 必須の環境変数が設定されているかチェック
-    if not RECOMMENDER_PARENT or not DESTINATION_TABLE_ID:
-        msg = "Missing required environment variables: RECOMMENDER_PARENT and DESTINATION_TABLE_ID must be set."
+    if not (ASSESSMENT_SCOPES or RECOMMENDER_PARENT) or not DESTINATION_TABLE_ID:
+        msg = "Missing required environment variables: ASSESSMENT_SCOPES (or RECOMMENDER_PARENT) and DESTINATION_TABLE_ID must be set."
         logger.error(msg)
         raise ValueError(msg) # Functionを失敗させる
 
     logger.info("Starting overpermission analysis using IAM Recommender...")
     try:
-        recommender_name = f"{RECOMMENDER_PARENT}/recommenders/google.iam.policy.Recommender"
-
-        # 1. IAM Recommenderから推奨を取得 (グローバルインスタンスを使用)
-        recommendations = recommender_client.list_recommendations(parent=recommender_name, timeout=300.0)
+        parents = _recommender_parents(ASSESSMENT_SCOPES or [RECOMMENDER_PARENT])
+        logger.info(f"Collecting recommendations from {len(parents)} parents.", extra={"parents": len(parents), "max_workers": RECOMMENDER_MAX_WORKERS})
 
-        rows_to_insert = []
         current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        # 宛先と同じスキーマの空のステージングテーブルを作り、バッチはそこに追記する
+        staging_table_id = f"{DESTINATION_TABLE_ID}{STAGING_TABLE_SUFFIX}"
+        run_dml_query(
+            f"CREATE OR REPLACE TABLE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{staging_table_id}` "
+            f"LIKE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}`"
+        )
+        sink = _BatchSink(staging_table_id, LOAD_BATCH_SIZE)
+        failed_parents = []
 
-        # 2. 取得した推奨を解析し、BigQueryに書き込むデータを作成
-        for rec in recommendations:
-            details = rec.content.overview
-            
-            recommended_role = _parse_recommended_role(rec.content.operations)
-            
-            # --- 修正点: recommender_subtype を取得 ---
-            recommendation_subtype = rec.recommender_subtype
-            # --- 修正点 ここまで ---
-
-            rows_to_insert.append({
-                "assessment_timestamp": current_timestamp,
-                "principal_email": details.get('member'),
-                "resource_name": details.get('resource'),
-                "current_role": details.get('role'),
-                "recommended_role": recommended_role,
-                "reason": "IAM_RECOMMENDER",
-                # --- 修正点: recommendation_subtype を追加 ---
-                "recommendation_subtype": recommendation_subtype
-                # --- 修正点 ここまで ---
-            })
-
-        # 3. 発見したリスクをoverpermission_risksテーブルに書き込み
-        if rows_to_insert:
-            # グローバルインスタンス (bigquery_client) を使用
-            # DESTINATION_TABLE_IDは環境変数から読み込まれたものを使用
-            table_ref = bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(DESTINATION_TABLE_ID)
-            # テーブルスキーマが更新されていることを前提とする
-            job_config = bigquery.JobConfig(write_disposition="WRITE_TRUNCATE")
-            
-            errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert, job_config=job_config)
-            
-            if not errors:
-                logger.info(f"Successfully wrote {len(rows_to_insert)} recommendations to BigQuery.")
-            else:
-                # BigQueryへの書き込みエラーの詳細を出力
-                logger.error(f"BigQuery insert errors occurred: {errors}")
-                raise Exception(f"BigQuery insert errors: {errors}")
+        # 1. 親リソースごとに推奨を並列に取得し、完了したものから順にシンクへ流す
+        with ThreadPoolExecutor(max_workers=max(1, RECOMMENDER_MAX_WORKERS)) as executor:
+            futures = {executor.submit(_list_parent_recommendations, parent): parent for parent in parents}
+            for future in as_completed(futures):
+                parent = futures[future]
+                try:
+                    recommendations = future.result()
+                except SKIPPABLE_ERRORS as e:
+                    logger.warning(f"Skipping recommender parent {parent}: {e}")
+                    continue
+                except Exception as e:
+                    logger.error(f"Failed to list recommendations for {parent}: {e}")
+                    failed_parents.append(parent)
+                    continue
+                # 2. 取得した推奨を解析し、BigQueryに書き込むデータを作成
+                sink.extend(_recommendation_row(rec, current_timestamp) for rec in recommendations)
+
+        # 3. 残りの行を書き込み
+        sink.flush()
+
+        if failed_parents:
+            raise RuntimeError(
+                f"Failed to list recommendations for {len(failed_parents)} of {len(parents)} parents. "
+                f"{DESTINATION_TABLE_ID} was not updated."
+            )
+        # 4. 全ての親リソースの結果がそろった場合のみ、宛先を置き換える (0件の場合も空のテーブルで洗い替える)
+        copy_table(staging_table_id, DESTINATION_TABLE_ID, write_disposition="WRITE_TRUNCATE")
+        run_dml_query(f"DROP TABLE IF EXISTS `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{staging_table_id}`")
+        if sink.written_rows:
+            logger.info(
+                f"Successfully wrote {sink.written_rows} recommendations to BigQuery.",
+                extra={"rows": sink.written_rows, "load_jobs": sink.load_jobs, "failed_parents": failed_parents}
+            )
         else:
             logger.info("No overpermission recommendations found from IAM Recommender.")
-            
+
     except Exception as e:
         logger.error(f"An unexpected error occurred during overpermission analysis: {e}", exc_info=True) # exc_info=True を追加してスタックトレースを出力
         raise
 
+
+class _BatchSink:
+    """
+    行をバッファし、batch_size ごとにロードジョブで書き込む (WRITE_APPEND)。
+    書き込み先は実行ごとに作り直すステージングテーブルのため、洗い替えは宛先との入れ替えで行う。
+    """
+
+    def __init__(self, destination_table_id: str, batch_size: int):
+        self.destination_table_id = destination_table_id
+        self.batch_size = max(1, batch_size)
+        self.buffer = []
+        self.written_rows = 0
+        self.load_jobs = 0
+
+    def extend(self, rows):
+        for row in rows:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        load_rows_to_table(self.buffer, self.destination_table_id, write_disposition="WRITE_APPEND")
+        self.written_rows += len(self.buffer)
+        self.load_jobs += 1
+        self.buffer = []
+
+
+def _recommender_parents(scopes: list) -> list:
+    """
+    評価スコープを Recommender の親リソース (projects/<id>/locations/<location>) のリストに展開する。
+    プロジェクトはそのまま、組織・フォルダは Cloud Asset Inventory で配下のプロジェクトを列挙する。
+    """
+    parents = []
+    for scope in scopes:
+        if "/locations/" in scope:
+            parents.append(scope) # 親リソースが直接指定された場合 (RECOMMENDER_PARENT)
+            continue
+        if scope.startswith("projects/"):
+            parents.append(f"{scope}/locations/{RECOMMENDER_LOCATION}")
+            continue
+        resources = call_api_pages(
+            "asset", asset_client.search_all_resources,
+            {"scope": scope, "asset_types": [PROJECT_ASSET_TYPE]}, "results",
+            timeout=300.0
+        )
+        for resource in resources:
+            # resource.project は projects/<プロジェクト番号>
+            parents.append(f"{resource.project}/locations/{RECOMMENDER_LOCATION}")
+    # 重複するスコープ (組織とその配下のフォルダなど) を除く。順序は保持する
+    return list(dict.fromkeys(parents))
+
+
+def _list_parent_recommendations(parent: str) -> list:
+    """
+    1つの親リソースの推奨を全ページ取得する。再試行はページ単位で行い、
+    途中のページで失敗しても取得済みのページは取り直さない。
+    """
+    recommender_name = f"{parent}/recommenders/{RECOMMENDER_ID}"
+    return list(call_api_pages(
+        "recommender", recommender_client.list_recommendations,
+        {"parent": recommender_name, "page_size": RECOMMENDER_PAGE_SIZE, "page_token": ""}, "recommendations",
+        timeout=300.0
+    ))
+
+
+def _recommendation_row(rec, current_timestamp: str) -> dict:
+    details = rec.content.overview
+    return {
+        "assessment_timestamp": current_timestamp,
+        "principal_email": details.get('member'),
+        "resource_name": details.get('resource'),
+        "current_role": details.get('role'),
+        "recommended_role": _parse_recommended_role(rec.content.operations),
+        "reason": "IAM_RECOMMENDER",
+        # --- 修正点: recommendation_subtype を追加 ---
+        "recommendation_subtype": rec.recommender_subtype
+    }
+
+
 def _parse_recommended_role(operations):
     """
     Recommenderのオペレーションリストから、推奨される新しいロールを抽出する。
@@ -97,4 +206,4 @@ def _parse_recommended_role(operations):
         if hasattr(op, 'action') and hasattr(op, 'path') and hasattr(op, 'value'):
              if op.action == 'replace' and '/bindings/role' in op.path and hasattr(op.value, 'string_value'):
                  return op.value.string_value
-    return None # 見つからなかった場合も None を返す
\ No newline at end of file
+    return None # 見つからなかった場合も None を返す
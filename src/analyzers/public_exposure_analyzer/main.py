@@ -1,7 +1,11 @@
 import os
 import functions_framework
 # 変更点: bigqueryライブラリの直接インポートは不要になり、ヘルパー関数をインポートする
-from utils.bq_helpers import run_query_and_save_results
+from utils.bq_helpers import (
+    run_query_and_save_results, resolve_snapshot_timestamp, lookup_analysis_cache, record_analysis_fingerprint
+)
+from utils.sql_helpers import access_source_sql
+from utils.instrumentation import instrument_invocation
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -11,13 +15,19 @@ BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされた定数を環境変数から読み込む
 SOURCE_TABLE_ID = os.getenv('SOURCE_TABLE_ID')
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: フラット化されたアクセスファクトテーブル (オプション)。設定時はUNNESTせずに直接参照する
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID')
+# 変更点: 分析結果のキャッシュ用フィンガープリントを保存するテーブル (オプション)
+ANALYSIS_CACHE_TABLE_ID = os.getenv('ANALYSIS_CACHE_TABLE_ID')
 
 # 1クエリあたりの最大スキャンバイト数を設定 (例: 10GB)
-MAX_BYTES_BILLED = 10 * 1024 * 1024 * 1024
+# 変更点: analyzerごとの予算として環境変数で上書き可能にする。ドライランの見積もりがこれを超えるクエリは実行しない
+MAX_BYTES_BILLED = int(os.getenv('MAX_BYTES_BILLED', 10 * 1024 * 1024 * 1024))
 
 logger = get_logger(__name__)
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def analyze_public_exposure(cloud_event):
     """
     Pub/Subメッセージをトリガーに、principal_access_listテーブルを分析し、
@@ -31,25 +41,47 @@ def analyze_public_exposure(cloud_event):
         logger.error(msg)
         raise ValueError(msg) # Functionを失敗させる
 
+    # 変更点: 分析対象のスナップショットを決定 (トリガーメッセージの snapshot_id、なければ最新)
+    snapshot_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}`"
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, snapshot_table_fqn)
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Skipping analysis.")
+        return
+    logger.info(f"Analyzing snapshot: {snapshot_timestamp}")
+
     try:
         # --- ここからがメインの処理 ---
         # SOURCE_TABLE_IDは環境変数から読み込まれたものを使用
-        source_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{SOURCE_TABLE_ID}`"
+        access_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, snapshot_timestamp)
 
         # BigQueryで外部公開されているリソースを抽出するSQLクエリ
         query = f"""
         SELECT
-            t.assessment_timestamp,
-            t.scope,
+            access.assessment_timestamp,
+            access.scope,
             access.resource_name,
-            t.principal_email AS public_principal,
+            access.principal_email AS public_principal,
             access.role
         FROM
-            {source_table_fqn} AS t, UNNEST(t.access_list) AS access
+            {access_source} AS access
         WHERE
-            t.principal_email IN ('allUsers', 'allAuthenticatedUsers')
+            access.principal_email IN ('allUsers', 'allAuthenticatedUsers')
         """
 
+        # 変更点: ソーステーブルとクエリ・設定が前回の実行から変わっていなければ、スキャンせずに終了する
+        cache_hit, fingerprint = lookup_analysis_cache(
+            ANALYSIS_CACHE_TABLE_ID, "analyze_public_exposure",
+            [f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}"],
+            query
+        )
+        if cache_hit:
+            logger.info("Source tables and configuration are unchanged since the last run. Skipping analysis.", extra={"cache_hit": True})
+            return
+
         # 変更点: ヘルパー関数を呼び出し、結果でテーブルを上書き(TRUNCATE)する
         run_query_and_save_results(
             query=query,
@@ -59,6 +91,7 @@ def analyze_public_exposure(cloud_event):
             max_bytes_billed=MAX_BYTES_BILLED
         )
 
+        record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, "analyze_public_exposure", fingerprint)
         logger.info(f"Successfully completed public exposure analysis.")
         # --- ここまでがメインの処理 ---
 
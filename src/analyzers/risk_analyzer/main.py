@@ -1,7 +1,13 @@
 import os
 import functions_framework
 import json # ◀◀ JSONをパースするためにインポート
-from utils.bq_helpers import run_query_and_save_results
+import re
+from google.cloud import bigquery
+from utils.bq_helpers import (
+    run_query_and_save_results, resolve_snapshot_timestamp, lookup_analysis_cache, record_analysis_fingerprint
+)
+from utils.sql_helpers import access_source_sql
+from utils.instrumentation import instrument_invocation
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -10,9 +16,16 @@ BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされた定数を環境変数から読み込む
 SOURCE_TABLE_ID = os.getenv('SOURCE_TABLE_ID')
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: フラット化されたアクセスファクトテーブル (オプション)。ロールでクラスタ化されているため絞り込みが効く
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID')
+# 変更点: 分析結果のキャッシュ用フィンガープリントを保存するテーブル (オプション)
+ANALYSIS_CACHE_TABLE_ID = os.getenv('ANALYSIS_CACHE_TABLE_ID')
+# 変更点: ロール → 権限のカタログ (オプション)。設定時は 'permission:<権限名>' のエントリで、権限を含むロールも分類する
+ROLE_PERMISSIONS_TABLE_ID = os.getenv('ROLE_PERMISSIONS_TABLE_ID')
 
 # 1クエリあたりの最大スキャンバイト数を設定 (例: 10GB)
-MAX_BYTES_BILLED = 10 * 1024 * 1024 * 1024
+# 変更点: analyzerごとの予算として環境変数で上書き可能にする。ドライランの見積もりがこれを超えるクエリは実行しない
+MAX_BYTES_BILLED = int(os.getenv('MAX_BYTES_BILLED', 10 * 1024 * 1024 * 1024))
 
 logger = get_logger(__name__)
 
@@ -24,7 +37,93 @@ except json.JSONDecodeError:
     logger.critical("Invalid JSON format for HIGH_RISK_ROLES_JSON env var.")
     HIGH_RISK_ROLES = {} # エラー時は空にする
 
+# 変更点: ロールごとに CASE の分岐と IN (...) をSQL文字列に連結する方式は、カタログが大きくなるとクエリが肥大化し、
+# 実行ごとにクエリ文字列が変わるためキャッシュも効かなかった。カタログはJSONのクエリパラメータとして渡し、
+# 完全一致のロールはハッシュ結合で、ワイルドカード (例: roles/*.admin, projects/*/roles/*) はロールの種類ごとに1回だけ評価する
+HIGH_RISK_ROLES_QUERY_TEMPLATE = """
+WITH Catalog AS (
+    SELECT
+        priority,
+        JSON_VALUE(c, '$.role') AS role,
+        JSON_VALUE(c, '$.pattern') AS pattern,
+        JSON_VALUE(c, '$.permission') AS permission,
+        JSON_VALUE(c, '$.permission_pattern') AS permission_pattern,
+        JSON_VALUE(c, '$.category') AS category
+    FROM UNNEST(JSON_QUERY_ARRAY(@high_risk_roles)) AS c WITH OFFSET AS priority
+), ExactRoles AS (
+    SELECT role, category FROM Catalog WHERE role IS NOT NULL
+), PatternRoles AS (
+    -- パターンはアクセスソースに現れるロールの種類ごとに評価し、最初に定義されたパターンのカテゴリを採用する
+    SELECT roles.role, ARRAY_AGG(p.category ORDER BY p.priority LIMIT 1)[OFFSET(0)] AS category
+    FROM (SELECT DISTINCT role FROM {access_source}) AS roles
+    CROSS JOIN (SELECT priority, pattern, category FROM Catalog WHERE pattern IS NOT NULL) AS p
+    WHERE REGEXP_CONTAINS(roles.role, p.pattern)
+        AND roles.role NOT IN (SELECT role FROM ExactRoles)
+    GROUP BY roles.role
+){permission_ctes}, RoleCategories AS (
+    SELECT role, category FROM ExactRoles
+    UNION ALL
+    SELECT role, category FROM PatternRoles{permission_union}
+)
+SELECT
+    access.assessment_timestamp,
+    access.scope,
+    access.principal_type,
+    access.principal_email,
+    access.resource_name,
+    access.role AS high_risk_role,
+    rc.category AS risk_category
+FROM {access_source} AS access
+INNER JOIN RoleCategories AS rc ON access.role = rc.role
+"""
+
+# ロール名・パターンで分類されなかったロールを、含まれる権限で分類する (ROLE_PERMISSIONS_TABLE_ID 設定時)
+PERMISSION_CTES_TEMPLATE = """, CatalogPermissions AS (
+    -- 権限の完全一致はハッシュ結合、パターンは権限の種類ごとに1回だけ評価する
+    SELECT permission, priority, category FROM Catalog WHERE permission IS NOT NULL
+    UNION ALL
+    SELECT perms.permission, p.priority, p.category
+    FROM (SELECT DISTINCT permission FROM {role_permissions_fqn}) AS perms
+    CROSS JOIN (SELECT priority, permission_pattern, category FROM Catalog WHERE permission_pattern IS NOT NULL) AS p
+    WHERE REGEXP_CONTAINS(perms.permission, p.permission_pattern)
+), PermissionRoles AS (
+    SELECT rp.role, ARRAY_AGG(cp.category ORDER BY cp.priority LIMIT 1)[OFFSET(0)] AS category
+    FROM {role_permissions_fqn} AS rp
+    INNER JOIN CatalogPermissions AS cp ON rp.permission = cp.permission
+    WHERE rp.role NOT IN (SELECT role FROM ExactRoles UNION ALL SELECT role FROM PatternRoles)
+    GROUP BY rp.role
+)"""
+
+PERMISSION_UNION_SQL = """
+    UNION ALL
+    SELECT role, category FROM PermissionRoles"""
+
+def _role_pattern_regex(pattern: str) -> str:
+    """ワイルドカード ('*' は任意の文字列、'?' は任意の1文字) を、ロール名全体に一致するRE2の正規表現に変換する"""
+    regex = "".join(".*" if ch == "*" else "." if ch == "?" else re.escape(ch) for ch in pattern)
+    return f"^{regex}$"
+
+def _build_catalog_rows(high_risk_roles: dict) -> list:
+    """
+    HIGH_RISK_ROLES (ロールまたはパターン → カテゴリ) を、クエリパラメータとして渡す行のリストに変換する。順序が優先度になる。
+    'permission:' で始まるキーは権限 (またはそのパターン) として扱う。
+    """
+    rows = []
+    for role, category in high_risk_roles.items():
+        if role.startswith("permission:"):
+            permission = role[len("permission:"):]
+            if "*" in permission or "?" in permission:
+                rows.append({"permission_pattern": _role_pattern_regex(permission), "category": category})
+            else:
+                rows.append({"permission": permission, "category": category})
+        elif "*" in role or "?" in role:
+            rows.append({"pattern": _role_pattern_regex(role), "category": category})
+        else:
+            rows.append({"role": role, "category": category})
+    return rows
+
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def analyze_high_risk_roles(cloud_event):
     """
     Pub/Subメッセージをトリガーに、principal_access_listテーブルを分析し、
@@ -37,30 +136,59 @@ def analyze_high_risk_roles(cloud_event):
         logger.error("Missing required environment variables: SOURCE_TABLE_ID, DESTINATION_TABLE_ID, or HIGH_RISK_ROLES_JSON must be set.")
         raise ValueError("Missing required environment variables.")
 
+    # 変更点: 分析対象のスナップショットを決定 (トリガーメッセージの snapshot_id、なければ最新)
+    snapshot_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}`"
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, snapshot_table_fqn)
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Skipping analysis.")
+        return
+    logger.info(f"Analyzing snapshot: {snapshot_timestamp}")
+
     try:
         # --- ここからがメインの処理 ---
-        source_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{SOURCE_TABLE_ID}`"
-        high_risk_roles_tuple = tuple(HIGH_RISK_ROLES.keys())
+        access_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, snapshot_timestamp)
 
         # HIGH_RISK_ROLESが空でないかチェック
-        if not high_risk_roles_tuple:
+        if not HIGH_RISK_ROLES:
             logger.warning("HIGH_RISK_ROLES_JSON is empty or invalid. Skipping analysis.")
             return
 
-        # BigQueryで高リスク権限を持つプリンシパルを抽出するSQLクエリ
-        query = f"SELECT t.assessment_timestamp, t.scope, t.principal_type, t.principal_email, access.resource_name, access.role AS high_risk_role, CASE access.role "
-        for role, category in HIGH_RISK_ROLES.items():
-            query += f" WHEN '{role}' THEN '{category}'"
-        query += f" ELSE 'UNCATEGORIZED' END AS risk_category FROM {source_table_fqn} AS t, UNNEST(t.access_list) AS access WHERE access.role IN {high_risk_roles_tuple}"
+        # BigQueryで高リスク権限を持つプリンシパルを抽出するSQLクエリ (カタログはパラメータで渡すため、クエリはカタログに依存しない)
+        permission_ctes, permission_union = "", ""
+        if ROLE_PERMISSIONS_TABLE_ID:
+            permission_ctes = PERMISSION_CTES_TEMPLATE.format(role_permissions_fqn=f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ROLE_PERMISSIONS_TABLE_ID}`")
+            permission_union = PERMISSION_UNION_SQL
+        elif any(role.startswith("permission:") for role in HIGH_RISK_ROLES):
+            logger.warning("ROLE_PERMISSIONS_TABLE_ID is not set. Permission entries in HIGH_RISK_ROLES_JSON will be ignored.")
+        query = HIGH_RISK_ROLES_QUERY_TEMPLATE.format(
+            access_source=access_source, permission_ctes=permission_ctes, permission_union=permission_union
+        )
+        high_risk_roles_param = json.dumps(_build_catalog_rows(HIGH_RISK_ROLES))
+
+        # 変更点: ソーステーブルとクエリ・設定が前回の実行から変わっていなければ、スキャンせずに終了する
+        cache_hit, fingerprint = lookup_analysis_cache(
+            ANALYSIS_CACHE_TABLE_ID, "analyze_high_risk_roles",
+            [f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}" for table_id in (ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID, ROLE_PERMISSIONS_TABLE_ID) if table_id],
+            query, high_risk_roles_param
+        )
+        if cache_hit:
+            logger.info("Source tables and configuration are unchanged since the last run. Skipping analysis.", extra={"cache_hit": True})
+            return
 
         # ヘルパー関数を呼び出し、結果をテーブルに追加(APPEND)する
         run_query_and_save_results(
             query=query,
             destination_table_id=DESTINATION_TABLE_ID,
             write_disposition="WRITE_APPEND", # 前のanalyzerでTRUNCATEしている場合、APPENDでOK
-            max_bytes_billed=MAX_BYTES_BILLED
+            max_bytes_billed=MAX_BYTES_BILLED,
+            query_parameters=[bigquery.ScalarQueryParameter("high_risk_roles", "STRING", high_risk_roles_param)]
         )
 
+        record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, "analyze_high_risk_roles", fingerprint)
         logger.info(f"Successfully completed high-risk role analysis.")
         # --- ここまでがメインの処理 ---
 
@@ -1,8 +1,17 @@
 import os
 import functions_framework
 import json
+import datetime
+from collections import Counter
+from google.cloud import bigquery
 from google.cloud.exceptions import NotFound # テーブル存在確認用
-from utils.bq_helpers import run_query_and_save_results
+from utils.bq_helpers import (
+    run_query_and_save_results, run_dml_query, fetch_query_rows, resolve_snapshot_timestamp,
+    fetch_analysis_fingerprint, lookup_analysis_cache, record_analysis_fingerprint
+)
+from utils.sql_helpers import access_source_sql, sod_violations_sql
+from utils.sod_rules import normalize_sod_rules, classify_sod_rules
+from utils.instrumentation import instrument_invocation
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -11,45 +20,23 @@ BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 SOURCE_TABLE_ID = os.getenv('SOURCE_TABLE_ID') # principal_access_list
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID') # sod_violations
 WORKSPACE_ROLES_TABLE_ID = os.getenv('WORKSPACE_ROLES_TABLE_ID') # workspace_admin_roles (オプション)
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID') # access_facts (オプション、設定時はUNNEST不要)
+ANALYSIS_CACHE_TABLE_ID = os.getenv('ANALYSIS_CACHE_TABLE_ID') # analysis_fingerprints (オプション、SOD_MODE=INCREMENTAL では必須)
+ROLE_PERMISSIONS_TABLE_ID = os.getenv('ROLE_PERMISSIONS_TABLE_ID') # role_permissions (オプション、GCP_PERMISSION タイプのルールに必要)
 SOD_RULES_JSON = os.getenv('SOD_RULES_JSON', '[]')
+# SOD_MODE: 'FULL' (毎回洗い替え) または 'INCREMENTAL' (最後にMERGEしたスナップショットからアクセスが変わったプリンシパルのみ再評価してMERGE)
+SOD_MODE = os.getenv('SOD_MODE', 'FULL').upper()
 
 # 1クエリあたりの最大スキャンバイト数を設定 (例: 10GB)
-MAX_BYTES_BILLED = 10 * 1024 * 1024 * 1024
+# 変更点: analyzerごとの予算として環境変数で上書き可能にする。ドライランの見積もりがこれを超えるクエリは実行しない
+MAX_BYTES_BILLED = int(os.getenv('MAX_BYTES_BILLED', 10 * 1024 * 1024 * 1024))
 
 logger = get_logger(__name__)
 
 # SoDルールをパース (グローバルスコープ)
+# 変更点: ルールの検証・正規化はローカルSoDエンジンと共通の utils.sod_rules で行う
 try:
-    SOD_RULES = json.loads(SOD_RULES_JSON)
-    if not isinstance(SOD_RULES, list):
-        logger.warning("SOD_RULES_JSON is not a valid JSON array. Treating as empty list.")
-        SOD_RULES = []
-    # 修正点: 各ルールの role1, role2 がリストであることを確認 (文字列ならリストに変換)
-    valid_rules = []
-    for rule in SOD_RULES:
-        if isinstance(rule, dict):
-            # Role1
-            role1 = rule.get('role1')
-            if isinstance(role1, str):
-                rule['role1'] = [role1] # 文字列ならリストに変換
-            elif not isinstance(role1, list):
-                rule['role1'] = [] # リストでも文字列でもなければ空リスト
-            # Role2
-            role2 = rule.get('role2')
-            if isinstance(role2, str):
-                rule['role2'] = [role2] # 文字列ならリストに変換
-            elif not isinstance(role2, list):
-                rule['role2'] = [] # リストでも文字列でもなければ空リスト
-            # Role1, Role2 が空リストでなく、rule_id があれば有効なルールとする
-            if rule.get('rule_id') and rule['role1'] and rule['role2']:
-                 valid_rules.append(rule)
-            else:
-                 rule_id_log = rule.get('rule_id', 'UNKNOWN')
-                 logger.warning(f"Invalid SoD rule skipped (missing id or empty roles): {rule_id_log}")
-        else:
-             logger.warning(f"Invalid item found in SOD_RULES_JSON (not a dict): {rule}")
-    SOD_RULES = valid_rules # 有効なルールのみ保持
-
+    SOD_RULES = normalize_sod_rules(json.loads(SOD_RULES_JSON), logger)
 except json.JSONDecodeError:
     logger.warning("Invalid JSON format for SOD_RULES_JSON env var. Treating as empty list.")
     SOD_RULES = []
@@ -57,21 +44,135 @@ except json.JSONDecodeError:
 # BigQuery Client (グローバル) - テーブル存在確認で使用
 from utils.gcp_clients import bigquery_client
 
-# --- Helper Function to create SQL IN clause from list ---
-def _create_sql_in_clause(role_list):
-    """['roleA', 'roleB'] -> "('roleA','roleB')" """
-    if not role_list:
-        return "('')" # 空のリストの場合はマッチしないように
-    # 各ロールをシングルクォートで囲む
-    quoted_roles = [f"'{role.replace('\'', '\\\'')}'" for role in role_list] # SQLインジェクション対策でシングルクォートをエスケープ
-    return f"({','.join(quoted_roles)})"
+# INCREMENTAL モードで、ルール定義の変更を検出するために analysis_fingerprints に記録する名前
+SOD_RULES_CACHE_NAME = "analyze_sod_violations.rules"
+# 修正点: 最後に sod_violations にMERGEしたスナップショット。差分はこのスナップショットとの間で取る
+# (直前のスナップショットと比較すると、実行が失敗・スキップされた間の変更が反映されなかった)
+SOD_MERGED_SNAPSHOT_CACHE_NAME = "analyze_sod_violations.merged_snapshot"
+
+def _changed_principals_sql(current_source, previous_source, workspace_table_fqn):
+    """
+    2つのスナップショット間で、アクセス (ロール + リソース) の集合が変わったプリンシパルを返すクエリ。
+    片方にしか存在しないプリンシパル (追加・削除) も含む。
+    Workspaceロールのテーブルはスナップショットを持たないため、Workspaceロールを持つプリンシパルは常に対象とする。
+    """
+    access_hash = "FARM_FINGERPRINT(STRING_AGG(DISTINCT CONCAT(role, '|', IFNULL(resource_name, '')) ORDER BY CONCAT(role, '|', IFNULL(resource_name, ''))))"
+    query = f"""
+    WITH CurrentAccess AS (
+        SELECT principal_email, {access_hash} AS access_hash FROM {current_source} GROUP BY principal_email
+    ), PreviousAccess AS (
+        SELECT principal_email, {access_hash} AS access_hash FROM {previous_source} GROUP BY principal_email
+    )
+    SELECT principal_email
+    FROM CurrentAccess AS c
+    FULL OUTER JOIN PreviousAccess AS p USING (principal_email)
+    WHERE c.access_hash IS DISTINCT FROM p.access_hash
+    """
+    if workspace_table_fqn:
+        query += f"""
+    UNION DISTINCT
+    SELECT principal_email FROM {workspace_table_fqn}
+    """
+    return query
+
+def _merge_incremental(access_source, workspace_table_fqn, snapshot_timestamp, rule_rows, sod_rules_param,
+                       role_permissions_fqn=None):
+    """
+    最後にMERGEしたスナップショットからアクセスが変わったプリンシパルのみを再評価し、sod_violations にMERGEする。
+    新たな違反は violation_opened_at を、解消した違反は violation_closed_at をスナップショットの時刻で記録する。
+    ルール定義が変わった場合やMERGE済みのスナップショットがない場合は、全プリンシパルを再評価する (履歴は維持)。
+    MERGE済みのスナップショットより古いスナップショットはMERGEしない。
+    """
+    # 修正点: 同じ rule_id のルールが複数あると、MERGEで1行に複数のソース行が一致して失敗するため、実行前に止める
+    duplicate_rule_ids = sorted(rule_id for rule_id, n in Counter(rule["rule_id"] for rule in rule_rows).items() if n > 1)
+    if duplicate_rule_ids:
+        raise ValueError(f"Duplicate rule_id in SOD_RULES_JSON: {duplicate_rule_ids}. rule_id must be unique in INCREMENTAL mode.")
+
+    last_merged_snapshot = fetch_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, SOD_MERGED_SNAPSHOT_CACHE_NAME)
+    if last_merged_snapshot:
+        current, last_merged = datetime.datetime.fromisoformat(snapshot_timestamp), datetime.datetime.fromisoformat(last_merged_snapshot)
+        if current == last_merged:
+            logger.info(f"Snapshot {snapshot_timestamp} is already merged into {DESTINATION_TABLE_ID}. Nothing to merge.")
+            return
+        if current < last_merged:
+            # 古いスナップショットをMERGEすると、以降のスナップショットで記録した違反の開始・解消が巻き戻る
+            logger.error(
+                f"Snapshot {snapshot_timestamp} is older than the last merged snapshot {last_merged_snapshot}. Skipping merge.",
+                extra={"last_merged_snapshot": last_merged_snapshot}
+            )
+            return
+
+    # 権限カタログが更新された場合も、ルールの対象ロールが変わるため全プリンシパルを再評価する
+    catalog_table_ids = [f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ROLE_PERMISSIONS_TABLE_ID}"] if ROLE_PERMISSIONS_TABLE_ID else []
+    rules_unchanged, rules_fingerprint = lookup_analysis_cache(ANALYSIS_CACHE_TABLE_ID, SOD_RULES_CACHE_NAME, catalog_table_ids, sod_rules_param)
+    full_scope = not rules_unchanged or not last_merged_snapshot
+
+    changed_principals = []
+    if not full_scope:
+        previous_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, last_merged_snapshot)
+        rows = fetch_query_rows(
+            _changed_principals_sql(access_source, previous_source, workspace_table_fqn),
+            max_bytes_billed=MAX_BYTES_BILLED
+        )
+        changed_principals = [row["principal_email"] for row in rows]
+        logger.info(
+            f"{len(changed_principals)} principals changed since the last merged snapshot {last_merged_snapshot}.",
+            extra={"previous_snapshot": last_merged_snapshot, "changed_principals": len(changed_principals)}
+        )
+        if not changed_principals:
+            logger.info("No principals changed since the last merged snapshot. Nothing to merge.")
+            record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, SOD_MERGED_SNAPSHOT_CACHE_NAME, snapshot_timestamp)
+            return
+    else:
+        logger.info("SoD rules changed or no merged snapshot found. Re-evaluating all principals.")
+
+    violations_query = sod_violations_sql(access_source, workspace_table_fqn, scoped=not full_scope, role_permissions_fqn=role_permissions_fqn)
+    merge_query = f"""
+    MERGE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}` AS t
+    USING ({violations_query}) AS s
+    -- スキップ行 (principal_email がNULL) もルール単位で1行として扱う。解消済みの行は履歴として残す
+    ON t.rule_id = s.rule_id AND IFNULL(t.principal_email, '') = IFNULL(s.principal_email, '') AND t.violation_closed_at IS NULL
+    WHEN MATCHED THEN
+        UPDATE SET
+            description = s.description, principal_type = s.principal_type,
+            conflicting_role1 = s.conflicting_role1, conflicting_role2 = s.conflicting_role2,
+            role1_type = s.role1_type, role2_type = s.role2_type, assignments = s.assignments
+    WHEN NOT MATCHED BY TARGET THEN
+        INSERT (rule_id, description, principal_email, principal_type, conflicting_role1, conflicting_role2,
+                role1_type, role2_type, assignments, violation_opened_at, violation_closed_at)
+        VALUES (s.rule_id, s.description, s.principal_email, s.principal_type, s.conflicting_role1, s.conflicting_role2,
+                s.role1_type, s.role2_type, s.assignments, TIMESTAMP(@snapshot_timestamp), NULL)
+    -- 評価対象のプリンシパル、スキップ行、削除されたルールのうち、今回検出されなかった違反を解消済みにする
+    WHEN NOT MATCHED BY SOURCE AND t.violation_closed_at IS NULL AND (
+        @full_scope OR t.principal_email IS NULL
+        OR t.principal_email IN UNNEST(@changed_principals) OR t.rule_id NOT IN UNNEST(@rule_ids)
+    ) THEN
+        UPDATE SET violation_closed_at = TIMESTAMP(@snapshot_timestamp)
+    """
+    affected_rows = run_dml_query(
+        merge_query,
+        query_parameters=[
+            bigquery.ScalarQueryParameter("sod_rules", "STRING", sod_rules_param),
+            bigquery.ScalarQueryParameter("snapshot_timestamp", "STRING", snapshot_timestamp),
+            bigquery.ScalarQueryParameter("full_scope", "BOOL", full_scope),
+            bigquery.ArrayQueryParameter("changed_principals", "STRING", changed_principals),
+            bigquery.ArrayQueryParameter("rule_ids", "STRING", [rule["rule_id"] for rule in rule_rows]),
+        ],
+        max_bytes_billed=MAX_BYTES_BILLED
+    )
+    record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, SOD_RULES_CACHE_NAME, rules_fingerprint)
+    record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, SOD_MERGED_SNAPSHOT_CACHE_NAME, snapshot_timestamp)
+    logger.info(f"Merged SoD violations into {DESTINATION_TABLE_ID}.", extra={"affected_rows": affected_rows, "full_scope": full_scope})
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def analyze_sod_violations(cloud_event):
     """
     principal_access_list テーブルと (オプションで) workspace_admin_roles テーブルを分析し、
     定義された職務分掌ルールに違反するプリンシパルを抽出する。
     Role1またはRole2に複数のロールが定義されている場合はOR条件で評価する。
+    全ルールはクエリパラメータとして渡し、1回のスキャンでまとめて評価する。
+    SOD_MODE=INCREMENTAL の場合は、アクセスが変わったプリンシパルのみを再評価してMERGEする。
     """
     logger.info(f"Starting Segregation of Duties (SoD) analysis...")
 
@@ -80,6 +181,13 @@ def analyze_sod_violations(cloud_event):
         logger.error(msg)
         raise ValueError(msg)
 
+    # 修正点: INCREMENTAL モードはルール定義のフィンガープリントとMERGE済みのスナップショットをキャッシュテーブルに記録する。
+    # 未設定のままでは、毎回全プリンシパルを再評価していた
+    if SOD_MODE == "INCREMENTAL" and not ANALYSIS_CACHE_TABLE_ID:
+        msg = "Missing required environment variable: ANALYSIS_CACHE_TABLE_ID must be set when SOD_MODE is INCREMENTAL."
+        logger.error(msg)
+        raise ValueError(msg)
+
     if not SOD_RULES:
          logger.warning("SOD_RULES_JSON is empty or invalid. No SoD rules to analyze.")
          # 空のテーブルを作成/上書き
@@ -96,6 +204,18 @@ def analyze_sod_violations(cloud_event):
              raise
          return
 
+    # 変更点: 分析対象のスナップショットを決定 (トリガーメッセージの snapshot_id、なければ最新)
+    snapshot_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}`"
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, snapshot_table_fqn)
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Skipping analysis.")
+        return
+    logger.info(f"Analyzing snapshot: {snapshot_timestamp}")
+
     # --- Workspaceロールテーブルの確認 ---
     workspace_data_available = False
     workspace_table_fqn = ""
@@ -115,189 +235,56 @@ def analyze_sod_violations(cloud_event):
 
 
     try:
-        source_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{SOURCE_TABLE_ID}`"
-
-        sub_queries = []
-        skipped_rules = []
-        for rule in SOD_RULES:
-            rule_id = rule.get('rule_id')
-            description = rule.get('description', 'N/A')
-            # role1 と role2 はリストになっているはず
-            role1_list = rule.get('role1', [])
-            role2_list = rule.get('role2', [])
-            role1_type = rule.get('role1_type', 'GCP_IAM').upper()
-            role2_type = rule.get('role2_type', 'GCP_IAM').upper()
-
-            # --- 基本チェック (リストが空でないか) ---
-            if not rule_id or not role1_list or not role2_list:
-                logger.warning(f"Skipping invalid SoD rule (missing id or empty roles list): {rule_id}")
-                skipped_rules.append(rule_id if rule_id else "INVALID_RULE_MISSING_ROLES")
-                continue
-
-            # --- Workspaceデータチェック ---
-            if ('WORKSPACE_ADMIN' in [role1_type, role2_type]) and not workspace_data_available:
-                logger.warning(f"Skipping SoD rule '{rule_id}' because Workspace role data is unavailable or table not configured.")
-                skipped_rules.append(rule_id)
-                continue
-
-            # --- SQL IN句を作成 ---
-            role1_in_clause = _create_sql_in_clause(role1_list)
-            role2_in_clause = _create_sql_in_clause(role2_list)
-
-            # --- クエリ生成ロジック (Typeに応じて分岐) ---
-            sub_query = ""
-            # Case 1: GCP vs GCP
-            if role1_type == 'GCP_IAM' and role2_type == 'GCP_IAM':
-                sub_query = f"""
-                (WITH Role1Principals AS (
-                    SELECT DISTINCT principal_email, principal_type
-                    FROM {source_table_fqn}, UNNEST(access_list) AS a WHERE a.role IN {role1_in_clause}
-                ), Role2Principals AS (
-                    SELECT DISTINCT principal_email
-                    FROM {source_table_fqn}, UNNEST(access_list) AS a WHERE a.role IN {role2_in_clause}
-                )
-                SELECT
-                    '{rule_id}' AS rule_id,
-                    '{description}' AS description,
-                    r1p.principal_email,
-                    r1p.principal_type,
-                    -- 代表的なロールを表示 (配列全体はassignmentsへ)
-                    '{role1_list[0]}' AS conflicting_role1, -- 最初のロールを表示
-                    '{role2_list[0]}' AS conflicting_role2, -- 最初のロールを表示
-                    'GCP_IAM' AS role1_type,
-                    'GCP_IAM' AS role2_type,
-                    -- 関連する可能性のある全ての割り当て (role1リスト + role2リスト)
-                    (SELECT ARRAY_AGG(STRUCT(a.resource_name, a.role))
-                     FROM {source_table_fqn} AS t, UNNEST(t.access_list) AS a
-                     WHERE t.principal_email = r1p.principal_email
-                       AND a.role IN {_create_sql_in_clause(role1_list + role2_list)}) AS assignments
-                FROM Role1Principals r1p
-                INNER JOIN Role2Principals r2p ON r1p.principal_email = r2p.principal_email)
-                """
-            # Case 2: GCP vs Workspace
-            elif role1_type == 'GCP_IAM' and role2_type == 'WORKSPACE_ADMIN':
-                sub_query = f"""
-                (WITH GcpUsers AS (
-                    SELECT DISTINCT principal_email, principal_type
-                    FROM {source_table_fqn}, UNNEST(access_list) AS a WHERE a.role IN {role1_in_clause}
-                ), WorkspaceUsers AS (
-                    SELECT DISTINCT principal_email
-                    FROM {workspace_table_fqn} WHERE workspace_role_name IN {role2_in_clause}
-                )
-                SELECT
-                    '{rule_id}' AS rule_id,
-                    '{description}' AS description,
-                    gcp.principal_email,
-                    gcp.principal_type,
-                    '{role1_list[0]}' AS conflicting_role1,
-                    '{role2_list[0]}' AS conflicting_role2,
-                    'GCP_IAM' AS role1_type,
-                    'WORKSPACE_ADMIN' AS role2_type,
-                    (SELECT ARRAY_AGG(STRUCT(a.resource_name, a.role)) FROM {source_table_fqn} AS t, UNNEST(t.access_list) AS a WHERE t.principal_email = gcp.principal_email AND a.role IN {role1_in_clause}) AS assignments
-                FROM GcpUsers gcp
-                INNER JOIN WorkspaceUsers ws ON gcp.principal_email = ws.principal_email)
-                """
-            # Case 3: Workspace vs GCP
-            elif role1_type == 'WORKSPACE_ADMIN' and role2_type == 'GCP_IAM':
-                 sub_query = f"""
-                (WITH WorkspaceUsers AS (
-                    SELECT DISTINCT principal_email
-                    FROM {workspace_table_fqn} WHERE workspace_role_name IN {role1_in_clause}
-                ), GcpUsers AS (
-                    SELECT DISTINCT principal_email, principal_type
-                    FROM {source_table_fqn}, UNNEST(access_list) AS a WHERE a.role IN {role2_in_clause}
-                )
-                SELECT
-                    '{rule_id}' AS rule_id,
-                    '{description}' AS description,
-                    ws.principal_email,
-                    gcp.principal_type,
-                    '{role1_list[0]}' AS conflicting_role1,
-                    '{role2_list[0]}' AS conflicting_role2,
-                    'WORKSPACE_ADMIN' AS role1_type,
-                    'GCP_IAM' AS role2_type,
-                    (SELECT ARRAY_AGG(STRUCT(a.resource_name, a.role)) FROM {source_table_fqn} AS t, UNNEST(t.access_list) AS a WHERE t.principal_email = ws.principal_email AND a.role IN {role2_in_clause}) AS assignments
-                FROM WorkspaceUsers ws
-                INNER JOIN GcpUsers gcp ON ws.principal_email = gcp.principal_email)
-                """
-            # Case 4: Workspace vs Workspace
-            elif role1_type == 'WORKSPACE_ADMIN' and role2_type == 'WORKSPACE_ADMIN':
-                 sub_query = f"""
-                 (WITH Role1Users AS (
-                    SELECT DISTINCT principal_email FROM {workspace_table_fqn} WHERE workspace_role_name IN {role1_in_clause}
-                 ), Role2Users AS (
-                    SELECT DISTINCT principal_email FROM {workspace_table_fqn} WHERE workspace_role_name IN {role2_in_clause}
-                 )
-                 SELECT
-                    '{rule_id}' AS rule_id,
-                    '{description}' AS description,
-                    r1.principal_email,
-                    'USER' AS principal_type, -- 仮定
-                    '{role1_list[0]}' AS conflicting_role1,
-                    '{role2_list[0]}' AS conflicting_role2,
-                    'WORKSPACE_ADMIN' AS role1_type,
-                    'WORKSPACE_ADMIN' AS role2_type,
-                    -- Workspace割り当て (代表ロールを配列に) - assignments スキーマに合わせる
-                    [STRUCT(CAST(NULL AS STRING), '{role1_list[0]}'), STRUCT(CAST(NULL AS STRING), '{role2_list[0]}')] AS assignments
-                 FROM Role1Users r1
-                 INNER JOIN Role2Users r2 ON r1.principal_email = r2.principal_email)
-                 """
-            # Unsupported Case
-            else:
-                 logger.warning(f"Unsupported role type combination for rule '{rule_id}' ({role1_type} vs {role2_type}). Skipping.")
-                 skipped_rules.append(rule_id)
-                 continue
+        access_source = access_source_sql(BQ_PROJECT_ID, BQ_DATASET_ID, ACCESS_FACTS_TABLE_ID, SOURCE_TABLE_ID, snapshot_timestamp)
 
-            if sub_query:
-                sub_queries.append(sub_query)
-
-        # --- クエリの結合と実行 ---
-        final_query = ""
-        if sub_queries:
-            final_query = "\nUNION ALL\n".join(sub_queries)
-
-        if skipped_rules:
-            skipped_query_parts = []
-            assignments_schema = "CAST([] AS ARRAY<STRUCT<resource_name STRING, role STRING>>)"
-            for skipped_rule_id in skipped_rules:
-                 rule_info = next((r for r in SOD_RULES if r.get('rule_id') == skipped_rule_id), {})
-                 desc = rule_info.get('description', 'N/A') + " (SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE)"
-                 # リストの最初の要素を表示（存在すれば）
-                 r1 = rule_info.get('role1', ['N/A'])[0]
-                 r2 = rule_info.get('role2', ['N/A'])[0]
-                 r1t = rule_info.get('role1_type', 'N/A')
-                 r2t = rule_info.get('role2_type', 'N/A')
-                 skipped_query_parts.append(f"SELECT '{skipped_rule_id}', '{desc}', CAST(NULL AS STRING), CAST(NULL AS STRING), '{r1}', '{r2}', '{r1t}', '{r2t}', {assignments_schema}")
-
-            if skipped_query_parts:
-                 skipped_query = "\nUNION ALL\n".join(skipped_query_parts)
-                 if final_query:
-                      final_query = f"{final_query}\nUNION ALL\n{skipped_query}"
-                 else:
-                      final_query = skipped_query
+        # 変更点: ルールごとにCTEを生成して UNION ALL で結合する方式は、ルール数に比例してSQLが長くなり、
+        # スキャンもルール数 x 3 回発生していた。ルール自体はJSONのクエリパラメータとして渡し、1回のスキャンで評価する
+        role_permissions_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ROLE_PERMISSIONS_TABLE_ID}`" if ROLE_PERMISSIONS_TABLE_ID else None
+        rule_rows, skipped_rules = classify_sod_rules(
+            SOD_RULES, workspace_data_available, logger, permission_data_available=bool(ROLE_PERMISSIONS_TABLE_ID)
+        )
+        final_query = sod_violations_sql(
+            access_source, workspace_table_fqn if workspace_data_available else None, role_permissions_fqn=role_permissions_fqn
+        )
+        sod_rules_param = json.dumps(rule_rows, sort_keys=True)
 
-        if not final_query:
-            logger.warning("No SoD rules were processed or generated query is empty.")
-            logger.info(f"Truncating destination table: {DESTINATION_TABLE_ID}")
-            truncate_query = f"TRUNCATE TABLE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}`"
-            try:
-                run_query_and_save_results(
-                    query=truncate_query, destination_table_id=DESTINATION_TABLE_ID,
-                    write_disposition="WRITE_TRUNCATE", max_bytes_billed=MAX_BYTES_BILLED
-                )
-            except Exception as e:
-                logger.error(f"Failed to truncate table {DESTINATION_TABLE_ID}: {e}")
-                raise
+        # 変更点: ソーステーブルとクエリ・ルールが前回の実行から変わっていなければ、スキャンせずに終了する
+        source_table_ids = [f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ACCESS_FACTS_TABLE_ID or SOURCE_TABLE_ID}"]
+        if workspace_data_available:
+            source_table_ids.append(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{WORKSPACE_ROLES_TABLE_ID}")
+        if ROLE_PERMISSIONS_TABLE_ID:
+            source_table_ids.append(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{ROLE_PERMISSIONS_TABLE_ID}")
+        cache_hit, fingerprint = lookup_analysis_cache(
+            ANALYSIS_CACHE_TABLE_ID, "analyze_sod_violations", source_table_ids, final_query, sod_rules_param
+        )
+        if cache_hit:
+            logger.info("Source tables and SoD rules are unchanged since the last run. Skipping analysis.", extra={"cache_hit": True})
             return
 
-        logger.info(f"Executing SoD analysis query and saving to {DESTINATION_TABLE_ID}")
-        run_query_and_save_results(
-            query=final_query,
-            destination_table_id=DESTINATION_TABLE_ID,
-            write_disposition="WRITE_TRUNCATE",
-            max_bytes_billed=MAX_BYTES_BILLED
-        )
+        if SOD_MODE == "INCREMENTAL":
+            logger.info(f"Executing incremental SoD analysis and merging into {DESTINATION_TABLE_ID}")
+            _merge_incremental(
+                access_source, workspace_table_fqn if workspace_data_available else None,
+                snapshot_timestamp, rule_rows, sod_rules_param, role_permissions_fqn
+            )
+        else:
+            logger.info(f"Executing SoD analysis query and saving to {DESTINATION_TABLE_ID}")
+            # 洗い替えの場合、全ての違反はこのスナップショットで検出されたものとして記録する
+            run_query_and_save_results(
+                query=f"""
+                SELECT v.*, TIMESTAMP(@snapshot_timestamp) AS violation_opened_at, CAST(NULL AS TIMESTAMP) AS violation_closed_at
+                FROM ({final_query}) AS v
+                """,
+                destination_table_id=DESTINATION_TABLE_ID,
+                write_disposition="WRITE_TRUNCATE",
+                max_bytes_billed=MAX_BYTES_BILLED,
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("sod_rules", "STRING", sod_rules_param),
+                    bigquery.ScalarQueryParameter("snapshot_timestamp", "STRING", snapshot_timestamp),
+                ]
+            )
 
+        record_analysis_fingerprint(ANALYSIS_CACHE_TABLE_ID, "analyze_sod_violations", fingerprint)
         logger.info(f"Successfully completed SoD analysis.")
         if skipped_rules:
             logger.warning(f"Skipped/Invalid SoD rules: {skipped_rules}")
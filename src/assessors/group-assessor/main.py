@@ -1,9 +1,18 @@
 # ./src/assessors/group-assessor/main.py
 import os
+import hashlib
 import functions_framework
 import datetime
+from collections import defaultdict
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound # テーブル存在確認用
 # 修正点: クラスではなく、グローバルインスタンスを直接インポート
-from utils.gcp_clients import bigquery_client, identity_client
+from utils.gcp_clients import identity_client, bigquery_client
+from utils.bq_helpers import load_rows_to_table, run_dml_query, fetch_query_rows
+from utils.group_graph import compute_transitive_closure
+from utils.instrumentation import instrument_invocation, span, count, set_attribute
+from utils.run_ledger import message_from_event
+from utils.rate_limiter import call_api
 from utils.logging_handler import get_logger
 
 # --- グローバル定数 ---
@@ -13,16 +22,305 @@ BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
 GSUITE_CUSTOMER_ID = os.getenv('GSUITE_CUSTOMER_ID') 
 
+# 変更点: 差分同期モード用の設定
+# SYNC_MODE: 'FULL' (毎回洗い替え) または 'INCREMENTAL' (変更のあったグループのみ反映)
+SYNC_MODE = os.getenv('SYNC_MODE', 'FULL').upper()
+GROUP_HASH_TABLE_ID = os.getenv('GROUP_HASH_TABLE_ID') # group_membership_hashes
+CHANGE_LOG_TABLE_ID = os.getenv('CHANGE_LOG_TABLE_ID') # group_membership_changes
+# 変更点: ネストを展開した実効メンバーシップの出力先 (オプション)
+TRANSITIVE_TABLE_ID = os.getenv('TRANSITIVE_TABLE_ID') # group_transitive_members
+
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
 # 修正点: インスタンスの初期化コードを削除 (gcp_clients.py からインポート)
 
 
+def _compute_group_hash(edges) -> str:
+    """グループのメンバーシップ (member_email, member_type) の集合から、順序に依存しないハッシュを計算する"""
+    canonical = "\n".join(sorted(f"{member_type}:{member_email}" for member_email, member_type in set(edges)))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _diff_group_edges(previous_edges: dict, current_edges: dict) -> tuple:
+    """
+    グループごとのメンバーシップ集合を比較し、(追加されたエッジ, 削除されたエッジ) を返す。
+    各エッジは (group_email, member_email, member_type) のタプル。
+    """
+    added, removed = [], []
+    for group_email in set(previous_edges) | set(current_edges):
+        before = set(previous_edges.get(group_email, ()))
+        after = set(current_edges.get(group_email, ()))
+        added.extend((group_email, m, t) for m, t in sorted(after - before, key=str))
+        removed.extend((group_email, m, t) for m, t in sorted(before - after, key=str))
+    return added, removed
+
+
+def _fetch_group_edges(groups) -> tuple:
+    """
+    各グループのメンバーを取得し、{group_email: [(member_email, member_type), ...]} と
+    取得に失敗したグループのセットを返す。
+    """
+    edges_by_group = {}
+    failed_groups = set()
+    for group in groups:
+        group_email = group.group_key.id
+        try:
+            # 修正点2: APIの効率化 (N+1クエリの解消)
+            # 変更点: 共通のレート制限・再試行を通す (全ページを読み切るまでを再試行の対象にする)
+            memberships_iterator = call_api("identity", lambda: list(identity_client.list_memberships(
+                parent=group.name,
+                view=1, # 1 = MembershipView.FULL
+                timeout=60.0
+            )))
+
+            edges = []
+            for membership in memberships_iterator:
+                member_email = membership.preferred_member_key.id
+
+                if membership.type_ == 2: # membership.Type.GROUP
+                    member_type = "GROUP"
+                elif membership.type_ == 1: # membership.Type.USER
+                    if '.gserviceaccount.com' in member_email:
+                        member_type = "SERVICE_ACCOUNT"
+                    else:
+                        member_type = "USER"
+                else:
+                    member_type = "UNKNOWN"
+
+                edges.append((member_email, member_type))
+            edges_by_group[group_email] = edges
+        except Exception as e:
+            logger.warning(f"Failed to process memberships for group {group_email}: {e}")
+            failed_groups.add(group_email)
+    return edges_by_group, failed_groups
+
+
+def _fetch_previous_edges(groups) -> dict:
+    """group_membership_details から、指定したグループの前回のエッジを {group_email: [(member_email, member_type), ...]} で取得する"""
+    details_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}`"
+    previous_edges = defaultdict(list)
+    for row in fetch_query_rows(
+        f"SELECT group_email, member_email, member_type FROM {details_table_fqn} WHERE group_email IN UNNEST(@groups)",
+        query_parameters=[bigquery.ArrayQueryParameter("groups", "STRING", sorted(groups))]
+    ):
+        previous_edges[row["group_email"]].append((row["member_email"], row["member_type"]))
+    return previous_edges
+
+
+def _membership_rows(edges_by_group: dict, timestamp: str) -> list:
+    """メンバーシップをBigQuery書き込み用の行に変換する"""
+    return [
+        {
+            "assessment_timestamp": timestamp,
+            "group_email": group_email,
+            "member_email": member_email,
+            "member_type": member_type,
+        }
+        for group_email, edges in edges_by_group.items()
+        for member_email, member_type in edges
+    ]
+
+
+def _hash_rows(group_hashes: dict, edges_by_group: dict, timestamp: str, carried_rows: dict = None) -> list:
+    """
+    グループハッシュをBigQuery書き込み用の行に変換する。
+    carried_rows ({group_email: 前回の行}) のグループは、前回の行をハッシュの計算時刻・メンバー数ごと引き継ぐ
+    (取得に失敗したグループを、今回検証済みとして扱わないため。ポリシーキャッシュはこの時刻で鮮度を判定する)。
+    修正点: snapshot_timestamp には、すべての行に今回のスナップショットを記録する。
+    INCREMENTAL モードの group_membership_details は変更のあった行のみを書き換えるため、
+    メンバーシップがどのスナップショット時点のものかは、このテーブルと group_email で結合して得る。
+    """
+    rows = [
+        {
+            "assessment_timestamp": timestamp,
+            "snapshot_timestamp": timestamp,
+            "group_email": group_email,
+            "content_hash": content_hash,
+            "member_count": len(edges_by_group.get(group_email, [])),
+        }
+        for group_email, content_hash in group_hashes.items()
+    ]
+    for group_email, row in (carried_rows or {}).items():
+        if group_email in group_hashes:
+            continue
+        hashed_at = row["assessment_timestamp"]
+        rows.append({
+            "assessment_timestamp": hashed_at.isoformat() if hasattr(hashed_at, "isoformat") else hashed_at,
+            "snapshot_timestamp": timestamp,
+            "group_email": group_email,
+            "content_hash": row["content_hash"],
+            "member_count": row["member_count"],
+        })
+    return rows
+
+
+def _sync_full(edges_by_group: dict, group_hashes: dict, timestamp: str) -> bool:
+    """全メンバーシップでテーブルを洗い替える。書き込みを行った場合は True を返す"""
+    rows_to_insert = _membership_rows(edges_by_group, timestamp)
+    if not rows_to_insert:
+        logger.warning("No group memberships found or processed. No data written to BigQuery.")
+        return False
+
+    logger.info(f"Writing {len(rows_to_insert)} group membership records to BigQuery...")
+    # 修正点: insert_rows は write_disposition を受け付けないため、ロードジョブで洗い替える
+    load_rows_to_table(rows_to_insert, DESTINATION_TABLE_ID, "WRITE_TRUNCATE") # 毎回テーブルを洗い替える
+    logger.info(f"Successfully wrote {len(rows_to_insert)} records to {BQ_DATASET_ID}.{DESTINATION_TABLE_ID}.")
+
+    # 差分同期モードの場合、次回比較用のハッシュも保存しておく
+    if GROUP_HASH_TABLE_ID:
+        load_rows_to_table(_hash_rows(group_hashes, edges_by_group, timestamp), GROUP_HASH_TABLE_ID, "WRITE_TRUNCATE")
+    return True
+
+
+def _sync_incremental(edges_by_group: dict, failed_groups: set, group_hashes: dict, timestamp: str) -> bool:
+    """
+    前回のグループハッシュと比較し、変更のあったグループのエッジ差分のみを
+    変更ログに追記した上で、MERGE で group_membership_details に反映する。
+    修正点: 変更のない行は書き換えない (行の assessment_timestamp はエッジを追加したスナップショットのまま)。
+    書き込み量を変更の量に比例させ、テーブルの更新時刻も変更があった場合のみ進める (analyzer の分析キャッシュが効く)。
+    今回のスナップショットは group_membership_hashes の snapshot_timestamp に記録する。
+    変更があった場合は True を返す。
+    """
+    hash_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{GROUP_HASH_TABLE_ID}`"
+    details_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{DESTINATION_TABLE_ID}`"
+    change_log_table_fqn = f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{CHANGE_LOG_TABLE_ID}`"
+
+    # 1. 前回のハッシュを取得
+    previous_rows = {
+        row["group_email"]: row
+        for row in fetch_query_rows(f"SELECT group_email, content_hash, assessment_timestamp, member_count FROM {hash_table_fqn}")
+    }
+    previous_hashes = {g: row["content_hash"] for g, row in previous_rows.items()}
+    if not previous_hashes:
+        logger.info("No previous group hashes found. Falling back to full sync.")
+        return _sync_full(edges_by_group, group_hashes, timestamp)
+
+    # 2. ハッシュが変化したグループ (新規・削除を含む) を特定
+    # 取得に失敗したグループは削除扱いにせず、前回の状態を維持する
+    changed_groups = sorted(
+        g for g in set(group_hashes) | set(previous_hashes)
+        if g not in failed_groups and group_hashes.get(g) != previous_hashes.get(g)
+    )
+    logger.info(
+        f"{len(changed_groups)} of {len(group_hashes)} groups changed since the previous snapshot.",
+        extra={"changed_groups": len(changed_groups), "failed_groups": len(failed_groups)}
+    )
+    # 取得に失敗したグループは前回のハッシュ (と計算時刻) を引き継ぐ
+    carried_rows = {g: previous_rows[g] for g in failed_groups if g in previous_rows}
+    if not changed_groups:
+        # 変更がなくても、ハッシュの計算時刻は今回のスナップショットに更新する
+        # (ポリシーキャッシュは、評価後に計算されたハッシュでのみグループの無変更を確認できる)
+        load_rows_to_table(
+            _hash_rows(group_hashes, edges_by_group, timestamp, carried_rows), GROUP_HASH_TABLE_ID, "WRITE_TRUNCATE"
+        )
+        logger.info("No group membership changes detected. Skipping membership writes.")
+        return False
+
+    # 3. 変更のあったグループについてのみ、前回のエッジを取得して差分を計算
+    previous_edges = _fetch_previous_edges(changed_groups)
+
+    added, removed = _diff_group_edges(
+        previous_edges, {g: edges_by_group.get(g, []) for g in changed_groups}
+    )
+    change_rows = [
+        {
+            "assessment_timestamp": timestamp,
+            "change_type": change_type,
+            "group_email": group_email,
+            "member_email": member_email,
+            "member_type": member_type,
+        }
+        for change_type, edges in (("ADDED", added), ("REMOVED", removed))
+        for group_email, member_email, member_type in edges
+    ]
+
+    # 4. 変更ログに追記し、それをソースとして MERGE する
+    if change_rows:
+        load_rows_to_table(change_rows, CHANGE_LOG_TABLE_ID, "WRITE_APPEND")
+        merge_query = f"""
+        MERGE {details_table_fqn} AS t
+        USING (
+            SELECT * FROM {change_log_table_fqn} WHERE assessment_timestamp = @ts
+        ) AS s
+        ON t.group_email = s.group_email
+            AND t.member_email IS NOT DISTINCT FROM s.member_email
+            AND t.member_type IS NOT DISTINCT FROM s.member_type
+        WHEN MATCHED AND s.change_type = 'REMOVED' THEN
+            DELETE
+        WHEN NOT MATCHED BY TARGET AND s.change_type = 'ADDED' THEN
+            INSERT (assessment_timestamp, group_email, member_email, member_type)
+            VALUES (s.assessment_timestamp, s.group_email, s.member_email, s.member_type)
+        """
+        run_dml_query(
+            merge_query,
+            query_parameters=[bigquery.ScalarQueryParameter("ts", "TIMESTAMP", timestamp)]
+        )
+
+    logger.info(
+        f"Applied group membership changes: {len(added)} added, {len(removed)} removed.",
+        extra={"edges_added": len(added), "edges_removed": len(removed), "changed_groups": len(changed_groups)}
+    )
+
+    # 5. 次回比較用のハッシュを保存 (取得に失敗したグループは前回のハッシュを引き継ぐ)
+    load_rows_to_table(
+        _hash_rows(group_hashes, edges_by_group, timestamp, carried_rows), GROUP_HASH_TABLE_ID, "WRITE_TRUNCATE"
+    )
+    return True
+
+
+def _carried_edges(failed_groups: set) -> dict:
+    """
+    取得に失敗したグループの前回のエッジを取得する (推移閉包で前回のメンバーを引き継ぐため)。
+    FULL モードでは group_membership_details を洗い替える前に呼び出す。テーブルがまだ存在しない場合は空。
+    """
+    if not failed_groups:
+        return {}
+    try:
+        return dict(_fetch_previous_edges(failed_groups))
+    except NotFound:
+        return {}
+
+
+def _transitive_table_is_empty() -> bool:
+    """推移閉包テーブルが存在しない、または空か (初回の実行や、前回の書き込みに失敗した場合)"""
+    try:
+        table = bigquery_client.get_table(bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(TRANSITIVE_TABLE_ID))
+    except NotFound:
+        return True
+    return not table.num_rows
+
+
+def _write_transitive_members(edges_by_group: dict, failed_groups: set, carried_edges: dict, timestamp: str):
+    """
+    ネストを展開した実効メンバーシップ (推移閉包) を計算し、テーブルを洗い替える。
+    取得に失敗したグループは前回のエッジ (carried_edges) を引き継ぎ、前回のエッジもないグループのみ葉として扱う。
+    """
+    leaf_groups = failed_groups - set(carried_edges)
+    if failed_groups:
+        logger.warning(
+            f"{len(failed_groups)} groups could not be fetched. {len(failed_groups) - len(leaf_groups)} of them use the previous "
+            f"memberships and {len(leaf_groups)} are treated as leaves in the transitive closure."
+        )
+    edges_by_group = {**carried_edges, **edges_by_group}
+
+    rows_to_insert = [
+        {"assessment_timestamp": timestamp, **row}
+        for row in compute_transitive_closure(edges_by_group)
+    ]
+    load_rows_to_table(rows_to_insert, TRANSITIVE_TABLE_ID, "WRITE_TRUNCATE")
+    logger.info(
+        f"Successfully wrote {len(rows_to_insert)} transitive membership records to {BQ_DATASET_ID}.{TRANSITIVE_TABLE_ID}.",
+        extra={"transitive_rows": len(rows_to_insert), "max_depth": max((r["depth"] for r in rows_to_insert), default=0)}
+    )
+
+
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def assess_all_groups(cloud_event):
     """
     Google Workspace/Cloud Identity内の全グループと
     そのメンバーシップ情報を取得し、BigQueryに書き込みます。
+    SYNC_MODE=INCREMENTAL の場合は、変更のあったグループの差分のみを反映します。
     """
     logger.info("Starting assessment of all groups and memberships...")
 
@@ -32,67 +330,47 @@ def assess_all_groups(cloud_event):
         logger.error(msg)
         raise ValueError(msg) # Functionを失敗させる
 
+    if SYNC_MODE == "INCREMENTAL" and (not GROUP_HASH_TABLE_ID or not CHANGE_LOG_TABLE_ID):
+        msg = "Missing required environment variables for INCREMENTAL mode: GROUP_HASH_TABLE_ID and CHANGE_LOG_TABLE_ID must be set."
+        logger.error(msg)
+        raise ValueError(msg)
+
     try:
         # 1. 組織内の全グループを取得
         logger.debug(f"Searching groups for customer: {GSUITE_CUSTOMER_ID}")
         # グローバルインスタンス (identity_client) を使用
-        groups_iterator = identity_client.search_groups(
+        groups = call_api("identity", lambda: list(identity_client.search_groups(
             parent=f"customers/{GSUITE_CUSTOMER_ID}",
             timeout=120.0
-        )
-        groups = list(groups_iterator)
+        )))
         logger.info(f"Found {len(groups)} groups to assess.")
         
-        rows_to_insert = []
-        current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-        # 2. 各グループのメンバーを取得
-        for group in groups:
-            group_email = group.group_key.id
-            try:
-                # 修正点2: APIの効率化 (N+1クエリの解消)
-                memberships_iterator = identity_client.list_memberships(
-                    parent=group.name,
-                    view=1, # 1 = MembershipView.FULL
-                    timeout=60.0
-                )
-                
-                for membership in memberships_iterator:
-                    member_email = membership.preferred_member_key.id
-                    
-                    if membership.type_ == 2: # membership.Type.GROUP
-                        member_type = "GROUP"
-                    elif membership.type_ == 1: # membership.Type.USER
-                        if '.gserviceaccount.com' in member_email:
-                            member_type = "SERVICE_ACCOUNT"
-                        else:
-                            member_type = "USER"
-                    else:
-                        member_type = "UNKNOWN"
-                    
-                    rows_to_insert.append({
-                        "assessment_timestamp": current_timestamp,
-                        "group_email": group_email,
-                        "member_email": member_email,
-                        "member_type": member_type,
-                    })
-            except Exception as e:
-                logger.warning(f"Failed to process memberships for group {group_email}: {e}")
-        
+        # 修正点: ディスパッチャーから起動された場合は、その実行のスナップショットの時刻で書き込む
+        current_timestamp = (
+            message_from_event(cloud_event).get("assessment_timestamp")
+            or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        )
+        set_attribute("assessment_timestamp", current_timestamp)
+
+        # 2. 各グループのメンバーを取得し、グループごとのハッシュを計算
+        with span("membership_fetch"):
+            edges_by_group, failed_groups = _fetch_group_edges(groups)
+        count("resources_processed", len(groups))
+        count("errors", len(failed_groups))
+        group_hashes = {g: _compute_group_hash(edges) for g, edges in edges_by_group.items()}
+
+        # 取得に失敗したグループの前回のエッジ (推移閉包用)。FULL モードで洗い替える前に取得しておく
+        carried_edges = _carried_edges(failed_groups) if TRANSITIVE_TABLE_ID else {}
+
         # 3. 結果をBigQueryに書き込み
-        if rows_to_insert:
-            logger.info(f"Writing {len(rows_to_insert)} group membership records to BigQuery...")
-            # グローバルインスタンス (bigquery_client) を使用
-            # DESTINATION_TABLE_IDは環境変数から読み込まれたものを使用
-            bigquery_client.insert_rows(
-                dataset_id=BQ_DATASET_ID,
-                table_id=DESTINATION_TABLE_ID,
-                rows=rows_to_insert,
-                write_disposition="WRITE_TRUNCATE" # 毎回テーブルを洗い替える
-            )
-            logger.info(f"Successfully wrote {len(rows_to_insert)} records to {BQ_DATASET_ID}.{DESTINATION_TABLE_ID}.")
+        if SYNC_MODE == "INCREMENTAL":
+            changed = _sync_incremental(edges_by_group, failed_groups, group_hashes, current_timestamp)
         else:
-            logger.warning("No group memberships found or processed. No data written to BigQuery.")
+            changed = _sync_full(edges_by_group, group_hashes, current_timestamp)
+
+        # 4. 推移閉包テーブルを更新 (メンバーシップに変更があった場合と、テーブルが存在しない・空の場合)
+        if TRANSITIVE_TABLE_ID and (changed or _transitive_table_is_empty()):
+            _write_transitive_members(edges_by_group, failed_groups, carried_edges, current_timestamp)
 
     except Exception as e:
         logger.error(f"An unexpected error occurred during group assessment: {e}", exc_info=True)
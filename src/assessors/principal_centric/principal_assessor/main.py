@@ -7,7 +7,10 @@ import datetime
 # 修正点: クラスではなく、グローバルインスタンスを直接インポート
 from utils.gcp_clients import asset_client, bigquery_client, identity_client
 from utils.iam_helpers import expand_member
+from utils.bq_helpers import load_rows_to_table
 from collections import defaultdict
+from utils.instrumentation import instrument_invocation, span, count, set_attribute
+from utils.rate_limiter import call_api_pages
 from utils.logging_handler import get_logger
 
 # --- 環境変数 ---
@@ -15,6 +18,8 @@ BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
 BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされたテーブル名を環境変数から読み込む
 DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: analyzer向けのフラット化されたアクセスファクトテーブル (オプション)
+ACCESS_FACTS_TABLE_ID = os.getenv('ACCESS_FACTS_TABLE_ID')
 
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
@@ -22,6 +27,7 @@ logger = get_logger(__name__)
 
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def assess_principal_centric(cloud_event):
     """
     Pub/Subメッセージをトリガーに、指定されたスコープ内の全IAMポリシーをプリンシパル中心に評価する。
@@ -35,10 +41,16 @@ def assess_principal_centric(cloud_event):
     try:
         message_data_str = base64.b64decode(cloud_event.data["message"]["data"]).decode("utf-8")
         scopes = []
+        snapshot_timestamp = None
         try:
             parsed_scopes = json.loads(message_data_str)
             if isinstance(parsed_scopes, list):
                 scopes = parsed_scopes
+            elif isinstance(parsed_scopes, dict):
+                # 変更点: {"scopes": [...], "run_id": ...} の形式も受け付ける (バッチ実行が run_id を引き継ぐため)
+                scopes = list(parsed_scopes.get("scopes") or [])
+                # 修正点: ディスパッチャーから起動された場合は、その実行のスナップショットとして書き込む
+                snapshot_timestamp = parsed_scopes.get("assessment_timestamp")
         except json.JSONDecodeError:
             scopes.append(message_data_str)
 
@@ -50,6 +62,7 @@ def assess_principal_centric(cloud_event):
         return # メッセージが不正な場合はエラーにせず、処理を終了
 
     logger.info(f"Starting principal-centric assessment for scopes: {scopes}")
+    set_attribute("scope", ",".join(scopes))
 
     try:
         # --- ここからがメインの処理 ---
@@ -57,25 +70,35 @@ def assess_principal_centric(cloud_event):
         for scope in scopes:
             try:
                 # グローバルインスタンス (asset_client) を使用
-                all_policies = asset_client.search_all_iam_policies(scope=scope, timeout=300.0)
-                for policy in all_policies:
-                    for binding in policy.policy.bindings:
-                        for member in binding.members:
-                            principal_permissions[member].append({
-                                "resource_name": policy.resource,
-                                "role": binding.role,
-                                "scope": scope 
-                            })
+                with span("policy_search"):
+                    # 変更点: 共通のレート制限・再試行をページごとに通す (ポリシーは読み切らずに、ページを順に集計する)。
+                    # スコープの途中で失敗した場合に一部だけが残らないよう、スコープ単位で集計してから反映する
+                    scope_permissions = defaultdict(list)
+                    policies = call_api_pages(
+                        "asset", asset_client.search_all_iam_policies, {"scope": scope}, "results", timeout=300.0
+                    )
+                    for policy in policies:
+                        for binding in policy.policy.bindings:
+                            for member in binding.members:
+                                scope_permissions[member].append({
+                                    "resource_name": policy.resource,
+                                    "role": binding.role,
+                                    "scope": scope 
+                                })
+                for member, access_list in scope_permissions.items():
+                    principal_permissions[member].extend(access_list)
             except Exception as e:
                 logger.error(f"Failed to get IAM policies for scope {scope}: {e}")
+                count("errors")
                 continue
         
         final_permissions = defaultdict(list)
-        for principal, access_list in principal_permissions.items():
-            member_type, member_id = principal.split(":", 1)
-            # グローバルインスタンス (identity_client) を使用
-            for expanded_member in expand_member(identity_client, member_type.upper(), member_id, set()):
-                final_permissions[expanded_member].extend(access_list)
+        with span("group_expansion"):
+            for principal, access_list in principal_permissions.items():
+                member_type, member_id = principal.split(":", 1)
+                # グローバルインスタンス (identity_client) を使用
+                for expanded_member in expand_member(identity_client, member_type.upper(), member_id, set()):
+                    final_permissions[expanded_member].extend(access_list)
                 
         final_permissions_with_scope = defaultdict(lambda: defaultdict(list))
         for principal, permissions in final_permissions.items():
@@ -85,7 +108,8 @@ def assess_principal_centric(cloud_event):
                 final_permissions_with_scope[principal][scope].append(access)
 
         rows_to_insert = []
-        current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        current_timestamp = snapshot_timestamp or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        set_attribute("assessment_timestamp", current_timestamp)
         
         for principal, scope_mappings in final_permissions_with_scope.items():
             p_type, p_email = principal.split(":", 1)
@@ -98,15 +122,42 @@ def assess_principal_centric(cloud_event):
                     "access_list": access_list
                 })
 
+        # 変更点: 実行台帳ではプリンシパルを処理件数として集計する
+        count("resources_processed", len(final_permissions_with_scope))
+        count("rows_built", len(rows_to_insert))
+
         if rows_to_insert:
             # グローバルインスタンス (bigquery_client) を使用
             # DESTINATION_TABLE_IDは環境変数から読み込まれたものを使用
             table_ref = bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(DESTINATION_TABLE_ID)
-            errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
+            with span("bq_write"):
+                errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
             if errors:
-                logger.error(f"BigQuery insert errors: {errors}")
+                # 修正点: principal_access_list に書き込めなかった場合はアクセスファクトにも書き込まない
+                # (同じスナップショットで2つのテーブルの内容が食い違わないようにする)
+                logger.error(f"BigQuery insert errors: {errors}. Skipping the access facts load for this snapshot.")
+                count("errors")
+                return
             else:
+                count("bq.rows_written", len(rows_to_insert))
                 logger.info(f"Successfully wrote {len(rows_to_insert)} principals to BigQuery.")
+
+            # 変更点: 同じ内容を (プリンシパル, リソース, ロール) 単位にフラット化してアクセスファクトテーブルにも書き込む
+            # analyzerはUNNESTせずにこのテーブルを参照でき、パーティション/クラスタによる絞り込みが効く
+            if ACCESS_FACTS_TABLE_ID:
+                fact_rows = [
+                    {
+                        "assessment_timestamp": row["assessment_timestamp"],
+                        "scope": row["scope"],
+                        "principal_type": row["principal_type"],
+                        "principal_email": row["principal_email"],
+                        "resource_name": access["resource_name"],
+                        "role": access["role"],
+                    }
+                    for row in rows_to_insert
+                    for access in row["access_list"]
+                ]
+                load_rows_to_table(fact_rows, ACCESS_FACTS_TABLE_ID, "WRITE_APPEND")
         # --- ここまでがメインの処理 ---
         
     except Exception as e:
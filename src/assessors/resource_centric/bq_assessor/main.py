@@ -7,6 +7,9 @@ from collections import defaultdict
 # 修正点: グローバルインスタンスと、動的初期化用のクラスの両方をインポート
 from utils.gcp_clients import bigquery_client, identity_client, BigQueryClientClass
 from utils.iam_helpers import expand_member
+from utils.policy_cache import PolicyEtagCache, has_unexpanded_members
+from utils.instrumentation import instrument_invocation, span, count, count_api_call, set_attribute
+from utils.rate_limiter import call_api
 from utils.logging_handler import get_logger
 
 # --------------------------------------------------
@@ -16,12 +19,19 @@ BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
 BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされたテーブル名を環境変数から読み込む
 BQ_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: ポリシーの etag キャッシュ (オプション)。etag と展開したグループのメンバーシップが前回から変わっていなければ、
+# グループを展開せずに前回の行を引き継ぐ
+POLICY_ETAG_TABLE_ID = os.getenv('POLICY_ETAG_TABLE_ID') # resource_policy_etags
+GROUP_HASH_TABLE_ID = os.getenv('GROUP_HASH_TABLE_ID') # group_membership_hashes
 
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
+# ウォーム層 (メモリ上のキャッシュ) は関数インスタンスが再利用される間、呼び出しをまたいで保持される
+policy_cache = PolicyEtagCache(POLICY_ETAG_TABLE_ID, GROUP_HASH_TABLE_ID)
 # 修正点: インスタンスの初期化コードを削除 (gcp_clients.py からインポート)
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def assess_iam_policy_pubsub(cloud_event):
     """
     Pub/Subメッセージをトリガーに、BigQueryデータセットのIAMポリシーを評価し、
@@ -42,9 +52,16 @@ def assess_iam_policy_pubsub(cloud_event):
         project_id, _, dataset_id = resource_full_name.split('/')[-1].split(':')[-1].partition('.')
         assessment_timestamp = message_data['assessment_timestamp']
 
+        # 変更点: 実行台帳 (pipeline_runs) の行に、評価したリソースとスナップショットを記録する
+        set_attribute("scope", scope)
+        set_attribute("resource_name", resource_full_name)
+        set_attribute("assessment_timestamp", assessment_timestamp)
+        count("resources_processed")
+
         logger.info(f"Assessing dataset: {project_id}.{dataset_id}")
     except (KeyError, json.JSONDecodeError) as e:
         logger.error(f"Invalid message format, skipping: {e}")
+        count("errors")
         return # メッセージが不正な場合はエラーにせず、処理を終了
 
     try:
@@ -53,50 +70,69 @@ def assess_iam_policy_pubsub(cloud_event):
         # 1. データセットの情報を取得
         # 修正点: 動的初期化のために 'BigQueryClientClass' を使用
         bq_client_for_target = BigQueryClientClass(project=project_id)
-        dataset = bq_client_for_target.get_dataset(dataset_id, timeout=30.0)
+        with span("policy_fetch"):
+            count_api_call("bigquery", "get_dataset") # 対象プロジェクトのクライアントは LazyClient ではないため明示的に数える
+            dataset = call_api("bigquery", bq_client_for_target.get_dataset, dataset_id, timeout=30.0)
+        resource_name = f"{project_id}.{dataset_id}"
+
+        # 変更点: データセット (アクセスエントリを含む) とグループが前回から変わっていなければ、前回の行を引き継いで終了する
+        # データセットの etag はアクセスエントリ以外のメタデータの変更でも変わるため、安全側 (再評価) に倒れる
+        cached = policy_cache.lookup("BIGQUERY_DATASET", resource_name, dataset.etag)
+        if cached and policy_cache.carry_forward(cached, "BIGQUERY_DATASET", resource_name, assessment_timestamp, scope):
+            logger.info(f"Access entries for dataset {resource_name} are unchanged. Previous records will be carried forward.", extra={"cache_hit": True})
+            return
 
         rows_to_insert = []
+        touched_groups = set()
 
         # 2. データセットのアクセスエントリを直接ループし、ポリシーを解析
-        if dataset.access_entries:
-            for entry in dataset.access_entries:
-                member_type, member_id = "Unknown", None
-                if entry.entity_type == "user":
-                    member_type, member_id = "USER", entry.entity_id
-                elif entry.entity_type == "groupByEmail":
-                    member_type, member_id = "GROUP", entry.entity_id
-                elif entry.entity_type == "serviceAccount":
-                    member_type, member_id = "SERVICE_ACCOUNT", entry.entity_id
-                elif entry.entity_type == "specialGroup":
-                    member_type, member_id = "SPECIAL_GROUP", entry.entity_id
-
-                if member_id:
-                    # グローバルインスタンス (identity_client) を使用
-                    for expanded_member in expand_member(identity_client, member_type, member_id, set()):
-                        member_type_final, member_email_final = expanded_member.split(":", 1)
-                        rows_to_insert.append({
-                            "assessment_timestamp": assessment_timestamp,
-                            "scope": scope,
-                            "resource_type": "BIGQUERY_DATASET",
-                            "resource_name": f"{project_id}.{dataset_id}",
-                            "principal_type": member_type_final,
-                            "principal_email": member_email_final,
-                            "role": entry.role,
-                        })
+        with span("group_expansion"):
+            if dataset.access_entries:
+                for entry in dataset.access_entries:
+                    member_type, member_id = "Unknown", None
+                    if entry.entity_type == "user":
+                        member_type, member_id = "USER", entry.entity_id
+                    elif entry.entity_type == "groupByEmail":
+                        member_type, member_id = "GROUP", entry.entity_id
+                    elif entry.entity_type == "serviceAccount":
+                        member_type, member_id = "SERVICE_ACCOUNT", entry.entity_id
+                    elif entry.entity_type == "specialGroup":
+                        member_type, member_id = "SPECIAL_GROUP", entry.entity_id
+
+                    if member_id:
+                        # グローバルインスタンス (identity_client) を使用
+                        for expanded_member in expand_member(identity_client, member_type, member_id, set(), touched_groups):
+                            member_type_final, member_email_final = expanded_member.split(":", 1)
+                            rows_to_insert.append({
+                                "assessment_timestamp": assessment_timestamp,
+                                "scope": scope,
+                                "resource_type": "BIGQUERY_DATASET",
+                                "resource_name": resource_name,
+                                "principal_type": member_type_final,
+                                "principal_email": member_email_final,
+                                "role": entry.role,
+                            })
+
+        count("rows_built", len(rows_to_insert))
 
         # 3. 結果をBigQueryに書き込み
         if rows_to_insert:
             # グローバルインスタンス (bigquery_client) を使用
             # BQ_TABLE_IDは環境変数から読み込まれたものを使用
             table_ref = bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(BQ_TABLE_ID)
-            errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
+            with span("bq_write"):
+                errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
             if errors:
                 raise Exception(f"BigQuery insert errors: {errors}")
             else:
+                count("bq.rows_written", len(rows_to_insert))
                 logger.info(f"Successfully wrote {len(rows_to_insert)} records for dataset {dataset_id} to BigQuery.")
         else:
             logger.info(f"No direct access entries found for dataset {dataset_id}.")
 
+        policy_cache.record("BIGQUERY_DATASET", resource_name, dataset.etag, touched_groups, assessment_timestamp, len(rows_to_insert),
+                            complete=not has_unexpanded_members(rows_to_insert), scope=scope)
+
         # --- ここまでがメインの処理 ---
 
     except Exception as e:
@@ -0,0 +1,45 @@
+# ./src/assessors/resource_centric/carry_forward_finalizer/main.py
+import os
+import functions_framework
+from utils.bq_helpers import resolve_snapshot_timestamp
+from utils.policy_cache import PolicyEtagCache
+from utils.instrumentation import instrument_invocation
+from utils.logging_handler import get_logger
+
+# --- 環境変数 ---
+BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
+BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
+DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID') # unified_access_permissions
+POLICY_ETAG_TABLE_ID = os.getenv('POLICY_ETAG_TABLE_ID') # resource_policy_etags
+
+logger = get_logger(__name__)
+
+
+@functions_framework.cloud_event
+@instrument_invocation(logger)
+def finalize_carried_forward_resources(cloud_event):
+    """
+    resource-centric assessor が etag キャッシュのヒットとして記録したリソースの評価結果の行を、
+    スナップショットごとに1回の MERGE で前回のスナップショットから複製する。
+    assessor の後・analyzer の前に Scheduler から実行する。対象はトリガーメッセージの snapshot_id、なければ最新のスナップショット。
+    """
+    if not DESTINATION_TABLE_ID or not POLICY_ETAG_TABLE_ID:
+        msg = "Missing required environment variables: DESTINATION_TABLE_ID and POLICY_ETAG_TABLE_ID must be set."
+        logger.error(msg)
+        raise ValueError(msg)
+
+    try:
+        snapshot_timestamp = resolve_snapshot_timestamp(cloud_event, f"`{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{POLICY_ETAG_TABLE_ID}`")
+    except ValueError as e:
+        logger.error(f"Invalid message format, skipping: {e}")
+        return
+    if not snapshot_timestamp:
+        logger.warning("No assessment snapshot found. Nothing to carry forward.")
+        return
+    logger.info(f"Carrying forward unchanged resources for snapshot: {snapshot_timestamp}")
+
+    try:
+        PolicyEtagCache(POLICY_ETAG_TABLE_ID).carry_forward_snapshot(DESTINATION_TABLE_ID, snapshot_timestamp)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while carrying forward unchanged resources: {e}", exc_info=True)
+        raise
@@ -6,6 +6,9 @@ import functions_framework
 # 修正点: クラスではなく、グローバルインスタンスを直接インポート
 from utils.gcp_clients import compute_client, bigquery_client, identity_client
 from utils.iam_helpers import expand_member
+from utils.policy_cache import PolicyEtagCache, has_unexpanded_members
+from utils.instrumentation import instrument_invocation, span, count, count_api_call, set_attribute
+from utils.rate_limiter import call_api
 from utils.logging_handler import get_logger
 
 # --------------------------------------------------
@@ -15,12 +18,19 @@ BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
 BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
 # 修正点: ハードコードされたテーブル名を環境変数から読み込む
 BQ_TABLE_ID = os.getenv('DESTINATION_TABLE_ID')
+# 変更点: ポリシーの etag キャッシュ (オプション)。etag と展開したグループのメンバーシップが前回から変わっていなければ、
+# グループを展開せずに前回の行を引き継ぐ
+POLICY_ETAG_TABLE_ID = os.getenv('POLICY_ETAG_TABLE_ID') # resource_policy_etags
+GROUP_HASH_TABLE_ID = os.getenv('GROUP_HASH_TABLE_ID') # group_membership_hashes
 
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
+# ウォーム層 (メモリ上のキャッシュ) は関数インスタンスが再利用される間、呼び出しをまたいで保持される
+policy_cache = PolicyEtagCache(POLICY_ETAG_TABLE_ID, GROUP_HASH_TABLE_ID)
 # 修正点: インスタンスの初期化コードを削除
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def assess_compute_instance_policy(cloud_event):
     """
     Pub/Subメッセージをトリガーに、Compute Engine VMインスタンスのIAMポリシーを評価する。
@@ -43,9 +53,16 @@ def assess_compute_instance_policy(cloud_event):
         instance_name = parts[8]
         assessment_timestamp = message_data['assessment_timestamp']
 
+        # 変更点: 実行台帳 (pipeline_runs) の行に、評価したリソースとスナップショットを記録する
+        set_attribute("scope", scope)
+        set_attribute("resource_name", resource_full_name)
+        set_attribute("assessment_timestamp", assessment_timestamp)
+        count("resources_processed")
+
         logger.info(f"Assessing VM instance: {instance_name} in project {project_id}")
     except (KeyError, json.JSONDecodeError, IndexError) as e:
         logger.error(f"Invalid message format, skipping: {e}")
+        count("errors")
         return # メッセージが不正な場合はエラーにせず、処理を終了
 
     try:
@@ -53,42 +70,59 @@ def assess_compute_instance_policy(cloud_event):
 
         # 1. VMインスタンスのIAMポリシーを取得
         # グローバルインスタンス (compute_client) を使用
-        policy = compute_client.get_iam_policy(project=project_id, zone=zone, resource=instance_name, timeout=30.0)
+        with span("policy_fetch"):
+            policy = call_api("compute", compute_client.get_iam_policy, project=project_id, zone=zone, resource=instance_name, timeout=30.0)
+        resource_name = f"{project_id}/{zone}/{instance_name}"
+
+        # 変更点: ポリシーとグループが前回から変わっていなければ、前回の行を引き継いで終了する
+        cached = policy_cache.lookup("COMPUTE_INSTANCE", resource_name, policy.etag)
+        if cached and policy_cache.carry_forward(cached, "COMPUTE_INSTANCE", resource_name, assessment_timestamp, scope):
+            logger.info(f"IAM policy for VM {instance_name} is unchanged. Previous records will be carried forward.", extra={"cache_hit": True})
+            return
 
         rows_to_insert = []
+        touched_groups = set()
 
         # 2. ポリシーを解析し、グループを展開
-        for binding in policy.bindings:
-            role = binding.role
-            for member in binding.members:
-                member_type, member_id = member.split(":", 1)
-
-                # グローバルインスタンス (identity_client) を使用
-                for expanded_member in expand_member(identity_client, member_type.upper(), member_id, set()):
-                    e_type, e_email = expanded_member.split(":", 1)
-                    rows_to_insert.append({
-                        "assessment_timestamp": assessment_timestamp,
-                        "scope": scope,
-                        "resource_type": "COMPUTE_INSTANCE",
-                        "resource_name": f"{project_id}/{zone}/{instance_name}",
-                        "principal_type": e_type,
-                        "principal_email": e_email,
-                        "role": role,
-                    })
+        with span("group_expansion"):
+            for binding in policy.bindings:
+                role = binding.role
+                for member in binding.members:
+                    member_type, member_id = member.split(":", 1)
+
+                    # グローバルインスタンス (identity_client) を使用
+                    for expanded_member in expand_member(identity_client, member_type.upper(), member_id, set(), touched_groups):
+                        e_type, e_email = expanded_member.split(":", 1)
+                        rows_to_insert.append({
+                            "assessment_timestamp": assessment_timestamp,
+                            "scope": scope,
+                            "resource_type": "COMPUTE_INSTANCE",
+                            "resource_name": resource_name,
+                            "principal_type": e_type,
+                            "principal_email": e_email,
+                            "role": role,
+                        })
+
+        count("rows_built", len(rows_to_insert))
 
         # 3. 結果をBigQueryに書き込み
         if rows_to_insert:
             # グローバルインスタンス (bigquery_client) を使用
             # BQ_TABLE_IDは環境変数から読み込まれたものを使用
             table_ref = bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(BQ_TABLE_ID)
-            errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
+            with span("bq_write"):
+                errors = bigquery_client.insert_rows_json(table_ref, rows_to_insert)
             if errors:
                 raise Exception(f"BigQuery insert errors: {errors}")
             else:
+                count("bq.rows_written", len(rows_to_insert))
                 logger.info(f"Successfully wrote {len(rows_to_insert)} records for VM {instance_name} to BigQuery.")
         else:
             logger.info(f"No IAM bindings found for VM {instance_name}.")
 
+        policy_cache.record("COMPUTE_INSTANCE", resource_name, policy.etag, touched_groups, assessment_timestamp, len(rows_to_insert),
+                            complete=not has_unexpanded_members(rows_to_insert), scope=scope)
+
         # --- ここまでがメインの処理 ---
 
     except Exception as e:
@@ -0,0 +1,49 @@
+# ./src/assessors/role_catalog_assessor/main.py
+import os
+import datetime
+import functions_framework
+from utils.bq_helpers import load_rows_to_table
+from utils.permission_catalog import load_role_definitions_from_iam
+from utils.instrumentation import instrument_invocation
+from utils.logging_handler import get_logger
+
+# --- グローバル定数 ---
+BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
+BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
+DESTINATION_TABLE_ID = os.getenv('DESTINATION_TABLE_ID') # role_permissions
+# カスタムロールを読み込む親リソース (カンマ区切り、例: organizations/123456789012,projects/my-proj)
+CUSTOM_ROLE_PARENTS = [p.strip() for p in os.getenv('CUSTOM_ROLE_PARENTS', '').split(',') if p.strip()]
+
+logger = get_logger(__name__)
+
+
+@functions_framework.cloud_event
+@instrument_invocation(logger)
+def assess_role_catalog(cloud_event):
+    """
+    事前定義ロールとカスタムロールの定義をIAM APIから取得し、
+    ロールと権限の組を role_permissions テーブルに書き込む (毎回洗い替え)。
+    analyzer はこのテーブルを使って、ロール名ではなく権限でリスク・SoDを評価できる。
+    """
+    logger.info("Starting role catalog assessment...")
+
+    if not DESTINATION_TABLE_ID:
+        msg = "Missing required environment variable: DESTINATION_TABLE_ID must be set."
+        logger.error(msg)
+        raise ValueError(msg)
+
+    try:
+        catalog = load_role_definitions_from_iam(CUSTOM_ROLE_PARENTS)
+        current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        rows_to_insert = list(catalog.rows(current_timestamp))
+        logger.info(
+            f"Loaded {len(catalog)} roles with {len(catalog.permissions)} distinct permissions.",
+            extra={"roles": len(catalog), "permissions": len(catalog.permissions), "custom_role_parents": CUSTOM_ROLE_PARENTS}
+        )
+
+        load_rows_to_table(rows_to_insert, DESTINATION_TABLE_ID, write_disposition="WRITE_TRUNCATE")
+        logger.info(f"Successfully wrote {len(rows_to_insert)} role permissions to {BQ_DATASET_ID}.{DESTINATION_TABLE_ID}.")
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during role catalog assessment: {e}", exc_info=True)
+        raise
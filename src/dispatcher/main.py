@@ -4,7 +4,11 @@ import json
 import functions_framework
 import datetime
 # 修正点: クラスではなく、グローバルインスタンスを直接インポート
-from utils.gcp_clients import asset_client, publisher_client
+from utils.gcp_clients import publisher_client
+from utils.instrumentation import instrument_invocation, count, current_run_id, set_attribute
+from utils.run_ledger import new_run_id
+# 変更点: アセットの検索はバッチ実行 (tools/batch_runner.py) と共有する
+from utils.asset_discovery import discover_resources
 from utils.logging_handler import get_logger
 
 # --------------------------------------------------
@@ -13,6 +17,9 @@ from utils.logging_handler import get_logger
 HOST_PROJECT_ID = os.getenv('GCP_PROJECT')
 SCOPES_JSON = os.getenv('ASSESSMENT_SCOPES', '[]')
 ASSESSOR_TOPICS_JSON = os.getenv('ASSESSOR_TOPIC_NAMES', '{}')
+# 修正点: 実行ごとに1回だけ起動する assessor (ASSESSOR_TOPIC_NAMES のキー)。スコープのリストと一緒に
+# run_id と assessment_timestamp を送り、リソースごとの assessor と同じ実行・スナップショットとして書き込ませる
+RUN_LEVEL_ASSESSORS = ("principal-assessor", "group-assessor")
 
 # 修正点: ロガーのみ初期化
 logger = get_logger(__name__)
@@ -35,17 +42,9 @@ except json.JSONDecodeError as e:
     # Function起動時にパース失敗したら、後続の処理は実行不可能
     raise ValueError(f"Invalid JSON in environment variables: {e}")
 
-# --------------------------------------------------
-# 設定値の定義
-# --------------------------------------------------
-ASSET_TYPE_TO_ASSESSOR_MAP = {
-    "bigquery.googleapis.com/Dataset": "bq-assessor",
-    "storage.googleapis.com/Bucket": "gcs-assessor",
-    "compute.googleapis.com/Instance": "compute-assessor",
-}
-
 
 @functions_framework.cloud_event
+@instrument_invocation(logger)
 def discover_and_dispatch_assets(cloud_event):
     """
     指定されたスコープ内のターゲットアセットを検索し、対応する評価Functionの
@@ -56,38 +55,52 @@ def discover_and_dispatch_assets(cloud_event):
     try:
         # --- ここからがメインの処理 ---
         current_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        # 変更点: 実行の run_id を assessment_timestamp と一緒に各 assessor へ伝搬する
+        # (計測が無効な場合は、ここで採番する)
+        run_id = current_run_id() or new_run_id()
+        set_attribute("scope", ",".join(ASSESSMENT_SCOPES))
+        set_attribute("assessment_timestamp", current_timestamp)
+
+        for assessor_name in RUN_LEVEL_ASSESSORS:
+            topic_name = ASSESSOR_TOPICS.get(assessor_name)
+            if not topic_name:
+                continue
+            message_payload = {"scopes": ASSESSMENT_SCOPES, "assessment_timestamp": current_timestamp, "run_id": run_id}
+            future = publisher_client.publish(
+                publisher_client.topic_path(HOST_PROJECT_ID, topic_name), json.dumps(message_payload).encode("utf-8")
+            )
+            future.result()
+            # スナップショットの完了の判定で、この assessor の終了も待つ
+            count("assessors_triggered")
+            logger.info(f"Triggered {assessor_name} for this run.")
 
         for scope in ASSESSMENT_SCOPES:
             logger.info(f"Processing scope: {scope}")
             try:
-                # グローバルインスタンス (asset_client) を使用
-                response = asset_client.search_all_resources(
-                    request={"scope": scope, "asset_types": ASSET_TYPE_TO_ASSESSOR_MAP.keys()},
-                    timeout=300.0
-                )
-
-                for resource in response:
-                    assessor_name = ASSET_TYPE_TO_ASSESSOR_MAP.get(resource.asset_type)
+                for assessor_name, resource_name in discover_resources(scope):
                     topic_name = ASSESSOR_TOPICS.get(assessor_name)
 
                     if not topic_name:
-                        logger.warning(f"Warning: No topic found for assessor '{assessor_name}'. Skipping resource {resource.name}")
+                        logger.warning(f"Warning: No topic found for assessor '{assessor_name}'. Skipping resource {resource_name}")
                         continue
 
                     # グローバルインスタンス (publisher_client) を使用
                     topic_path = publisher_client.topic_path(HOST_PROJECT_ID, topic_name)
                     message_payload = {
                         "scope": scope,
-                        "resource_name": resource.name,
-                        "assessment_timestamp": current_timestamp
+                        "resource_name": resource_name,
+                        "assessment_timestamp": current_timestamp,
+                        "run_id": run_id
                     }
                     message_data = json.dumps(message_payload).encode("utf-8")
 
                     future = publisher_client.publish(topic_path, message_data)
                     future.result()
+                    count("resources_processed")
 
             except Exception as e:
                 logger.error(f"Error processing scope {scope}: {e}")
+                count("errors")
                 continue
         # --- ここまでがメインの処理 ---
 
@@ -95,4 +108,4 @@ def discover_and_dispatch_assets(cloud_event):
         logger.error(f"An unexpected error occurred during main processing: {e}")
         raise
 
-    logger.info("All scopes processed.")
+    logger.info("All scopes processed.", extra={"run_id": run_id})
@@ -0,0 +1,26 @@
+# ./src/utils/asset_discovery.py
+# 評価対象のアセットの検索。dispatcher と、Cloud Functions を使わずにパイプラインを実行するバッチ実行 (tools/batch_runner.py) で共有する
+from typing import Iterator, Tuple
+from .gcp_clients import asset_client
+from .rate_limiter import call_api_pages
+
+# アセットタイプ -> 評価する assessor の名前 (ASSESSOR_TOPIC_NAMES のキー)
+ASSET_TYPE_TO_ASSESSOR_MAP = {
+    "bigquery.googleapis.com/Dataset": "bq-assessor",
+    "storage.googleapis.com/Bucket": "gcs-assessor",
+    "compute.googleapis.com/Instance": "compute-assessor",
+}
+
+
+def discover_resources(scope: str) -> Iterator[Tuple[str, str]]:
+    """
+    スコープ内の評価対象のアセットを (assessor の名前, リソース名) で返す。
+    共通のレート制限・再試行をページごとに通す (リソースは読み切らずに、ページを順に取得しながら返す)
+    """
+    resources = call_api_pages(
+        "asset", asset_client.search_all_resources,
+        {"scope": scope, "asset_types": list(ASSET_TYPE_TO_ASSESSOR_MAP)}, "results",
+        timeout=300.0
+    )
+    for resource in resources:
+        yield ASSET_TYPE_TO_ASSESSOR_MAP.get(resource.asset_type), resource.name
@@ -1,31 +1,422 @@
 import os
+import json
+import base64
+import datetime
+import time
+import hashlib
 from google.cloud import bigquery
 from .gcp_clients import bigquery_client
+from .instrumentation import count, span, set_attribute, adopt_run_id, current_invocation
+from .run_ledger import DISPATCH_STAGE, RUN_LEVEL_STAGES
 from .logging_handler import get_logger
 # 変更点: ロガーを初期化
 logger = get_logger(__name__)
 
-def run_query_and_save_results(query: str, destination_table_id: str, write_disposition: str, max_bytes_billed: int = None):
+# 変更点: ドライランの見積もりに上乗せする余裕。実行時の maximum_bytes_billed はこの分だけ見積もりより大きく設定する
+DRY_RUN_HEADROOM_RATIO = 1.25
+# BigQueryは参照テーブルごとに最低10MBを課金するため、動的な上限にも下限を設ける
+MIN_BYTES_BILLED = 10 * 1024 * 1024
+
+class QueryBudgetExceededError(Exception):
+    """ドライランで見積もったスキャン量が、analyzerのスキャン予算 (max_bytes_billed) を超えた場合に送出される"""
+
+def _dry_run(query: str, query_parameters: list = None):
+    """クエリをドライランし、見積もり (total_bytes_processed・referenced_tables) を持つジョブを返す (課金されない)"""
+    job_config = bigquery.QueryJobConfig(
+        dry_run=True,
+        use_query_cache=False,
+        query_parameters=query_parameters or []
+    )
+    return bigquery_client.query(query, job_config=job_config)
+
+def estimate_query_bytes(query: str, query_parameters: list = None) -> int:
+    """
+    ドライランでクエリのスキャンバイト数を見積もるヘルパー関数 (課金されない)
     """
-    指定されたクエリを実行し、結果を指定テーブルに保存するヘルパー関数
+    return _dry_run(query, query_parameters).total_bytes_processed or 0
+
+def _adaptive_bytes_cap(estimated_bytes: int, max_bytes_billed: int = None, referenced_tables: int = 1) -> int:
+    """
+    見積もりに余裕を持たせた maximum_bytes_billed を計算する (予算が指定されていればそれを超えない)
+    修正点: 最低課金額は参照テーブルごとにかかるため、下限は参照テーブル数 x 10MB とする
+    (複数のテーブルを結合する小さなクエリが bytesBilledLimitExceeded で失敗していた)
+    """
+    cap = max(int(estimated_bytes * DRY_RUN_HEADROOM_RATIO), MIN_BYTES_BILLED * max(referenced_tables, 1))
+    return min(cap, max_bytes_billed) if max_bytes_billed else cap
+
+def _job_stats(query_job) -> dict:
+    """完了したクエリジョブから、チューニングに使う実績値を取り出す (呼び出しの計測にも課金バイト数を加算する)"""
+    count("bq.bytes_billed", query_job.total_bytes_billed or 0)
+    return {
+        "total_bytes_processed": query_job.total_bytes_processed,
+        "total_bytes_billed": query_job.total_bytes_billed,
+        "slot_millis": query_job.slot_millis,
+        "cache_hit": query_job.cache_hit,
+    }
+
+def submit_query_and_save_results(query: str, destination_table_id: str, write_disposition: str, max_bytes_billed: int = None, query_parameters: list = None):
+    """
+    run_query_and_save_results の非同期版。ドライランと予算チェックを行った上でクエリジョブを投入し、
+    完了を待たずにジョブを返す。複数のジョブは wait_for_query_jobs でまとめて待機する。
     """
     dataset_id = os.getenv('BQ_DATASET_ID')
     dest_table_ref = bigquery_client.dataset(dataset_id).table(destination_table_id)
+
+    # 変更点: ドライランで見積もり、予算を超えるクエリは実行前に止める
+    dry_run_job = _dry_run(query, query_parameters)
+    estimated_bytes = dry_run_job.total_bytes_processed or 0
+    if max_bytes_billed and estimated_bytes > max_bytes_billed:
+        logger.error(
+            f"Estimated scan for {destination_table_id} exceeds the byte budget. Query was not executed.",
+            extra={
+                "estimated_bytes": estimated_bytes,
+                "max_bytes_billed": max_bytes_billed,
+                "destination_table": destination_table_id
+            }
+        )
+        raise QueryBudgetExceededError(
+            f"Estimated {estimated_bytes} bytes exceeds budget of {max_bytes_billed} bytes for {destination_table_id}."
+        )
     
     job_config = bigquery.QueryJobConfig(
         destination=dest_table_ref,
         write_disposition=write_disposition,
-        maximum_bytes_billed=max_bytes_billed
+        maximum_bytes_billed=_adaptive_bytes_cap(
+            estimated_bytes, max_bytes_billed, len(dry_run_job.referenced_tables or [])
+        ),
+        query_parameters=query_parameters or []
     )
     
     query_job = bigquery_client.query(query, job_config=job_config)
+    logger.info(
+        f"Query submitted for {destination_table_id}.",
+        extra={"job_id": query_job.job_id, "destination_table": destination_table_id, "estimated_bytes": estimated_bytes}
+    )
+    return query_job
+
+def wait_for_query_jobs(jobs: dict, poll_interval: float = 1.0, timeout: float = None) -> dict:
+    """
+    投入済みの複数のクエリジョブ {名前: QueryJob} をまとめてポーリングし、
+    {名前: {"job_id", "stats", "error"}} を返す。失敗したジョブは error にメッセージが入り、例外は送出しない。
+    timeout を超えたジョブはキャンセルを試み、タイムアウトとして報告する。
+    """
+    results = {}
+    pending = dict(jobs)
+    deadline = time.monotonic() + timeout if timeout else None
+
+    while pending:
+        for name, query_job in list(pending.items()):
+            if not query_job.done():
+                continue
+            pending.pop(name)
+            error = query_job.exception()
+            results[name] = {
+                "job_id": query_job.job_id,
+                "stats": None if error else _job_stats(query_job),
+                "error": str(error) if error else None,
+            }
+            if error:
+                logger.error(f"Query job '{name}' failed: {error}", extra={"job_id": query_job.job_id})
+            else:
+                logger.info(f"Query job '{name}' completed.", extra={"job_id": query_job.job_id, **results[name]["stats"]})
+
+        if not pending:
+            break
+        if deadline and time.monotonic() > deadline:
+            for name, query_job in pending.items():
+                query_job.cancel()
+                results[name] = {"job_id": query_job.job_id, "stats": None, "error": f"Timed out after {timeout} seconds."}
+                logger.error(f"Query job '{name}' timed out and was cancelled.", extra={"job_id": query_job.job_id})
+            break
+        time.sleep(poll_interval)
+
+    return results
+
+def run_query_and_save_results(query: str, destination_table_id: str, write_disposition: str, max_bytes_billed: int = None, query_parameters: list = None) -> dict:
+    """
+    指定されたクエリを実行し、結果を指定テーブルに保存するヘルパー関数。
+    実行前にドライランでスキャン量を見積もり、max_bytes_billed (analyzerごとの予算) を超える場合は
+    実行せずに QueryBudgetExceededError を送出する。実行後のジョブ統計を返す。
+    """
+    query_job = submit_query_and_save_results(query, destination_table_id, write_disposition, max_bytes_billed, query_parameters)
     query_job.result() # 完了を待つ
     
-    # 変更点: print() を logger.info() に置き換え、構造化された情報をextraで渡す
+    # 変更点: num_dml_affected_rows はSELECTでは意味がないため、実際のスキャン量・課金量・スロット時間を記録する
+    stats = _job_stats(query_job)
     logger.info(
         f"Query completed and results saved to {destination_table_id}.",
         extra={
-            "affected_rows": query_job.num_dml_affected_rows,
+            "destination_table": destination_table_id,
+            **stats
+        }
+    )
+    return stats
+
+def run_dml_query(query: str, query_parameters: list = None, max_bytes_billed: int = None) -> int:
+    """
+    MERGE / DELETE などのDMLクエリを実行し、影響を受けた行数を返すヘルパー関数
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_parameters or [],
+        maximum_bytes_billed=max_bytes_billed
+    )
+
+    query_job = bigquery_client.query(query, job_config=job_config)
+    query_job.result() # 完了を待つ
+
+    affected_rows = query_job.num_dml_affected_rows or 0
+    logger.info(
+        "DML query completed.",
+        extra={"affected_rows": affected_rows, **_job_stats(query_job)}
+    )
+    return affected_rows
+
+def fetch_query_rows(query: str, query_parameters: list = None, max_bytes_billed: int = None) -> list:
+    """
+    クエリを実行し、結果の行をdictのリストとして返すヘルパー関数 (小さな結果セット向け)
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_parameters or [],
+        maximum_bytes_billed=max_bytes_billed
+    )
+    query_job = bigquery_client.query(query, job_config=job_config)
+    rows = [dict(row.items()) for row in query_job.result()]
+    count("bq.bytes_billed", query_job.total_bytes_billed or 0)
+    return rows
+
+def load_rows_to_table(rows: list, destination_table_id: str, write_disposition: str):
+    """
+    行のリストをロードジョブでテーブルに書き込むヘルパー関数。
+    ストリーミング挿入と異なり、WRITE_TRUNCATE を指定して洗い替えができる。
+    """
+    dataset_id = os.getenv('BQ_DATASET_ID')
+    dest_table_ref = bigquery_client.dataset(dataset_id).table(destination_table_id)
+
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=write_disposition,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+    )
+    with span("bq_write"):
+        load_job = bigquery_client.load_table_from_json(rows, dest_table_ref, job_config=job_config)
+        load_job.result() # 完了を待つ
+    count("bq.rows_written", len(rows))
+    count("bq.bytes_written", getattr(load_job, "output_bytes", None) or 0)
+
+    logger.info(
+        f"Loaded {len(rows)} rows into {destination_table_id}.",
+        extra={
+            "output_rows": load_job.output_rows,
             "destination_table": destination_table_id
         }
-    )
\ No newline at end of file
+    )
+
+def copy_table(source_table_id: str, destination_table_id: str, write_disposition: str = "WRITE_TRUNCATE"):
+    """
+    同じデータセットのテーブルをコピージョブで複製するヘルパー関数 (スキャン・課金なし)。
+    WRITE_TRUNCATE の場合、宛先はコピーの完了時に一度に置き換わる (ステージングテーブルからの入れ替えに使う)
+    """
+    dataset_id = os.getenv('BQ_DATASET_ID')
+    dataset_ref = bigquery_client.dataset(dataset_id)
+    job_config = bigquery.CopyJobConfig(write_disposition=write_disposition)
+    with span("bq_write"):
+        copy_job = bigquery_client.copy_table(
+            dataset_ref.table(source_table_id), dataset_ref.table(destination_table_id), job_config=job_config
+        )
+        copy_job.result() # 完了を待つ
+    logger.info(
+        f"Copied {source_table_id} to {destination_table_id}.",
+        extra={"source_table": source_table_id, "destination_table": destination_table_id}
+    )
+
+def resolve_snapshot_timestamp(cloud_event, table_fqn: str, lookback_days: int = 7) -> str:
+    """
+    分析対象のスナップショット (assessment_timestamp) を決定するヘルパー関数。
+    トリガーメッセージに snapshot_id が指定されていればそれを使い、なければ
+    直近 lookback_days 日のパーティションから、書き込みが完了した最新の assessment_timestamp を取得する。
+    スナップショットが存在しない場合は None を返す。不正な snapshot_id は ValueError。
+    修正点: analyzer の実行時に assessor の書き込みがまだ続いている場合があるため、単純な最新のスナップショットは使わない。
+    実行台帳 (pipeline_runs) があれば、ディスパッチしたすべての assessor の呼び出しが終了したスナップショットのみを対象とする。
+    台帳がなければ、テーブルへのストリーミング挿入が続いている間は最新のスナップショットを除く。
+    """
+    snapshot_id = None
+    try:
+        message_data_str = base64.b64decode(cloud_event.data["message"]["data"]).decode("utf-8")
+        snapshot_id = json.loads(message_data_str).get("snapshot_id")
+    except (KeyError, TypeError, ValueError, AttributeError):
+        pass # Schedulerからの "{}" など、snapshot_id を含まないメッセージ
+
+    if snapshot_id:
+        # SQLに埋め込むため、タイムスタンプとして解釈できることを検証して正規化する
+        try:
+            snapshot_timestamp = datetime.datetime.fromisoformat(str(snapshot_id)).isoformat()
+        except ValueError:
+            raise ValueError(f"Invalid snapshot_id in trigger message: {snapshot_id}")
+        run_id = _snapshot_run_id(snapshot_timestamp) if current_invocation() is not None else None
+    elif os.getenv('PIPELINE_RUNS_TABLE_ID'):
+        snapshot_timestamp, run_id = _latest_completed_snapshot(table_fqn, lookback_days)
+    else:
+        snapshot_timestamp, run_id = _latest_settled_snapshot(table_fqn, lookback_days), None
+
+    # 変更点: 実行台帳 (pipeline_runs) で、analyzer の行を分析したスナップショットの assessor の行と結び付ける
+    set_attribute("assessment_timestamp", snapshot_timestamp)
+    # 修正点: Scheduler から起動した場合は、run_id もスナップショットを書き込んだ実行のものを引き継ぐ
+    adopt_run_id(run_id)
+    return snapshot_timestamp
+
+def _runs_table_fqn() -> str:
+    return f"`{os.getenv('BQ_PROJECT_ID')}.{os.getenv('BQ_DATASET_ID')}.{os.getenv('PIPELINE_RUNS_TABLE_ID')}`"
+
+def _latest_completed_snapshot(table_fqn: str, lookback_days: int) -> tuple:
+    """
+    table_fqn にあるスナップショットのうち、実行台帳で完了が確認できる最新のものを (assessment_timestamp, run_id) で返す。
+    完了の条件は、ディスパッチャーが正常に終了し、ディスパッチしたリソース (スコープ・リソース名ごと) と
+    実行ごとの assessor がすべて正常に終了していること (Pub/Sub の再試行で成功した呼び出しも数える)。
+    """
+    rows = fetch_query_rows(
+        f"""
+        WITH dispatched AS (
+          SELECT assessment_timestamp, run_id, resources_processed,
+                 IFNULL(CAST(JSON_VALUE(counters, '$.assessors_triggered') AS INT64), 0) AS assessors_triggered
+          FROM {_runs_table_fqn()}
+          WHERE stage = @dispatch_stage AND status = 'ok'
+            AND started_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(lookback_days)} DAY)
+        ),
+        finished AS (
+          SELECT assessment_timestamp,
+                 COUNT(DISTINCT IF(resource_name IS NULL, NULL, CONCAT(IFNULL(scope, ''), '|', resource_name))) AS resources,
+                 COUNT(DISTINCT IF(stage IN UNNEST(@run_level_stages), stage, NULL)) AS assessors
+          FROM {_runs_table_fqn()}
+          WHERE stage != @dispatch_stage AND status = 'ok'
+            AND started_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(lookback_days) + 1} DAY)
+          GROUP BY assessment_timestamp
+        )
+        SELECT d.assessment_timestamp AS snapshot, d.run_id
+        FROM dispatched AS d
+        LEFT JOIN finished AS f USING (assessment_timestamp)
+        WHERE IFNULL(f.resources, 0) >= IFNULL(d.resources_processed, 0)
+          AND IFNULL(f.assessors, 0) >= d.assessors_triggered
+          AND d.assessment_timestamp IN (
+            SELECT assessment_timestamp FROM {table_fqn}
+            WHERE assessment_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(lookback_days)} DAY)
+          )
+        ORDER BY d.assessment_timestamp DESC
+        LIMIT 1
+        """,
+        query_parameters=[
+            bigquery.ScalarQueryParameter("dispatch_stage", "STRING", DISPATCH_STAGE),
+            bigquery.ArrayQueryParameter("run_level_stages", "STRING", list(RUN_LEVEL_STAGES)),
+        ]
+    )
+    if not rows:
+        return None, None
+    return rows[0]["snapshot"].isoformat(), rows[0]["run_id"]
+
+def _latest_settled_snapshot(table_fqn: str, lookback_days: int) -> str:
+    """
+    実行台帳がない場合のスナップショット。テーブルにストリーミング挿入中の行がある (assessor の書き込みが続いている
+    可能性がある) 間は、最新のスナップショットを除いた最新のものを返す。
+    """
+    table = bigquery_client.get_table(table_fqn.strip("`"))
+    settled = table.streaming_buffer is None
+    rows = fetch_query_rows(
+        f"SELECT ARRAY_AGG(DISTINCT assessment_timestamp ORDER BY assessment_timestamp DESC LIMIT 2) AS snapshots FROM {table_fqn} "
+        f"WHERE assessment_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(lookback_days)} DAY)"
+    )
+    snapshots = (rows[0]["snapshots"] or []) if rows else []
+    if not settled:
+        snapshots = snapshots[1:]
+    return snapshots[0].isoformat() if snapshots else None
+
+def _snapshot_run_id(snapshot_timestamp: str) -> str:
+    """実行台帳 (pipeline_runs) から、スナップショットを書き込んだ実行の run_id を返す。台帳が未設定・記録がなければ None"""
+    runs_table_id = os.getenv('PIPELINE_RUNS_TABLE_ID')
+    if not runs_table_id:
+        return None
+    rows = fetch_query_rows(
+        f"SELECT run_id FROM {_runs_table_fqn()} "
+        # ディスパッチャーはスナップショットの時刻の直前に開始するため、開始日のパーティションを前日までに絞り込む
+        f"WHERE assessment_timestamp = TIMESTAMP(@snapshot_timestamp) "
+        f"AND started_at >= TIMESTAMP_SUB(TIMESTAMP(@snapshot_timestamp), INTERVAL 1 DAY) "
+        f"ORDER BY started_at LIMIT 1",
+        query_parameters=[bigquery.ScalarQueryParameter("snapshot_timestamp", "STRING", snapshot_timestamp)]
+    )
+    return rows[0]["run_id"] if rows else None
+
+def resolve_previous_snapshot_timestamp(table_fqn: str, snapshot_timestamp: str, lookback_days: int = 7) -> str:
+    """
+    snapshot_timestamp の直前のスナップショット (assessment_timestamp) を返す。
+    直近 lookback_days 日のパーティションのみを対象とし、存在しない場合は None を返す。
+    """
+    rows = fetch_query_rows(
+        f"SELECT MAX(assessment_timestamp) AS snapshot FROM {table_fqn} "
+        f"WHERE assessment_timestamp < TIMESTAMP(@snapshot_timestamp) "
+        f"AND assessment_timestamp >= TIMESTAMP_SUB(TIMESTAMP(@snapshot_timestamp), INTERVAL {int(lookback_days)} DAY)",
+        query_parameters=[bigquery.ScalarQueryParameter("snapshot_timestamp", "STRING", snapshot_timestamp)]
+    )
+    snapshot = rows[0]["snapshot"] if rows else None
+    return snapshot.isoformat() if snapshot else None
+
+def _table_fingerprint_part(table_id: str) -> dict:
+    """テーブルのメタデータ (更新時刻・行数・ストリーミングバッファ) を取得する。スキャンは発生しない"""
+    table = bigquery_client.get_table(table_id)
+    streaming_buffer = table.streaming_buffer
+    return {
+        "table": table_id,
+        "modified": table.modified.isoformat() if table.modified else None,
+        "num_rows": table.num_rows,
+        # ストリーミング挿入された行は modified に反映されない場合があるため、バッファの状態も含める
+        "streaming_rows": streaming_buffer.estimated_rows if streaming_buffer else None,
+    }
+
+def _cache_table_fqn(cache_table_id: str) -> str:
+    """キャッシュテーブルの完全修飾名。クライアントの既定のプロジェクトに依存しないよう、他のクエリと同じく BQ_PROJECT_ID で修飾する"""
+    return f"`{os.getenv('BQ_PROJECT_ID')}.{os.getenv('BQ_DATASET_ID')}.{cache_table_id}`"
+
+def fetch_analysis_fingerprint(cache_table_id: str, analyzer_name: str) -> str:
+    """キャッシュテーブルに記録した値 (フィンガープリントなど) を返す。記録がなければ None"""
+    rows = fetch_query_rows(
+        f"SELECT fingerprint FROM {_cache_table_fqn(cache_table_id)} WHERE analyzer_name = @analyzer_name",
+        query_parameters=[bigquery.ScalarQueryParameter("analyzer_name", "STRING", analyzer_name)]
+    )
+    return rows[0]["fingerprint"] if rows else None
+
+def lookup_analysis_cache(cache_table_id: str, analyzer_name: str, source_table_ids: list, *config) -> tuple:
+    """
+    ソーステーブルのメタデータと、クエリ文字列・設定値 (config) からフィンガープリントを計算し、
+    前回の実行時に記録したものと一致するかを確認する。(cache_hit, fingerprint) を返す。
+    cache_table_id が未設定の場合はキャッシュを使用しない (False, None)。
+    """
+    if not cache_table_id:
+        return False, None
+
+    parts = [json.dumps(_table_fingerprint_part(table_id), sort_keys=True) for table_id in source_table_ids]
+    parts.extend(str(value) for value in config)
+    fingerprint = hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    cache_hit = fetch_analysis_fingerprint(cache_table_id, analyzer_name) == fingerprint
+    logger.info(
+        f"Analysis cache {'hit' if cache_hit else 'miss'} for {analyzer_name}.",
+        extra={"analyzer_name": analyzer_name, "cache_hit": cache_hit, "fingerprint": fingerprint}
+    )
+    return cache_hit, fingerprint
+
+def record_analysis_fingerprint(cache_table_id: str, analyzer_name: str, fingerprint: str):
+    """分析が成功した後に、次回の比較用のフィンガープリントを記録する (analyzerごとに1行)"""
+    if not cache_table_id or not fingerprint:
+        return
+
+    run_dml_query(
+        f"""
+        MERGE {_cache_table_fqn(cache_table_id)} AS t
+        USING (SELECT @analyzer_name AS analyzer_name, @fingerprint AS fingerprint) AS s
+        ON t.analyzer_name = s.analyzer_name
+        WHEN MATCHED THEN
+            UPDATE SET fingerprint = s.fingerprint, updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (analyzer_name, fingerprint, updated_at) VALUES (s.analyzer_name, s.fingerprint, CURRENT_TIMESTAMP())
+        """,
+        query_parameters=[
+            bigquery.ScalarQueryParameter("analyzer_name", "STRING", analyzer_name),
+            bigquery.ScalarQueryParameter("fingerprint", "STRING", fingerprint),
+        ]
+    )
@@ -1,38 +1,107 @@
 # ./src/utils/gcp_clients.py
 # 共通して使用するGoogle Cloudクライアントのクラスを定義するモジュール
-
-from google.cloud import (
-    bigquery,
-    storage,
-    compute_v1,
-    asset_v1,
-    pubsub_v1,
-    identity_v1,
-    recommender_v1
-)
+import functools
+import importlib
+import threading
+from .instrumentation import current_invocation, count_api_call
 
 # --------------------------------------------------
-# 修正点1: クラスのエイリアス (動的初期化で使うため 'Class' 接尾辞)
+# 変更点: クライアントは最初に使われた時点で生成する (遅延初期化)
+# 以前はインポート時に7つのクライアントをすべて生成しており、各Functionは使わないクライアントの
+# google.cloud サブモジュールの読み込みと gRPC チャネルの作成をコールドスタートのたびに負担していた。
+# インポート名 (bigquery_client, BigQueryClientClass など) は変わらない。
 # --------------------------------------------------
-BigQueryClientClass = bigquery.Client
-StorageClientClass = storage.Client
-ComputeInstancesClientClass = compute_v1.InstancesClient
-AssetServiceClientClass = asset_v1.AssetServiceClient
-PublisherClientClass = pubsub_v1.PublisherClient
-IdentityGroupsServiceClientClass = identity_v1.GroupsServiceClient
-RecommenderClientClass = recommender_v1.RecommenderClient
+
+# クラスのエイリアス名 -> (モジュール, クラス名)。モジュールはエイリアスが最初に参照されたときに読み込む
+_CLIENT_CLASSES = {
+    "BigQueryClientClass": ("google.cloud.bigquery", "Client"),
+    "StorageClientClass": ("google.cloud.storage", "Client"),
+    "ComputeInstancesClientClass": ("google.cloud.compute_v1", "InstancesClient"),
+    "AssetServiceClientClass": ("google.cloud.asset_v1", "AssetServiceClient"),
+    "PublisherClientClass": ("google.cloud.pubsub_v1", "PublisherClient"),
+    "IdentityGroupsServiceClientClass": ("google.cloud.identity_v1", "GroupsServiceClient"),
+    "RecommenderClientClass": ("google.cloud.recommender_v1", "RecommenderClient"),
+}
+
+
+# ローカルで完結する (APIを呼び出さない) メソッド。計測の API 呼び出し数には含めない
+_LOCAL_METHODS = frozenset({"dataset", "table", "bucket", "blob", "topic_path"})
+
+
+def _client_class(class_name: str):
+    module_name, attribute = _CLIENT_CLASSES[class_name]
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def __getattr__(name):
+    """クラスのエイリアス (例: bq_assessor で動的初期化に使う BigQueryClientClass) を参照時に解決する"""
+    if name in _CLIENT_CLASSES:
+        client_class = _client_class(name)
+        globals()[name] = client_class
+        return client_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazyClient:
+    """
+    クライアントの代理オブジェクト。属性に最初にアクセスした時点でクライアントを1つだけ生成し、以降はそれに委譲する。
+    overpermission-analyzer などスレッドから同時に使われる場合も、生成はロックで1回に限られる。
+    """
+
+    def __init__(self, class_name: str, api_name: str):
+        self._class_name = class_name
+        self._api_name = api_name
+        self._client = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        """クライアントの実体を返す (未生成なら生成する)"""
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = _client_class(self._class_name)()
+                client = self._client
+        return client
+
+    @property
+    def initialized(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, name):
+        # __init__ 前 (コピー・pickle など) に自身の属性を探した場合に resolve() で無限再帰しないようにする
+        if name in ("_class_name", "_api_name", "_client", "_lock"):
+            raise AttributeError(name)
+        attribute = getattr(self.resolve(), name)
+        # 変更点: 計測中は、メソッドの呼び出しをクライアント・メソッドごとの API 呼び出し数として数える
+        if current_invocation() is not None and callable(attribute) and name not in _LOCAL_METHODS:
+            return _counted_call(self._api_name, name, attribute)
+        return attribute
+
+    def __repr__(self):
+        state = "initialized" if self.initialized else "not initialized"
+        return f"<LazyClient {self._class_name} ({state})>"
+
+
+def _counted_call(api_name: str, method_name: str, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        count_api_call(api_name, method_name)
+        return method(*args, **kwargs)
+    return wrapper
+
 
 # --------------------------------------------------
 # 修正点2: グローバルインスタンス (シングルトンとして使用)
-# Cloud Functionsのベストプラクティスに基づき、ここで一元的に初期化
+# 変更点: 実体は各Functionが最初に使ったときに生成される
 # --------------------------------------------------
-bigquery_client = BigQueryClientClass()
-storage_client = StorageClientClass()
-compute_client = ComputeInstancesClientClass()
-asset_client = AssetServiceClientClass()
-publisher_client = PublisherClientClass()
-identity_client = IdentityGroupsServiceClientClass()
-recommender_client = RecommenderClientClass()
+bigquery_client = LazyClient("BigQueryClientClass", "bigquery")
+storage_client = LazyClient("StorageClientClass", "storage")
+compute_client = LazyClient("ComputeInstancesClientClass", "compute")
+asset_client = LazyClient("AssetServiceClientClass", "asset")
+publisher_client = LazyClient("PublisherClientClass", "pubsub")
+identity_client = LazyClient("IdentityGroupsServiceClientClass", "identity")
+recommender_client = LazyClient("RecommenderClientClass", "recommender")
 
 
 # --------------------------------------------------
@@ -55,4 +124,4 @@ __all__ = [
     "publisher_client",
     "identity_client",
     "recommender_client",
-]
\ No newline at end of file
+]
@@ -0,0 +1,146 @@
+from collections import defaultdict, deque
+from typing import Dict, Iterator, List, Tuple
+
+
+def _nested_groups(edges_by_group: Dict[str, List[Tuple[str, str]]], group_email: str) -> Iterator[str]:
+    """グループの直接のメンバーのうち、メンバーシップを持つ (展開できる) グループ"""
+    for member_email, member_type in edges_by_group.get(group_email, ()):
+        if member_type == "GROUP" and member_email in edges_by_group:
+            yield member_email
+
+
+def _strongly_connected_components(edges_by_group: Dict[str, List[Tuple[str, str]]]) -> List[List[str]]:
+    """
+    ネストの有向グラフの強連結成分を、逆トポロジカル順 (ネストの内側の成分が先) で返す。
+    深いネストで再帰の上限に達しないよう、Tarjan のアルゴリズムを反復で実装する。
+    """
+    index, lowlink, on_stack = {}, {}, set()
+    stack, components = [], []
+    for start in edges_by_group:
+        if start in index:
+            continue
+        work = [(start, iter(_nested_groups(edges_by_group, start)))]
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(_nested_groups(edges_by_group, child))))
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+def _closure_of(root: str, component: set, edges_by_group: Dict[str, List[Tuple[str, str]]], closures: dict) -> list:
+    """
+    root の実効メンバーを深さごとに返す。深さ d のメンバーは levels[d - 1] に、同じ経路のメンバーをまとめた
+    [(path, [(member_email, member_type), ...]), ...] の形で入る (path はグループのリストで、メンバー間で共有する)。
+    同じ強連結成分内のグループはBFSで辿り、成分の外のネストしたグループは計算済みの実効メンバー (closures) を再利用する。
+
+    採用する経路と各深さ内の並び順は、グループごとのBFSと同じ (最短で、経路上のメンバーの位置の列が辞書順で最初のもの)。
+    """
+    # 1. 成分内のグループへの最短経路 (root は訪問済みとして再展開しない)。position は直接メンバーのリスト内の添字
+    reached = {root: (0, (), [root])}
+    queue = deque([root])
+    while queue:
+        group_email = queue.popleft()
+        depth, key, path = reached[group_email]
+        for position, (member_email, member_type) in enumerate(edges_by_group.get(group_email, ())):
+            if member_type == "GROUP" and member_email in component and member_email not in reached:
+                reached[member_email] = (depth + 1, key + (position,), path + [member_email])
+                queue.append(member_email)
+
+    # 2. 成分内の各グループの直接メンバーを、経路の辞書順に並べる (成分が root のみの場合は直接メンバーの並び順)
+    prefixes = [
+        (key + (position,), depth, path, member_email, member_type)
+        for depth, key, path in reached.values()
+        for position, (member_email, member_type) in enumerate(edges_by_group.get(path[-1], ()))
+    ]
+    if len(reached) > 1:
+        prefixes.sort(key=lambda prefix: prefix[0])
+
+    # 3. 直接メンバーと、成分の外のネストしたグループの実効メンバーを、深さごとに経路の辞書順で並べる
+    #    (path, ネストしたグループ内の経路 (直接メンバーは None), メンバーのリスト)
+    sources_by_depth = defaultdict(list)
+    for _, depth, path, member_email, member_type in prefixes:
+        sources = sources_by_depth[depth + 1]
+        if sources and sources[-1][0] is path and sources[-1][1] is None:
+            sources[-1][2].append((member_email, member_type))
+        else:
+            sources.append((path, None, [(member_email, member_type)]))
+        if member_type == "GROUP" and member_email not in component:
+            for nested_depth, nested_level in enumerate(closures.get(member_email, ()), start=depth + 2):
+                sources_by_depth[nested_depth].extend((path, nested_path, members) for nested_path, members in nested_level)
+
+    # 4. 浅い順に、最初に現れた経路を採用する
+    #    ネストしたグループのメンバーのまとまりは、経路の末尾のグループの直接メンバーの一部で、その残りは同じネストしたグループの
+    #    より前のまとまりにある。末尾のグループのまとまりを一度取り込めば、以降の同じグループのまとまりはすべて取り込み済みになる
+    seen = set()
+    expanded_groups = set()
+    levels = []
+    for depth in range(1, max(sources_by_depth, default=0) + 1):
+        level = []
+        for path, nested_path, members in sources_by_depth.get(depth, ()):
+            if nested_path is not None:
+                if nested_path[-1] in expanded_groups:
+                    continue
+                expanded_groups.add(nested_path[-1])
+            if nested_path is None:
+                # 直接メンバーのリストには重複がありうる
+                new_members = list(dict.fromkeys(member for member in members if member not in seen))
+            else:
+                new_members = [member for member in members if member not in seen]
+            if new_members:
+                seen.update(new_members)
+                level.append((path if nested_path is None else path + nested_path, new_members))
+        levels.append(level)
+    return levels
+
+
+def compute_transitive_closure(edges_by_group: Dict[str, List[Tuple[str, str]]]) -> Iterator[dict]:
+    """
+    グループの直接メンバーシップ {group_email: [(member_email, member_type), ...]} から、
+    各グループの実効メンバー (ネストを全て展開したもの) を計算する。
+
+    各メンバーには最短の深さ (depth) と、そこに至るグループの経路 (path) が1つ記録される (グループごとのBFSと同じ結果)。
+    循環参照は訪問済みセットで打ち切る。
+    変更点: グループごとに独立してBFSを行うと、共有されたサブグループを根の数だけ辿り直す。
+    強連結成分を内側から順に処理し、サブグループの実効メンバーを再利用する。
+    """
+    closures = {}
+    for component in _strongly_connected_components(edges_by_group):
+        members = set(component)
+        for group_email in component:
+            closures[group_email] = _closure_of(group_email, members, edges_by_group, closures)
+
+    for root in edges_by_group:
+        for depth, level in enumerate(closures[root], start=1):
+            for path, members in level:
+                for member_email, member_type in members:
+                    yield {
+                        "group_email": root,
+                        "member_email": member_email,
+                        "member_type": member_type,
+                        "depth": depth,
+                        "path": path,
+                    }
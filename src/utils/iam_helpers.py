@@ -1,12 +1,71 @@
-from typing import Iterator, Set
+from typing import Iterator, List, Set, Tuple
+from .instrumentation import count
+from .rate_limiter import call_api, is_quota_error
 # 変更点: identity_clientのインポートを削除
 
+# 変更点: グループの直接のメンバーのキャッシュ (オプション)。{グループのメールアドレス: [(メンバー, メンバータイプ), ...]} の辞書。
+# バッチ実行 (tools/batch_runner.py) ではプロセス間で共有する辞書 (multiprocessing.Manager().dict()) を設定し、
+# 同じグループを何度も Identity API で展開しないようにする。Cloud Functions では設定しない (毎回 API から取得する)
+_membership_cache = None
+
+
+def set_membership_cache(cache):
+    """グループのメンバーのキャッシュを設定する (None で無効化)"""
+    global _membership_cache
+    _membership_cache = cache
+
+
+def _group_members(identity_client, group_email: str) -> List[Tuple[str, str]]:
+    """グループの直接のメンバーを [(メールアドレス, メンバータイプ), ...] で返す (種類が不明なメンバーは除く)"""
+    cache = _membership_cache
+    if cache is not None:
+        cached = cache.get(group_email)
+        if cached is not None:
+            count("cache.group_members.hit")
+            return cached
+
+    # 1. グループID (メールアドレス) からグループの `name` (例: groups/123xyz) を取得
+    group_name = call_api("identity", identity_client.lookup_group_name, group_key={'id': group_email}).name
+
+    # 修正点: `get_membership` が不要になるよう `view=1` (FULL) を指定
+    # 修正点: `parent` の指定方法を `parent=group_name` に修正
+    # 変更点: 2ページ目以降の取得も再試行の対象にするため、呼び出しの中で全ページを読み切る
+    memberships = call_api("identity", lambda: list(identity_client.list_memberships(parent=group_name, view=1)))
+
+    members = []
+    for membership in memberships:
+        # `view=1` のおかげで、`membership` に全情報が含まれる
+        member_email = membership.preferred_member_key.id
+
+        # 修正点: `membership.type_` を使って次のメンバータイプを判別
+        if membership.type_ == 2: # 2 = GROUP
+            members.append((member_email, "GROUP"))
+        elif membership.type_ == 1: # 1 = USER
+            if ".gserviceaccount.com" in member_email:
+                members.append((member_email, "SERVICE_ACCOUNT"))
+            else:
+                members.append((member_email, "USER"))
+        # 不明なタイプはスキップ
+
+    if cache is not None:
+        count("cache.group_members.miss")
+        cache[group_email] = members
+    return members
+
+
 def expand_member(
-    identity_client, member_type: str, member_id: str, visited_groups: Set[str]
+    identity_client, member_type: str, member_id: str, visited_groups: Set[str], touched_groups: Set[str] = None
 ) -> Iterator[str]:
-    """メンバーがグループの場合、再帰的に展開する"""
-    
+    """
+    メンバーがグループの場合、再帰的に展開する
+    変更点: touched_groups を渡すと、展開したグループ (ネストしたグループを含む) を記録する (ポリシーキャッシュの検証用)
+    変更点: Identity API の呼び出しは共通のレート制限・再試行を通す。再試行してもクォータ超過が続く場合は
+    UNEXPANDED として記録せずに例外を送出する (呼び出しを失敗させ、Pub/Sub の再配信で評価し直す)
+    """
+
     if member_type == "GROUP":
+        if touched_groups is not None:
+            touched_groups.add(member_id)
         # 修正点: 循環参照チェックをグループIDに対してのみ行う
         if member_id in visited_groups:
             return
@@ -14,35 +73,20 @@ def expand_member(
         visited_groups.add(member_id)
 
         try:
-            # 1. グループID (メールアドレス) からグループの `name` (例: groups/123xyz) を取得
-            group_name = identity_client.lookup_group_name(group_key={'id': member_id}).name
-            
-            # 修正点: `get_membership` が不要になるよう `view=1` (FULL) を指定
-            # 修正点: `parent` の指定方法を `parent=group_name` に修正
-            memberships = identity_client.list_memberships(parent=group_name, view=1)
-            
-            for membership in memberships:
-                # `view=1` のおかげで、`membership` に全情報が含まれる
-                member_email = membership.preferred_member_key.id
-                
-                # 修正点: `membership.type_` を使って次のメンバータイプを判別
-                if membership.type_ == 2: # 2 = GROUP
-                    next_member_type = "GROUP"
-                elif membership.type_ == 1: # 1 = USER
-                    if ".gserviceaccount.com" in member_email:
-                        next_member_type = "SERVICE_ACCOUNT"
-                    else:
-                        next_member_type = "USER"
-                else:
-                    continue # 不明なタイプはスキップ
+            members = _group_members(identity_client, member_id)
+            count("groups_expanded")
 
+            for member_email, next_member_type in members:
                 # 変更点: identity_clientを再帰呼び出しに渡す
                 yield from expand_member(
-                    identity_client, next_member_type, member_email, visited_groups.copy()
+                    identity_client, next_member_type, member_email, visited_groups.copy(), touched_groups
                 )
-        except Exception:
+        except Exception as e:
+            if is_quota_error(e):
+                raise
             # グループ展開に失敗した場合 (例: 権限不足)
+            count("groups_unexpanded")
             yield f"{member_type} (UNEXPANDED):{member_id}"
     else:
         # メンバータイプが GROUP 以外 (USER, SERVICE_ACCOUNT, SPECIAL_GROUP) の場合
-        yield f"{member_type}:{member_id}"
\ No newline at end of file
+        yield f"{member_type}:{member_id}"
@@ -0,0 +1,212 @@
+# ./src/utils/instrumentation.py
+# 関数の呼び出しごとの計測 (区間ごとの所要時間とカウンタ)。呼び出しの終了時に1件の構造化ログとして出力する
+import datetime
+import functools
+import os
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from .run_ledger import new_run_id, run_id_from_event, stage_row, append_stage
+
+# INSTRUMENTATION_ENABLED=false の場合、エントリポイントはラップされず、span() / count() は何もしない
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# OpenTelemetry のメトリクスとしても送信する (opentelemetry-api と、エクスポーターの設定が必要)
+OTEL_METRICS_ENABLED = os.getenv('OTEL_METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+_NOOP_SPAN = nullcontext()
+# 実行中の呼び出し。Cloud Functions のインスタンスは同時に1件の呼び出しのみを処理するため、
+# ContextVar ではなくモジュール変数で保持する (ThreadPoolExecutor のスレッドからも同じ呼び出しに集計される)
+_current = None
+
+
+class Invocation:
+    """1回の呼び出しで集計した区間 (span) とカウンタ"""
+
+    def __init__(self, function_name: str, run_id: str = None):
+        self.function_name = function_name
+        self.invocation_id = uuid.uuid4().hex
+        # 変更点: パイプラインの実行 ID (トリガーのメッセージから引き継ぐ。なければ新しく採番する)
+        self.run_id = run_id or new_run_id()
+        self.run_id_inherited = bool(run_id)
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.started = time.perf_counter()
+        self.spans = {} # name -> [回数, 合計秒数, 最大秒数]
+        self.counters = {}
+        self.attributes = {} # 実行台帳に記録する scope / resource_name / assessment_timestamp
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [1, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = max(span[2], seconds)
+
+    def add(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, status: str) -> dict:
+        return {
+            "function": self.function_name,
+            "invocation_id": self.invocation_id,
+            "run_id": self.run_id,
+            "status": status,
+            "duration_seconds": round(time.perf_counter() - self.started, 4),
+            "spans": {
+                name: {"count": count, "total_seconds": round(total, 4), "max_seconds": round(longest, 4)}
+                for name, (count, total, longest) in sorted(self.spans.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+class _Span:
+    __slots__ = ("invocation", "name", "started")
+
+    def __init__(self, invocation: Invocation, name: str):
+        self.invocation = invocation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.invocation.add_span(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def current_invocation():
+    """実行中の呼び出し (計測が無効、または呼び出しの外では None)"""
+    return _current
+
+
+def current_run_id():
+    """実行中の呼び出しの run_id (計測が無効、または呼び出しの外では None)"""
+    invocation = _current
+    return invocation.run_id if invocation is not None else None
+
+
+def adopt_run_id(run_id: str):
+    """
+    トリガーのメッセージに run_id がなく採番した呼び出し (Scheduler から起動した analyzer など) の run_id を、
+    分析するスナップショットを書き込んだ実行の run_id に置き換える。メッセージから引き継いだ run_id はそのまま
+    """
+    invocation = _current
+    if invocation is not None and run_id and not invocation.run_id_inherited:
+        invocation.run_id = run_id
+        invocation.run_id_inherited = True
+
+
+def set_attribute(name: str, value):
+    """実行台帳の行に記録する属性を設定する (例: set_attribute("scope", scope))"""
+    invocation = _current
+    if invocation is not None:
+        invocation.attributes[name] = value
+
+
+def span(name: str):
+    """with span("policy_fetch"): のように区間の所要時間を計測する。計測が無効なら何もしない"""
+    invocation = _current
+    if invocation is None:
+        return _NOOP_SPAN
+    return _Span(invocation, name)
+
+
+def count(name: str, value=1):
+    """カウンタに value を加算する (例: count("rows_built", len(rows)))"""
+    invocation = _current
+    if invocation is not None:
+        invocation.add(name, value)
+
+
+def count_api_call(client: str, method: str):
+    count(f"api_calls.{client}.{method}")
+
+
+# 変更点: 呼び出しの終了時 (サマリーの出力後) に実行する処理。QUEUE モードのロガーがログの書き切りを登録する
+_flush_hooks = []
+
+
+def register_flush_hook(hook):
+    """呼び出しの終了前に実行する処理を登録する (計測が無効でも実行される)"""
+    if hook not in _flush_hooks:
+        _flush_hooks.append(hook)
+
+
+def _run_flush_hooks():
+    for hook in _flush_hooks:
+        hook()
+
+
+_otel_instruments = {}
+
+
+def _export_otel(summary: dict, logger):
+    try:
+        from opentelemetry import metrics
+    except ImportError:
+        logger.warning("OTEL_METRICS_ENABLED is set but opentelemetry-api is not installed. Skipping metric export.")
+        return
+    meter = metrics.get_meter("iam_assessor")
+    attributes = {"function": summary["function"], "status": summary["status"]}
+
+    def instrument(kind: str, name: str):
+        key = (kind, name)
+        if key not in _otel_instruments:
+            create = meter.create_histogram if kind == "histogram" else meter.create_counter
+            _otel_instruments[key] = create(name)
+        return _otel_instruments[key]
+
+    instrument("histogram", "invocation.duration_seconds").record(summary["duration_seconds"], attributes)
+    for name, span_summary in summary["spans"].items():
+        instrument("histogram", f"span.{name}.seconds").record(span_summary["total_seconds"], attributes)
+    for name, value in summary["counters"].items():
+        instrument("counter", name).add(value, attributes)
+
+
+def instrument_invocation(logger):
+    """
+    エントリポイントのデコレータ。呼び出しの間の span() / count() を集計し、終了時 (例外時も含む) に
+    "Invocation summary" のログを1件出力する。計測が無効な場合は関数をそのまま返す。
+    変更点: 同じサマリーを実行台帳 (pipeline_runs) にも1行追記する。run_id は CloudEvent のメッセージから引き継ぐ
+    変更点: 最後に register_flush_hook() で登録された処理 (キューに入ったログの書き切り) を実行してから戻る
+    """
+    def decorator(func):
+        if not INSTRUMENTATION_ENABLED:
+            if not _flush_hooks:
+                return func
+
+            @functools.wraps(func)
+            def flushing_wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _run_flush_hooks()
+            return flushing_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _current
+            invocation = Invocation(func.__name__, run_id_from_event(args[0]) if args else None)
+            previous, _current = _current, invocation
+            status = "error"
+            try:
+                result = func(*args, **kwargs)
+                status = "ok"
+                return result
+            finally:
+                _current = previous
+                summary = invocation.summary(status)
+                logger.info(f"Invocation summary for {func.__name__}", extra={"invocation_summary": summary})
+                if OTEL_METRICS_ENABLED:
+                    _export_otel(summary, logger)
+                append_stage(stage_row(summary, invocation.attributes, invocation.started_at), logger)
+                _run_flush_hooks()
+        return wrapper
+    return decorator
@@ -1,19 +1,196 @@
-import logging
+import os
 import sys
+import json
+import copy
+import queue
+import random
+import atexit
+import logging
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
+from .instrumentation import current_invocation, register_flush_hook
+
+# --------------------------------------------------
+# 変更点: ログの出力モード
+# SYNC  (既定): 各ロガーの StreamHandler が、ログを呼び出したスレッドで JSON に整形して stdout に書き込む
+# QUEUE: ロガーはレコードをキューに入れるだけで、整形と書き込みはバックグラウンドのスレッド (QueueListener) が行う。
+#        INFO 以下のログのサンプリング・レート制限と、同じ警告の集約を行い、関数の終了前に必ずキューを書き切る
+# --------------------------------------------------
+LOG_MODE = os.getenv('LOG_MODE', 'SYNC').upper()
+# メッセージ種別 -> 出力する割合 (0〜1)。種別は extra の log_type、"ロガー名:行番号"、ロガー名の順に照合する
+# 例: {"main:102": 0.1, "utils.policy_cache": 0.5}
+LOG_SAMPLE_RATES = json.loads(os.getenv('LOG_SAMPLE_RATES', '{}'))
+# メッセージ種別ごとの INFO 以下のログの1秒あたりの上限 (0 は無制限)
+LOG_INFO_RATE_LIMIT = int(os.getenv('LOG_INFO_RATE_LIMIT', '0'))
+
+_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+
+class InvocationFilter(logging.Filter):
+    """変更点: 計測中の呼び出しの ID をログに付与し、同じ呼び出しのログと計測のサマリーを結び付ける"""
+
+    def filter(self, record):
+        invocation = current_invocation()
+        if invocation is not None:
+            record.invocation_id = invocation.invocation_id
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    QUEUE モードでキューに入れる前に適用するフィルタ。
+    - INFO 以下: メッセージ種別ごとにサンプリング (LOG_SAMPLE_RATES) とレート制限 (LOG_INFO_RATE_LIMIT) を行う
+    - WARNING: 同じ種別の警告は最初の1件のみ出力し、残りは件数を数えて drain() でまとめて報告する
+    - ERROR 以上と、呼び出しのサマリー (invocation_summary) は常に出力する
+    """
+
+    def __init__(self, sample_rates: dict = None, rate_limit: int = 0, rng: random.Random = None):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate_limit = rate_limit
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._windows = {} # 種別 -> [秒, その秒の件数]
+        self._warnings = {} # 種別 -> [件数, 最初のメッセージ]
+        self._dropped = {} # 種別 -> サンプリング・レート制限で出力しなかった件数
+
+    @staticmethod
+    def message_type(record) -> str:
+        return getattr(record, "log_type", None) or f"{record.name}:{record.lineno}"
+
+    def _sample_rate(self, record, key: str) -> float:
+        for candidate in (key, record.name):
+            if candidate in self.sample_rates:
+                return float(self.sample_rates[candidate])
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR or hasattr(record, "invocation_summary"):
+            return True
+        key = self.message_type(record)
+        with self._lock:
+            if record.levelno >= logging.WARNING:
+                seen = self._warnings.get(key)
+                if seen is None:
+                    self._warnings[key] = [1, record.getMessage()]
+                    return True
+                seen[0] += 1
+                return False
+
+            rate = self._sample_rate(record, key)
+            if rate < 1.0 and self._rng.random() >= rate:
+                self._dropped[key] = self._dropped.get(key, 0) + 1
+                return False
+            if self.rate_limit:
+                second = int(time.monotonic())
+                window = self._windows.get(key)
+                if window is None or window[0] != second:
+                    window = self._windows[key] = [second, 0]
+                if window[1] >= self.rate_limit:
+                    self._dropped[key] = self._dropped.get(key, 0) + 1
+                    return False
+                window[1] += 1
+            return True
+
+    def drain(self) -> tuple:
+        """集約した警告 {種別: (抑制した件数, 最初のメッセージ)} と、出力しなかった INFO の件数 {種別: 件数} を返し、状態をリセットする"""
+        with self._lock:
+            repeated = {key: (n - 1, message) for key, (n, message) in self._warnings.items() if n > 1}
+            dropped = self._dropped
+            self._warnings, self._dropped, self._windows = {}, {}, {}
+        return repeated, dropped
+
+
+class _PreparedQueueHandler(QueueHandler):
+    """
+    キューに入れる前にメッセージだけを確定する (JSON への整形はリスナーのスレッドで行う)。
+    標準の prepare() は例外のトレースバックをメッセージに連結するため、exc_text として残して JsonFormatter に渡す
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_queue_handler = None
+_listener = None
+_sampling_filter = None
+_queue_lock = threading.Lock()
+
+
+def _stdout_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(jsonlogger.JsonFormatter(_FORMAT))
+    return handler
+
+
+def _shared_queue_handler() -> logging.Handler:
+    """QUEUE モードで全ロガーが共有する QueueHandler (初回にリスナーのスレッドを開始する)"""
+    global _queue_handler, _listener, _sampling_filter
+    with _queue_lock:
+        if _queue_handler is None:
+            log_queue = queue.Queue()
+            _sampling_filter = SamplingFilter(LOG_SAMPLE_RATES, LOG_INFO_RATE_LIMIT)
+            handler = _PreparedQueueHandler(log_queue)
+            # 呼び出しの ID は、ログを出したスレッドで付与する
+            handler.addFilter(InvocationFilter())
+            handler.addFilter(_sampling_filter)
+            _listener = QueueListener(log_queue, _stdout_handler(), respect_handler_level=True)
+            _listener.start()
+            _queue_handler = handler
+            register_flush_hook(flush_logs)
+            atexit.register(_stop_listener)
+    return _queue_handler
+
+
+def _stop_listener():
+    # 停止済み (スレッドが None) のリスナーの stop() は Python 3.11 では例外になる
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _enqueue_summary(level: int, message: str, extra: dict):
+    # フィルタを通さずにキューに入れる (集約の報告自体が集約・サンプリングされないように)
+    logger = logging.getLogger(__name__)
+    record = logger.makeRecord(logger.name, level, __file__, 0, message, None, None, extra=extra)
+    _queue_handler.enqueue(_queue_handler.prepare(record))
+
+
+def flush_logs():
+    """
+    QUEUE モードで、集約した警告と間引いたログの件数を出力し、キューに入ったログがすべて書き込まれるまで待つ。
+    Cloud Functions は応答後に CPU が割り当てられないため、instrument_invocation が関数の終了前に呼び出す
+    """
+    if _queue_handler is None:
+        return
+    repeated, dropped = _sampling_filter.drain()
+    for key, (suppressed, message) in repeated.items():
+        _enqueue_summary(logging.WARNING, f"Repeated warning suppressed {suppressed} times: {message}",
+                         {"log_type": key, "suppressed": suppressed})
+    if dropped:
+        _enqueue_summary(logging.INFO, f"Sampled out {sum(dropped.values())} log records.", {"sampled_out": dropped})
+    _listener.queue.join()
+
 
 def get_logger(name: str):
     """構造化JSONロガーを取得する"""
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
-    
+
     # 既にハンドラが設定されている場合は追加しない (Functionの再利用対策)
     if not logger.handlers:
-        handler = logging.StreamHandler(sys.stdout)
-        formatter = jsonlogger.JsonFormatter(
-            '%(asctime)s %(name)s %(levelname)s %(message)s'
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        
+        if LOG_MODE == 'QUEUE':
+            logger.addHandler(_shared_queue_handler())
+        else:
+            handler = _stdout_handler()
+            handler.addFilter(InvocationFilter())
+            logger.addHandler(handler)
+
     return logger
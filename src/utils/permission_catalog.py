@@ -0,0 +1,169 @@
+# ./src/utils/permission_catalog.py
+# ロール → 権限のカタログ。権限ベースのリスク分析・SoD評価で使用する
+import fnmatch
+import json
+from typing import Dict, Iterable, Iterator, List
+
+
+def _bit_indexes(mask: int) -> Iterator[int]:
+    """ビットセット (int) で立っているビットの位置を小さい順に返す"""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+class PermissionCatalog:
+    """
+    ロール定義 (ロール名 → 含まれる権限) を保持し、双方向の索引を提供する。
+
+    ロール名・権限名はそれぞれ連番のIDにインターンし、
+    - 正引き: ロールID → 権限IDのビットセット
+    - 逆引き: 権限ID → ロールIDのビットセット
+    を持つ。ロールが特定の権限を含むか、ある権限を含むロールはどれか、といった問い合わせは
+    ロール定義を走査せずに辞書参照とビット演算で答えられる。
+    """
+
+    def __init__(self):
+        self.roles: List[str] = []
+        self.permissions: List[str] = []
+        self.role_sources: Dict[str, str] = {}
+        self._role_ids: Dict[str, int] = {}
+        self._permission_ids: Dict[str, int] = {}
+        self._role_permission_bits: List[int] = []
+        self._permission_role_bits: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def __contains__(self, role: str) -> bool:
+        return role in self._role_ids
+
+    def _intern_permission(self, permission: str) -> int:
+        permission_id = self._permission_ids.get(permission)
+        if permission_id is None:
+            permission_id = len(self.permissions)
+            self._permission_ids[permission] = permission_id
+            self.permissions.append(permission)
+            self._permission_role_bits.append(0)
+        return permission_id
+
+    def add_role(self, role: str, permissions: Iterable[str], source: str = None):
+        """ロール定義を追加する。同じロールが再度追加された場合は権限を追記する"""
+        role_id = self._role_ids.get(role)
+        if role_id is None:
+            role_id = len(self.roles)
+            self._role_ids[role] = role_id
+            self.roles.append(role)
+            self._role_permission_bits.append(0)
+        self.role_sources[role] = source or ("PREDEFINED" if role.startswith("roles/") else "CUSTOM")
+
+        role_bit = 1 << role_id
+        mask = self._role_permission_bits[role_id]
+        for permission in permissions:
+            permission_id = self._intern_permission(permission)
+            mask |= 1 << permission_id
+            self._permission_role_bits[permission_id] |= role_bit
+        self._role_permission_bits[role_id] = mask
+
+    def permission_mask(self, permissions: Iterable[str]) -> int:
+        """権限名のリストをビットセットに変換する (カタログにない権限は無視)"""
+        mask = 0
+        for permission in permissions:
+            permission_id = self._permission_ids.get(permission)
+            if permission_id is not None:
+                mask |= 1 << permission_id
+        return mask
+
+    def permissions_of(self, role: str) -> List[str]:
+        """ロールに含まれる権限 (カタログにないロールは空)"""
+        role_id = self._role_ids.get(role)
+        if role_id is None:
+            return []
+        return [self.permissions[i] for i in _bit_indexes(self._role_permission_bits[role_id])]
+
+    def role_has_any_permission(self, role: str, permission_mask: int) -> bool:
+        """ロールが permission_mask (permission_mask() の結果) のいずれかの権限を含むか"""
+        role_id = self._role_ids.get(role)
+        return role_id is not None and bool(self._role_permission_bits[role_id] & permission_mask)
+
+    def roles_with_permission(self, permission: str) -> List[str]:
+        """権限を含むロールの一覧 (逆引き)"""
+        permission_id = self._permission_ids.get(permission)
+        if permission_id is None:
+            return []
+        return [self.roles[i] for i in _bit_indexes(self._permission_role_bits[permission_id])]
+
+    def roles_with_any_permission(self, permissions: Iterable[str]) -> List[str]:
+        """
+        いずれかの権限を含むロールの一覧。権限にはワイルドカード (例: *.setIamPolicy) も指定できる。
+        ワイルドカードはロール定義ではなく権限の語彙に対して評価する。
+        """
+        mask = 0
+        for permission in permissions:
+            if "*" in permission or "?" in permission:
+                for matched in fnmatch.filter(self.permissions, permission):
+                    mask |= self._permission_role_bits[self._permission_ids[matched]]
+            else:
+                permission_id = self._permission_ids.get(permission)
+                if permission_id is not None:
+                    mask |= self._permission_role_bits[permission_id]
+        return [self.roles[i] for i in _bit_indexes(mask)]
+
+    def rows(self, assessment_timestamp: str = None) -> Iterator[dict]:
+        """role_permissions テーブルに書き込む行 (1行 = ロールと権限の組) を返す"""
+        for role_id, role in enumerate(self.roles):
+            for permission_id in _bit_indexes(self._role_permission_bits[role_id]):
+                yield {
+                    "assessment_timestamp": assessment_timestamp,
+                    "role": role,
+                    "role_source": self.role_sources[role],
+                    "permission": self.permissions[permission_id],
+                }
+
+    @classmethod
+    def from_role_definitions(cls, definitions) -> "PermissionCatalog":
+        """
+        ロール定義からカタログを作成する。以下のいずれかの形式を受け付ける。
+        - IAM API (roles.get / roles.list の FULL ビュー) のロールのリスト: [{"name": ..., "includedPermissions": [...]}, ...]
+        - {"roles": [...]} (roles.list のレスポンス)
+        - ロール名 → 権限のリストの辞書
+        """
+        catalog = cls()
+        if isinstance(definitions, dict) and "roles" in definitions:
+            definitions = definitions["roles"]
+        if isinstance(definitions, dict):
+            for role, permissions in definitions.items():
+                catalog.add_role(role, permissions or [])
+            return catalog
+        for definition in definitions:
+            permissions = definition.get("includedPermissions", definition.get("included_permissions")) or []
+            catalog.add_role(definition["name"], permissions, definition.get("source"))
+        return catalog
+
+
+def load_role_definitions_file(path: str) -> PermissionCatalog:
+    """ローカルのJSONスナップショット (from_role_definitions が受け付ける形式) からカタログを作成する"""
+    with open(path, encoding="utf-8") as f:
+        return PermissionCatalog.from_role_definitions(json.load(f))
+
+
+def load_role_definitions_from_iam(parents: Iterable[str] = ()) -> PermissionCatalog:
+    """
+    IAM API から事前定義ロールと、parents (例: organizations/123, projects/my-proj) のカスタムロールを読み込む。
+    修正点: 共通のレート制限・再試行をページごとに通す (utils.rate_limiter の "iam")
+    """
+    # IAM Admin API のクライアントはカタログを作成する場合にのみ必要になるため、ここでインポートする
+    from google.cloud import iam_admin_v1
+    from .rate_limiter import call_api_pages
+
+    client = iam_admin_v1.IAMClient()
+    catalog = PermissionCatalog()
+    # parent が空の場合は事前定義ロールを返す
+    for parent in ["", *parents]:
+        roles = call_api_pages(
+            "iam", client.list_roles, {"parent": parent, "view": iam_admin_v1.RoleView.FULL}, "roles", timeout=300.0
+        )
+        for role in roles:
+            catalog.add_role(role.name, role.included_permissions, "CUSTOM" if parent else "PREDEFINED")
+    return catalog
@@ -0,0 +1,233 @@
+# ./src/utils/policy_cache.py
+# リソースのIAMポリシーの etag をキャッシュし、変更のないリソースの再評価 (グループ展開・書き込み) を省略する
+import os
+import json
+import time
+import datetime
+from google.cloud import bigquery
+from .bq_helpers import fetch_query_rows, run_dml_query
+from .gcp_clients import bigquery_client
+from .instrumentation import count
+from .logging_handler import get_logger
+
+logger = get_logger(__name__)
+
+# 前回の評価結果を探す日数 (これより古いエントリは使わない)
+CACHE_LOOKBACK_DAYS = 7
+
+
+class PolicyEtagCache:
+    """
+    リソースごとのポリシー etag と、展開に関わったグループのメンバーシップのバージョン
+    (group_membership_hashes の content_hash) を記録する。
+
+    - BigQuery の resource_policy_etags テーブル (追記のみ) が永続層。
+      多数の assessor が並行して書き込むため、DMLではなくストリーミング挿入で追記し、読み込み時にリソースごとの最新行を使う。
+    - 関数インスタンスのメモリ上の辞書がウォーム層。テーブルは resource_type ごとに1回だけ読み込み、ttl_seconds 後に読み直す。
+      他のインスタンスが記録したエントリが見えなくても、より古い (同じ内容の) 評価結果を引き継ぐだけで正しさは変わらない。
+    - グループの展開は評価時に Identity API から直接行うが、バージョンは group-assessor が書き込んだハッシュで比較する。
+      そのため、ハッシュ (group_membership_hashes の assessment_timestamp) がエントリの評価時刻より新しい場合にのみ
+      エントリを使う。group-assessor がディスパッチャーより後に実行された場合や、実行されなかった場合は再評価になる。
+    - 展開に失敗したグループ (UNEXPANDED) を含む評価結果は記録しない (次回も再評価して展開を試みる)。
+    - キャッシュにヒットしたリソースは、assessor ではエントリ (引き継ぎ元のスナップショット source_timestamp 付き) のみを記録し、
+      評価結果の行はスナップショットごとに carry_forward_snapshot() の1回の MERGE でまとめて複製する。
+    """
+
+    def __init__(self, cache_table_id: str = None, group_hash_table_id: str = None, ttl_seconds: int = 600):
+        self.cache_table_id = cache_table_id
+        self.group_hash_table_id = group_hash_table_id
+        self.ttl_seconds = ttl_seconds
+        self._entries = {} # resource_type -> (読み込み時刻, {resource_name: entry})
+        self._group_hashes = None # (読み込み時刻, {group_email: content_hash}, {group_email: ハッシュの計算時刻})
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cache_table_id)
+
+    def _fqn(self, table_id: str) -> str:
+        return f"`{os.getenv('BQ_PROJECT_ID')}.{os.getenv('BQ_DATASET_ID')}.{table_id}`"
+
+    def _fresh(self, loaded_at: float) -> bool:
+        return time.monotonic() - loaded_at < self.ttl_seconds
+
+    def _entries_for(self, resource_type: str) -> dict:
+        cached = self._entries.get(resource_type)
+        if cached and self._fresh(cached[0]):
+            return cached[1]
+        rows = fetch_query_rows(
+            f"""
+            SELECT resource_name, etag, group_versions, assessment_timestamp, source_timestamp, row_count
+            FROM {self._fqn(self.cache_table_id)}
+            WHERE resource_type = @resource_type
+              AND assessment_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {CACHE_LOOKBACK_DAYS} DAY)
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY resource_name ORDER BY assessment_timestamp DESC) = 1
+              -- 引き継ぎを重ねたエントリも、実際に評価したスナップショットが古すぎる場合は使わない (定期的に再評価する)
+              AND COALESCE(source_timestamp, assessment_timestamp) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {CACHE_LOOKBACK_DAYS} DAY)
+            """,
+            query_parameters=[bigquery.ScalarQueryParameter("resource_type", "STRING", resource_type)]
+        )
+        entries = {}
+        for row in rows:
+            entries[row["resource_name"]] = {
+                "etag": row["etag"],
+                "group_versions": json.loads(row["group_versions"] or "{}"),
+                "assessment_timestamp": _as_isoformat(row["assessment_timestamp"]),
+                "source_timestamp": _as_isoformat(row.get("source_timestamp")),
+                "row_count": row["row_count"],
+            }
+        self._entries[resource_type] = (time.monotonic(), entries)
+        return entries
+
+    def _load_group_hashes(self) -> tuple:
+        if self._group_hashes and self._fresh(self._group_hashes[0]):
+            return self._group_hashes[1:]
+        hashes, hashed_at = {}, {}
+        if self.group_hash_table_id:
+            rows = fetch_query_rows(
+                f"SELECT group_email, content_hash, assessment_timestamp FROM {self._fqn(self.group_hash_table_id)}"
+            )
+            for row in rows:
+                hashes[row["group_email"]] = row["content_hash"]
+                hashed_at[row["group_email"]] = _as_datetime(row["assessment_timestamp"])
+        self._group_hashes = (time.monotonic(), hashes, hashed_at)
+        return hashes, hashed_at
+
+    def _current_group_hashes(self) -> dict:
+        return self._load_group_hashes()[0]
+
+    def group_versions(self, groups) -> dict:
+        """グループごとの現在のメンバーシップのバージョン (不明な場合は None)"""
+        hashes = self._current_group_hashes() if groups else {}
+        return {group: hashes.get(group) for group in sorted(groups)}
+
+    def lookup(self, resource_type: str, resource_name: str, etag: str):
+        """
+        ポリシーの etag と、前回の展開に関わったグループのバージョンがすべて一致すれば前回のエントリを返す。
+        バージョンが不明なグループ (group-assessor の対象外など) を含む場合や、グループのハッシュが
+        エントリの評価時刻以前に計算されたもの (評価後のメンバー変更を反映していない可能性がある) の場合は使わない。
+        """
+        if not self.enabled or not etag:
+            return None
+        entry = self._entries_for(resource_type).get(resource_name)
+        if not entry or entry["etag"] != etag:
+            count("cache.policy_etag.miss")
+            return None
+        recorded = entry["group_versions"]
+        if any(version is None for version in recorded.values()) or self.group_versions(recorded) != recorded:
+            count("cache.policy_etag.miss")
+            return None
+        if recorded:
+            hashed_at = self._load_group_hashes()[1]
+            assessed_at = _as_datetime(entry["assessment_timestamp"])
+            if any(hashed_at.get(group) is None or hashed_at[group] <= assessed_at for group in recorded):
+                count("cache.policy_etag.stale_group_hashes")
+                count("cache.policy_etag.miss")
+                return None
+        count("cache.policy_etag.hit")
+        return entry
+
+    def record(self, resource_type: str, resource_name: str, etag: str, groups, assessment_timestamp: str, row_count: int,
+               complete: bool = True, scope: str = None, source_timestamp: str = None) -> bool:
+        """
+        評価結果を書き込んだ後に、次回の比較用のエントリを記録する。記録できた場合は True を返す。
+        complete=False (展開に失敗したグループを含む) の場合は記録しない。
+        source_timestamp は、評価結果の行を書き込んだスナップショット (引き継いだエントリのみ。自分で書き込んだ場合は None)。
+        """
+        if not self.enabled or not etag:
+            return False
+        if not complete:
+            count("cache.policy_etag.not_recorded")
+            return False
+        entry = {
+            "etag": etag,
+            "group_versions": self.group_versions(groups),
+            "assessment_timestamp": assessment_timestamp,
+            "source_timestamp": source_timestamp,
+            "row_count": row_count,
+        }
+        errors = bigquery_client.insert_rows_json(
+            self._fqn(self.cache_table_id).strip("`"),
+            [{"resource_type": resource_type, "resource_name": resource_name, "scope": scope, **entry,
+              "group_versions": json.dumps(entry["group_versions"])}]
+        )
+        if errors:
+            # キャッシュの記録に失敗しても評価結果は書き込み済みのため、次回は再評価されるだけ
+            logger.warning(f"Failed to record policy etag for {resource_name}: {errors}")
+            return False
+        self._entries_for(resource_type)[resource_name] = entry
+        return True
+
+    def carry_forward(self, entry: dict, resource_type: str, resource_name: str, assessment_timestamp: str, scope: str) -> bool:
+        """
+        前回の評価結果を新しい assessment_timestamp に引き継ぐエントリを記録する。
+        修正点: リソースごとに DML で行をコピーすると、ヒットごとにテーブル全体のスキャンが課金され、並行する DML も詰まる。
+        ここではエントリのストリーミング挿入のみを行い、行の複製は carry_forward_snapshot() がスナップショットごとにまとめて行う。
+        同じ assessment_timestamp で既に記録済み (メッセージの再配信) の場合は何もしない。
+        エントリを記録できなかった場合は False を返し、呼び出し側で再評価する。
+        """
+        if entry["assessment_timestamp"] == assessment_timestamp:
+            return True
+        # 引き継ぎを重ねても、行を実際に書き込んだスナップショットから複製する (途中の複製が行われなかった場合も欠けない)
+        source_timestamp = entry.get("source_timestamp") or entry["assessment_timestamp"]
+        if not self.record(resource_type, resource_name, entry["etag"], entry["group_versions"], assessment_timestamp,
+                           entry["row_count"], scope=scope, source_timestamp=source_timestamp):
+            return False
+        count("cache.policy_etag.carried_forward")
+        return True
+
+    def carry_forward_snapshot(self, destination_table_id: str, assessment_timestamp: str) -> int:
+        """
+        assessment_timestamp で引き継ぎを記録したリソースの評価結果の行を、引き継ぎ元のスナップショットから1回の MERGE で複製し、
+        複製した行数を返す。既に複製済みの行は挿入しないため、再実行しても重複しない。
+        """
+        if not self.enabled:
+            return 0
+        table_fqn = self._fqn(destination_table_id)
+        copied = run_dml_query(
+            f"""
+            MERGE {table_fqn} AS t
+            USING (
+              SELECT TIMESTAMP(@assessment_timestamp) AS assessment_timestamp, COALESCE(c.scope, d.scope) AS scope,
+                     d.resource_type, d.resource_name, d.principal_type, d.principal_email, d.role
+              FROM (
+                SELECT resource_type, resource_name, scope, source_timestamp
+                FROM {self._fqn(self.cache_table_id)}
+                WHERE assessment_timestamp = TIMESTAMP(@assessment_timestamp) AND source_timestamp IS NOT NULL
+                -- メッセージの再配信で同じリソースのエントリが重複しても、行は1回だけ複製する
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY resource_type, resource_name ORDER BY source_timestamp DESC) = 1
+              ) AS c
+              JOIN {table_fqn} AS d
+                ON d.assessment_timestamp = c.source_timestamp
+               AND d.resource_type = c.resource_type AND d.resource_name = c.resource_name
+            ) AS s
+            ON t.assessment_timestamp = s.assessment_timestamp
+               AND t.resource_type = s.resource_type AND t.resource_name = s.resource_name
+               AND t.principal_type IS NOT DISTINCT FROM s.principal_type
+               AND t.principal_email IS NOT DISTINCT FROM s.principal_email AND t.role = s.role
+            WHEN NOT MATCHED THEN
+              INSERT (assessment_timestamp, scope, resource_type, resource_name, principal_type, principal_email, role)
+              VALUES (s.assessment_timestamp, s.scope, s.resource_type, s.resource_name, s.principal_type, s.principal_email, s.role)
+            """,
+            query_parameters=[bigquery.ScalarQueryParameter("assessment_timestamp", "STRING", assessment_timestamp)]
+        )
+        count("bq.rows_written", copied)
+        logger.info(f"Carried forward {copied} rows of unchanged resources into {destination_table_id}.",
+                    extra={"assessment_timestamp": assessment_timestamp, "rows_copied": copied})
+        return copied
+
+
+def _as_isoformat(value):
+    """BigQuery の TIMESTAMP 値 (datetime) を ISO 8601 文字列に揃える (文字列・None はそのまま)"""
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def _as_datetime(value) -> datetime.datetime:
+    """BigQuery の TIMESTAMP 値 (datetime) または ISO 8601 文字列を datetime に揃える"""
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
+def has_unexpanded_members(rows) -> bool:
+    """評価結果の行に、展開に失敗したグループ (principal_type が "... (UNEXPANDED)") が含まれるか"""
+    return any(row["principal_type"].endswith("(UNEXPANDED)") for row in rows)
@@ -0,0 +1,125 @@
+# ./src/utils/rate_limiter.py
+# Google Cloud API の呼び出しに共通のレート制限 (API ごとのトークンバケット) と再試行ポリシー
+import os
+import json
+import random
+import threading
+import time
+from .instrumentation import count
+from .logging_handler import get_logger
+
+logger = get_logger(__name__)
+
+# API名 (gcp_clients の api_name: identity, asset, compute, storage, bigquery, recommender, pubsub, iam) -> 1秒あたりの呼び出し数の上限。
+# 例: {"identity": 10, "asset": 5}。未設定の API は制限しない。
+# 注意: 上限は関数インスタンスごと (インスタンス内のスレッドで共有)。プロジェクトのクォータに対しては「QPS × 最大インスタンス数」で設定する
+API_QPS_LIMITS = json.loads(os.getenv('API_QPS_LIMITS', '{}'))
+# クォータ超過 (429) と一時的な過負荷 (503) の再試行回数と、指数バックオフの初期値・上限 (秒)
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', '5'))
+API_BACKOFF_BASE_SECONDS = float(os.getenv('API_BACKOFF_BASE_SECONDS', '1'))
+API_BACKOFF_MAX_SECONDS = float(os.getenv('API_BACKOFF_MAX_SECONDS', '32'))
+
+# 再試行する HTTP ステータス (google.api_core.exceptions の code)。ResourceExhausted / TooManyRequests は 429
+_RETRYABLE_STATUS_CODES = frozenset({429, 503})
+# Cloud Storage などの JSON API は、レート制限を 403 (reason: rateLimitExceeded) で返す。権限不足の 403 とはこの reason で区別する
+_RATE_LIMIT_REASONS = frozenset({"rateLimitExceeded", "userRateLimitExceeded"})
+
+
+class TokenBucket:
+    """
+    1秒あたり qps 個のトークンを補充するトークンバケット。スレッドセーフで、トークンがなければ補充されるまで待つ。
+    バケットの容量 (連続して呼び出せる数) は qps (最低1)。
+    """
+
+    def __init__(self, qps: float):
+        self.qps = float(qps)
+        self.capacity = max(1.0, self.qps)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """トークンを1つ取得し、待った秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.qps)
+            self._updated = now
+            # 先にトークンを予約してからロックの外で待つ (待っている間も他のスレッドは順番に予約できる)
+            self._tokens -= 1
+            wait = -self._tokens / self.qps if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket(api_name: str):
+    """API のトークンバケット (上限が未設定なら None)。プロセス内で API ごとに1つを共有する"""
+    qps = API_QPS_LIMITS.get(api_name)
+    if not qps:
+        return None
+    bucket = _buckets.get(api_name)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.setdefault(api_name, TokenBucket(qps))
+    return bucket
+
+
+def is_quota_error(exc: Exception) -> bool:
+    """クォータ超過・レート制限・一時的な過負荷のエラー (再試行すれば成功しうる) かどうか。権限不足や NotFound は False"""
+    code = getattr(exc, "code", None)
+    if code in _RETRYABLE_STATUS_CODES:
+        return True
+    if code == 403:
+        reasons = {error.get("reason") for error in getattr(exc, "errors", None) or [] if isinstance(error, dict)}
+        return bool(reasons & _RATE_LIMIT_REASONS)
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """attempt 回目 (0始まり) の再試行までの待ち時間。指数バックオフに、同時に失敗した呼び出しが揃って再試行しないようジッターを加える"""
+    return min(API_BACKOFF_BASE_SECONDS * 2 ** attempt, API_BACKOFF_MAX_SECONDS) + random.uniform(0, API_BACKOFF_BASE_SECONDS)
+
+
+def call_api(api_name: str, func, *args, **kwargs):
+    """
+    func(*args, **kwargs) を API ごとのレート制限の下で呼び出し、クォータ超過 (429)・一時的な過負荷 (503) は
+    ジッター付きの指数バックオフで再試行する。権限不足 (403) や NotFound などは再試行せずにそのまま送出する。
+    再試行し尽くした場合も元の例外を送出するため、呼び出し側は is_quota_error() で区別できる。
+
+    一覧系の API (pager を返すもの) は、最初のページの取得のみが対象になる。全ページを再試行の対象にする場合は
+    call_api_pages() でページごとに呼び出すか、call_api("identity", lambda: list(identity_client.list_memberships(...)))
+    のように func の中で読み切る。
+    """
+    bucket = _bucket(api_name)
+    for attempt in range(API_MAX_RETRIES + 1):
+        if bucket is not None and bucket.acquire():
+            count(f"throttled.{api_name}")
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == API_MAX_RETRIES or not is_quota_error(e):
+                raise
+            delay = backoff_delay(attempt)
+            count(f"retries.{api_name}")
+            logger.warning(f"Retrying {api_name} API call in {delay:.1f}s after quota error: {e}")
+            time.sleep(delay)
+
+
+def call_api_pages(api_name: str, method, request: dict, items_field: str, **kwargs):
+    """
+    一覧系の API (pager を返すもの) の要素を、ページごとに call_api() を通して取得しながら返す。
+    method(request=..., **kwargs) の最初のページのみを読み、次のページは page_token を設定して改めて要求する。
+    再試行はページ単位で行い、途中のページでクォータ超過になっても取得済みのページは取り直さない。
+    items_field はレスポンスの要素のフィールド名 (search_all_resources なら "results"、list_assets なら "assets")。
+    """
+    request = dict(request)
+    while True:
+        page = call_api(api_name, lambda: next(iter(method(request=request, **kwargs).pages)))
+        yield from getattr(page, items_field)
+        if not page.next_page_token:
+            return
+        request["page_token"] = page.next_page_token
@@ -0,0 +1,188 @@
+# ./src/utils/resource_hierarchy.py
+# リソース階層 (組織 → フォルダ → プロジェクト → リソース) の索引と、継承を考慮した実効アクセスの計算
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+CRM_PREFIX = "//cloudresourcemanager.googleapis.com/"
+# ノードの種類。コンテナ (組織・フォルダ・プロジェクト) は Asset の ancestors と同じ短い名前 (例: folders/123) で保持する
+RESOURCE, PROJECT, FOLDER, ORGANIZATION = 0, 1, 2, 3
+_CONTAINER_KINDS = (("projects/", PROJECT), ("folders/", FOLDER), ("organizations/", ORGANIZATION))
+
+
+def _kind_of(key: str) -> int:
+    for prefix, kind in _CONTAINER_KINDS:
+        if key.startswith(prefix):
+            return kind
+    return RESOURCE
+
+
+class ResourceHierarchy:
+    """
+    Cloud Asset Inventory の ancestors から作るリソース階層の索引。
+
+    数十万ノードを関数のメモリに収めるため、ノードは連番のIDにインターンし、
+    親ID・種類は array / bytearray に保持する (子のリストは持たない)。
+    コンテナは短い名前 (projects/<番号>) をキーとし、完全なリソース名
+    (//cloudresourcemanager.googleapis.com/projects/<ID>) は別名として引けるようにする。
+    """
+
+    def __init__(self):
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._aliases: Dict[str, int] = {}
+        self.parents = array('l')
+        self.kinds = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _intern(self, key: str) -> int:
+        node_id = self._ids.get(key)
+        if node_id is None:
+            node_id = len(self.names)
+            self._ids[key] = node_id
+            self.names.append(key)
+            self.parents.append(-1)
+            self.kinds.append(_kind_of(key))
+        return node_id
+
+    def add_asset(self, name: str, ancestors: Iterable[str]):
+        """
+        Asset (name と ancestors) を追加する。ancestors は自身に近い順
+        (例: ["projects/123", "folders/45", "organizations/1"])。コンテナの Asset では先頭が自身になる。
+        """
+        ancestors = list(ancestors or ())
+        if name.startswith(CRM_PREFIX) and ancestors and _kind_of(ancestors[0]) != RESOURCE:
+            node_id = self._intern(ancestors[0])
+            self._aliases[name] = node_id
+            chain = ancestors
+        else:
+            self._intern(name)
+            chain = [name, *ancestors]
+        # ancestors の連続する組から親子関係を張る。フォルダの Asset が列挙されていなくても階層がつながる
+        for child, parent in zip(chain, chain[1:]):
+            child_id, parent_id = self._intern(child), self._intern(parent)
+            if self.parents[child_id] == -1:
+                self.parents[child_id] = parent_id
+
+    def node_id(self, resource_name: str) -> Optional[int]:
+        """リソース名 (完全な名前・短い名前のどちらでも可) からノードIDを返す。階層にない場合は None"""
+        node_id = self._ids.get(resource_name)
+        if node_id is None:
+            node_id = self._aliases.get(resource_name)
+        if node_id is None and resource_name.startswith(CRM_PREFIX):
+            node_id = self._ids.get(resource_name[len(CRM_PREFIX):])
+        return node_id
+
+    @classmethod
+    def from_assets(cls, assets: Iterable) -> "ResourceHierarchy":
+        """Asset (dict または name/ancestors 属性を持つオブジェクト) のイテラブルから索引を作る"""
+        hierarchy = cls()
+        for asset in assets:
+            if isinstance(asset, dict):
+                hierarchy.add_asset(asset["name"], asset.get("ancestors"))
+            else:
+                hierarchy.add_asset(asset.name, asset.ancestors)
+        return hierarchy
+
+
+class EffectiveAccessEngine:
+    """
+    バインディングを階層の下方向に伝播させ、ノードごとの実効ポリシー (適用されるバインディングの集合) を計算する。
+
+    実効ポリシーは「自身のバインディング ∪ 親の実効ポリシー」で、ノードごとにメモ化する。
+    自身にバインディングがないノードは親の frozenset をそのまま共有するため、
+    異なる実効ポリシーの数はバインディングを持つノードの数で抑えられる。
+    """
+
+    def __init__(self, hierarchy: ResourceHierarchy, bindings: List[dict]):
+        """bindings: {resource_name, principal_email, role, ...} の行 (access_facts 形式)"""
+        self.hierarchy = hierarchy
+        self.bindings = bindings
+        self.binding_nodes: List[Optional[int]] = [hierarchy.node_id(b["resource_name"]) for b in bindings]
+        self._own: Dict[int, List[int]] = {}
+        for index, node_id in enumerate(self.binding_nodes):
+            if node_id is not None:
+                self._own.setdefault(node_id, []).append(index)
+        self._memo: List[Optional[frozenset]] = [None] * len(hierarchy)
+
+    def _effective(self, node_id: int) -> frozenset:
+        # 再帰せず、未計算の祖先までたどってから上から順に埋める
+        chain = []
+        current = node_id
+        while current != -1 and self._memo[current] is None:
+            chain.append(current)
+            current = self.hierarchy.parents[current]
+        policy = self._memo[current] if current != -1 else frozenset()
+        for current in reversed(chain):
+            own = self._own.get(current)
+            if own:
+                policy = policy.union(own)
+            self._memo[current] = policy
+        return policy
+
+    def effective_policy(self, resource_name: str) -> List[dict]:
+        """リソースに (継承を含めて) 適用されるバインディング"""
+        node_id = self.hierarchy.node_id(resource_name)
+        if node_id is None:
+            return []
+        return [self.bindings[i] for i in sorted(self._effective(node_id))]
+
+    def coverage(self) -> List[dict]:
+        """
+        バインディングごとに、それが及ぶ子孫ノードの数 (バインディングが付与されたノード自身は含まない) を返す。
+        全ノードの実効ポリシーを求め、同じ実効ポリシーを共有するノードをまとめて数える。
+        """
+        nodes_by_policy: Dict[int, list] = {}
+        kinds = self.hierarchy.kinds
+        for node_id in range(len(self.hierarchy)):
+            policy = self._effective(node_id)
+            if not policy:
+                continue
+            entry = nodes_by_policy.get(id(policy))
+            if entry is None:
+                entry = nodes_by_policy[id(policy)] = [policy, 0, 0]
+            entry[1] += 1
+            if kinds[node_id] == PROJECT:
+                entry[2] += 1
+
+        covered = [0] * len(self.bindings)
+        covered_projects = [0] * len(self.bindings)
+        for policy, node_count, project_count in nodes_by_policy.values():
+            for index in policy:
+                covered[index] += node_count
+                covered_projects[index] += project_count
+
+        results = []
+        for index, node_id in enumerate(self.binding_nodes):
+            if node_id is None:
+                results.append({"in_hierarchy": False, "descendant_count": 0, "descendant_project_count": 0})
+                continue
+            # 付与されたノード自身を除く
+            results.append({
+                "in_hierarchy": True,
+                "descendant_count": covered[index] - 1,
+                "descendant_project_count": covered_projects[index] - (1 if kinds[node_id] == PROJECT else 0),
+            })
+        return results
+
+
+def load_hierarchy_from_asset_inventory(scopes: Iterable[str], page_size: int = 1000) -> ResourceHierarchy:
+    """
+    Cloud Asset Inventory の list_assets (RESOURCE) から、各スコープ配下の階層を読み込む。
+    Asset は1件ずつ索引に追加し、レスポンス全体をメモリに保持しない。
+    """
+    from .gcp_clients import asset_client # ローカルの Asset データのみを使う場合にGCPライブラリを要求しない
+    from .rate_limiter import call_api_pages
+
+    hierarchy = ResourceHierarchy()
+    for scope in scopes:
+        # クォータ超過の再試行はページごとに行う
+        assets = call_api_pages(
+            "asset", asset_client.list_assets,
+            {"parent": scope, "content_type": "RESOURCE", "page_size": page_size}, "assets",
+            timeout=300.0
+        )
+        for asset in assets:
+            hierarchy.add_asset(asset.name, asset.ancestors)
+    return hierarchy
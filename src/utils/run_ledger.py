@@ -0,0 +1,87 @@
+# ./src/utils/run_ledger.py
+# パイプラインの実行台帳。ディスパッチャー → assessor → analyzer の各呼び出しを run_id で結び付け、
+# ステージごとのメトリクス (所要時間、処理件数、API 呼び出し数、書き込み行数、BigQuery の課金バイト数、エラー数) を
+# pipeline_runs テーブルに1行ずつ追記する。行は instrumentation の呼び出しサマリーから作る
+import os
+import json
+import base64
+import datetime
+import uuid
+
+BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID')
+BQ_DATASET_ID = os.getenv('BQ_DATASET_ID')
+# 未設定の場合、台帳には書き込まない (run_id の採番と伝搬は行う)
+PIPELINE_RUNS_TABLE_ID = os.getenv('PIPELINE_RUNS_TABLE_ID') # pipeline_runs
+# ディスパッチャーのステージ名 (エントリポイントの関数名)。スナップショットの時刻と、ディスパッチした件数を記録する
+DISPATCH_STAGE = "discover_and_dispatch_assets"
+# ディスパッチャーが実行ごとに1回起動する assessor のステージ名。スナップショットの完了の判定に使う
+RUN_LEVEL_STAGES = ("assess_principal_centric", "assess_all_groups")
+
+
+def new_run_id() -> str:
+    """新しい実行の run_id を採番する"""
+    return uuid.uuid4().hex
+
+
+def message_from_event(cloud_event) -> dict:
+    """
+    Pub/Sub トリガーのメッセージが JSON オブジェクトであればその dict を返す。
+    スコープのリストや不正なメッセージでは空の dict
+    """
+    try:
+        message_data_str = base64.b64decode(cloud_event.data["message"]["data"]).decode("utf-8")
+        message_data = json.loads(message_data_str)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return {}
+    return message_data if isinstance(message_data, dict) else {}
+
+
+def run_id_from_event(cloud_event):
+    """
+    Pub/Sub トリガーのメッセージ (JSON オブジェクト) に含まれる run_id を返す。
+    Scheduler からの "{}" やスコープのリストなど、run_id を含まないメッセージでは None
+    """
+    run_id = message_from_event(cloud_event).get("run_id")
+    return str(run_id) if run_id else None
+
+
+def stage_row(summary: dict, attributes: dict, started_at: datetime.datetime) -> dict:
+    """呼び出しのサマリーを pipeline_runs の1行に変換する"""
+    counters = summary["counters"]
+    errors = counters.get("errors", 0) + (1 if summary["status"] == "error" else 0)
+    return {
+        "run_id": summary["run_id"],
+        "stage": summary["function"],
+        "invocation_id": summary["invocation_id"],
+        "started_at": started_at.isoformat(),
+        "duration_seconds": summary["duration_seconds"],
+        "status": summary["status"],
+        "scope": attributes.get("scope"),
+        "resource_name": attributes.get("resource_name"),
+        "assessment_timestamp": attributes.get("assessment_timestamp"),
+        "resources_processed": counters.get("resources_processed", 0),
+        "api_calls": sum(value for name, value in counters.items() if name.startswith("api_calls.")),
+        "rows_written": counters.get("bq.rows_written", 0),
+        "bytes_billed": counters.get("bq.bytes_billed", 0),
+        "errors": errors,
+        "spans": json.dumps(summary["spans"]),
+        "counters": json.dumps(counters),
+    }
+
+
+def append_stage(row: dict, logger):
+    """
+    pipeline_runs に1行をストリーミング挿入する。同じ実行の多数の assessor が同時に書き込むため、ロードジョブではなく
+    insert_rows_json を使う。台帳の書き込みに失敗しても関数は失敗させない (警告ログのみ)
+    """
+    if not PIPELINE_RUNS_TABLE_ID:
+        return
+    # gcp_clients は instrumentation に依存するため、循環インポートを避けて書き込み時に読み込む
+    from .gcp_clients import bigquery_client
+    try:
+        table_ref = bigquery_client.dataset(BQ_DATASET_ID, project=BQ_PROJECT_ID).table(PIPELINE_RUNS_TABLE_ID)
+        errors = bigquery_client.insert_rows_json(table_ref, [row])
+        if errors:
+            logger.warning(f"Failed to append the stage to {PIPELINE_RUNS_TABLE_ID}: {errors}", extra={"run_id": row["run_id"]})
+    except Exception as e:
+        logger.warning(f"Failed to append the stage to {PIPELINE_RUNS_TABLE_ID}: {e}", extra={"run_id": row["run_id"]})
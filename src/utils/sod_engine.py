@@ -0,0 +1,178 @@
+# ./src/utils/sod_engine.py
+# BigQueryを使わずにSoDルールを評価するローカルエンジン (大量のルールや what-if 分析向け)
+import json
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from .sod_rules import classify_sod_rules, SKIPPED_RULE_SUFFIX
+from .permission_catalog import PermissionCatalog
+
+GCP_IAM = 'GCP_IAM'
+WORKSPACE_ADMIN = 'WORKSPACE_ADMIN'
+GCP_PERMISSION = 'GCP_PERMISSION'
+
+
+class SodEngine:
+    """
+    プリンシパル → ロールのスナップショットをビットセットに変換して保持し、SoDルールを評価する。
+
+    ロール語彙の各ロール (role_type, role) ごとに「そのロールを持つプリンシパル」のビットセット
+    (Pythonのint、ビット i = i番目のプリンシパル) を作る。ルールの評価は
+    (role1 の各ロールのビットセットの OR) AND (role2 の各ロールのビットセットの OR) の整数演算のみで、
+    プリンシパル数に対してループしない。違反したプリンシパルだけ割り当ての詳細を組み立てる。
+    """
+
+    def __init__(self, grants: Iterable[dict], workspace_roles: Optional[Iterable[dict]] = None,
+                 permission_catalog: Optional[PermissionCatalog] = None):
+        """
+        grants: principal_access_list (access_facts) 形式の行
+                {principal_email, principal_type, resource_name, role}
+        workspace_roles: workspace_admin_roles 形式の行 {principal_email, workspace_role_name}。
+                None の場合は Workspace データなしとして扱い、Workspaceを含むルールはスキップする。
+        permission_catalog: GCP_PERMISSION タイプのルールを評価するためのロール → 権限のカタログ。
+                None の場合、GCP_PERMISSION を含むルールはスキップする。
+        """
+        self.workspace_data_available = workspace_roles is not None
+        self.permission_catalog = permission_catalog
+        self.principals: List[str] = []
+        self._principal_index: Dict[str, int] = {}
+        self._role_bits: Dict[tuple, int] = {}
+        # プリンシパルごとの割り当て (role_type, role, resource_name, principal_type)。重複はSQLのDISTINCTと同様に除く
+        self._assignments: List[set] = []
+
+        for grant in grants:
+            self._add(grant['principal_email'], GCP_IAM, grant['role'], grant.get('resource_name'), grant.get('principal_type'))
+        for row in workspace_roles or ():
+            self._add(row['principal_email'], WORKSPACE_ADMIN, row['workspace_role_name'], None, None)
+
+    def _add(self, principal_email, role_type, role, resource_name, principal_type):
+        index = self._principal_index.get(principal_email)
+        if index is None:
+            index = len(self.principals)
+            self._principal_index[principal_email] = index
+            self.principals.append(principal_email)
+            self._assignments.append(set())
+        key = (role_type, role)
+        self._role_bits[key] = self._role_bits.get(key, 0) | (1 << index)
+        self._assignments[index].add((role_type, role, resource_name, principal_type))
+
+    @property
+    def role_count(self) -> int:
+        """ロール語彙のサイズ"""
+        return len(self._role_bits)
+
+    def _rule_roles(self, role_type: str, items: list) -> set:
+        """ルールの片側を (role_type, role) の集合に変換する。権限は、その権限を含むロールに展開する"""
+        if role_type == GCP_PERMISSION:
+            return {(GCP_IAM, role) for role in self.permission_catalog.roles_with_any_permission(items)}
+        return {(role_type, item) for item in items}
+
+    def _mask(self, rule_roles: set) -> int:
+        mask = 0
+        for key in rule_roles:
+            mask |= self._role_bits.get(key, 0)
+        return mask
+
+    def evaluate(self, rules: list, logger: logging.Logger = None) -> List[dict]:
+        """
+        正規化済みのSoDルール (utils.sod_rules.normalize_sod_rules の結果) を評価し、
+        sod_violations テーブルと同じ形式の行を返す。評価できないルールはスキップ行になる。
+        """
+        rule_rows, _ = classify_sod_rules(
+            rules, self.workspace_data_available, logger, permission_data_available=self.permission_catalog is not None
+        )
+        results = []
+        for rule in rule_rows:
+            role1, role2 = rule['role1'], rule['role2']
+            row_base = {
+                "rule_id": rule['rule_id'],
+                "conflicting_role1": role1[0] if role1 else None,
+                "conflicting_role2": role2[0] if role2 else None,
+                "role1_type": rule['role1_type'],
+                "role2_type": rule['role2_type'],
+            }
+            if rule['skipped']:
+                results.append({
+                    **row_base,
+                    "description": (rule['description'] or 'N/A') + SKIPPED_RULE_SUFFIX,
+                    "principal_email": None,
+                    "principal_type": None,
+                    "assignments": [],
+                })
+                continue
+
+            role1_keys = self._rule_roles(rule['role1_type'], role1)
+            role2_keys = self._rule_roles(rule['role2_type'], role2)
+            violators = self._mask(role1_keys) & self._mask(role2_keys)
+            if not violators:
+                continue
+
+            rule_roles = role1_keys | role2_keys
+            while violators:
+                lowest = violators & -violators
+                index = lowest.bit_length() - 1
+                violators ^= lowest
+
+                matched = [a for a in self._assignments[index] if (a[0], a[1]) in rule_roles]
+                principal_types = [a[3] for a in matched if a[3]]
+                # SQL版と同じく role, resource_name の順 (NULLが先) に並べる
+                matched.sort(key=lambda a: (a[1], a[2] is not None, a[2] or ""))
+                results.append({
+                    **row_base,
+                    "description": rule['description'],
+                    "principal_email": self.principals[index],
+                    "principal_type": max(principal_types) if principal_types else 'USER',
+                    "assignments": [{"resource_name": a[2], "role": a[1]} for a in matched],
+                })
+        return results
+
+
+def load_snapshot_file(path: str) -> tuple:
+    """
+    ローカルファイル (JSON配列 または 改行区切りJSON) からスナップショットを読み込む。
+    principal_access_list からエクスポートした行 (access_list を持つ) と、フラットな access_facts 形式の行の両方に対応する。
+    workspace_role_name を持つ行は Workspace 管理者ロールとして扱う。(grants, workspace_roles) を返し、
+    Workspace の行がなければ workspace_roles は None。
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        rows = json.loads(text)
+    else:
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    grants, workspace_roles = [], []
+    for row in rows:
+        if 'workspace_role_name' in row:
+            workspace_roles.append(row)
+        elif 'access_list' in row:
+            for access in row['access_list'] or ():
+                grants.append({
+                    "principal_email": row['principal_email'],
+                    "principal_type": row.get('principal_type'),
+                    "resource_name": access.get('resource_name'),
+                    "role": access['role'],
+                })
+        else:
+            grants.append(row)
+    return grants, (workspace_roles or None)
+
+
+def load_snapshot_from_bigquery(access_source: str, workspace_table_fqn: str = None, max_bytes_billed: int = None) -> tuple:
+    """
+    BigQueryからスナップショットを読み込む。access_source は utils.sql_helpers.access_source_sql の結果。
+    (grants, workspace_roles) を返す。
+    """
+    from .bq_helpers import fetch_query_rows # ローカルファイルのみを使う場合にGCPライブラリを要求しない
+
+    grants = fetch_query_rows(
+        f"SELECT DISTINCT principal_email, principal_type, resource_name, role FROM {access_source}",
+        max_bytes_billed=max_bytes_billed
+    )
+    workspace_roles = None
+    if workspace_table_fqn:
+        workspace_roles = fetch_query_rows(
+            f"SELECT DISTINCT principal_email, workspace_role_name FROM {workspace_table_fqn}",
+            max_bytes_billed=max_bytes_billed
+        )
+    return grants, workspace_roles
@@ -0,0 +1,75 @@
+# ./src/utils/sod_rules.py
+# SoDルールの正規化と分類 (sod-analyzer と ローカルSoDエンジンで共通、GCPクライアントに依存しない)
+import logging
+
+# GCP_PERMISSION: role1/role2 に権限名を指定し、その権限を含むロールを持つプリンシパルを対象とする
+SUPPORTED_ROLE_TYPES = ('GCP_IAM', 'WORKSPACE_ADMIN', 'GCP_PERMISSION')
+SKIPPED_RULE_SUFFIX = " (SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE)"
+
+def normalize_sod_rules(rules, logger: logging.Logger = None) -> list:
+    """
+    SOD_RULES_JSON をパースした値を検証し、有効なルールのリストを返す。
+    role1, role2 は文字列ならリストに変換し、rule_id がない・ロールが空のルールは除外する。
+    """
+    logger = logger or logging.getLogger(__name__)
+    if not isinstance(rules, list):
+        logger.warning("SOD_RULES_JSON is not a valid JSON array. Treating as empty list.")
+        return []
+
+    valid_rules = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            logger.warning(f"Invalid item found in SOD_RULES_JSON (not a dict): {rule}")
+            continue
+        for key in ('role1', 'role2'):
+            roles = rule.get(key)
+            if isinstance(roles, str):
+                rule[key] = [roles] # 文字列ならリストに変換
+            elif not isinstance(roles, list):
+                rule[key] = [] # リストでも文字列でもなければ空リスト
+        # Role1, Role2 が空リストでなく、rule_id があれば有効なルールとする
+        if rule.get('rule_id') and rule['role1'] and rule['role2']:
+            valid_rules.append(rule)
+        else:
+            rule_id_log = rule.get('rule_id', 'UNKNOWN')
+            logger.warning(f"Invalid SoD rule skipped (missing id or empty roles): {rule_id_log}")
+    return valid_rules
+
+def classify_sod_rules(rules: list, workspace_data_available: bool, logger: logging.Logger = None,
+                       permission_data_available: bool = False) -> tuple:
+    """
+    正規化済みのSoDルールを評価用の行 (rule_id, description, role1, role2, role1_type, role2_type, skipped) に変換する。
+    評価できないルール (未対応のタイプ、Workspaceデータなし、権限カタログなし) は skipped=True とし、結果にスキップ行として出力する。
+    (rule_rows, skipped_rule_ids) を返す。
+    """
+    logger = logger or logging.getLogger(__name__)
+    rule_rows = []
+    skipped_rules = []
+    for rule in rules:
+        rule_id = rule.get('rule_id')
+        role1_type = rule.get('role1_type', 'GCP_IAM').upper()
+        role2_type = rule.get('role2_type', 'GCP_IAM').upper()
+
+        skipped = False
+        if role1_type not in SUPPORTED_ROLE_TYPES or role2_type not in SUPPORTED_ROLE_TYPES:
+            logger.warning(f"Unsupported role type combination for rule '{rule_id}' ({role1_type} vs {role2_type}). Skipping.")
+            skipped = True
+        elif 'WORKSPACE_ADMIN' in [role1_type, role2_type] and not workspace_data_available:
+            logger.warning(f"Skipping SoD rule '{rule_id}' because Workspace role data is unavailable or table not configured.")
+            skipped = True
+        elif 'GCP_PERMISSION' in [role1_type, role2_type] and not permission_data_available:
+            logger.warning(f"Skipping SoD rule '{rule_id}' because the role permission catalog is unavailable.")
+            skipped = True
+
+        if skipped:
+            skipped_rules.append(rule_id)
+        rule_rows.append({
+            "rule_id": rule_id,
+            "description": rule.get('description', 'N/A'),
+            "role1": rule.get('role1', []),
+            "role2": rule.get('role2', []),
+            "role1_type": role1_type,
+            "role2_type": role2_type,
+            "skipped": skipped,
+        })
+    return rule_rows, skipped_rules
@@ -0,0 +1,196 @@
+# ./src/utils/sql_helpers.py
+# analyzer間で共通して使用するSQL断片を生成するモジュール (GCPクライアントに依存しない)
+
+def access_source_sql(project_id: str, dataset_id: str, access_facts_table_id: str, principal_table_id: str,
+                      snapshot_timestamp: str = None) -> str:
+    """
+    analyzer向けに、1行 = (プリンシパル, リソース, ロール) のフラットなアクセス情報を返すFROM句を生成する。
+    access_facts テーブルが設定されていればそれを参照し (パーティション/クラスタによる絞り込みが効く)、
+    なければ principal_access_list を UNNEST したサブクエリにフォールバックする。
+    snapshot_timestamp を指定すると、そのスナップショット (パーティション) のみに限定する。
+    列: assessment_timestamp, scope, principal_type, principal_email, resource_name, role
+    """
+    snapshot_filter = snapshot_predicate_sql("assessment_timestamp", snapshot_timestamp)
+    if access_facts_table_id:
+        facts_table_fqn = f"`{project_id}.{dataset_id}.{access_facts_table_id}`"
+        if not snapshot_filter:
+            return facts_table_fqn
+        return f"(SELECT * FROM {facts_table_fqn} WHERE {snapshot_filter})"
+    return (
+        "(SELECT t.assessment_timestamp, t.scope, t.principal_type, t.principal_email, a.resource_name, a.role "
+        f"FROM `{project_id}.{dataset_id}.{principal_table_id}` AS t, UNNEST(t.access_list) AS a"
+        + (f" WHERE t.{snapshot_filter})" if snapshot_filter else ")")
+    )
+
+
+def snapshot_predicate_sql(column: str, snapshot_timestamp: str = None) -> str:
+    """
+    スナップショットに限定するWHERE条件を返す。定数のタイムスタンプと比較するため、
+    パーティション列であればパーティションプルーニングが効く。未指定なら空文字。
+    """
+    if not snapshot_timestamp:
+        return ""
+    return f"{column} = TIMESTAMP('{snapshot_timestamp}')"
+
+
+# sod_violations_sql で使用するテンプレート。ルールは @sod_rules (JSON配列の文字列) パラメータで渡す
+SOD_VIOLATIONS_QUERY_TEMPLATE = """
+WITH Rules AS (
+    SELECT
+        rule_index,
+        JSON_VALUE(r, '$.rule_id') AS rule_id,
+        JSON_VALUE(r, '$.description') AS description,
+        JSON_VALUE_ARRAY(r, '$.role1') AS role1,
+        JSON_VALUE_ARRAY(r, '$.role2') AS role2,
+        JSON_VALUE(r, '$.role1_type') AS role1_type,
+        JSON_VALUE(r, '$.role2_type') AS role2_type,
+        CAST(JSON_VALUE(r, '$.skipped') AS BOOL) AS skipped
+    FROM UNNEST(JSON_QUERY_ARRAY(@sod_rules)) AS r WITH OFFSET AS rule_index
+), RuleItems AS (
+    SELECT rule_index, 1 AS side, item, role1_type AS item_type FROM Rules, UNNEST(role1) AS item WHERE NOT skipped
+    UNION ALL
+    SELECT rule_index, 2 AS side, item, role2_type AS item_type FROM Rules, UNNEST(role2) AS item WHERE NOT skipped
+), RuleRoles AS (
+    -- (ルール, ロール) ごとに、Role1側/Role2側のどちらに属するかを持つ (両方に属する場合もある)
+    SELECT rule_index, role, role_type, LOGICAL_OR(side = 1) AS in_role1, LOGICAL_OR(side = 2) AS in_role2
+    FROM (
+        SELECT rule_index, side, item AS role, item_type AS role_type FROM RuleItems WHERE item_type != 'GCP_PERMISSION'{permission_roles}
+    )
+    GROUP BY rule_index, role, role_type
+), Grants AS (
+    -- アクセスソースのスキャンはここでの1回のみ。いずれかのルールに含まれるロールだけを残す
+    SELECT DISTINCT a.principal_email, a.principal_type, a.resource_name, a.role, 'GCP_IAM' AS role_type
+    FROM {access_source} AS a
+    WHERE a.role IN (SELECT role FROM RuleRoles WHERE role_type = 'GCP_IAM'){principal_scope}{workspace_grants}
+), Violations AS (
+    SELECT
+        rr.rule_index,
+        g.principal_email,
+        MAX(g.principal_type) AS principal_type,
+        -- 関連する全ての割り当て (Workspaceロールは resource_name がNULL)
+        ARRAY_AGG(STRUCT(g.resource_name, g.role) ORDER BY g.role, g.resource_name) AS assignments
+    FROM Grants AS g
+    INNER JOIN RuleRoles AS rr ON g.role = rr.role AND g.role_type = rr.role_type
+    GROUP BY rr.rule_index, g.principal_email
+    HAVING LOGICAL_OR(rr.in_role1) AND LOGICAL_OR(rr.in_role2)
+)
+SELECT
+    r.rule_id,
+    r.description,
+    v.principal_email,
+    COALESCE(v.principal_type, 'USER') AS principal_type, -- Workspaceロールのみの場合はUSERと仮定
+    -- 代表的なロールを表示 (配列全体はassignmentsへ)
+    r.role1[SAFE_OFFSET(0)] AS conflicting_role1,
+    r.role2[SAFE_OFFSET(0)] AS conflicting_role2,
+    r.role1_type,
+    r.role2_type,
+    v.assignments
+FROM Violations AS v
+INNER JOIN Rules AS r ON v.rule_index = r.rule_index
+UNION ALL
+SELECT
+    rule_id,
+    CONCAT(COALESCE(description, 'N/A'), ' (SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE)'),
+    CAST(NULL AS STRING),
+    CAST(NULL AS STRING),
+    role1[SAFE_OFFSET(0)],
+    role2[SAFE_OFFSET(0)],
+    role1_type,
+    role2_type,
+    CAST([] AS ARRAY<STRUCT<resource_name STRING, role STRING>>)
+FROM Rules
+WHERE skipped
+"""
+
+SOD_WORKSPACE_GRANTS_TEMPLATE = """
+    UNION DISTINCT
+    SELECT principal_email, CAST(NULL AS STRING), CAST(NULL AS STRING), workspace_role_name, 'WORKSPACE_ADMIN'
+    FROM {workspace_table_fqn}
+    WHERE workspace_role_name IN (SELECT role FROM RuleRoles WHERE role_type = 'WORKSPACE_ADMIN'){principal_scope}"""
+
+# GCP_PERMISSION タイプのルールを、その権限を含むロール (role_permissions テーブル) に展開する
+SOD_PERMISSION_ROLES_TEMPLATE = """
+        UNION ALL
+        SELECT ri.rule_index, ri.side, rp.role, 'GCP_IAM'
+        FROM RuleItems AS ri
+        INNER JOIN {role_permissions_fqn} AS rp ON rp.permission = ri.item
+        WHERE ri.item_type = 'GCP_PERMISSION'"""
+
+# 評価対象を @changed_principals (ARRAY<STRING>) パラメータのプリンシパルに限定する条件 (差分評価用)
+SOD_PRINCIPAL_SCOPE_SQL = "\n    AND principal_email IN UNNEST(@changed_principals)"
+
+
+def sod_violations_sql(access_source: str, workspace_table_fqn: str = None, scoped: bool = False,
+                       role_permissions_fqn: str = None) -> str:
+    """
+    全てのSoDルールを1回のスキャンで評価するクエリを生成する。ルールは @sod_rules パラメータ
+    (utils.sod_rules.classify_sod_rules が返す行のJSON配列) で渡すため、クエリの長さはルール数に依存しない。
+    workspace_table_fqn を指定すると、Workspace管理者ロールも同じ集合に含めて評価する。
+    scoped=True の場合は @changed_principals パラメータのプリンシパルのみを評価する (スキップ行は常に出力する)。
+    role_permissions_fqn (role_permissions テーブル) を指定すると、GCP_PERMISSION タイプのルールを評価できる。
+    列は sod_violations テーブルのスキーマから violation_opened_at / violation_closed_at を除いたもの。
+    """
+    principal_scope = SOD_PRINCIPAL_SCOPE_SQL if scoped else ""
+    workspace_grants = ""
+    if workspace_table_fqn:
+        workspace_grants = SOD_WORKSPACE_GRANTS_TEMPLATE.format(workspace_table_fqn=workspace_table_fqn, principal_scope=principal_scope)
+    permission_roles = SOD_PERMISSION_ROLES_TEMPLATE.format(role_permissions_fqn=role_permissions_fqn) if role_permissions_fqn else ""
+    return SOD_VIOLATIONS_QUERY_TEMPLATE.format(
+        access_source=access_source, workspace_grants=workspace_grants, principal_scope=principal_scope,
+        permission_roles=permission_roles
+    )
+
+
+# access_changes_sql で使用するテンプレート。各バインディング (リソース, プリンシパル, ロール) を
+# FARM_FINGERPRINT で64ビットの整数にし、2つのスナップショットをその整数同士の結合 (ハッシュ結合) で突き合わせる
+ACCESS_CHANGES_QUERY_TEMPLATE = """
+WITH CurrentBindings AS (
+    {current_bindings}
+), PreviousBindings AS (
+    {previous_bindings}
+)
+SELECT
+    TIMESTAMP(@snapshot_timestamp) AS assessment_timestamp,
+    TIMESTAMP(@previous_snapshot_timestamp) AS previous_assessment_timestamp,
+    'ADDED' AS change_type,
+    c.*
+FROM CurrentBindings AS c
+LEFT JOIN PreviousBindings AS p USING (binding_fingerprint)
+WHERE p.binding_fingerprint IS NULL
+UNION ALL
+SELECT
+    TIMESTAMP(@snapshot_timestamp),
+    TIMESTAMP(@previous_snapshot_timestamp),
+    'REMOVED',
+    p.*
+FROM PreviousBindings AS p
+LEFT JOIN CurrentBindings AS c USING (binding_fingerprint)
+WHERE c.binding_fingerprint IS NULL
+"""
+
+# バインディングの安定したフィンガープリント。区切り文字には名前に現れない制御文字 (\x1f) を使う
+BINDING_FINGERPRINT_SQL = (
+    "FARM_FINGERPRINT(CONCAT(IFNULL(resource_name, ''), '\\x1f', IFNULL(principal_type, ''), ':', principal_email, "
+    "'\\x1f', IFNULL(role, '')))"
+)
+
+
+def _bindings_sql(access_source: str) -> str:
+    # 同じバインディングが複数のスコープから見える場合があるため、フィンガープリントごとに1行にまとめる
+    return (
+        f"SELECT {BINDING_FINGERPRINT_SQL} AS binding_fingerprint, "
+        "ANY_VALUE(scope) AS scope, ANY_VALUE(principal_type) AS principal_type, ANY_VALUE(principal_email) AS principal_email, "
+        "ANY_VALUE(resource_name) AS resource_name, ANY_VALUE(role) AS role "
+        f"FROM {access_source} GROUP BY binding_fingerprint"
+    )
+
+
+def access_changes_sql(current_source: str, previous_source: str) -> str:
+    """
+    2つのスナップショット (access_source_sql の結果) の間で、追加・削除されたバインディングのみを返すクエリを生成する。
+    スナップショットの時刻は @snapshot_timestamp / @previous_snapshot_timestamp パラメータで渡す。
+    列は access_changes テーブルのスキーマと同じ。
+    """
+    return ACCESS_CHANGES_QUERY_TEMPLATE.format(
+        current_bindings=_bindings_sql(current_source), previous_bindings=_bindings_sql(previous_source)
+    )
@@ -10,6 +10,10 @@ locals {
       environment_variables = config.environment_variables
     }
   }
+
+  # 修正点: 作成するテーブル (table_schemas のキー)。テーブルが作成される場合のみ、そのテーブルを使う環境変数を設定する
+  bq_tables          = keys(var.table_schemas)
+  resource_assessors = ["gcs-assessor", "bq-assessor", "compute-assessor"]
 }
 
 # --- 必要なAPIを有効化 ---
@@ -57,7 +61,26 @@ module "assessment_functions" {
     } : {},
     # overpermission-analyzerにだけ追加したい環境変数 (tfvarsに移行可能だが互換性のため残す)
     each.key == "overpermission-analyzer" ? {
-      RECOMMENDER_PARENT = var.assessment_scope == "ORGANIZATION" ? "organizations/${var.org_id}" : "projects/${var.target_project_ids[0]}"
+      # 変更点: 評価スコープ配下の全プロジェクトの推奨を取得する (組織モードでは Cloud Asset Inventory でプロジェクトを列挙)
+      ASSESSMENT_SCOPES = jsonencode(var.assessment_scope == "ORGANIZATION" ? ["organizations/${var.org_id}"] : [for p in var.target_project_ids : "projects/${p}"])
+    } : {},
+
+    # 修正点: パイプラインの補助テーブル (実行台帳・etagキャッシュ・グループのハッシュ・アクセスファクト・分析キャッシュ)。
+    # 未設定のままでは、デプロイしたFunctionはこれらのテーブルに書き込まない
+    contains(local.bq_tables, "pipeline_runs") ? {
+      PIPELINE_RUNS_TABLE_ID = "pipeline_runs"
+    } : {},
+    (contains(local.resource_assessors, each.key) || each.key == "carry-forward-finalizer") && contains(local.bq_tables, "resource_policy_etags") ? {
+      POLICY_ETAG_TABLE_ID = "resource_policy_etags"
+    } : {},
+    (contains(local.resource_assessors, each.key) || each.key == "group-assessor") && contains(local.bq_tables, "group_membership_hashes") ? {
+      GROUP_HASH_TABLE_ID = "group_membership_hashes"
+    } : {},
+    (each.key == "principal-assessor" || var.assessment_functions[each.key].category == "analyzers") && contains(local.bq_tables, "access_facts") ? {
+      ACCESS_FACTS_TABLE_ID = "access_facts"
+    } : {},
+    var.assessment_functions[each.key].category == "analyzers" && contains(local.bq_tables, "analysis_fingerprints") ? {
+      ANALYSIS_CACHE_TABLE_ID = "analysis_fingerprints"
     } : {},
 
     # 修正点: tfvarsから渡されたFunction固有の環境変数をマージ
@@ -117,6 +140,7 @@ module "bq_storage" {
   project_id       = var.project_id
   dataset_id       = var.bq_dataset_id
   table_schemas    = var.table_schemas
+  table_options    = var.bq_table_options
   dataset_location = var.bq_dataset_location
 }
 
@@ -18,4 +18,15 @@ resource "google_bigquery_table" "assessment_tables" {
   # file()関数で、マップの値 (例: "../schemas/iam_policy_schema.json") で
   # 指定されたファイルの内容を文字列として読み込む
   schema = file(each.value)
+
+  # 変更点: table_optionsで指定されたテーブルのみ、日単位のパーティションとクラスタリングを設定する
+  dynamic "time_partitioning" {
+    for_each = try(var.table_options[each.key].partition_field, null) != null ? [var.table_options[each.key]] : []
+    content {
+      type  = "DAY"
+      field = time_partitioning.value.partition_field
+    }
+  }
+
+  clustering = try(var.table_options[each.key].clustering, null)
 }
\ No newline at end of file
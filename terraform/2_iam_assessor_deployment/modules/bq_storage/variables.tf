@@ -14,6 +14,16 @@ variable "table_schemas" {
   default     = {}
 }
 
+# 変更点: テーブルごとのパーティション列とクラスタ列を受け取る変数を追加
+variable "table_options" {
+  type = map(object({
+    partition_field = optional(string)
+    clustering      = optional(list(string))
+  }))
+  description = "テーブル名をキーとした、パーティション列 (TIMESTAMP, 日単位) とクラスタ列の設定。"
+  default     = {}
+}
+
 variable "dataset_location" {
   type        = string
   description = "BigQueryデータセットを作成するロケーション。"
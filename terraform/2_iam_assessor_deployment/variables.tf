@@ -41,6 +41,43 @@ variable "table_schemas" {
   default     = {}
 }
 
+variable "bq_table_options" {
+  type = map(object({
+    partition_field = optional(string)
+    clustering      = optional(list(string))
+  }))
+  description = <<-EOT
+    テーブル名をキーとした、パーティション列とクラスタ列の設定。table_schemasに存在するテーブルにのみ適用される。
+    analyzerは最新のスナップショット (assessment_timestamp) のみを参照するため、スナップショットを蓄積する
+    テーブルは assessment_timestamp でパーティション分割しておくことで、スキャン量が履歴の長さに比例しなくなる。
+    注意: 既存テーブルのパーティション設定を変更すると、テーブルが再作成され履歴が失われる。
+    既定値は新しく作成するテーブルのみを対象とする。既存の principal_access_list と unified_access_permissions を
+    分割する場合は、README の「既存テーブルのパーティション分割」の手順でデータを移行してから追加すること。
+  EOT
+  default     = {
+    # analyzerが参照するフラット化されたアクセスファクト。評価日で分割し、ロールとプリンシパルでクラスタ化する
+    access_facts = {
+      partition_field = "assessment_timestamp"
+      clustering      = ["role", "principal_email"]
+    }
+    # アクセスの差分。スナップショット単位の DELETE と参照を検出日のパーティションに限定する
+    access_changes = {
+      partition_field = "assessment_timestamp"
+      clustering      = ["principal_email", "role"]
+    }
+    # ポリシーの etag キャッシュ。直近7日の参照をパーティションで絞り込み、resource_type ごとの読み込みをクラスタで絞り込む
+    resource_policy_etags = {
+      partition_field = "assessment_timestamp"
+      clustering      = ["resource_type", "resource_name"]
+    }
+    # 実行台帳。週をまたいだ推移を呼び出しの開始日で絞り込み、実行とステージでクラスタ化する
+    pipeline_runs = {
+      partition_field = "started_at"
+      clustering      = ["run_id", "stage"]
+    }
+  }
+}
+
 variable "enabled_apis" {
   type        = list(string)
   description = "プロジェクトで有効化するAPIのリスト。"
@@ -0,0 +1,81 @@
+import os
+import types
+from unittest import mock
+import importlib
+import pytest
+
+from src.utils import sql_helpers, instrumentation
+
+# Target module path
+MODULE_PATH = 'src.analyzers.access_drift_analyzer.main'
+SNAPSHOT = '2026-01-02T00:00:00+00:00'
+PREVIOUS = '2026-01-01T00:00:00+00:00'
+
+
+def import_module_with_env(env: dict, bq_helpers):
+    """Helper to import the module fresh with specific env vars and mocked dependencies."""
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': bq_helpers,
+        'utils.sql_helpers': sql_helpers,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': types.SimpleNamespace(
+            ScalarQueryParameter=lambda name, type_, value: types.SimpleNamespace(name=name, type_=type_, value=value)
+        ),
+    }), mock.patch.dict(os.environ, env, clear=False):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+@pytest.fixture(autouse=True)
+def isolate_env(monkeypatch):
+    for k in ['SOURCE_TABLE_ID', 'DESTINATION_TABLE_ID', 'ACCESS_FACTS_TABLE_ID']:
+        monkeypatch.delenv(k, raising=False)
+
+
+def _bq_helpers(previous):
+    return types.SimpleNamespace(
+        run_query_and_save_results=mock.MagicMock(return_value={}),
+        run_dml_query=mock.MagicMock(),
+        resolve_snapshot_timestamp=mock.MagicMock(return_value=SNAPSHOT),
+        resolve_previous_snapshot_timestamp=mock.MagicMock(return_value=previous),
+    )
+
+
+ENV = {
+    'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds',
+    'ACCESS_FACTS_TABLE_ID': 'access_facts', 'DESTINATION_TABLE_ID': 'access_changes',
+}
+
+
+def test_consecutive_snapshots_are_diffed_by_binding_fingerprint():
+    bq_helpers = _bq_helpers(PREVIOUS)
+    mod = import_module_with_env(ENV, bq_helpers)
+    mod.analyze_access_drift(types.SimpleNamespace(data={}))
+
+    # 再実行に備えて、このスナップショットの差分を先に消してから追記する
+    delete_query = bq_helpers.run_dml_query.call_args[0][0]
+    assert delete_query.startswith('DELETE FROM `proj.ds.access_changes`')
+
+    kwargs = bq_helpers.run_query_and_save_results.call_args[1]
+    query = kwargs['query']
+    assert kwargs['write_disposition'] == 'WRITE_APPEND'
+    assert f"assessment_timestamp = TIMESTAMP('{SNAPSHOT}')" in query
+    assert f"assessment_timestamp = TIMESTAMP('{PREVIOUS}')" in query
+    assert query.count('FARM_FINGERPRINT') == 2
+    assert 'USING (binding_fingerprint)' in query
+    assert {p.name: p.value for p in kwargs['query_parameters']} == {
+        'snapshot_timestamp': SNAPSHOT, 'previous_snapshot_timestamp': PREVIOUS,
+    }
+
+
+def test_first_snapshot_writes_nothing():
+    bq_helpers = _bq_helpers(None)
+    mod = import_module_with_env(ENV, bq_helpers)
+    mod.analyze_access_drift(types.SimpleNamespace(data={}))
+
+    bq_helpers.run_dml_query.assert_not_called()
+    bq_helpers.run_query_and_save_results.assert_not_called()
@@ -0,0 +1,148 @@
+import os
+import types
+from unittest import mock
+import importlib
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from src.utils import instrumentation
+
+# Target module path
+MODULE_PATH = 'src.analyzers.overpermission_analyzer.main'
+
+
+def _recommendation(member, role='roles/editor'):
+    return types.SimpleNamespace(
+        content=types.SimpleNamespace(overview={'member': member, 'resource': '//p', 'role': role}, operations=[]),
+        recommender_subtype='REMOVE_ROLE',
+    )
+
+
+def _page(recommendations, next_page_token=''):
+    response = types.SimpleNamespace(recommendations=recommendations, next_page_token=next_page_token)
+    return types.SimpleNamespace(pages=iter([response]))
+
+
+def import_rate_limiter():
+    """Helper to import the shared rate limiter with a mocked logger (the module is kept out of sys.modules)."""
+    with mock.patch.dict(importlib.sys.modules, {
+        'src.utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+    }):
+        importlib.sys.modules.pop('src.utils.rate_limiter', None)
+        return importlib.import_module('src.utils.rate_limiter')
+
+
+rate_limiter = import_rate_limiter()
+
+
+def import_module_with_env(env: dict, asset_client, recommender_client, load_rows_to_table, bq_helpers: dict = None):
+    """Helper to import the module fresh with specific env vars and mocked dependencies."""
+    bq_helpers = {'run_dml_query': mock.MagicMock(), 'copy_table': mock.MagicMock(), **(bq_helpers or {})}
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.gcp_clients': types.SimpleNamespace(asset_client=asset_client, recommender_client=recommender_client),
+        'utils.bq_helpers': types.SimpleNamespace(load_rows_to_table=load_rows_to_table, **bq_helpers),
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.rate_limiter': rate_limiter,
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+    }), mock.patch.dict(os.environ, env, clear=False):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+@pytest.fixture(autouse=True)
+def isolate_env(monkeypatch):
+    for k in ['ASSESSMENT_SCOPES', 'RECOMMENDER_PARENT', 'DESTINATION_TABLE_ID', 'LOAD_BATCH_SIZE', 'RECOMMENDER_MAX_WORKERS']:
+        monkeypatch.delenv(k, raising=False)
+
+
+def test_scopes_expand_to_project_parents_and_results_are_loaded_in_batches():
+    asset_client = mock.MagicMock()
+    asset_client.search_all_resources.return_value = types.SimpleNamespace(pages=iter([types.SimpleNamespace(
+        results=[types.SimpleNamespace(project='projects/111'), types.SimpleNamespace(project='projects/222')],
+        next_page_token='',
+    )]))
+    pages = {
+        ('projects/111/locations/global/recommenders/google.iam.policy.Recommender', ''): _page([_recommendation('user:a')], 'next'),
+        ('projects/111/locations/global/recommenders/google.iam.policy.Recommender', 'next'): _page([_recommendation('user:b')]),
+        ('projects/222/locations/global/recommenders/google.iam.policy.Recommender', ''): _page([_recommendation('user:c')]),
+    }
+    recommender_client = mock.MagicMock()
+    recommender_client.list_recommendations.side_effect = lambda request, timeout: pages[(request['parent'], request['page_token'])]
+    load_rows_to_table = mock.MagicMock()
+    copy_table = mock.MagicMock()
+
+    mod = import_module_with_env(
+        {'ASSESSMENT_SCOPES': '["organizations/1", "projects/111"]', 'DESTINATION_TABLE_ID': 'overpermission_risks', 'LOAD_BATCH_SIZE': '2'},
+        asset_client, recommender_client, load_rows_to_table, {'copy_table': copy_table}
+    )
+    mod.analyze_overpermission(types.SimpleNamespace(data={}))
+
+    assert asset_client.search_all_resources.call_count == 1 # プロジェクトのスコープは列挙しない
+    assert recommender_client.list_recommendations.call_count == 3
+    # バッチはステージングテーブルに追記し、最後に宛先と入れ替える
+    assert [(c.args[1], c.kwargs['write_disposition']) for c in load_rows_to_table.call_args_list] == [
+        ('overpermission_risks_staging', 'WRITE_APPEND'), ('overpermission_risks_staging', 'WRITE_APPEND'),
+    ]
+    members = sorted(row['principal_email'] for c in load_rows_to_table.call_args_list for row in c.args[0])
+    assert members == ['user:a', 'user:b', 'user:c']
+    copy_table.assert_called_once_with('overpermission_risks_staging', 'overpermission_risks', write_disposition='WRITE_TRUNCATE')
+
+
+def test_quota_errors_are_retried_and_inaccessible_parents_are_skipped():
+    calls = {'n': 0}
+
+    def list_recommendations(request, timeout):
+        if request['parent'].startswith('projects/denied/'):
+            raise api_exceptions.PermissionDenied('recommender API disabled')
+        calls['n'] += 1
+        if calls['n'] == 1:
+            raise api_exceptions.ResourceExhausted('quota')
+        return _page([_recommendation('user:a')])
+
+    recommender_client = mock.MagicMock()
+    recommender_client.list_recommendations.side_effect = list_recommendations
+    load_rows_to_table = mock.MagicMock()
+
+    mod = import_module_with_env(
+        {'ASSESSMENT_SCOPES': '["projects/ok", "projects/denied"]', 'DESTINATION_TABLE_ID': 'overpermission_risks'},
+        mock.MagicMock(), recommender_client, load_rows_to_table
+    )
+    with mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+        mod.analyze_overpermission(types.SimpleNamespace(data={}))
+
+    assert sleep.call_count == 1
+    (rows, table_id), kwargs = load_rows_to_table.call_args
+    assert table_id == 'overpermission_risks_staging'
+    assert [r['principal_email'] for r in rows] == ['user:a']
+
+
+def test_destination_is_replaced_even_without_recommendations_and_kept_when_a_parent_fails():
+    def list_recommendations(request, timeout):
+        if request['parent'].startswith('projects/broken/'):
+            raise RuntimeError('backend error')
+        return _page([])
+
+    recommender_client = mock.MagicMock()
+    recommender_client.list_recommendations.side_effect = list_recommendations
+
+    # 推奨が0件でも、空のステージングテーブルで宛先を洗い替える
+    copy_table = mock.MagicMock()
+    mod = import_module_with_env(
+        {'ASSESSMENT_SCOPES': '["projects/ok"]', 'DESTINATION_TABLE_ID': 'overpermission_risks'},
+        mock.MagicMock(), recommender_client, mock.MagicMock(), {'copy_table': copy_table}
+    )
+    mod.analyze_overpermission(types.SimpleNamespace(data={}))
+    copy_table.assert_called_once()
+
+    # 一部の親リソースで失敗した場合は、宛先を更新せずに失敗させる
+    copy_table = mock.MagicMock()
+    mod = import_module_with_env(
+        {'ASSESSMENT_SCOPES': '["projects/ok", "projects/broken"]', 'DESTINATION_TABLE_ID': 'overpermission_risks'},
+        mock.MagicMock(), recommender_client, mock.MagicMock(), {'copy_table': copy_table}
+    )
+    with pytest.raises(RuntimeError, match='1 of 2 parents'):
+        mod.analyze_overpermission(types.SimpleNamespace(data={}))
+    copy_table.assert_not_called()
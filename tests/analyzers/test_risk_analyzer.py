@@ -0,0 +1,99 @@
+import os
+import re
+import json
+import types
+from unittest import mock
+import importlib
+import pytest
+
+from src.utils import sql_helpers, instrumentation
+
+# Target module path
+MODULE_PATH = 'src.analyzers.risk_analyzer.main'
+SNAPSHOT = '2026-01-01T00:00:00+00:00'
+
+
+def import_module_with_env(env: dict, run_query_and_save_results):
+    """Helper to import the module fresh with specific env vars and mocked dependencies."""
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': types.SimpleNamespace(
+            run_query_and_save_results=run_query_and_save_results,
+            resolve_snapshot_timestamp=mock.MagicMock(return_value=SNAPSHOT),
+            lookup_analysis_cache=mock.MagicMock(return_value=(False, None)),
+            record_analysis_fingerprint=mock.MagicMock(),
+        ),
+        'utils.sql_helpers': sql_helpers,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': types.SimpleNamespace(
+            ScalarQueryParameter=lambda name, type_, value: types.SimpleNamespace(name=name, type_=type_, value=value)
+        ),
+    }), mock.patch.dict(os.environ, env, clear=False):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+@pytest.fixture(autouse=True)
+def isolate_env(monkeypatch):
+    for k in ['SOURCE_TABLE_ID', 'DESTINATION_TABLE_ID', 'HIGH_RISK_ROLES_JSON', 'ACCESS_FACTS_TABLE_ID', 'ANALYSIS_CACHE_TABLE_ID', 'ROLE_PERMISSIONS_TABLE_ID']:
+        monkeypatch.delenv(k, raising=False)
+
+
+def _env(catalog):
+    return {
+        'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds',
+        'SOURCE_TABLE_ID': 'principal_access_list', 'DESTINATION_TABLE_ID': 'high_risk_findings',
+        'HIGH_RISK_ROLES_JSON': json.dumps(catalog),
+    }
+
+
+def test_catalog_is_passed_as_parameter_and_query_does_not_depend_on_it():
+    queries = []
+    for catalog in ({'roles/owner': 'ADMIN'}, {f'roles/custom{i}': 'CUSTOM' for i in range(2000)}):
+        run_query_and_save_results = mock.MagicMock()
+        mod = import_module_with_env(_env(catalog), run_query_and_save_results)
+        mod.analyze_high_risk_roles(types.SimpleNamespace(data={}))
+
+        kwargs = run_query_and_save_results.call_args[1]
+        (param,) = kwargs['query_parameters']
+        assert param.name == 'high_risk_roles'
+        assert len(json.loads(param.value)) == len(catalog)
+        queries.append(kwargs['query'])
+
+    assert queries[0] == queries[1]
+    assert 'roles/owner' not in queries[0]
+    assert 'INNER JOIN RoleCategories' in queries[0]
+
+
+def test_wildcard_patterns_become_anchored_regexes():
+    run_query_and_save_results = mock.MagicMock()
+    mod = import_module_with_env(_env({
+        'roles/owner': 'ADMIN',
+        'roles/*.admin': 'SERVICE_ADMIN',
+        'projects/*/roles/*': 'CUSTOM',
+    }), run_query_and_save_results)
+
+    rows = mod._build_catalog_rows(mod.HIGH_RISK_ROLES)
+
+    assert rows[0] == {'role': 'roles/owner', 'category': 'ADMIN'}
+    service_admin = re.compile(rows[1]['pattern'])
+    assert service_admin.match('roles/storage.admin')
+    assert not service_admin.match('roles/storage.adminViewer')
+    assert not service_admin.match('xroles/storage.admin')
+    assert re.compile(rows[2]['pattern']).match('projects/my-proj/roles/myCustomRole')
+
+
+def test_permission_entries_use_role_permissions_table():
+    run_query_and_save_results = mock.MagicMock()
+    env = dict(_env({'roles/owner': 'ADMIN', 'permission:*.setIamPolicy': 'IAM_ADMIN'}), ROLE_PERMISSIONS_TABLE_ID='role_permissions')
+    mod = import_module_with_env(env, run_query_and_save_results)
+    mod.analyze_high_risk_roles(types.SimpleNamespace(data={}))
+
+    kwargs = run_query_and_save_results.call_args[1]
+    assert 'FROM `proj.ds.role_permissions` AS rp' in kwargs['query']
+    assert 'SELECT role, category FROM PermissionRoles' in kwargs['query']
+    catalog = json.loads(kwargs['query_parameters'][0].value)
+    assert catalog[1] == {'permission_pattern': r'^.*\.setIamPolicy$', 'category': 'IAM_ADMIN'}
@@ -6,6 +6,8 @@ from unittest import mock
 import importlib
 import pytest
 
+from src.utils import sql_helpers, sod_rules, instrumentation
+
 # Target module path
 MODULE_PATH = 'src.analyzers.sod-analyzer.main'
 
@@ -13,9 +15,9 @@ MODULE_PATH = 'src.analyzers.sod-analyzer.main'
 # New behaviors to test (documented for clarity):
 # 1) Invalid JSON in SOD_RULES_JSON should log a warning and trigger TRUNCATE.
 # 2) Unsupported role type combinations should be skipped and included in skipped results.
-# 3) Workspace vs Workspace rule should generate proper query including assignments placeholder.
-# 4) GCP vs Workspace rule should join workspace table and include assignments from source table.
-# 5) SQL IN clause should correctly handle single role strings provided (converted to lists by module).
+# 3) Workspace rules should add the workspace table to the single grants scan.
+# 4) All rules are passed as one JSON query parameter, so the query text does not depend on the rules.
+# 5) Single role strings are converted to lists by the module.
 
 
 def import_module_with_env(env: dict):
@@ -36,7 +38,7 @@ def isolate_env(monkeypatch):
     # Ensure unrelated env vars don't leak
     keys = [
         'BQ_PROJECT_ID', 'BQ_DATASET_ID', 'SOURCE_TABLE_ID', 'DESTINATION_TABLE_ID',
-        'WORKSPACE_ROLES_TABLE_ID', 'SOD_RULES_JSON'
+        'WORKSPACE_ROLES_TABLE_ID', 'SOD_RULES_JSON', 'ACCESS_FACTS_TABLE_ID', 'ANALYSIS_CACHE_TABLE_ID', 'SOD_MODE'
     ]
     for k in keys:
         monkeypatch.delenv(k, raising=False)
@@ -47,6 +49,29 @@ def dummy_event():
     return DummyCloudEvent()
 
 
+SNAPSHOT = '2026-01-01T00:00:00+00:00'
+_resolve_snapshot = mock.MagicMock(return_value=SNAPSHOT)
+# ScalarQueryParameter は渡された引数をそのまま保持する
+_BIGQUERY = types.SimpleNamespace(
+    ScalarQueryParameter=lambda name, type_, value: types.SimpleNamespace(name=name, type_=type_, value=value),
+    ArrayQueryParameter=lambda name, type_, values: types.SimpleNamespace(name=name, type_=type_, value=values),
+)
+_BQ_DEFAULTS = dict(
+    lookup_analysis_cache=mock.MagicMock(return_value=(False, None)),
+    record_analysis_fingerprint=mock.MagicMock(),
+    run_dml_query=mock.MagicMock(),
+    fetch_query_rows=mock.MagicMock(return_value=[]),
+    fetch_analysis_fingerprint=mock.MagicMock(return_value=None),
+)
+
+
+def _rules_param(run_query_and_save_results):
+    """実行されたクエリに渡された sod_rules パラメータをデコードして返す"""
+    params = {p.name: p for p in run_query_and_save_results.call_args[1]['query_parameters']}
+    param = params['sod_rules']
+    return {rule['rule_id']: rule for rule in json.loads(param.value)}
+
+
 def _base_env(**overrides):
     base = {
         'BQ_PROJECT_ID': 'proj',
@@ -70,16 +95,20 @@ def test_truncate_when_no_rules(monkeypatch, dummy_event):
 
     # Provide utils modules
     utils_pkg = types.SimpleNamespace()
-    bq_helpers_mod = types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results)
+    bq_helpers_mod = types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS)
     logging_handler_mod = types.SimpleNamespace(get_logger=get_logger)
     gcp_clients_mod = types.SimpleNamespace(bigquery_client=mock.MagicMock())
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': utils_pkg,
         'utils.bq_helpers': bq_helpers_mod,
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': logging_handler_mod,
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': gcp_clients_mod,
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -107,10 +136,14 @@ def test_missing_required_env_raises(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=mock.MagicMock()),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=mock.MagicMock(), resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -143,10 +176,14 @@ def test_skips_workspace_rules_when_table_missing(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=bigquery_client),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=NotFoundEx),
     }):
         mod = import_module_with_env(env)
@@ -161,7 +198,7 @@ def test_skips_workspace_rules_when_table_missing(monkeypatch, dummy_event):
     assert 'UNION ALL' not in kwargs['query'] or 'SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE' in kwargs['query']
 
 
-def test_gcp_vs_gcp_rule_generates_union_query(monkeypatch, dummy_event):
+def test_gcp_vs_gcp_rule_is_passed_as_parameter(monkeypatch, dummy_event):
     # Arrange: simple GCP vs GCP
     rules = [{
         'rule_id': 'R2', 'description': 'desc2',
@@ -175,10 +212,14 @@ def test_gcp_vs_gcp_rule_generates_union_query(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -186,12 +227,17 @@ def test_gcp_vs_gcp_rule_generates_union_query(monkeypatch, dummy_event):
     # Act
     mod.analyze_sod_violations(dummy_event)
 
-    # Assert: query contains both IN clauses and assignments aggregation
+    # Assert: roles are passed as a parameter and the source is scanned only once
     _, kwargs = run_query_and_save_results.call_args
     q = kwargs['query']
-    assert "IN ('roles/a','roles/b')" in q
-    assert "IN ('roles/c')" in q
-    assert 'ARRAY_AGG(STRUCT(a.resource_name, a.role))' in q
+    assert 'roles/a' not in q
+    assert q.count('`proj.ds.principal_access_list`') == 1
+    assert 'JSON_QUERY_ARRAY(@sod_rules)' in q
+    assert 'ARRAY_AGG(STRUCT(g.resource_name, g.role)' in q
+    rule = _rules_param(run_query_and_save_results)['R2']
+    assert rule['role1'] == ['roles/a', 'roles/b']
+    assert rule['role2'] == ['roles/c']
+    assert rule['skipped'] is False
 
 
 def test_empty_after_all_rules_skipped_truncates(monkeypatch, dummy_event):
@@ -204,10 +250,14 @@ def test_empty_after_all_rules_skipped_truncates(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -228,10 +278,14 @@ def test_invalid_json_triggers_truncate(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -257,10 +311,14 @@ def test_unsupported_role_types_are_skipped(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -268,9 +326,9 @@ def test_unsupported_role_types_are_skipped(monkeypatch, dummy_event):
     mod.analyze_sod_violations(dummy_event)
 
     q = run_query_and_save_results.call_args[1]['query']
-    # There should be only a skipped row produced
+    # The rule is passed through as skipped and produces only a skipped row
     assert 'SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE' in q
-    assert 'UNION ALL' not in q or q.strip().startswith("SELECT 'R4'")
+    assert _rules_param(run_query_and_save_results)['R4']['skipped'] is True
 
 
 def test_workspace_vs_workspace_query(monkeypatch, dummy_event):
@@ -290,10 +348,14 @@ def test_workspace_vs_workspace_query(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=bigquery_client),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -302,8 +364,9 @@ def test_workspace_vs_workspace_query(monkeypatch, dummy_event):
 
     q = run_query_and_save_results.call_args[1]['query']
     assert 'FROM `proj.ds.workspace_roles`' in q
-    assert "'WORKSPACE_ADMIN' AS role1_type" in q
-    assert 'STRUCT(CAST(NULL AS STRING), ' in q  # assignments placeholder
+    rule = _rules_param(run_query_and_save_results)['R5']
+    assert (rule['role1_type'], rule['role2_type']) == ('WORKSPACE_ADMIN', 'WORKSPACE_ADMIN')
+    assert rule['skipped'] is False
 
 
 def test_gcp_vs_workspace_query(monkeypatch, dummy_event):
@@ -322,10 +385,14 @@ def test_gcp_vs_workspace_query(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=bigquery_client),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
@@ -333,12 +400,12 @@ def test_gcp_vs_workspace_query(monkeypatch, dummy_event):
     mod.analyze_sod_violations(dummy_event)
 
     q = run_query_and_save_results.call_args[1]['query']
-    assert 'JOIN' in q or 'INNER JOIN' in q
-    assert "'GCP_IAM' AS role1_type" in q and "'WORKSPACE_ADMIN' AS role2_type" in q
-    assert 'ARRAY_AGG(STRUCT(a.resource_name, a.role))' in q
-
+    assert 'FROM `proj.ds.workspace_roles`' in q
+    assert q.count('`proj.ds.principal_access_list`') == 1
+    rule = _rules_param(run_query_and_save_results)['R6']
+    assert (rule['role1_type'], rule['role2_type']) == ('GCP_IAM', 'WORKSPACE_ADMIN')
+    assert rule['skipped'] is False
 
-essage = None
 
 def test_single_role_as_string_is_handled(monkeypatch, dummy_event):
     # Provide role1/role2 as string; module should coerce to lists during import
@@ -354,17 +421,244 @@ def test_single_role_as_string_is_handled(monkeypatch, dummy_event):
 
     with mock.patch.dict(importlib.sys.modules, {
         'utils': types.SimpleNamespace(),
-        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
         'utils.logging_handler': types.SimpleNamespace(get_logger=get_logger),
+        'utils.instrumentation': instrumentation,
+        'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
+        'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
+    }):
+        mod = import_module_with_env(env)
+
+    mod.analyze_sod_violations(dummy_event)
+
+    rule = _rules_param(run_query_and_save_results)['R7']
+    assert rule['role1'] == ['roles/storage.admin']
+    assert rule['role2'] == ['roles/owner']
+
+
+
+def test_queries_are_restricted_to_resolved_snapshot(monkeypatch, dummy_event):
+    rules = [{
+        'rule_id': 'R8', 'description': 'snapshot',
+        'role1': ['roles/a'], 'role2': ['roles/b'],
+        'role1_type': 'GCP_IAM', 'role2_type': 'GCP_IAM'
+    }]
+    env = _base_env(SOD_RULES_JSON=json.dumps(rules), ACCESS_FACTS_TABLE_ID='access_facts')
+
+    run_query_and_save_results = mock.MagicMock()
+    resolve_snapshot = mock.MagicMock(return_value=SNAPSHOT)
+
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=resolve_snapshot, **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
         'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
         'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
         'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
     }):
         mod = import_module_with_env(env)
 
     mod.analyze_sod_violations(dummy_event)
 
+    assert resolve_snapshot.call_args[0][1] == '`proj.ds.access_facts`'
     q = run_query_and_save_results.call_args[1]['query']
-    assert "IN ('roles/storage.admin')" in q
-    assert "IN ('roles/owner')" in q
+    assert 'principal_access_list' not in q
+    assert f"FROM `proj.ds.access_facts` WHERE assessment_timestamp = TIMESTAMP('{SNAPSHOT}')" in q
+
+
+def test_no_snapshot_skips_analysis(monkeypatch, dummy_event):
+    rules = [{'rule_id': 'R9', 'role1': ['roles/a'], 'role2': ['roles/b']}]
+    env = _base_env(SOD_RULES_JSON=json.dumps(rules))
+
+    run_query_and_save_results = mock.MagicMock()
+
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=mock.MagicMock(return_value=None), **_BQ_DEFAULTS),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
+        'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
+    }):
+        mod = import_module_with_env(env)
+
+    mod.analyze_sod_violations(dummy_event)
+
+    run_query_and_save_results.assert_not_called()
+
+
+def test_unchanged_sources_skip_analysis(monkeypatch, dummy_event):
+    rules = [{'rule_id': 'R10', 'role1': ['roles/a'], 'role2': ['roles/b']}]
+    env = _base_env(SOD_RULES_JSON=json.dumps(rules), ANALYSIS_CACHE_TABLE_ID='analysis_fingerprints')
+
+    run_query_and_save_results = mock.MagicMock()
+    lookup_analysis_cache = mock.MagicMock(return_value=(True, 'abc'))
+    record_analysis_fingerprint = mock.MagicMock()
+
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': types.SimpleNamespace(**{
+            **_BQ_DEFAULTS,
+            'run_query_and_save_results': run_query_and_save_results, 'resolve_snapshot_timestamp': _resolve_snapshot,
+            'lookup_analysis_cache': lookup_analysis_cache, 'record_analysis_fingerprint': record_analysis_fingerprint,
+        }),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
+        'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
+    }):
+        mod = import_module_with_env(env)
 
+    mod.analyze_sod_violations(dummy_event)
+
+    assert lookup_analysis_cache.call_args[0][0] == 'analysis_fingerprints'
+    assert lookup_analysis_cache.call_args[0][1] == 'analyze_sod_violations'
+    run_query_and_save_results.assert_not_called()
+    record_analysis_fingerprint.assert_not_called()
+
+
+def test_query_text_does_not_grow_with_rule_count(monkeypatch, dummy_event):
+    def run_with(rules):
+        run_query_and_save_results = mock.MagicMock()
+        with mock.patch.dict(importlib.sys.modules, {
+            'utils': types.SimpleNamespace(),
+            'utils.bq_helpers': types.SimpleNamespace(run_query_and_save_results=run_query_and_save_results, resolve_snapshot_timestamp=_resolve_snapshot, **_BQ_DEFAULTS),
+            'utils.sql_helpers': sql_helpers,
+            'utils.sod_rules': sod_rules,
+            'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+            'utils.instrumentation': instrumentation,
+            'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
+            'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+            'google.cloud.bigquery': _BIGQUERY,
+            'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
+        }):
+            mod = import_module_with_env(_base_env(SOD_RULES_JSON=json.dumps(rules)))
+        mod.analyze_sod_violations(dummy_event)
+        return run_query_and_save_results
+
+    one = run_with([{'rule_id': 'R0', 'role1': ['roles/a0'], 'role2': ['roles/b0']}])
+    many = run_with([{'rule_id': f'R{i}', 'role1': [f'roles/a{i}'], 'role2': [f'roles/b{i}']} for i in range(300)])
+
+    assert one.call_args[1]['query'] == many.call_args[1]['query']
+    assert len(_rules_param(many)) == 300
+
+
+def _rules_unchanged():
+    """分析結果のキャッシュはミス、ルール定義のフィンガープリントは前回と一致"""
+    return mock.MagicMock(side_effect=lambda table, name, *args: (name.endswith('.rules'), f'{name}-fp'))
+
+
+def _import_incremental(dummy_event, bq_overrides, **env_overrides):
+    rules = [{'rule_id': 'R11', 'role1': ['roles/a'], 'role2': ['roles/b']}]
+    env = _base_env(**{
+        'SOD_RULES_JSON': json.dumps(rules), 'SOD_MODE': 'INCREMENTAL', 'ANALYSIS_CACHE_TABLE_ID': 'analysis_fingerprints', **env_overrides
+    })
+    bq_helpers = {
+        **_BQ_DEFAULTS,
+        'run_query_and_save_results': mock.MagicMock(),
+        'run_dml_query': mock.MagicMock(return_value=1),
+        'resolve_snapshot_timestamp': _resolve_snapshot,
+        **bq_overrides,
+    }
+    with mock.patch.dict(importlib.sys.modules, {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': types.SimpleNamespace(**bq_helpers),
+        'utils.sql_helpers': sql_helpers,
+        'utils.sod_rules': sod_rules,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.gcp_clients': types.SimpleNamespace(bigquery_client=mock.MagicMock()),
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': _BIGQUERY,
+        'google.cloud.exceptions': types.SimpleNamespace(NotFound=type('NF', (), {}) ),
+    }):
+        mod = import_module_with_env(env)
+    mod.analyze_sod_violations(dummy_event)
+    return bq_helpers
+
+
+def test_incremental_merges_only_changed_principals(monkeypatch, dummy_event):
+    # ルール定義は前回と同じ (キャッシュヒット)、前回のスナップショットあり
+    bq = _import_incremental(dummy_event, {
+        'lookup_analysis_cache': _rules_unchanged(),
+        'fetch_analysis_fingerprint': mock.MagicMock(return_value='2025-12-31T00:00:00+00:00'),
+        'fetch_query_rows': mock.MagicMock(return_value=[{'principal_email': 'alice@example.com'}]),
+    })
+
+    changed_query = bq['fetch_query_rows'].call_args[0][0]
+    # 差分は最後にMERGEしたスナップショットとの間で取る
+    assert "TIMESTAMP('2025-12-31T00:00:00+00:00')" in changed_query
+    assert 'FULL OUTER JOIN' in changed_query
+
+    bq['run_query_and_save_results'].assert_not_called()
+    merge_query = bq['run_dml_query'].call_args[0][0]
+    params = {p.name: p.value for p in bq['run_dml_query'].call_args[1]['query_parameters']}
+    assert merge_query.strip().startswith('MERGE `proj.ds.sod_violations`')
+    assert 'AND principal_email IN UNNEST(@changed_principals)' in merge_query
+    assert 'violation_closed_at = TIMESTAMP(@snapshot_timestamp)' in merge_query
+    assert params['changed_principals'] == ['alice@example.com']
+    assert params['full_scope'] is False
+    assert params['rule_ids'] == ['R11']
+    assert params['snapshot_timestamp'] == SNAPSHOT
+    bq['record_analysis_fingerprint'].assert_any_call('analysis_fingerprints', 'analyze_sod_violations.rules', 'analyze_sod_violations.rules-fp')
+
+
+def test_incremental_without_previous_snapshot_evaluates_everyone(monkeypatch, dummy_event):
+    bq = _import_incremental(dummy_event, {})
+
+    bq['fetch_query_rows'].assert_not_called()
+    merge_query = bq['run_dml_query'].call_args[0][0]
+    params = {p.name: p.value for p in bq['run_dml_query'].call_args[1]['query_parameters']}
+    assert 'AND principal_email IN UNNEST(@changed_principals)' not in merge_query
+    assert params['full_scope'] is True
+
+
+def test_incremental_with_no_changes_skips_merge(monkeypatch, dummy_event):
+    bq = _import_incremental(dummy_event, {
+        'lookup_analysis_cache': _rules_unchanged(),
+        'fetch_analysis_fingerprint': mock.MagicMock(return_value='2025-12-31T00:00:00+00:00'),
+        'fetch_query_rows': mock.MagicMock(return_value=[]),
+    })
+
+    bq['run_dml_query'].assert_not_called()
+    # 変更がなくても、このスナップショットまでMERGE済みとして記録する
+    bq['record_analysis_fingerprint'].assert_any_call('analysis_fingerprints', 'analyze_sod_violations.merged_snapshot', SNAPSHOT)
+
+
+def test_incremental_does_not_merge_a_snapshot_older_than_the_last_merged_one(monkeypatch, dummy_event):
+    bq = _import_incremental(dummy_event, {
+        'lookup_analysis_cache': _rules_unchanged(),
+        'fetch_analysis_fingerprint': mock.MagicMock(return_value='2026-01-02T00:00:00+00:00'),
+    })
+
+    bq['fetch_query_rows'].assert_not_called()
+    bq['run_dml_query'].assert_not_called()
+
+
+def test_incremental_requires_the_analysis_cache_table(monkeypatch, dummy_event):
+    with pytest.raises(ValueError, match='ANALYSIS_CACHE_TABLE_ID'):
+        _import_incremental(dummy_event, {}, ANALYSIS_CACHE_TABLE_ID='')
+
+
+def test_incremental_rejects_duplicate_rule_ids_before_merging(monkeypatch, dummy_event):
+    rules = [{'rule_id': 'R1', 'role1': ['roles/a'], 'role2': ['roles/b']}, {'rule_id': 'R1', 'role1': ['roles/c'], 'role2': ['roles/d']}]
+    run_dml_query = mock.MagicMock()
+    with pytest.raises(ValueError, match='Duplicate rule_id'):
+        _import_incremental(dummy_event, {'run_dml_query': run_dml_query}, SOD_RULES_JSON=json.dumps(rules))
+    run_dml_query.assert_not_called()
@@ -0,0 +1,264 @@
+import os
+import json
+import base64
+import types
+from unittest import mock
+import importlib
+import pytest
+
+from src.utils import group_graph, instrumentation, run_ledger
+
+# Target module path
+MODULE_PATH = 'src.assessors.group-assessor.main'
+
+
+def import_module_with_env(env: dict, utils_modules: dict):
+    """Helper to import the module fresh with specific env vars and mocked utils."""
+    with mock.patch.dict(os.environ, env, clear=False), mock.patch.dict(importlib.sys.modules, utils_modules):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+class DummyCloudEvent:
+    def __init__(self, payload=None):
+        self.data = {}
+        if payload is not None:
+            self.data = {'message': {'data': base64.b64encode(json.dumps(payload).encode()).decode()}}
+
+
+@pytest.fixture(autouse=True)
+def isolate_env(monkeypatch):
+    keys = [
+        'BQ_PROJECT_ID', 'BQ_DATASET_ID', 'DESTINATION_TABLE_ID', 'GSUITE_CUSTOMER_ID',
+        'SYNC_MODE', 'GROUP_HASH_TABLE_ID', 'CHANGE_LOG_TABLE_ID', 'TRANSITIVE_TABLE_ID'
+    ]
+    for k in keys:
+        monkeypatch.delenv(k, raising=False)
+
+
+def _base_env(**overrides):
+    base = {
+        'BQ_PROJECT_ID': 'proj',
+        'BQ_DATASET_ID': 'ds',
+        'DESTINATION_TABLE_ID': 'group_membership_details',
+        'GSUITE_CUSTOMER_ID': 'C0123',
+    }
+    base.update(overrides)
+    return base
+
+
+def _membership(email, type_):
+    return types.SimpleNamespace(preferred_member_key=types.SimpleNamespace(id=email), type_=type_)
+
+
+def _group(email):
+    return types.SimpleNamespace(name=f"groups/{email}", group_key=types.SimpleNamespace(id=email))
+
+
+def _utils_modules(identity_client, bq_helpers, bigquery_client=None):
+    return {
+        'utils': types.SimpleNamespace(),
+        'utils.bq_helpers': bq_helpers,
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.run_ledger': run_ledger,
+        'utils.rate_limiter': types.SimpleNamespace(call_api=lambda api_name, func, *args, **kwargs: func(*args, **kwargs)),
+        'utils.gcp_clients': types.SimpleNamespace(identity_client=identity_client, bigquery_client=bigquery_client or mock.MagicMock()),
+        'utils.group_graph': group_graph,
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+        'google.cloud.bigquery': mock.MagicMock(),
+    }
+
+
+def _bq_helpers(fetch_results=()):
+    return types.SimpleNamespace(
+        load_rows_to_table=mock.MagicMock(),
+        run_dml_query=mock.MagicMock(return_value=0),
+        fetch_query_rows=mock.MagicMock(side_effect=list(fetch_results)),
+    )
+
+
+def test_group_hash_is_order_independent():
+    mod = import_module_with_env(_base_env(), _utils_modules(mock.MagicMock(), _bq_helpers()))
+
+    edges = [('a@example.com', 'USER'), ('sa@p.iam.gserviceaccount.com', 'SERVICE_ACCOUNT')]
+    assert mod._compute_group_hash(edges) == mod._compute_group_hash(list(reversed(edges)))
+    assert mod._compute_group_hash(edges) != mod._compute_group_hash(edges[:1])
+
+
+def test_diff_group_edges_returns_added_and_removed():
+    mod = import_module_with_env(_base_env(), _utils_modules(mock.MagicMock(), _bq_helpers()))
+
+    previous = {'g1@example.com': [('a@example.com', 'USER'), ('b@example.com', 'USER')]}
+    current = {'g1@example.com': [('b@example.com', 'USER'), ('c@example.com', 'USER')], 'g2@example.com': []}
+
+    added, removed = mod._diff_group_edges(previous, current)
+
+    assert added == [('g1@example.com', 'c@example.com', 'USER')]
+    assert removed == [('g1@example.com', 'a@example.com', 'USER')]
+
+
+def test_incremental_requires_state_tables():
+    env = _base_env(SYNC_MODE='INCREMENTAL')
+    mod = import_module_with_env(env, _utils_modules(mock.MagicMock(), _bq_helpers()))
+
+    with pytest.raises(ValueError):
+        mod.assess_all_groups(DummyCloudEvent())
+
+
+def test_incremental_skips_membership_writes_when_hashes_unchanged():
+    identity_client = mock.MagicMock()
+    identity_client.search_groups.return_value = [_group('g1@example.com'), _group('broken@example.com')]
+    identity_client.list_memberships.side_effect = [[_membership('a@example.com', 1)], RuntimeError('forbidden')]
+    env = _base_env(SYNC_MODE='INCREMENTAL', GROUP_HASH_TABLE_ID='group_membership_hashes',
+                    CHANGE_LOG_TABLE_ID='group_membership_changes')
+
+    bq_helpers = _bq_helpers()
+    mod = import_module_with_env(env, _utils_modules(identity_client, bq_helpers))
+    previous_hash = mod._compute_group_hash([('a@example.com', 'USER')])
+    bq_helpers.fetch_query_rows.side_effect = [[
+        {'group_email': 'g1@example.com', 'content_hash': previous_hash, 'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+        {'group_email': 'broken@example.com', 'content_hash': 'h-broken', 'assessment_timestamp': '2026-01-01T00:00:00+00:00',
+         'member_count': 7},
+    ]]
+
+    mod.assess_all_groups(DummyCloudEvent())
+
+    # メンバーシップの行は書き換えない
+    bq_helpers.run_dml_query.assert_not_called()
+    # ハッシュは計算時刻を今回のスナップショットに更新する (取得に失敗したグループは前回の行のまま)
+    (hash_rows, table_id, write_disposition), _ = bq_helpers.load_rows_to_table.call_args
+    assert (table_id, write_disposition) == ('group_membership_hashes', 'WRITE_TRUNCATE')
+    by_group = {r['group_email']: r for r in hash_rows}
+    current = by_group['g1@example.com']['snapshot_timestamp']
+    assert by_group['g1@example.com']['assessment_timestamp'] == current != '2026-01-01T00:00:00+00:00'
+    # 今回のスナップショットは、取得に失敗したグループを含むすべての行に記録する
+    assert by_group['broken@example.com'] == {
+        'group_email': 'broken@example.com', 'content_hash': 'h-broken',
+        'assessment_timestamp': '2026-01-01T00:00:00+00:00', 'snapshot_timestamp': current, 'member_count': 7,
+    }
+
+
+def test_incremental_merges_only_changed_edges():
+    identity_client = mock.MagicMock()
+    identity_client.search_groups.return_value = [_group('g1@example.com'), _group('g2@example.com')]
+    identity_client.list_memberships.side_effect = [
+        [_membership('a@example.com', 1), _membership('c@example.com', 1)],  # g1: b removed, c added
+        [_membership('x@example.com', 1)],                                     # g2: unchanged
+    ]
+    env = _base_env(SYNC_MODE='INCREMENTAL', GROUP_HASH_TABLE_ID='group_membership_hashes',
+                    CHANGE_LOG_TABLE_ID='group_membership_changes')
+
+    bq_helpers = _bq_helpers()
+    mod = import_module_with_env(env, _utils_modules(identity_client, bq_helpers))
+    bq_helpers.fetch_query_rows.side_effect = [
+        [
+            {'group_email': 'g1@example.com', 'content_hash': 'stale', 'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+            {'group_email': 'g2@example.com', 'content_hash': mod._compute_group_hash([('x@example.com', 'USER')]),
+             'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+        ],
+        [
+            {'group_email': 'g1@example.com', 'member_email': 'a@example.com', 'member_type': 'USER'},
+            {'group_email': 'g1@example.com', 'member_email': 'b@example.com', 'member_type': 'USER'},
+        ],
+    ]
+
+    mod.assess_all_groups(DummyCloudEvent())
+
+    # Only the changed group's previous edges are read back
+    edges_query_params = bq_helpers.fetch_query_rows.call_args_list[1][1]['query_parameters']
+    assert len(edges_query_params) == 1
+
+    change_log_call, hash_call = bq_helpers.load_rows_to_table.call_args_list
+    change_rows = change_log_call[0][0]
+    assert change_log_call[0][1:] == ('group_membership_changes', 'WRITE_APPEND')
+    assert {(r['change_type'], r['member_email']) for r in change_rows} == {('ADDED', 'c@example.com'), ('REMOVED', 'b@example.com')}
+
+    merge_query = bq_helpers.run_dml_query.call_args[0][0]
+    assert 'MERGE `proj.ds.group_membership_details`' in merge_query
+    assert 'FROM `proj.ds.group_membership_changes`' in merge_query
+    # 変更のない行は書き換えない
+    assert 'NOT MATCHED BY SOURCE' not in merge_query and 'UPDATE' not in merge_query
+
+    assert hash_call[0][1:] == ('group_membership_hashes', 'WRITE_TRUNCATE')
+    assert {r['group_email'] for r in hash_call[0][0]} == {'g1@example.com', 'g2@example.com'}
+
+
+def test_full_sync_writes_transitive_members():
+    identity_client = mock.MagicMock()
+    identity_client.search_groups.return_value = [_group('top@example.com'), _group('sub@example.com')]
+    identity_client.list_memberships.side_effect = [
+        [_membership('sub@example.com', 2)],
+        [_membership('u@example.com', 1)],
+    ]
+    env = _base_env(TRANSITIVE_TABLE_ID='group_transitive_members')
+
+    bq_helpers = _bq_helpers()
+    mod = import_module_with_env(env, _utils_modules(identity_client, bq_helpers))
+
+    mod.assess_all_groups(DummyCloudEvent())
+
+    details_call, transitive_call = bq_helpers.load_rows_to_table.call_args_list
+    assert details_call[0][1:] == ('group_membership_details', 'WRITE_TRUNCATE')
+    assert transitive_call[0][1:] == ('group_transitive_members', 'WRITE_TRUNCATE')
+    nested = [r for r in transitive_call[0][0] if r['group_email'] == 'top@example.com' and r['member_email'] == 'u@example.com']
+    assert nested[0]['depth'] == 2 and nested[0]['path'] == ['top@example.com', 'sub@example.com']
+
+
+def test_dispatched_run_writes_the_dispatcher_snapshot():
+    identity_client = mock.MagicMock()
+    identity_client.search_groups.return_value = [_group('g1@example.com')]
+    identity_client.list_memberships.return_value = [_membership('a@example.com', 1)]
+    bq_helpers = _bq_helpers()
+    mod = import_module_with_env(_base_env(), _utils_modules(identity_client, bq_helpers))
+
+    mod.assess_all_groups(DummyCloudEvent({'scopes': ['organizations/1'], 'assessment_timestamp': '2026-01-02T00:00:00+00:00', 'run_id': 'run-1'}))
+
+    (rows, table_id, _), _ = bq_helpers.load_rows_to_table.call_args
+    assert table_id == 'group_membership_details'
+    assert {r['assessment_timestamp'] for r in rows} == {'2026-01-02T00:00:00+00:00'}
+
+
+def test_transitive_members_are_written_when_the_table_is_empty_and_failed_groups_keep_previous_edges():
+    identity_client = mock.MagicMock()
+    identity_client.search_groups.return_value = [_group('top@example.com'), _group('sub@example.com')]
+    identity_client.list_memberships.side_effect = [[_membership('sub@example.com', 2)], RuntimeError('forbidden')]
+    env = _base_env(SYNC_MODE='INCREMENTAL', GROUP_HASH_TABLE_ID='group_membership_hashes',
+                    CHANGE_LOG_TABLE_ID='group_membership_changes', TRANSITIVE_TABLE_ID='group_transitive_members')
+
+    bq_helpers = _bq_helpers()
+    bigquery_client = mock.MagicMock()
+    bigquery_client.get_table.return_value = types.SimpleNamespace(num_rows=0)
+    mod = import_module_with_env(env, _utils_modules(identity_client, bq_helpers, bigquery_client))
+    top_hash = mod._compute_group_hash([('sub@example.com', 'GROUP')])
+    bq_helpers.fetch_query_rows.side_effect = [
+        # 取得に失敗した sub の前回のエッジ
+        [{'group_email': 'sub@example.com', 'member_email': 'u@example.com', 'member_type': 'USER'}],
+        # 前回のハッシュ (変更なし)
+        [
+            {'group_email': 'top@example.com', 'content_hash': top_hash, 'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+            {'group_email': 'sub@example.com', 'content_hash': 'h-sub', 'assessment_timestamp': '2026-01-01T00:00:00+00:00',
+             'member_count': 1},
+        ],
+    ]
+
+    mod.assess_all_groups(DummyCloudEvent())
+
+    # メンバーシップに変更がなくても、推移閉包テーブルが空なら書き込む
+    transitive_call = bq_helpers.load_rows_to_table.call_args_list[-1]
+    assert transitive_call[0][1:] == ('group_transitive_members', 'WRITE_TRUNCATE')
+    members_of_top = {r['member_email'] for r in transitive_call[0][0] if r['group_email'] == 'top@example.com'}
+    assert members_of_top == {'sub@example.com', 'u@example.com'}
+
+    # テーブルに行があり、変更もなければ書き込まない
+    bigquery_client.get_table.return_value = types.SimpleNamespace(num_rows=3)
+    identity_client.list_memberships.side_effect = [[_membership('sub@example.com', 2)], [_membership('u@example.com', 1)]]
+    sub_hash = mod._compute_group_hash([('u@example.com', 'USER')])
+    bq_helpers.fetch_query_rows.side_effect = [[
+        {'group_email': 'top@example.com', 'content_hash': top_hash, 'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+        {'group_email': 'sub@example.com', 'content_hash': sub_hash, 'assessment_timestamp': '2026-01-01T00:00:00+00:00'},
+    ]]
+    bq_helpers.load_rows_to_table.reset_mock()
+    mod.assess_all_groups(DummyCloudEvent())
+    assert [c[0][1] for c in bq_helpers.load_rows_to_table.call_args_list] == ['group_membership_hashes']
@@ -0,0 +1,93 @@
+import base64
+import json
+import os
+import types
+from unittest import mock
+import importlib
+import pytest
+
+from src.utils import instrumentation
+
+# Target module path
+MODULE_PATH = 'src.assessors.principal_centric.principal_assessor.main'
+
+
+def import_module_with_env(env: dict, bigquery_client, load_rows_to_table, policies):
+    """Helper to import the module fresh with specific env vars and mocked utils."""
+    utils_modules = {
+        'utils': types.SimpleNamespace(),
+        'utils.gcp_clients': types.SimpleNamespace(
+            asset_client=mock.MagicMock(), bigquery_client=bigquery_client, identity_client=mock.MagicMock()
+        ),
+        'utils.iam_helpers': types.SimpleNamespace(
+            expand_member=lambda client, member_type, member_id, visited: iter([f"{member_type}:{member_id}"])
+        ),
+        'utils.bq_helpers': types.SimpleNamespace(load_rows_to_table=load_rows_to_table),
+        'utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+        'utils.instrumentation': instrumentation,
+        'utils.rate_limiter': types.SimpleNamespace(call_api_pages=lambda api_name, method, request, items_field, **kwargs: iter(policies)),
+        'functions_framework': types.SimpleNamespace(cloud_event=lambda f: f),
+    }
+    with mock.patch.dict(os.environ, env, clear=False), mock.patch.dict(importlib.sys.modules, utils_modules):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+@pytest.fixture(autouse=True)
+def isolate_env(monkeypatch):
+    for k in ['BQ_PROJECT_ID', 'BQ_DATASET_ID', 'DESTINATION_TABLE_ID', 'ACCESS_FACTS_TABLE_ID']:
+        monkeypatch.delenv(k, raising=False)
+
+
+def _event(payload):
+    data = base64.b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+    return types.SimpleNamespace(data={'message': {'data': data}})
+
+
+def _policy(resource, role, members):
+    return types.SimpleNamespace(resource=resource, policy=types.SimpleNamespace(
+        bindings=[types.SimpleNamespace(role=role, members=members)]
+    ))
+
+
+ENV = {'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds', 'DESTINATION_TABLE_ID': 'principal_access_list',
+       'ACCESS_FACTS_TABLE_ID': 'access_facts'}
+
+
+def test_access_facts_are_written_with_the_principal_rows():
+    bigquery_client = mock.MagicMock()
+    bigquery_client.insert_rows_json.return_value = []
+    load_rows_to_table = mock.MagicMock()
+    mod = import_module_with_env(ENV, bigquery_client, load_rows_to_table, [_policy('//p/1', 'roles/viewer', ['user:a@example.com'])])
+
+    mod.assess_principal_centric(_event(['organizations/1']))
+
+    (fact_rows, table_id, write_disposition), _ = load_rows_to_table.call_args
+    assert (table_id, write_disposition) == ('access_facts', 'WRITE_APPEND')
+    assert [(r['principal_email'], r['resource_name'], r['role']) for r in fact_rows] == [('a@example.com', '//p/1', 'roles/viewer')]
+
+
+def test_access_facts_are_skipped_when_the_principal_insert_fails():
+    bigquery_client = mock.MagicMock()
+    bigquery_client.insert_rows_json.return_value = [{'index': 0, 'errors': ['invalid']}]
+    load_rows_to_table = mock.MagicMock()
+    mod = import_module_with_env(ENV, bigquery_client, load_rows_to_table, [_policy('//p/1', 'roles/viewer', ['user:a@example.com'])])
+
+    mod.assess_principal_centric(_event(['organizations/1']))
+
+    load_rows_to_table.assert_not_called()
+
+
+def test_dispatched_run_writes_the_dispatcher_snapshot():
+    bigquery_client = mock.MagicMock()
+    bigquery_client.insert_rows_json.return_value = []
+    load_rows_to_table = mock.MagicMock()
+    mod = import_module_with_env(ENV, bigquery_client, load_rows_to_table, [_policy('//p/1', 'roles/viewer', ['user:a@example.com'])])
+
+    mod.assess_principal_centric(_event({'scopes': ['organizations/1'], 'assessment_timestamp': '2026-01-02T00:00:00+00:00', 'run_id': 'run-1'}))
+
+    (rows,) = [call.args[1] for call in bigquery_client.insert_rows_json.call_args_list]
+    assert [r['assessment_timestamp'] for r in rows] == ['2026-01-02T00:00:00+00:00']
+    (fact_rows, _, _), _ = load_rows_to_table.call_args
+    assert [r['assessment_timestamp'] for r in fact_rows] == ['2026-01-02T00:00:00+00:00']
@@ -0,0 +1,62 @@
+import io
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+from tools import batch_runner
+from tools.batch_runner import LocalSink, _parse_api_qps
+
+
+def _read(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_local_sink_writes_rows_per_table_and_truncates_on_write_truncate(tmp_path):
+    sink = LocalSink(str(tmp_path))
+    table = sink.dataset("iam_assessment", project="p").table("unified_access_permissions")
+
+    assert sink.insert_rows_json(table, [{"a": 1}]) == []
+    sink.insert_rows_json("p.iam_assessment.unified_access_permissions", [{"a": 2}])
+    path = os.path.join(str(tmp_path), "unified_access_permissions", f"part-{os.getpid()}.jsonl")
+    assert _read(path) == [{"a": 1}, {"a": 2}]
+
+    job = sink.load_table_from_json(iter([{"b": 1}]), table, job_config=SimpleNamespace(write_disposition="WRITE_TRUNCATE"))
+    job.result()
+    assert job.output_rows == 1
+    assert _read(path) == [{"b": 1}]
+
+
+def test_local_sink_delegates_queries_and_pool_qps_is_split_across_workers():
+    delegate = SimpleNamespace(query=lambda sql: f"ran {sql}")
+    assert LocalSink("/tmp", delegate=delegate).query("SELECT 1") == "ran SELECT 1"
+    assert _parse_api_qps(["identity=200", "asset=10"], 4) == {"identity": 50.0, "asset": 2.5}
+
+
+def test_local_sink_reset_removes_parts_from_previous_runs(tmp_path):
+    stale = tmp_path / "unified_access_permissions" / "part-1.jsonl"
+    stale.parent.mkdir()
+    stale.write_text('{"a": 1}\n', encoding="utf-8")
+    other = tmp_path / "notes.txt"
+    other.write_text("keep", encoding="utf-8")
+
+    LocalSink(str(tmp_path)).reset()
+
+    assert not stale.exists() and other.exists()
+
+
+def test_workers_are_clamped_before_splitting_qps(tmp_path, monkeypatch):
+    calls = {}
+    monkeypatch.setattr(batch_runner, "run_pipeline", lambda settings, scopes, stages, workers: calls.update(
+        env=settings["env"], workers=workers) or {"stages": {}})
+    monkeypatch.setattr(sys, "argv", [
+        "batch_runner.py", "--scope", "organizations/1", "--workers", "0", "--api-qps", "identity=10",
+        "--sink", "local", "--output-dir", str(tmp_path),
+    ])
+    monkeypatch.setattr(sys, "__stdout__", io.StringIO())
+
+    batch_runner.main()
+
+    assert calls["workers"] == 1
+    assert json.loads(calls["env"]["API_QPS_LIMITS"]) == {"identity": 10.0}
@@ -0,0 +1,21 @@
+from tools.benchmark_pipeline import compare_results
+
+
+def test_compare_results_flags_regressions_by_metric_direction():
+    baseline = {"results": {
+        "gcs_assessor": {"bindings_per_sec": 1000.0, "seconds": 2.0, "errors": 0},
+        "principal_assessor": {"peak_rss_mb": 100.0},
+    }}
+    current = {"results": {
+        "gcs_assessor": {"bindings_per_sec": 800.0, "seconds": 1.5, "errors": 3},
+        "principal_assessor": {"peak_rss_mb": 105.0},
+        "group_assessor": {"groups_per_sec": 50.0},
+    }}
+
+    comparisons = {(c["benchmark"], c["metric"]): c for c in compare_results(current, baseline, threshold=0.1)}
+
+    # スループットの低下は悪化、所要時間の短縮は改善。件数の指標と前回にないベンチマークは比較しない
+    assert comparisons[("gcs_assessor", "bindings_per_sec")]["regression"] is True
+    assert comparisons[("gcs_assessor", "seconds")]["regression"] is False
+    assert comparisons[("principal_assessor", "peak_rss_mb")]["regression"] is False
+    assert set(comparisons) == {("gcs_assessor", "bindings_per_sec"), ("gcs_assessor", "seconds"), ("principal_assessor", "peak_rss_mb")}
@@ -0,0 +1,41 @@
+import pytest
+
+from tools.benchmark_cold_start import (
+    ENTRY_POINTS, MissingDependencyError, check_budget, load_budgets, measure_cold_start, parse_importtime
+)
+
+BUDGETS = load_budgets()
+
+
+@pytest.mark.parametrize("entry_point", sorted(ENTRY_POINTS))
+def test_entry_point_import_is_within_budget(entry_point):
+    """
+    各 Function のモジュールを新しいインタプリタで読み込み、インポート時間・モジュール数・RSSが予算内であることを確認する。
+    クライアントは生成しない (遅延初期化のため、インポートだけでは認証情報もネットワークも不要)。
+    """
+    try:
+        result = measure_cold_start(ENTRY_POINTS[entry_point], importtime=True, resolve_clients=False)
+    except MissingDependencyError as e:
+        pytest.skip(str(e))
+
+    violations = check_budget(result, BUDGETS[entry_point])
+    slowest = ", ".join(f"{i['module']} ({i['cumulative_us'] / 1e6:.3f}s)" for i in result["slowest_imports"][:5])
+    assert not violations, f"{entry_point} is over its cold-start budget: {violations}. Slowest imports: {slowest}"
+
+
+def test_every_entry_point_has_a_budget():
+    assert set(BUDGETS) == set(ENTRY_POINTS)
+    assert all({"import_seconds", "modules_loaded", "rss_mb"} <= set(budget) for budget in BUDGETS.values())
+
+
+def test_parse_importtime_and_check_budget():
+    stderr = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       300 |        300 |   google.cloud.bigquery.table",
+        "import time:      1200 |     950000 | google.cloud.bigquery",
+        "import time:       400 |       2000 | json",
+    ])
+    assert [i["module"] for i in parse_importtime(stderr)] == ["google.cloud.bigquery", "json"]
+
+    result = {"import_seconds": 3.1, "modules_loaded": 900, "rss_mb": 80.0}
+    assert check_budget(result, {"import_seconds": 2.5, "modules_loaded": 2500}) == ["import_seconds: 3.1 > 2.5"]
@@ -0,0 +1,58 @@
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+from tools.gcp_fakes import FaultInjector, build_clients_module, generate_org
+
+
+def test_generate_org_is_deterministic_and_has_diamond_groups():
+    org = generate_org(seed=7, folders=3, projects=6, resources_per_project=6, groups=30, nesting_depth=3, diamond_ratio=1.0)
+    again = generate_org(seed=7, folders=3, projects=6, resources_per_project=6, groups=30, nesting_depth=3, diamond_ratio=1.0)
+
+    assert org.stats() == again.stats()
+    assert [r['bindings'] for r in org.resources] == [r['bindings'] for r in again.resources]
+    assert org.stats()['resources'] == 36
+    # diamond_ratio=1.0 では2段目以降のグループが上の段の2つのグループに属する
+    parents_of = {}
+    for parent, members in org.groups.items():
+        for member, member_type in members:
+            if member_type == 'GROUP':
+                parents_of.setdefault(member, set()).add(parent)
+    assert parents_of and all(len(parents) == 2 for parents in parents_of.values())
+
+
+def test_fake_clients_answer_from_synthetic_org():
+    org = generate_org(seed=1, projects=2, resources_per_project=3, recommendations_per_project=5)
+    clients = build_clients_module(org)
+    project = org.projects[0]
+
+    buckets = list(clients.asset_client.search_all_resources(
+        request={"scope": f"projects/{project['project_id']}", "asset_types": ["storage.googleapis.com/Bucket"]}
+    ))
+    assert [b.project for b in buckets] == [f"projects/{project['number']}"]
+    bucket_name = buckets[0].name.split('/')[-1]
+    policy = clients.storage_client.bucket(bucket_name).get_iam_policy(requested_policy_version=3)
+    assert policy.etag and policy.bindings
+
+    pager = clients.recommender_client.list_recommendations(request={
+        "parent": f"projects/{project['project_id']}/locations/global/recommenders/google.iam.policy.Recommender",
+        "page_size": 2,
+    })
+    assert [len(page.recommendations) for page in pager.pages] == [2, 2, 1]
+    assets = clients.asset_client.list_assets(request={"parent": org.org_name, "page_size": 2})
+    first_page = next(iter(assets.pages))
+    assert len(first_page.assets) == 2 and first_page.next_page_token
+    assert len(list(assets)) == len(list(clients.asset_client.list_assets(request={"parent": org.org_name})))
+    assert clients.BigQueryClientClass() is clients.bigquery_client
+
+
+def test_fault_injector_raises_quota_errors_for_selected_methods():
+    org = generate_org(seed=1, projects=1, resources_per_project=3)
+    faults = FaultInjector(quota_error_rate=1.0, methods=["compute.get_iam_policy"])
+    clients = build_clients_module(org, faults=faults)
+
+    # 対象外のメソッドには注入しない
+    assert clients.asset_client.list_assets(request={"parent": org.org_name})
+    instance = next(r for r in org.resources if r['kind'] == 'COMPUTE_INSTANCE')
+    with pytest.raises(api_exceptions.ResourceExhausted):
+        clients.compute_client.get_iam_policy(project=instance['project_id'], zone=instance['zone'], resource=instance['instance'])
+    assert faults.quota_errors == 1
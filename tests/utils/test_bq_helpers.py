@@ -0,0 +1,204 @@
+import types
+from unittest import mock
+import importlib
+import pytest
+
+# Target module path
+MODULE_PATH = 'src.utils.bq_helpers'
+
+
+def import_bq_helpers(bigquery_client):
+    """Helper to import bq_helpers fresh with a mocked BigQuery client."""
+    bigquery_mod = mock.MagicMock()
+    # QueryJobConfig は渡された引数をそのまま保持する
+    bigquery_mod.QueryJobConfig.side_effect = lambda **kwargs: types.SimpleNamespace(**kwargs)
+    with mock.patch.dict(importlib.sys.modules, {
+        'google.cloud.bigquery': bigquery_mod,
+        'src.utils.gcp_clients': types.SimpleNamespace(bigquery_client=bigquery_client),
+        'src.utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+    }):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+def _client(estimated_bytes, **job_stats):
+    """dry_run の場合は見積もりだけを持つジョブを、それ以外は実行済みジョブを返すクライアント"""
+    client = mock.MagicMock()
+    executed_job = mock.MagicMock(
+        total_bytes_processed=job_stats.get('total_bytes_processed', estimated_bytes),
+        total_bytes_billed=job_stats.get('total_bytes_billed', estimated_bytes),
+        slot_millis=job_stats.get('slot_millis', 1234),
+        cache_hit=job_stats.get('cache_hit', False),
+    )
+
+    def query(_query, job_config):
+        if getattr(job_config, 'dry_run', False):
+            return mock.MagicMock(total_bytes_processed=estimated_bytes)
+        return executed_job
+
+    client.query.side_effect = query
+    return client
+
+
+def test_budget_exceeded_raises_before_execution():
+    client = _client(estimated_bytes=50 * 1024 ** 3)
+    mod = import_bq_helpers(client)
+
+    with pytest.raises(mod.QueryBudgetExceededError):
+        mod.run_query_and_save_results('SELECT 1', 'dest', 'WRITE_TRUNCATE', max_bytes_billed=10 * 1024 ** 3)
+
+    # ドライランのみで、実行はされない
+    assert client.query.call_count == 1
+    assert client.query.call_args[1]['job_config'].dry_run is True
+
+
+def test_cap_is_derived_from_estimate_and_stats_are_returned():
+    client = _client(estimated_bytes=100 * 1024 ** 2, total_bytes_billed=90 * 1024 ** 2, cache_hit=False)
+    mod = import_bq_helpers(client)
+
+    stats = mod.run_query_and_save_results('SELECT 1', 'dest', 'WRITE_TRUNCATE', max_bytes_billed=10 * 1024 ** 3)
+
+    executed_config = client.query.call_args_list[1][1]['job_config']
+    assert executed_config.maximum_bytes_billed == int(100 * 1024 ** 2 * mod.DRY_RUN_HEADROOM_RATIO)
+    assert stats == {
+        'total_bytes_processed': 100 * 1024 ** 2,
+        'total_bytes_billed': 90 * 1024 ** 2,
+        'slot_millis': 1234,
+        'cache_hit': False,
+    }
+
+
+def test_cap_has_minimum_and_never_exceeds_budget():
+    mod = import_bq_helpers(_client(estimated_bytes=0))
+
+    assert mod._adaptive_bytes_cap(0, 10 * 1024 ** 3) == mod.MIN_BYTES_BILLED
+    assert mod._adaptive_bytes_cap(9 * 1024 ** 3, 10 * 1024 ** 3) == 10 * 1024 ** 3
+    # 最低課金額は参照テーブルごとにかかる
+    assert mod._adaptive_bytes_cap(0, 10 * 1024 ** 3, referenced_tables=3) == 3 * mod.MIN_BYTES_BILLED
+
+
+def test_cap_floor_counts_the_tables_referenced_by_the_dry_run():
+    client = _client(estimated_bytes=1024)
+    mod = import_bq_helpers(client)
+    dry_run_job = mock.MagicMock(total_bytes_processed=1024, referenced_tables=['p.d.a', 'p.d.b'])
+    executed_job = mock.MagicMock(total_bytes_processed=1024, total_bytes_billed=20 * 1024 ** 2)
+    client.query.side_effect = lambda _query, job_config: dry_run_job if getattr(job_config, 'dry_run', False) else executed_job
+
+    mod.run_query_and_save_results('SELECT 1', 'dest', 'WRITE_TRUNCATE', max_bytes_billed=10 * 1024 ** 3)
+
+    assert client.query.call_args_list[1][1]['job_config'].maximum_bytes_billed == 2 * mod.MIN_BYTES_BILLED
+
+
+def test_wait_for_query_jobs_reports_stats_and_errors_per_job():
+    mod = import_bq_helpers(_client(estimated_bytes=0))
+
+    ok_job = mock.MagicMock(job_id='job-ok', total_bytes_processed=10, total_bytes_billed=10, slot_millis=5, cache_hit=True)
+    ok_job.done.side_effect = [False, True]
+    ok_job.exception.return_value = None
+    failed_job = mock.MagicMock(job_id='job-failed')
+    failed_job.done.return_value = True
+    failed_job.exception.return_value = RuntimeError('boom')
+
+    with mock.patch.object(mod.time, 'sleep'):
+        results = mod.wait_for_query_jobs({'ok': ok_job, 'failed': failed_job}, poll_interval=0)
+
+    assert results['ok'] == {
+        'job_id': 'job-ok', 'error': None,
+        'stats': {'total_bytes_processed': 10, 'total_bytes_billed': 10, 'slot_millis': 5, 'cache_hit': True},
+    }
+    assert results['failed'] == {'job_id': 'job-failed', 'stats': None, 'error': 'boom'}
+
+
+def test_wait_for_query_jobs_cancels_on_timeout():
+    mod = import_bq_helpers(_client(estimated_bytes=0))
+
+    slow_job = mock.MagicMock(job_id='job-slow')
+    slow_job.done.return_value = False
+
+    with mock.patch.object(mod.time, 'sleep'), mock.patch.object(mod.time, 'monotonic', side_effect=[0, 100]):
+        results = mod.wait_for_query_jobs({'slow': slow_job}, poll_interval=0, timeout=10)
+
+    slow_job.cancel.assert_called_once()
+    assert results['slow']['error'].startswith('Timed out')
+
+
+def test_analysis_cache_hits_only_when_sources_and_config_are_unchanged():
+    client = _client(estimated_bytes=0)
+    table = mock.MagicMock(num_rows=10, streaming_buffer=None)
+    table.modified.isoformat.return_value = '2026-01-01T00:00:00+00:00'
+    client.get_table.return_value = table
+    mod = import_bq_helpers(client)
+
+    with mock.patch.dict(mod.os.environ, {'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds'}), \
+            mock.patch.object(mod, 'fetch_query_rows', return_value=[]) as fetch_query_rows:
+        cache_hit, fingerprint = mod.lookup_analysis_cache('cache', 'analyzer', ['p.d.t'], 'SELECT 1')
+    assert cache_hit is False
+    # クライアントの既定のプロジェクトではなく、BQ_PROJECT_ID のテーブルを参照する
+    assert 'FROM `proj.ds.cache`' in fetch_query_rows.call_args[0][0]
+
+    with mock.patch.object(mod, 'fetch_query_rows', return_value=[{'fingerprint': fingerprint}]):
+        assert mod.lookup_analysis_cache('cache', 'analyzer', ['p.d.t'], 'SELECT 1') == (True, fingerprint)
+        # クエリ (設定) が変われば再計算する
+        assert mod.lookup_analysis_cache('cache', 'analyzer', ['p.d.t'], 'SELECT 2')[0] is False
+        # テーブルが更新されれば再計算する
+        table.modified.isoformat.return_value = '2026-01-02T00:00:00+00:00'
+        assert mod.lookup_analysis_cache('cache', 'analyzer', ['p.d.t'], 'SELECT 1')[0] is False
+
+    # キャッシュテーブル未設定時は常に実行する
+    assert mod.lookup_analysis_cache(None, 'analyzer', ['p.d.t'], 'SELECT 1') == (False, None)
+
+
+def test_resolved_snapshot_adopts_the_run_id_of_the_run_that_wrote_it():
+    mod = import_bq_helpers(_client(estimated_bytes=0))
+    instrumentation = importlib.sys.modules['src.utils.instrumentation']
+    logger = mock.MagicMock()
+    event = types.SimpleNamespace(data={'message': {'data': 'e30='}}) # "{}" (Scheduler)
+    snapshot = mock.MagicMock()
+    snapshot.isoformat.return_value = '2026-01-02T00:00:00+00:00'
+    run_ids = []
+
+    @instrumentation.instrument_invocation(logger)
+    def analyze(cloud_event):
+        assert mod.resolve_snapshot_timestamp(cloud_event, '`p.d.access_facts`') == '2026-01-02T00:00:00+00:00'
+        run_ids.append(instrumentation.current_run_id())
+
+    rows = [{'snapshot': snapshot, 'run_id': 'run-1'}]
+    with mock.patch.dict(mod.os.environ, {'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds', 'PIPELINE_RUNS_TABLE_ID': 'pipeline_runs'}), \
+            mock.patch.object(mod, 'fetch_query_rows', return_value=rows) as fetch_query_rows, \
+            mock.patch.object(instrumentation, 'append_stage'):
+        analyze(event)
+    assert run_ids == ['run-1']
+    assert 'FROM `proj.ds.pipeline_runs`' in fetch_query_rows.call_args[0][0]
+
+
+def test_latest_snapshot_requires_every_dispatched_assessor_to_finish():
+    mod = import_bq_helpers(_client(estimated_bytes=0))
+    event = types.SimpleNamespace(data={'message': {'data': 'e30='}})
+    with mock.patch.dict(mod.os.environ, {'BQ_PROJECT_ID': 'proj', 'BQ_DATASET_ID': 'ds', 'PIPELINE_RUNS_TABLE_ID': 'pipeline_runs'}), \
+            mock.patch.object(mod, 'fetch_query_rows', return_value=[]) as fetch_query_rows:
+        assert mod.resolve_snapshot_timestamp(event, '`p.d.access_facts`') is None
+    query = fetch_query_rows.call_args[0][0]
+    # ディスパッチしたリソース数と実行ごとの assessor 数の両方が、正常に終了した呼び出しでそろっていること
+    assert "f.resources, 0) >= IFNULL(d.resources_processed, 0)" in query
+    assert "f.assessors, 0) >= d.assessors_triggered" in query
+    assert 'FROM `p.d.access_facts`' in query
+    mod.bigquery.ScalarQueryParameter.assert_called_once_with('dispatch_stage', 'STRING', 'discover_and_dispatch_assets')
+
+
+@pytest.mark.parametrize('streaming_buffer, expected', [
+    (None, '2026-01-02T00:00:00+00:00'),
+    (object(), '2026-01-01T00:00:00+00:00'),
+])
+def test_latest_snapshot_without_ledger_skips_the_snapshot_still_being_written(streaming_buffer, expected):
+    client = _client(estimated_bytes=0)
+    client.get_table.return_value = types.SimpleNamespace(streaming_buffer=streaming_buffer)
+    mod = import_bq_helpers(client)
+    event = types.SimpleNamespace(data={'message': {'data': 'e30='}})
+    newest, previous = mock.MagicMock(), mock.MagicMock()
+    newest.isoformat.return_value = '2026-01-02T00:00:00+00:00'
+    previous.isoformat.return_value = '2026-01-01T00:00:00+00:00'
+    with mock.patch.dict(mod.os.environ, {'PIPELINE_RUNS_TABLE_ID': ''}), \
+            mock.patch.object(mod, 'fetch_query_rows', return_value=[{'snapshots': [newest, previous]}]):
+        assert mod.resolve_snapshot_timestamp(event, '`p.d.access_facts`') == expected
+    client.get_table.assert_called_once_with('p.d.access_facts')
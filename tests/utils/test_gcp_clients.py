@@ -0,0 +1,94 @@
+import threading
+import types
+from unittest import mock
+import importlib
+
+# Target module path
+MODULE_PATH = 'src.utils.gcp_clients'
+
+
+def import_gcp_clients(constructed):
+    """Helper to import gcp_clients fresh with google.cloud submodules replaced by counting fakes."""
+    def client_class(name):
+        class Client:
+            def __init__(self, *args, **kwargs):
+                constructed.append(name)
+                self.name = name
+        return Client
+
+    modules = {
+        'google.cloud.bigquery': types.SimpleNamespace(Client=client_class('bigquery')),
+        'google.cloud.storage': types.SimpleNamespace(Client=client_class('storage')),
+        'google.cloud.compute_v1': types.SimpleNamespace(InstancesClient=client_class('compute')),
+        'google.cloud.asset_v1': types.SimpleNamespace(AssetServiceClient=client_class('asset')),
+        'google.cloud.pubsub_v1': types.SimpleNamespace(PublisherClient=client_class('pubsub')),
+        'google.cloud.identity_v1': types.SimpleNamespace(GroupsServiceClient=client_class('identity')),
+        'google.cloud.recommender_v1': types.SimpleNamespace(RecommenderClient=client_class('recommender')),
+    }
+    patcher = mock.patch.dict(importlib.sys.modules, modules)
+    patcher.start()
+    if MODULE_PATH in list(importlib.sys.modules.keys()):
+        del importlib.sys.modules[MODULE_PATH]
+    return importlib.import_module(MODULE_PATH), patcher
+
+
+def test_clients_are_constructed_on_first_use_only():
+    constructed = []
+    mod, patcher = import_gcp_clients(constructed)
+    try:
+        assert constructed == []
+        assert not mod.storage_client.initialized
+
+        assert mod.storage_client.name == 'storage'
+        assert mod.storage_client.name == 'storage'
+        assert constructed == ['storage']
+        # クラスのエイリアスも参照時に解決される (インスタンスは生成しない)
+        assert mod.BigQueryClientClass is importlib.sys.modules['google.cloud.bigquery'].Client
+        assert constructed == ['storage']
+    finally:
+        patcher.stop()
+
+
+def test_concurrent_first_use_constructs_a_single_client():
+    constructed = []
+    mod, patcher = import_gcp_clients(constructed)
+    try:
+        barrier = threading.Barrier(8)
+        resolved = []
+
+        def use_client():
+            barrier.wait()
+            resolved.append(mod.recommender_client.resolve())
+
+        threads = [threading.Thread(target=use_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert constructed == ['recommender']
+        assert len({id(client) for client in resolved}) == 1
+    finally:
+        patcher.stop()
+
+
+def test_method_calls_are_counted_per_client_during_an_invocation():
+    constructed = []
+    mod, patcher = import_gcp_clients(constructed)
+    try:
+        instrumentation = importlib.sys.modules['src.utils.instrumentation']
+        mod.storage_client.resolve().get_bucket = lambda name: name
+        mod.storage_client.resolve().bucket = lambda name: name
+        logger = mock.MagicMock()
+
+        @instrumentation.instrument_invocation(logger)
+        def entry_point():
+            mod.storage_client.get_bucket('a')
+            mod.storage_client.get_bucket('b')
+            mod.storage_client.bucket('c') # ローカルのメソッドは数えない
+
+        entry_point()
+        counters = logger.info.call_args.kwargs['extra']['invocation_summary']['counters']
+        assert counters == {'api_calls.storage.get_bucket': 2}
+    finally:
+        patcher.stop()
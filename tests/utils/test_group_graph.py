@@ -0,0 +1,100 @@
+import random
+from collections import deque
+
+from src.utils.group_graph import compute_transitive_closure
+
+
+def _closure(edges_by_group):
+    return {
+        (r['group_email'], r['member_email']): (r['depth'], r['path'])
+        for r in compute_transitive_closure(edges_by_group)
+    }
+
+
+def test_nested_members_have_depth_and_path():
+    edges = {
+        'top@example.com': [('mid@example.com', 'GROUP'), ('a@example.com', 'USER')],
+        'mid@example.com': [('leaf@example.com', 'GROUP')],
+        'leaf@example.com': [('b@example.com', 'USER')],
+    }
+
+    closure = _closure(edges)
+
+    assert closure[('top@example.com', 'a@example.com')] == (1, ['top@example.com'])
+    assert closure[('top@example.com', 'b@example.com')] == (3, ['top@example.com', 'mid@example.com', 'leaf@example.com'])
+    assert closure[('mid@example.com', 'b@example.com')] == (2, ['mid@example.com', 'leaf@example.com'])
+
+
+def test_diamond_keeps_shortest_path_once():
+    edges = {
+        'top@example.com': [('left@example.com', 'GROUP'), ('right@example.com', 'GROUP'), ('deep@example.com', 'GROUP')],
+        'left@example.com': [('shared@example.com', 'GROUP')],
+        'right@example.com': [('shared@example.com', 'GROUP')],
+        'deep@example.com': [('left@example.com', 'GROUP')],
+        'shared@example.com': [('u@example.com', 'USER')],
+    }
+
+    rows = [r for r in compute_transitive_closure(edges) if r['group_email'] == 'top@example.com']
+
+    assert sum(1 for r in rows if r['member_email'] == 'u@example.com') == 1
+    assert _closure(edges)[('top@example.com', 'u@example.com')] == (3, ['top@example.com', 'left@example.com', 'shared@example.com'])
+
+
+def test_cycles_terminate():
+    edges = {
+        'a@example.com': [('b@example.com', 'GROUP'), ('u1@example.com', 'USER')],
+        'b@example.com': [('a@example.com', 'GROUP'), ('u2@example.com', 'USER')],
+    }
+
+    closure = _closure(edges)
+
+    assert closure[('a@example.com', 'u2@example.com')] == (2, ['a@example.com', 'b@example.com'])
+    assert closure[('b@example.com', 'u1@example.com')] == (2, ['b@example.com', 'a@example.com'])
+    # 循環しているグループは自分自身を実効メンバーとして含む
+    assert closure[('a@example.com', 'a@example.com')] == (2, ['a@example.com', 'b@example.com'])
+    assert len(closure) == 8
+
+
+def _bfs_closure(edges_by_group):
+    """グループごとに独立してBFSを行う素朴な実装 (比較用)"""
+    rows = []
+    for root in edges_by_group:
+        visited_groups, seen_members = {root}, set()
+        queue = deque([(root, 1, [root])])
+        while queue:
+            group_email, depth, path = queue.popleft()
+            for member_email, member_type in edges_by_group.get(group_email, ()):
+                if (member_email, member_type) in seen_members:
+                    continue
+                seen_members.add((member_email, member_type))
+                rows.append({'group_email': root, 'member_email': member_email, 'member_type': member_type,
+                             'depth': depth, 'path': path})
+                if member_type == 'GROUP' and member_email not in visited_groups:
+                    visited_groups.add(member_email)
+                    queue.append((member_email, depth + 1, path + [member_email]))
+    return rows
+
+
+def test_deep_diamonds_and_cycles_match_per_root_bfs():
+    # 各階層の2つのグループが、どちらも次の階層の2つのグループを含む (経路数が深さに対して指数的に増える)
+    edges = {}
+    for level in range(12):
+        for side in ('l', 'r'):
+            edges[f'g{level}{side}@example.com'] = [
+                (f'g{level + 1}l@example.com', 'GROUP'), (f'g{level + 1}r@example.com', 'GROUP'),
+                (f'u{level}{side}@example.com', 'USER'),
+            ]
+    edges['g12l@example.com'] = [('leaf@example.com', 'USER')]
+    edges['g12r@example.com'] = [('g6l@example.com', 'GROUP'), ('leaf@example.com', 'USER')] # 中間の階層への循環
+    assert list(compute_transitive_closure(edges)) == _bfs_closure(edges)
+
+    rng = random.Random(7)
+    for _ in range(30):
+        groups = [f'g{i}@example.com' for i in range(rng.randint(1, 25))]
+        edges = {
+            g: [(rng.choice(groups), 'GROUP') if rng.random() < 0.5 else (f'u{rng.randint(0, 9)}@example.com', 'USER')
+                for _ in range(rng.randint(0, 5))]
+            for g in groups
+        }
+        edges[groups[0]].append(('missing@example.com', 'GROUP')) # メンバーを取得できなかったグループ
+        assert list(compute_transitive_closure(edges)) == _bfs_closure(edges)
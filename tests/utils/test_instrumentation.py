@@ -0,0 +1,111 @@
+import os
+import json
+import base64
+import types
+from unittest import mock
+import importlib
+import pytest
+
+# Target module path
+MODULE_PATH = 'src.utils.instrumentation'
+
+
+def import_instrumentation(env: dict):
+    """Helper to import instrumentation fresh with specific env vars (the shared module in sys.modules is restored)."""
+    with mock.patch.dict(os.environ, env, clear=False), mock.patch.dict(importlib.sys.modules):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+def test_invocation_emits_one_summary_with_spans_and_counters():
+    mod = import_instrumentation({'INSTRUMENTATION_ENABLED': 'true'})
+    logger = mock.MagicMock()
+
+    @mod.instrument_invocation(logger)
+    def entry_point(event):
+        with mod.span('policy_fetch'):
+            mod.count_api_call('storage', 'get_iam_policy')
+        with mod.span('policy_fetch'):
+            pass
+        mod.count('rows_built', 12)
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        entry_point(None)
+
+    logger.info.assert_called_once()
+    summary = logger.info.call_args.kwargs['extra']['invocation_summary']
+    assert summary['function'] == 'entry_point'
+    assert summary['status'] == 'error'
+    assert summary['spans']['policy_fetch']['count'] == 2
+    assert summary['counters'] == {'api_calls.storage.get_iam_policy': 1, 'rows_built': 12}
+    # 呼び出しの外では集計しない
+    assert mod.current_invocation() is None
+    mod.count('rows_built')
+
+
+def test_disabled_instrumentation_leaves_entry_points_unwrapped():
+    mod = import_instrumentation({'INSTRUMENTATION_ENABLED': 'false'})
+    logger = mock.MagicMock()
+
+    def entry_point(event):
+        with mod.span('policy_fetch'):
+            mod.count('rows_built')
+        return 'done'
+
+    assert mod.instrument_invocation(logger)(entry_point) is entry_point
+    assert entry_point(None) == 'done'
+    logger.info.assert_not_called()
+
+
+def test_run_id_is_taken_from_the_trigger_message_and_the_stage_is_appended_to_the_ledger():
+    mod = import_instrumentation({'INSTRUMENTATION_ENABLED': 'true'})
+    logger = mock.MagicMock()
+    payload = {'scope': 'projects/p', 'resource_name': 'b', 'assessment_timestamp': '2024-01-01T00:00:00+00:00', 'run_id': 'run-1'}
+    event = types.SimpleNamespace(data={'message': {'data': base64.b64encode(json.dumps(payload).encode()).decode()}})
+
+    run_ids = []
+
+    @mod.instrument_invocation(logger)
+    def assess(cloud_event):
+        run_ids.append(mod.current_run_id())
+        mod.set_attribute('scope', payload['scope'])
+        mod.count_api_call('storage', 'get_iam_policy')
+        mod.count_api_call('identity', 'list_memberships')
+        mod.count('bq.rows_written', 3)
+        mod.count('errors')
+
+    with mock.patch.object(mod, 'append_stage') as append_stage:
+        assess(event)
+        # run_id を含まないメッセージ (Scheduler の "{}") では新しく採番する
+        assess(types.SimpleNamespace(data={'message': {'data': base64.b64encode(b'{}').decode()}}))
+
+    assert run_ids[0] == 'run-1' and run_ids[1] not in (None, 'run-1')
+    row = append_stage.call_args_list[0].args[0]
+    assert row['run_id'] == 'run-1'
+    assert row['stage'] == 'assess'
+    assert row['scope'] == 'projects/p'
+    assert (row['api_calls'], row['rows_written'], row['errors']) == (2, 3, 1)
+    assert append_stage.call_args_list[1].args[0]['run_id'] == run_ids[1]
+
+
+def test_adopt_run_id_replaces_only_a_minted_run_id():
+    mod = import_instrumentation({'INSTRUMENTATION_ENABLED': 'true'})
+    logger = mock.MagicMock()
+    scheduled = types.SimpleNamespace(data={'message': {'data': base64.b64encode(b'{}').decode()}})
+    dispatched = types.SimpleNamespace(data={'message': {'data': base64.b64encode(b'{"run_id": "run-2"}').decode()}})
+    run_ids = []
+
+    @mod.instrument_invocation(logger)
+    def analyze(cloud_event):
+        mod.adopt_run_id('run-1')
+        run_ids.append(mod.current_run_id())
+
+    with mock.patch.object(mod, 'append_stage') as append_stage:
+        analyze(scheduled)
+        analyze(dispatched)
+
+    # Scheduler から起動した呼び出しはスナップショットの run_id を引き継ぎ、メッセージの run_id は置き換えない
+    assert run_ids == ['run-1', 'run-2']
+    assert [call.args[0]['run_id'] for call in append_stage.call_args_list] == ['run-1', 'run-2']
@@ -0,0 +1,61 @@
+import io
+import os
+import json
+from unittest import mock
+import importlib
+
+
+def import_logging_handler(env: dict):
+    """Helper to import logging_handler (and the instrumentation it registers with) fresh with specific env vars."""
+    with mock.patch.dict(os.environ, env, clear=False), mock.patch.dict(importlib.sys.modules):
+        for name in ('src.utils.logging_handler', 'src.utils.instrumentation'):
+            importlib.sys.modules.pop(name, None)
+        return importlib.import_module('src.utils.logging_handler'), importlib.import_module('src.utils.instrumentation')
+
+
+def test_queue_mode_samples_coalesces_and_flushes_before_returning():
+    mod, instrumentation = import_logging_handler({
+        'LOG_MODE': 'QUEUE', 'LOG_SAMPLE_RATES': '{"per_resource": 0}', 'INSTRUMENTATION_ENABLED': 'true',
+    })
+    stdout = io.StringIO()
+    with mock.patch('sys.stdout', stdout):
+        logger = mod.get_logger('test_queue_mode')
+    try:
+        @instrumentation.instrument_invocation(logger)
+        def entry_point():
+            for i in range(5):
+                logger.info(f"Processed resource {i}", extra={"log_type": "per_resource"})
+            for i in range(3):
+                logger.warning(f"Group {i} could not be expanded")
+            logger.error("Write failed")
+
+        entry_point()
+        # 関数から戻った時点で、キューのログはすべて書き込まれている
+        records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    finally:
+        mod._stop_listener()
+
+    messages = [r['message'] for r in records]
+    assert not any(m.startswith('Processed resource') for m in messages)
+    assert messages.count('Group 0 could not be expanded') == 1
+    assert 'Group 1 could not be expanded' not in messages
+    assert 'Write failed' in messages
+    assert 'Repeated warning suppressed 2 times: Group 0 could not be expanded' in messages
+    (sampled,) = [r for r in records if 'sampled_out' in r]
+    assert sampled['sampled_out'] == {'per_resource': 5}
+    assert any('invocation_summary' in r for r in records)
+    assert all(r.get('invocation_id') for r in records if r['message'] == 'Write failed')
+
+
+def test_info_logs_are_rate_limited_per_message_type():
+    mod, _ = import_logging_handler({'LOG_MODE': 'SYNC'})
+    sampling = mod.SamplingFilter(rate_limit=2)
+    records = [
+        mod.logging.LogRecord('main', mod.logging.INFO, __file__, 10 if i < 4 else 20, 'msg', None, None)
+        for i in range(6)
+    ]
+    with mock.patch.object(mod.time, 'monotonic', return_value=5.0):
+        passed = [sampling.filter(record) for record in records]
+
+    assert passed == [True, True, False, False, True, True]
+    assert sampling.drain() == ({}, {'main:10': 2})
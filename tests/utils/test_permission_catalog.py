@@ -0,0 +1,67 @@
+import json
+import types
+from unittest import mock
+import importlib
+
+from src.utils.permission_catalog import PermissionCatalog, load_role_definitions_file, load_role_definitions_from_iam
+
+
+DEFINITIONS = [
+    {'name': 'roles/viewer', 'includedPermissions': ['storage.objects.get', 'compute.instances.get']},
+    {'name': 'roles/storage.admin', 'includedPermissions': ['storage.objects.get', 'storage.buckets.setIamPolicy']},
+    {'name': 'organizations/123/roles/custom', 'includedPermissions': ['resourcemanager.projects.setIamPolicy']},
+]
+
+
+def test_forward_and_inverted_indexes():
+    catalog = PermissionCatalog.from_role_definitions(DEFINITIONS)
+
+    assert catalog.permissions_of('roles/storage.admin') == ['storage.objects.get', 'storage.buckets.setIamPolicy']
+    assert catalog.roles_with_permission('storage.objects.get') == ['roles/viewer', 'roles/storage.admin']
+    assert catalog.roles_with_permission('unknown.permission') == []
+    assert catalog.role_sources == {
+        'roles/viewer': 'PREDEFINED', 'roles/storage.admin': 'PREDEFINED', 'organizations/123/roles/custom': 'CUSTOM',
+    }
+
+    mask = catalog.permission_mask(['compute.instances.get'])
+    assert catalog.role_has_any_permission('roles/viewer', mask)
+    assert not catalog.role_has_any_permission('roles/storage.admin', mask)
+    assert not catalog.role_has_any_permission('roles/unknown', mask)
+
+
+def test_wildcard_permissions_match_against_permission_vocabulary():
+    catalog = PermissionCatalog.from_role_definitions(DEFINITIONS)
+
+    assert catalog.roles_with_any_permission(['*.setIamPolicy']) == ['roles/storage.admin', 'organizations/123/roles/custom']
+
+
+def test_rows_and_file_loader(tmp_path):
+    path = tmp_path / 'roles.json'
+    path.write_text(json.dumps({'roles/a': ['p.one', 'p.two'], 'projects/x/roles/b': ['p.two']}))
+
+    catalog = load_role_definitions_file(str(path))
+    rows = list(catalog.rows('2026-01-01T00:00:00+00:00'))
+
+    assert len(catalog) == 2
+    assert [(r['role'], r['role_source'], r['permission']) for r in rows] == [
+        ('roles/a', 'PREDEFINED', 'p.one'), ('roles/a', 'PREDEFINED', 'p.two'), ('projects/x/roles/b', 'CUSTOM', 'p.two'),
+    ]
+
+
+def test_iam_roles_are_listed_through_the_shared_rate_limiter():
+    calls = []
+
+    def call_api_pages(api_name, method, request, items_field, **kwargs):
+        calls.append((api_name, request['parent'], items_field))
+        name = f"{request['parent']}/roles/custom" if request['parent'] else 'roles/viewer'
+        return iter([types.SimpleNamespace(name=name, included_permissions=['storage.objects.get'])])
+
+    iam_admin_v1 = types.SimpleNamespace(IAMClient=mock.MagicMock(), RoleView=types.SimpleNamespace(FULL=1))
+    with mock.patch.dict(importlib.sys.modules, {
+        'google.cloud.iam_admin_v1': iam_admin_v1,
+        'src.utils.rate_limiter': types.SimpleNamespace(call_api_pages=call_api_pages),
+    }), mock.patch('google.cloud.iam_admin_v1', iam_admin_v1, create=True):
+        catalog = load_role_definitions_from_iam(['organizations/123'])
+
+    assert calls == [('iam', '', 'roles'), ('iam', 'organizations/123', 'roles')]
+    assert catalog.role_sources == {'roles/viewer': 'PREDEFINED', 'organizations/123/roles/custom': 'CUSTOM'}
@@ -0,0 +1,118 @@
+import json
+import types
+from unittest import mock
+import importlib
+
+# Target module path
+MODULE_PATH = 'src.utils.policy_cache'
+PREVIOUS = '2026-01-01T00:00:00+00:00'
+CURRENT = '2026-01-02T00:00:00+00:00'
+
+
+def import_policy_cache(fetch_query_rows, run_dml_query, bigquery_client):
+    """Helper to import policy_cache fresh with mocked BigQuery helpers."""
+    with mock.patch.dict(importlib.sys.modules, {
+        'google.cloud.bigquery': types.SimpleNamespace(
+            ScalarQueryParameter=lambda name, type_, value: types.SimpleNamespace(name=name, type_=type_, value=value)
+        ),
+        'src.utils.bq_helpers': types.SimpleNamespace(fetch_query_rows=fetch_query_rows, run_dml_query=run_dml_query),
+        'src.utils.gcp_clients': types.SimpleNamespace(bigquery_client=bigquery_client),
+        'src.utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+    }):
+        if MODULE_PATH in list(importlib.sys.modules.keys()):
+            del importlib.sys.modules[MODULE_PATH]
+        return importlib.import_module(MODULE_PATH)
+
+
+def _fetch(group_hash, hashed_at='2026-01-01T12:00:00+00:00'):
+    def fetch_query_rows(query, query_parameters=None):
+        if 'group_membership_hashes' in query:
+            return [{'group_email': 'team@example.com', 'content_hash': group_hash, 'assessment_timestamp': hashed_at}]
+        return [{
+            'resource_name': 'bucket-a', 'etag': 'CAE=', 'row_count': 3, 'assessment_timestamp': PREVIOUS,
+            'group_versions': json.dumps({'team@example.com': 'h1'}),
+        }]
+    return mock.MagicMock(side_effect=fetch_query_rows)
+
+
+def test_lookup_requires_matching_etag_and_group_versions():
+    fetch_query_rows = _fetch('h1')
+    mod = import_policy_cache(fetch_query_rows, mock.MagicMock(), mock.MagicMock())
+    cache = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+
+    assert cache.lookup('GCS_BUCKET', 'bucket-a', 'CAE=')['assessment_timestamp'] == PREVIOUS
+    assert cache.lookup('GCS_BUCKET', 'bucket-a', 'CAI=') is None
+    assert cache.lookup('GCS_BUCKET', 'bucket-b', 'CAE=') is None
+    # ウォーム層: テーブルは resource_type ごと・グループハッシュは1回だけ読み込む
+    assert fetch_query_rows.call_count == 2
+
+    changed = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+    mod.fetch_query_rows = _fetch('h2')
+    assert changed.lookup('GCS_BUCKET', 'bucket-a', 'CAE=') is None
+
+    # 評価より前に計算されたハッシュでは、評価後のメンバー変更を検出できないため使わない
+    stale = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+    mod.fetch_query_rows = _fetch('h1', hashed_at=PREVIOUS)
+    assert stale.lookup('GCS_BUCKET', 'bucket-a', 'CAE=') is None
+
+    disabled = mod.PolicyEtagCache(None)
+    assert disabled.lookup('GCS_BUCKET', 'bucket-a', 'CAE=') is None
+
+
+def test_carry_forward_records_the_source_snapshot_without_copying_rows():
+    run_dml_query = mock.MagicMock(return_value=3)
+    bigquery_client = mock.MagicMock()
+    bigquery_client.insert_rows_json.return_value = []
+    mod = import_policy_cache(_fetch('h1', hashed_at='2026-01-02T12:00:00+00:00'), run_dml_query, bigquery_client)
+    cache = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+
+    entry = cache.lookup('GCS_BUCKET', 'bucket-a', 'CAE=')
+    assert cache.carry_forward(entry, 'GCS_BUCKET', 'bucket-a', CURRENT, 'organizations/1')
+    # ヒットごとの DML は発行しない
+    run_dml_query.assert_not_called()
+    (recorded,) = bigquery_client.insert_rows_json.call_args[0][1]
+    assert recorded['assessment_timestamp'] == CURRENT and recorded['source_timestamp'] == PREVIOUS
+    assert recorded['row_count'] == 3 and recorded['scope'] == 'organizations/1'
+
+    # 同じスナップショットの再配信では記録しない
+    assert cache.carry_forward(cache.lookup('GCS_BUCKET', 'bucket-a', 'CAE='), 'GCS_BUCKET', 'bucket-a', CURRENT, 'organizations/1')
+    assert bigquery_client.insert_rows_json.call_count == 1
+
+    # 引き継ぎを重ねても、行を書き込んだスナップショットから複製する
+    assert cache.carry_forward(cache.lookup('GCS_BUCKET', 'bucket-a', 'CAE='), 'GCS_BUCKET', 'bucket-a', '2026-01-03T00:00:00+00:00', 'organizations/1')
+    assert bigquery_client.insert_rows_json.call_args[0][1][0]['source_timestamp'] == PREVIOUS
+
+    # エントリを記録できなかった場合は再評価させる
+    bigquery_client.insert_rows_json.return_value = [{'errors': ['boom']}]
+    assert not cache.carry_forward(entry, 'GCS_BUCKET', 'bucket-a', '2026-01-04T00:00:00+00:00', 'organizations/1')
+
+
+def test_carry_forward_snapshot_copies_all_hits_in_one_merge():
+    run_dml_query = mock.MagicMock(return_value=42)
+    mod = import_policy_cache(_fetch('h1'), run_dml_query, mock.MagicMock())
+    cache = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+
+    assert cache.carry_forward_snapshot('unified_access', CURRENT) == 42
+    run_dml_query.assert_called_once()
+    query = run_dml_query.call_args[0][0]
+    assert 'MERGE' in query and 'WHEN NOT MATCHED THEN' in query and 'source_timestamp IS NOT NULL' in query
+    assert 'ON d.assessment_timestamp = c.source_timestamp' in query
+    params = {p.name: p.value for p in run_dml_query.call_args[1]['query_parameters']}
+    assert params == {'assessment_timestamp': CURRENT}
+
+    assert mod.PolicyEtagCache(None).carry_forward_snapshot('unified_access', CURRENT) == 0
+    assert run_dml_query.call_count == 1
+
+
+def test_results_with_unexpanded_groups_are_not_recorded():
+    bigquery_client = mock.MagicMock()
+    bigquery_client.insert_rows_json.return_value = []
+    mod = import_policy_cache(_fetch('h1'), mock.MagicMock(), bigquery_client)
+    cache = mod.PolicyEtagCache('resource_policy_etags', 'group_membership_hashes')
+
+    rows = [{'principal_type': 'USER'}, {'principal_type': 'GROUP (UNEXPANDED)'}]
+    assert mod.has_unexpanded_members(rows) and not mod.has_unexpanded_members(rows[:1])
+
+    cache.record('GCS_BUCKET', 'bucket-a', 'CAI=', {'team@example.com'}, CURRENT, 2, complete=not mod.has_unexpanded_members(rows))
+    bigquery_client.insert_rows_json.assert_not_called()
+    assert cache.lookup('GCS_BUCKET', 'bucket-a', 'CAI=') is None
@@ -0,0 +1,94 @@
+import os
+import types
+from unittest import mock
+import importlib
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+
+def import_utils(env: dict = None):
+    """Helper to import rate_limiter and iam_helpers fresh with a mocked logger and specific env vars."""
+    with mock.patch.dict(os.environ, env or {}, clear=False), mock.patch.dict(importlib.sys.modules, {
+        'src.utils.logging_handler': types.SimpleNamespace(get_logger=mock.MagicMock(return_value=mock.MagicMock())),
+    }):
+        for name in ('src.utils.rate_limiter', 'src.utils.iam_helpers'):
+            importlib.sys.modules.pop(name, None)
+        return importlib.import_module('src.utils.rate_limiter'), importlib.import_module('src.utils.iam_helpers')
+
+
+def test_quota_errors_are_distinguished_from_permission_errors():
+    rate_limiter, _ = import_utils()
+    assert rate_limiter.is_quota_error(api_exceptions.ResourceExhausted('quota'))
+    assert rate_limiter.is_quota_error(api_exceptions.TooManyRequests('slow down'))
+    assert rate_limiter.is_quota_error(api_exceptions.ServiceUnavailable('overloaded'))
+    assert rate_limiter.is_quota_error(api_exceptions.Forbidden('rate', errors=[{'reason': 'rateLimitExceeded'}]))
+    assert not rate_limiter.is_quota_error(api_exceptions.Forbidden('denied', errors=[{'reason': 'forbidden'}]))
+    assert not rate_limiter.is_quota_error(api_exceptions.PermissionDenied('denied'))
+    assert not rate_limiter.is_quota_error(api_exceptions.NotFound('missing'))
+
+
+def test_call_api_retries_quota_errors_with_backoff_and_raises_others_immediately():
+    rate_limiter, _ = import_utils({'API_MAX_RETRIES': '2'})
+    flaky = mock.MagicMock(side_effect=[api_exceptions.ResourceExhausted('quota'), 'ok'])
+    denied = mock.MagicMock(side_effect=api_exceptions.PermissionDenied('denied'))
+    exhausted = mock.MagicMock(side_effect=api_exceptions.ResourceExhausted('quota'))
+
+    with mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+        assert rate_limiter.call_api('identity', flaky, parent='groups/1') == 'ok'
+        assert sleep.call_count == 1
+        with pytest.raises(api_exceptions.PermissionDenied):
+            rate_limiter.call_api('identity', denied)
+        assert denied.call_count == 1
+        with pytest.raises(api_exceptions.ResourceExhausted):
+            rate_limiter.call_api('identity', exhausted)
+        assert exhausted.call_count == 3
+
+    flaky.assert_called_with(parent='groups/1')
+
+
+def test_call_api_pages_retries_each_page_without_refetching_earlier_pages():
+    rate_limiter, _ = import_utils({'API_MAX_RETRIES': '2'})
+    responses = {
+        None: types.SimpleNamespace(results=['a', 'b'], next_page_token='p2'),
+        'p2': types.SimpleNamespace(results=['c'], next_page_token=''),
+    }
+    requests = []
+
+    def search_all_resources(request, timeout):
+        requests.append(dict(request))
+        if request.get('page_token') == 'p2' and len(requests) == 2:
+            raise api_exceptions.ResourceExhausted('quota')
+        return types.SimpleNamespace(pages=iter([responses[request.get('page_token')]]))
+
+    with mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+        items = list(rate_limiter.call_api_pages('asset', search_all_resources, {'scope': 'organizations/1'}, 'results', timeout=300.0))
+
+    assert items == ['a', 'b', 'c']
+    assert sleep.call_count == 1
+    # 2ページ目のみを再試行する
+    assert [r.get('page_token') for r in requests] == [None, 'p2', 'p2']
+
+
+def test_token_bucket_waits_once_the_burst_is_spent():
+    rate_limiter, _ = import_utils()
+    with mock.patch.object(rate_limiter.time, 'monotonic', return_value=100.0), \
+            mock.patch.object(rate_limiter.time, 'sleep') as sleep:
+        bucket = rate_limiter.TokenBucket(2)
+        waits = [bucket.acquire() for _ in range(4)]
+
+    assert waits == [0.0, 0.0, 0.5, 1.0]
+    assert [c.args[0] for c in sleep.call_args_list] == [0.5, 1.0]
+
+
+def test_expand_member_raises_on_quota_errors_instead_of_marking_the_group_unexpanded():
+    _, iam_helpers = import_utils({'API_MAX_RETRIES': '0'})
+    identity_client = mock.MagicMock()
+
+    identity_client.lookup_group_name.side_effect = api_exceptions.PermissionDenied('denied')
+    assert list(iam_helpers.expand_member(identity_client, 'GROUP', 'team@example.com', set())) == [
+        'GROUP (UNEXPANDED):team@example.com'
+    ]
+
+    identity_client.lookup_group_name.side_effect = api_exceptions.ResourceExhausted('quota')
+    with pytest.raises(api_exceptions.ResourceExhausted):
+        list(iam_helpers.expand_member(identity_client, 'GROUP', 'team@example.com', set()))
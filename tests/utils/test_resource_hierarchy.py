@@ -0,0 +1,56 @@
+from src.utils.resource_hierarchy import ResourceHierarchy, EffectiveAccessEngine
+
+
+ASSETS = [
+    {'name': '//cloudresourcemanager.googleapis.com/organizations/1', 'ancestors': ['organizations/1']},
+    {'name': '//cloudresourcemanager.googleapis.com/projects/app', 'ancestors': ['projects/11', 'folders/2', 'organizations/1']},
+    {'name': '//cloudresourcemanager.googleapis.com/projects/data', 'ancestors': ['projects/12', 'folders/3', 'organizations/1']},
+    {'name': '//storage.googleapis.com/bucket-a', 'ancestors': ['projects/11', 'folders/2', 'organizations/1']},
+    {'name': '//storage.googleapis.com/bucket-b', 'ancestors': ['projects/12', 'folders/3', 'organizations/1']},
+    {'name': '//bigquery.googleapis.com/projects/data/datasets/d', 'ancestors': ['projects/12', 'folders/3', 'organizations/1']},
+]
+
+
+def test_hierarchy_links_ancestors_and_resolves_full_container_names():
+    hierarchy = ResourceHierarchy.from_assets(ASSETS)
+
+    # organizations/1, folders/2, folders/3, projects/11, projects/12 と3つのリソース
+    assert len(hierarchy) == 8
+    project_id = hierarchy.node_id('//cloudresourcemanager.googleapis.com/projects/app')
+    assert project_id == hierarchy.node_id('projects/11')
+    assert hierarchy.names[hierarchy.parents[project_id]] == 'folders/2'
+    assert hierarchy.node_id('//cloudresourcemanager.googleapis.com/folders/3') == hierarchy.node_id('folders/3')
+    assert hierarchy.node_id('//storage.googleapis.com/unknown') is None
+
+
+def test_bindings_propagate_down_and_coverage_counts_descendants():
+    hierarchy = ResourceHierarchy.from_assets(ASSETS)
+    grants = [
+        {'principal_email': 'a@example.com', 'resource_name': '//cloudresourcemanager.googleapis.com/organizations/1', 'role': 'roles/owner'},
+        {'principal_email': 'b@example.com', 'resource_name': '//cloudresourcemanager.googleapis.com/folders/3', 'role': 'roles/editor'},
+        {'principal_email': 'c@example.com', 'resource_name': '//cloudresourcemanager.googleapis.com/folders/999', 'role': 'roles/editor'},
+    ]
+    engine = EffectiveAccessEngine(hierarchy, grants)
+
+    assert [g['principal_email'] for g in engine.effective_policy('//storage.googleapis.com/bucket-b')] == ['a@example.com', 'b@example.com']
+    assert [g['principal_email'] for g in engine.effective_policy('//storage.googleapis.com/bucket-a')] == ['a@example.com']
+    assert engine.coverage() == [
+        {'in_hierarchy': True, 'descendant_count': 7, 'descendant_project_count': 2},
+        {'in_hierarchy': True, 'descendant_count': 3, 'descendant_project_count': 1},
+        {'in_hierarchy': False, 'descendant_count': 0, 'descendant_project_count': 0},
+    ]
+
+
+def test_wide_hierarchy_shares_effective_policies():
+    assets = [
+        {'name': f'//storage.googleapis.com/b{i}', 'ancestors': [f'projects/{i % 500}', f'folders/{i % 20}', 'organizations/1']}
+        for i in range(50_000)
+    ]
+    hierarchy = ResourceHierarchy.from_assets(assets)
+    grants = [{'principal_email': 'a@example.com', 'resource_name': 'organizations/1', 'role': 'roles/owner'}]
+    engine = EffectiveAccessEngine(hierarchy, grants)
+
+    (coverage,) = engine.coverage()
+    assert coverage['descendant_count'] == len(hierarchy) - 1
+    # バインディングを持たないノードは親の実効ポリシーを共有する
+    assert len({id(policy) for policy in engine._memo}) == 1
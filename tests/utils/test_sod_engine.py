@@ -0,0 +1,74 @@
+import json
+
+from src.utils.sod_engine import SodEngine, load_snapshot_file
+from src.utils.sod_rules import normalize_sod_rules
+from src.utils.permission_catalog import PermissionCatalog
+
+
+GRANTS = [
+    {'principal_email': 'alice@example.com', 'principal_type': 'USER', 'resource_name': '//p/1', 'role': 'roles/a'},
+    {'principal_email': 'alice@example.com', 'principal_type': 'USER', 'resource_name': '//p/2', 'role': 'roles/b'},
+    {'principal_email': 'alice@example.com', 'principal_type': 'USER', 'resource_name': '//p/2', 'role': 'roles/x'},
+    {'principal_email': 'bob@example.com', 'principal_type': 'USER', 'resource_name': '//p/1', 'role': 'roles/a'},
+    {'principal_email': 'sa@example.com', 'principal_type': 'SERVICE_ACCOUNT', 'resource_name': '//p/3', 'role': 'roles/c'},
+]
+
+
+def test_gcp_rule_reports_violators_with_matching_assignments():
+    rules = normalize_sod_rules([{'rule_id': 'R1', 'description': 'd', 'role1': ['roles/a'], 'role2': ['roles/b', 'roles/c']}])
+
+    rows = SodEngine(GRANTS).evaluate(rules)
+
+    assert rows == [{
+        'rule_id': 'R1', 'description': 'd',
+        'principal_email': 'alice@example.com', 'principal_type': 'USER',
+        'conflicting_role1': 'roles/a', 'conflicting_role2': 'roles/b',
+        'role1_type': 'GCP_IAM', 'role2_type': 'GCP_IAM',
+        'assignments': [{'resource_name': '//p/1', 'role': 'roles/a'}, {'resource_name': '//p/2', 'role': 'roles/b'}],
+    }]
+
+
+def test_workspace_rules_are_skipped_without_workspace_data():
+    rules = normalize_sod_rules([{
+        'rule_id': 'R2', 'role1': 'roles/c', 'role2': 'ws/admin',
+        'role1_type': 'GCP_IAM', 'role2_type': 'WORKSPACE_ADMIN'
+    }])
+
+    skipped = SodEngine(GRANTS).evaluate(rules)
+    assert skipped[0]['principal_email'] is None
+    assert skipped[0]['description'] == 'N/A (SKIPPED_RULE_INVALID_OR_DATA_UNAVAILABLE)'
+
+    workspace_roles = [{'principal_email': 'sa@example.com', 'workspace_role_name': 'ws/admin'}]
+    rows = SodEngine(GRANTS, workspace_roles).evaluate(rules)
+    assert [(r['principal_email'], r['principal_type']) for r in rows] == [('sa@example.com', 'SERVICE_ACCOUNT')]
+    assert rows[0]['assignments'] == [{'resource_name': '//p/3', 'role': 'roles/c'}, {'resource_name': None, 'role': 'ws/admin'}]
+
+
+def test_load_snapshot_file_flattens_principal_access_list_export(tmp_path):
+    path = tmp_path / 'snapshot.json'
+    path.write_text('\n'.join(json.dumps(row) for row in [
+        {'principal_email': 'alice@example.com', 'principal_type': 'USER',
+         'access_list': [{'resource_name': '//p/1', 'role': 'roles/a'}, {'resource_name': '//p/2', 'role': 'roles/b'}]},
+        {'principal_email': 'alice@example.com', 'workspace_role_name': 'ws/admin'},
+    ]))
+
+    grants, workspace_roles = load_snapshot_file(str(path))
+
+    assert [g['role'] for g in grants] == ['roles/a', 'roles/b']
+    assert workspace_roles == [{'principal_email': 'alice@example.com', 'workspace_role_name': 'ws/admin'}]
+
+
+def test_permission_rules_expand_to_roles_through_the_catalog():
+    catalog = PermissionCatalog.from_role_definitions({
+        'roles/a': ['iam.serviceAccounts.actAs'],
+        'roles/b': ['resourcemanager.projects.setIamPolicy'],
+    })
+    rules = normalize_sod_rules([{
+        'rule_id': 'R3', 'role1': ['iam.serviceAccounts.actAs'], 'role2': ['resourcemanager.projects.setIamPolicy'],
+        'role1_type': 'GCP_PERMISSION', 'role2_type': 'GCP_PERMISSION'
+    }])
+
+    assert SodEngine(GRANTS).evaluate(rules)[0]['principal_email'] is None  # カタログなしはスキップ
+    rows = SodEngine(GRANTS, permission_catalog=catalog).evaluate(rules)
+    assert [r['principal_email'] for r in rows] == ['alice@example.com']
+    assert [a['role'] for a in rows[0]['assignments']] == ['roles/a', 'roles/b']
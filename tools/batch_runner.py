@@ -0,0 +1,434 @@
+"""
+Cloud Functions・Pub/Sub・Scheduler を使わずに、パイプライン全体を1台のマシンで実行するバッチ実行ツール。
+バックフィルや新しい組織の初回評価と、ローカルでの性能検証のドライバーに使う。
+
+各 Function のモジュールをそのまま読み込み、エントリポイントを Pub/Sub と同じ形のイベントで呼び出す
+(etag キャッシュ・計測・実行台帳などの挙動は Cloud Functions 上と同じ)。
+1. group-assessor と principal-assessor をプロセスプールに投入する
+2. dispatcher と同じ検索 (utils.asset_discovery) で評価対象のリソースを列挙し、検索しながらプロセスプールに割り振る
+   (グループのメンバーはプロセス間で共有するキャッシュに入れ、同じグループを何度も Identity API で展開しない)
+3. etag キャッシュが有効な場合、キャッシュにヒットしたリソースの行をスナップショットに複製する (BigQuery に書き込む場合のみ)
+4. 設定ファイルに記載した analyzer を順に実行する (BigQuery に書き込む場合のみ)
+
+結果は BigQuery (既定) か、--sink local でテーブルごとの JSONL ファイル (<output-dir>/<テーブル>/part-<pid>.jsonl) に書き込む。
+--sink local では、実行の開始時に前回の実行の part ファイルを削除する。
+--fake-org を指定すると、tools/gcp_fakes の合成組織とフェイククライアントの上で実行し、スループットを報告する。
+
+設定ファイル (--config) の形式 (Function ごとの環境変数。env はすべての Function に共通):
+    {
+      "env": {"BQ_PROJECT_ID": "my-project", "BQ_DATASET_ID": "iam_assessment", "GSUITE_CUSTOMER_ID": "C0xxxx"},
+      "functions": {
+        "gcs_assessor": {"DESTINATION_TABLE_ID": "unified_access_permissions"},
+        "sod_analyzer": {"SOURCE_TABLE_ID": "principal_access_list", "DESTINATION_TABLE_ID": "sod_violations", "SOD_RULES_JSON": "[...]"}
+      }
+    }
+assessor は DEFAULT_FUNCTION_ENV のテーブル名を既定値とする。analyzer は設定ファイルに記載したものだけを実行する。
+
+例:
+    python tools/batch_runner.py --config batch.json --scope organizations/123 --workers 32 --api-qps identity=200
+    python tools/batch_runner.py --config batch.json --scope organizations/123 --sink local --output-dir batch-output
+    python tools/batch_runner.py --fake-org --projects 500 --resources-per-project 40 --groups 2000 --latency 0.02 --workers 16
+Function の依存パッケージ (google-cloud-bigquery など) がインストールされた環境で実行すること。
+"""
+import argparse
+import base64
+import datetime
+import glob
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TOOLS_DIR)
+SRC_DIR = os.path.join(REPO_ROOT, 'src')
+
+# 実行する Function (src 配下のディレクトリ, エントリポイント)
+FUNCTIONS = {
+    "gcs_assessor": ("assessors/resource_centric/gcs_assessor", "assess_gcs_bucket_policy"),
+    "bq_assessor": ("assessors/resource_centric/bq_assessor", "assess_iam_policy_pubsub"),
+    "compute_assessor": ("assessors/resource_centric/compute_assessor", "assess_compute_instance_policy"),
+    "carry_forward_finalizer": ("assessors/resource_centric/carry_forward_finalizer", "finalize_carried_forward_resources"),
+    "principal_assessor": ("assessors/principal_centric/principal_assessor", "assess_principal_centric"),
+    "group_assessor": ("assessors/group-assessor", "assess_all_groups"),
+    "access_drift_analyzer": ("analyzers/access_drift_analyzer", "analyze_access_drift"),
+    "inheritance_analyzer": ("analyzers/inheritance_analyzer", "analyze_inheritance_risks"),
+    "overpermission_analyzer": ("analyzers/overpermission_analyzer", "analyze_overpermission"),
+    "public_exposure_analyzer": ("analyzers/public_exposure_analyzer", "analyze_public_exposure"),
+    "risk_analyzer": ("analyzers/risk_analyzer", "analyze_high_risk_roles"),
+    "sod_analyzer": ("analyzers/sod-analyzer", "analyze_sod_violations"),
+}
+# utils.asset_discovery の assessor の名前 -> Function
+RESOURCE_ASSESSORS = {
+    "gcs-assessor": "gcs_assessor",
+    "bq-assessor": "bq_assessor",
+    "compute-assessor": "compute_assessor",
+}
+ANALYZERS = [name for name in FUNCTIONS if name.endswith("_analyzer")]
+DEFAULT_FUNCTION_ENV = {
+    "gcs_assessor": {"DESTINATION_TABLE_ID": "unified_access_permissions"},
+    "bq_assessor": {"DESTINATION_TABLE_ID": "unified_access_permissions"},
+    "compute_assessor": {"DESTINATION_TABLE_ID": "unified_access_permissions"},
+    "carry_forward_finalizer": {"DESTINATION_TABLE_ID": "unified_access_permissions", "POLICY_ETAG_TABLE_ID": "resource_policy_etags"},
+    "principal_assessor": {"DESTINATION_TABLE_ID": "principal_access_list", "ACCESS_FACTS_TABLE_ID": "access_facts"},
+    "group_assessor": {"DESTINATION_TABLE_ID": "group_membership_details", "TRANSITIVE_TABLE_ID": "group_transitive_members"},
+}
+STAGES = ("groups", "principals", "resources", "analyzers")
+FAKE_ENV = {"GCP_PROJECT": "batch-host", "BQ_PROJECT_ID": "batch-host", "BQ_DATASET_ID": "iam_assessment", "GSUITE_CUSTOMER_ID": "C0fake"}
+FAKE_ORG_PARAMETERS = (
+    "seed", "folders", "projects", "resources_per_project", "bindings_per_resource", "users", "groups",
+    "nesting_depth", "diamond_ratio", "members_per_group", "group_binding_ratio",
+)
+# 報告に含めるエラーの例の数
+MAX_ERROR_SAMPLES = 20
+
+
+class _SinkDataset:
+    def __init__(self, project, dataset_id):
+        self.project = project
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return SimpleNamespace(project=self.project, dataset_id=self.dataset_id, table_id=table_id)
+
+
+class LocalSink:
+    """
+    BigQuery クライアントの代わりに utils.gcp_clients.bigquery_client に設定し、書き込み (insert_rows_json /
+    load_table_from_json) をテーブルごとの JSONL ファイルに置き換える。プロセスごとに別のファイルに書き込む。
+    WRITE_TRUNCATE はそのプロセスのファイルのみを洗い替えるため、前回の実行のファイルはプールの起動前に reset() で削除する。
+    それ以外の呼び出し (クエリなど) は delegate のクライアントに委譲する。
+    """
+
+    def __init__(self, directory: str, delegate=None):
+        self.directory = directory
+        self._delegate = delegate
+        self._lock = threading.Lock() # overpermission-analyzer などはスレッドから書き込む
+
+    def dataset(self, dataset_id, project=None):
+        return _SinkDataset(project, dataset_id)
+
+    def path(self, table) -> str:
+        table_id = getattr(table, "table_id", None) or str(table).split(".")[-1]
+        return os.path.join(self.directory, table_id, f"part-{os.getpid()}.jsonl")
+
+    def reset(self):
+        """前回の実行の出力 (<directory>/<テーブル>/part-*.jsonl) を削除する。プールを起動する前にメインプロセスで1回だけ呼び出す"""
+        for path in glob.glob(os.path.join(self.directory, "*", "part-*.jsonl")):
+            os.remove(path)
+
+    def _write(self, table, rows, truncate: bool = False) -> int:
+        path = self.path(table)
+        data = "".join(json.dumps(row, default=str) + "\n" for row in rows)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w" if truncate else "a", encoding="utf-8") as f:
+                f.write(data)
+        return len(data.encode("utf-8"))
+
+    def insert_rows_json(self, table, json_rows, **kwargs):
+        self._write(table, json_rows)
+        return []
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, **kwargs):
+        rows = list(json_rows)
+        truncate = getattr(job_config, "write_disposition", None) == "WRITE_TRUNCATE"
+        output_bytes = self._write(destination, rows, truncate)
+        return SimpleNamespace(result=lambda *args, **kwargs: None, output_rows=len(rows), output_bytes=output_bytes)
+
+    def __getattr__(self, name):
+        if name == "_delegate":
+            raise AttributeError(name)
+        if self._delegate is None:
+            raise AttributeError(f"'{name}' is not supported by the local sink (use --sink bigquery)")
+        return getattr(self._delegate, name)
+
+
+def _event(payload) -> SimpleNamespace:
+    """Pub/Sub トリガーの CloudEvent と同じ形のオブジェクト"""
+    data = json.dumps(payload)
+    return SimpleNamespace(data={"message": {"data": base64.b64encode(data.encode("utf-8")).decode("ascii")}})
+
+
+def _prepare_process(settings: dict, role: str):
+    """
+    プロセスの初期化。関数のモジュールをインポートする前に、環境変数・ログの出力先・クライアント (実環境/フェイク) と
+    書き込み先を設定する。utils.gcp_clients のモジュールを返す。
+    """
+    sys.path.insert(0, SRC_DIR)
+    sys.path.insert(0, TOOLS_DIR)
+    os.environ.update(settings["env"])
+    # Function のJSONログは、ロガーのハンドラが作られる前に出力先を切り替える
+    if settings["log_dir"]:
+        os.makedirs(settings["log_dir"], exist_ok=True)
+        sys.stdout = open(os.path.join(settings["log_dir"], f"{role}-{os.getpid()}.jsonl"), "a", encoding="utf-8")
+    else:
+        sys.stdout = open(os.devnull, "w")
+
+    if settings["fake"]:
+        from gcp_fakes import FaultInjector, generate_org, install
+        org = generate_org(**settings["fake"]["org"])
+        gcp_clients = install(org, FaultInjector(**settings["fake"]["faults"]))
+    else:
+        import utils.gcp_clients as gcp_clients
+    if settings["sink"] == "local":
+        gcp_clients.bigquery_client = LocalSink(settings["output_dir"], delegate=gcp_clients.bigquery_client)
+    return gcp_clients
+
+
+def _load_function(name: str, settings: dict):
+    """Function のモジュールを、その Function の環境変数を設定して読み込む (モジュールは読み込み時に環境変数を参照する)"""
+    directory, entry_point = FUNCTIONS[name]
+    saved = dict(os.environ)
+    os.environ.update(settings["functions"].get(name, {}))
+    try:
+        spec = importlib.util.spec_from_file_location(f"batch_{name}", os.path.join(SRC_DIR, directory, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    return getattr(module, entry_point)
+
+
+# ワーカープロセスごとの状態 (読み込んだエントリポイント)
+_worker = {}
+
+
+def _init_worker(settings: dict, membership_cache):
+    _prepare_process(settings, "worker")
+    from utils.iam_helpers import set_membership_cache
+    set_membership_cache(membership_cache)
+    _worker["settings"] = settings
+    _worker["entry_points"] = {}
+
+
+def _run_function(entry_points: dict, settings: dict, name: str, payload: dict) -> tuple:
+    if name not in entry_points:
+        entry_points[name] = _load_function(name, settings)
+    started = time.perf_counter()
+    error = None
+    try:
+        entry_points[name](_event(payload))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return name, payload.get("resource_name"), time.perf_counter() - started, error
+
+
+def _run_task(task: tuple) -> tuple:
+    """ワーカーで1件の評価を実行し、(Function, リソース名, 秒数, エラー) を返す"""
+    name, payload = task
+    return _run_function(_worker["entry_points"], _worker["settings"], name, payload)
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.error_samples = []
+
+    def add(self, resource_name, seconds: float, error):
+        self.count += 1
+        self.seconds += seconds
+        if error:
+            self.errors += 1
+            if len(self.error_samples) < MAX_ERROR_SAMPLES:
+                self.error_samples.append({"resource_name": resource_name, "error": error})
+
+    def report(self) -> dict:
+        return {
+            "invocations": self.count, "errors": self.errors,
+            "busy_seconds": round(self.seconds, 3), "error_samples": self.error_samples,
+        }
+
+
+def _rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds > 0 else 0.0
+
+
+def run_pipeline(settings: dict, scopes: list, stages: list, workers: int) -> dict:
+    """パイプラインを実行し、ステージごとの件数・エラー・所要時間の報告を返す"""
+    _prepare_process(settings, "main")
+    from utils.asset_discovery import discover_resources
+    from utils.run_ledger import new_run_id
+
+    if settings["sink"] == "local":
+        # 前回の実行のファイル (別のプロセスIDの part) が残らないよう、ワーカーが書き込む前に削除する
+        LocalSink(settings["output_dir"]).reset()
+
+    run_id = new_run_id()
+    assessment_timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    report = {"run_id": run_id, "assessment_timestamp": assessment_timestamp, "scopes": scopes, "workers": workers, "stages": {}}
+    started = time.perf_counter()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        membership_cache = manager.dict()
+        with context.Pool(workers, initializer=_init_worker, initargs=(settings, membership_cache)) as pool:
+            # 1. 1回の呼び出しで全体を処理する assessor は、リソースの評価と並行して実行する
+            single_tasks = {}
+            if "groups" in stages:
+                if settings["env"].get("GSUITE_CUSTOMER_ID") or settings["functions"].get("group_assessor", {}).get("GSUITE_CUSTOMER_ID"):
+                    single_tasks["group_assessor"] = pool.apply_async(
+                        _run_task, (("group_assessor", {"assessment_timestamp": assessment_timestamp, "run_id": run_id}),)
+                    )
+                else:
+                    report["stages"]["group_assessor"] = {"skipped": "GSUITE_CUSTOMER_ID is not set"}
+            if "principals" in stages:
+                single_tasks["principal_assessor"] = pool.apply_async(
+                    _run_task, (("principal_assessor", {"scopes": scopes, "assessment_timestamp": assessment_timestamp, "run_id": run_id}),)
+                )
+
+            # 2. リソースを検索しながら割り振る (imap_unordered はタスクの生成を別スレッドで行うため、検索と評価が重なる)
+            if "resources" in stages:
+                def tasks():
+                    for scope in scopes:
+                        for assessor_name, resource_name in discover_resources(scope):
+                            name = RESOURCE_ASSESSORS.get(assessor_name)
+                            if name:
+                                yield name, {
+                                    "scope": scope, "resource_name": resource_name,
+                                    "assessment_timestamp": assessment_timestamp, "run_id": run_id,
+                                }
+
+                stage_started = time.perf_counter()
+                stats = {name: _StageStats() for name in RESOURCE_ASSESSORS.values()}
+                for name, resource_name, seconds, error in pool.imap_unordered(_run_task, tasks(), chunksize=4):
+                    stats[name].add(resource_name, seconds, error)
+                wall_seconds = time.perf_counter() - stage_started
+                for name, stage in stats.items():
+                    report["stages"][name] = {**stage.report(), "resources_per_sec": _rate(stage.count, wall_seconds)}
+                report["stages"]["resources"] = {
+                    "wall_seconds": round(wall_seconds, 3),
+                    "resources": sum(s.count for s in stats.values()),
+                    "resources_per_sec": _rate(sum(s.count for s in stats.values()), wall_seconds),
+                }
+
+            for name, result in single_tasks.items():
+                stage = _StageStats()
+                stage.add(*result.get()[1:])
+                report["stages"][name] = {**stage.report(), "wall_seconds": round(stage.seconds, 3)}
+        report["cached_groups"] = len(membership_cache)
+
+    # 3. キャッシュにヒットしたリソースの行は、assessor の書き込みが終わってから1回の MERGE でまとめて複製する
+    if "resources" in stages and any(settings["functions"].get(name, {}).get("POLICY_ETAG_TABLE_ID") for name in RESOURCE_ASSESSORS.values()):
+        if settings["sink"] == "local" or settings["fake"]:
+            report["stages"]["carry_forward_finalizer"] = {"skipped": "carrying forward runs a MERGE and needs --sink bigquery against a real project"}
+        else:
+            stage = _StageStats()
+            stage.add(*_run_function({}, settings, "carry_forward_finalizer", {"snapshot_id": assessment_timestamp, "run_id": run_id})[1:])
+            report["stages"]["carry_forward_finalizer"] = {**stage.report(), "wall_seconds": round(stage.seconds, 3)}
+
+    # 4. analyzer は BigQuery 上のクエリのため、assessor の書き込みが終わってから順に実行する
+    if "analyzers" in stages:
+        analyzers = [name for name in ANALYZERS if name in settings["functions"]]
+        if settings["sink"] == "local" or settings["fake"]:
+            report["stages"]["analyzers"] = {"skipped": "analyzers query BigQuery and need --sink bigquery against a real project"}
+        else:
+            entry_points = {}
+            for name in analyzers:
+                stage = _StageStats()
+                # snapshot_id は指定せず、assessor が書き込んだ最新のスナップショットを分析させる
+                stage.add(*_run_function(entry_points, settings, name, {"run_id": run_id})[1:])
+                report["stages"][name] = {**stage.report(), "wall_seconds": round(stage.seconds, 3)}
+
+    report["wall_seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def _parse_api_qps(values: list, workers: int) -> dict:
+    """--api-qps identity=200 (プール全体の QPS) を、ワーカーごとの API_QPS_LIMITS に変換する"""
+    limits = {}
+    for value in values or []:
+        api_name, _, qps = value.partition("=")
+        limits[api_name] = float(qps) / workers
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the whole assessment pipeline on one machine with a process pool.")
+    parser.add_argument("--config", help="JSON file with common and per-function environment variables")
+    parser.add_argument("--scope", action="append", default=[], help="assessment scope (repeatable), e.g. organizations/123")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated stages to run ({','.join(STAGES)})")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--api-qps", action="append", help="API=QPS limit for the whole pool (repeatable), e.g. identity=200")
+    parser.add_argument("--sink", choices=("bigquery", "local"), default="bigquery")
+    parser.add_argument("--output-dir", help="directory for --sink local")
+    parser.add_argument("--log-dir", help="directory for the function JSON logs (default: discarded; errors are in the report)")
+    parser.add_argument("--report", help="write the JSON report to this path as well")
+    fake = parser.add_argument_group("performance testing on offline fakes")
+    fake.add_argument("--fake-org", action="store_true", help="run against tools/gcp_fakes and a synthetic organization")
+    fake.add_argument("--seed", type=int, default=42)
+    fake.add_argument("--folders", type=int, default=10)
+    fake.add_argument("--projects", type=int, default=50)
+    fake.add_argument("--resources-per-project", type=int, default=30)
+    fake.add_argument("--bindings-per-resource", type=int, default=4)
+    fake.add_argument("--users", type=int, default=5000)
+    fake.add_argument("--groups", type=int, default=500)
+    fake.add_argument("--nesting-depth", type=int, default=4)
+    fake.add_argument("--diamond-ratio", type=float, default=0.1)
+    fake.add_argument("--members-per-group", type=int, default=20)
+    fake.add_argument("--group-binding-ratio", type=float, default=0.3)
+    fake.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API call")
+    fake.add_argument("--jitter", type=float, default=0.0, help="random extra latency (0..jitter seconds)")
+    fake.add_argument("--quota-error-rate", type=float, default=0.0, help="probability of an injected ResourceExhausted")
+    args = parser.parse_args()
+
+    config = {"env": {}, "functions": {}}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config.update(json.load(f))
+    if args.sink == "local" and not args.output_dir:
+        parser.error("--sink local requires --output-dir")
+
+    functions = {name: {**DEFAULT_FUNCTION_ENV.get(name, {}), **config["functions"].get(name, {})} for name in FUNCTIONS}
+    # analyzer は設定ファイルに記載したもののみ実行する
+    functions = {name: env for name, env in functions.items() if name not in ANALYZERS or name in config["functions"]}
+    env = {**(FAKE_ENV if args.fake_org else {}), **config["env"]}
+    # QPS をワーカー数で分割する前に、ワーカー数を1以上にそろえる
+    workers = max(1, args.workers)
+    qps_limits = _parse_api_qps(args.api_qps, workers)
+    if qps_limits:
+        env["API_QPS_LIMITS"] = json.dumps(qps_limits)
+
+    settings = {
+        "env": env, "functions": functions, "sink": args.sink,
+        "output_dir": os.path.abspath(args.output_dir) if args.output_dir else None,
+        "log_dir": os.path.abspath(args.log_dir) if args.log_dir else None,
+        "fake": None,
+    }
+    scopes = args.scope
+    if args.fake_org:
+        settings["fake"] = {
+            "org": {key: getattr(args, key) for key in FAKE_ORG_PARAMETERS},
+            "faults": {"latency": args.latency, "jitter": args.jitter, "quota_error_rate": args.quota_error_rate, "seed": args.seed},
+        }
+        sys.path.insert(0, TOOLS_DIR)
+        from gcp_fakes import generate_org
+        org = generate_org(**settings["fake"]["org"])
+        scopes = scopes or [org.org_name]
+        settings["fake"]["stats"] = org.stats()
+    if not scopes:
+        parser.error("at least one --scope is required (or --fake-org)")
+
+    report = run_pipeline(settings, scopes, [s for s in args.stages.split(",") if s], workers)
+    if settings["fake"]:
+        report["fake_org"] = settings["fake"]
+    output = json.dumps(report, indent=2, default=str)
+    if args.report:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(output)
+    # 関数のログはファイル (または破棄) に切り替えているため、報告は元の stdout に出力する
+    sys.__stdout__.write(output + "\n")
+    if any(stage.get("errors") for stage in report["stages"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
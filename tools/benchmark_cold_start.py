@@ -0,0 +1,222 @@
+"""
+Function ごとのコールドスタート (モジュールのインポートとクライアントの初期化) の計測。
+
+Function のモジュールを新しいインタプリタで読み込み、次の値をJSONで出力する。
+- import_seconds: main.py の読み込み時間 (utils と google.cloud の読み込みを含む)
+- first_use_seconds: Function が参照するクライアント (utils.gcp_clients の LazyClient) の生成時間
+- modules_loaded: 読み込み後の sys.modules の数
+- rss_mb: 読み込み後のRSS
+
+--ref に git のリビジョンを指定すると、そのリビジョンの src を一時ディレクトリに展開して同じ計測を行い、
+現在の作業ツリーの結果と並べて出力する (例: 遅延初期化の前後の比較)。
+クライアントの生成には認証情報が必要なため、アプリケーションのデフォルト認証情報が使える環境で実行すること。
+
+例:
+    python tools/benchmark_cold_start.py
+    python tools/benchmark_cold_start.py --ref HEAD~1 --repeat 5
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, 'src')
+
+# エントリポイント名 -> src 配下のディレクトリ
+ENTRY_POINTS = {
+    "discover_and_dispatch_assets": "dispatcher",
+    "assess_gcs_bucket_policy": "assessors/resource_centric/gcs_assessor",
+    "assess_iam_policy_pubsub": "assessors/resource_centric/bq_assessor",
+    "assess_compute_instance_policy": "assessors/resource_centric/compute_assessor",
+    "finalize_carried_forward_resources": "assessors/resource_centric/carry_forward_finalizer",
+    "assess_principal_centric": "assessors/principal_centric/principal_assessor",
+    "assess_all_groups": "assessors/group-assessor",
+    "assess_role_catalog": "assessors/role_catalog_assessor",
+    "analyze_sod_violations": "analyzers/sod-analyzer",
+    "analyze_high_risk_roles": "analyzers/risk_analyzer",
+    "analyze_public_exposure": "analyzers/public_exposure_analyzer",
+    "analyze_inheritance_risks": "analyzers/inheritance_analyzer",
+    "analyze_overpermission": "analyzers/overpermission_analyzer",
+    "analyze_access_drift": "analyzers/access_drift_analyzer",
+}
+# モジュールの読み込み時に検証される環境変数 (それ以外は呼び出し時に読み込まれる)
+IMPORT_ENV = {
+    "ASSESSMENT_SCOPES": json.dumps(["organizations/0"]),
+    "ASSESSOR_TOPIC_NAMES": json.dumps({"bq-assessor": "bq", "gcs-assessor": "gcs", "compute-assessor": "compute"}),
+}
+RESULT_MARKER = "COLD_START_RESULT "
+# Function ごとのコールドスタートの予算 (指定のない指標は default の値)
+BUDGETS_PATH = os.path.join(REPO_ROOT, 'tools', 'cold_start_budgets.json')
+
+
+class MissingDependencyError(RuntimeError):
+    """Function の依存パッケージがこの環境にインストールされていない"""
+
+# 新しいインタプリタで実行する計測コード。Function のログ (stdout) と区別するため結果には目印を付ける
+_CHILD_CODE = r"""
+import importlib.util, json, os, sys, time
+src_dir, directory, marker, resolve_clients = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4] == "1"
+sys.path.insert(0, src_dir)
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("main", os.path.join(src_dir, directory, "main.py"))
+module = importlib.util.module_from_spec(spec)
+sys.modules["main"] = module
+spec.loader.exec_module(module)
+import_seconds = time.perf_counter() - started
+
+# Function と utils が参照している遅延クライアントを生成する (gcp_clients 自身が持つ未使用のものは除く)
+lazy = {}
+for name, mod in list(sys.modules.items()) if resolve_clients else ():
+    if name == "main" or (name.startswith("utils.") and name != "utils.gcp_clients"):
+        for value in list(vars(mod).values()):
+            if type(value).__name__ == "LazyClient" and not value.initialized:
+                lazy[id(value)] = value
+started = time.perf_counter()
+for client in lazy.values():
+    client.resolve()
+first_use_seconds = time.perf_counter() - started
+
+rss_kb = 0
+with open("/proc/self/status") as status:
+    for line in status:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(marker + json.dumps({
+    "import_seconds": import_seconds,
+    "first_use_seconds": first_use_seconds,
+    "lazy_clients_resolved": len(lazy),
+    "modules_loaded": len(sys.modules),
+    "rss_mb": round(rss_kb / 1024, 1),
+}))
+"""
+
+
+def parse_importtime(stderr: str, top: int = 10) -> list:
+    """-X importtime の出力から、累積時間の大きいトップレベルのインポートを [{module, self_us, cumulative_us}] で返す"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue # ヘッダ行
+        # 名前の前のインデント (2スペースごとに1段) がないものが、子プロセスと main.py が直接インポートしたモジュール
+        if name.startswith("  ", 1):
+            continue
+        entries.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return sorted(entries, key=lambda e: e["cumulative_us"], reverse=True)[:top]
+
+
+def measure_cold_start(directory: str, src_dir: str = SRC_DIR, env: dict = None, importtime: bool = False,
+                       resolve_clients: bool = True) -> dict:
+    """
+    Function のディレクトリ (src 配下) を新しいインタプリタで読み込み、コールドスタートの指標を返す。
+    resolve_clients=False の場合はクライアントを生成しない (認証情報のない環境でインポートのみを計測する)。
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", _CHILD_CODE, src_dir, directory, RESULT_MARKER, "1" if resolve_clients else "0"]
+    process = subprocess.run(
+        command, capture_output=True, text=True, env={**os.environ, **IMPORT_ENV, **(env or {})}
+    )
+    result_lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if process.returncode != 0 or not result_lines:
+        errors = [line for line in process.stderr.splitlines() if not line.startswith("import time:")]
+        if any(line.startswith("ModuleNotFoundError") for line in errors):
+            raise MissingDependencyError(f"Failed to import {directory}: {errors[-1]}")
+        raise RuntimeError(f"Failed to import {directory}: {' '.join(errors[-3:])}")
+    result = json.loads(result_lines[-1][len(RESULT_MARKER):])
+    if importtime:
+        result["slowest_imports"] = parse_importtime(process.stderr)
+    return result
+
+
+def load_budgets(path: str = BUDGETS_PATH) -> dict:
+    """予算ファイルを読み込み、{エントリポイント: {指標: 上限}} を返す"""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    default = config.get("default", {})
+    return {entry_point: {**default, **config.get("functions", {}).get(entry_point, {})} for entry_point in ENTRY_POINTS}
+
+
+def check_budget(result: dict, budget: dict) -> list:
+    """予算を超えた指標を "指標: 実測値 > 上限" の形式で返す"""
+    return [
+        f"{metric}: {result[metric]} > {limit}"
+        for metric, limit in sorted(budget.items())
+        if metric in result and result[metric] > limit
+    ]
+
+
+def measure_all(src_dir: str, entry_points: list, repeat: int = 1, importtime: bool = False) -> dict:
+    """エントリポイントごとに repeat 回計測し、各指標の中央値を返す"""
+    results = {}
+    for entry_point in entry_points:
+        runs = [measure_cold_start(ENTRY_POINTS[entry_point], src_dir, importtime=importtime) for _ in range(repeat)]
+        result = {
+            key: round(statistics.median(run[key] for run in runs), 4)
+            for key in ("import_seconds", "first_use_seconds", "modules_loaded", "rss_mb")
+        }
+        result["cold_start_seconds"] = round(result["import_seconds"] + result["first_use_seconds"], 4)
+        result["lazy_clients_resolved"] = runs[0]["lazy_clients_resolved"]
+        if importtime:
+            result["slowest_imports"] = runs[0]["slowest_imports"]
+        results[entry_point] = result
+    return results
+
+
+def _export_src(ref: str, directory: str) -> str:
+    """git のリビジョンの src を directory に展開し、そのパスを返す"""
+    archive = subprocess.run(["git", "archive", ref, "src"], cwd=REPO_ROOT, capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, "src")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-function import and client initialization time.")
+    parser.add_argument("--functions", help="comma separated entry points (default: all)")
+    parser.add_argument("--ref", help="git revision to measure for comparison (e.g. HEAD~1)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per function (the median is reported)")
+    parser.add_argument("--importtime", action="store_true", help="also report the slowest imports (-X importtime)")
+    parser.add_argument("--output", help="write the result JSON to this file")
+    parser.add_argument("--check-budgets", action="store_true",
+                        help="exit with an error when a function exceeds tools/cold_start_budgets.json")
+    args = parser.parse_args()
+
+    entry_points = args.functions.split(",") if args.functions else list(ENTRY_POINTS)
+    report = {"current": measure_all(SRC_DIR, entry_points, args.repeat, args.importtime)}
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp:
+            report[args.ref] = measure_all(_export_src(args.ref, tmp), entry_points, args.repeat, args.importtime)
+        for entry_point in entry_points:
+            before = report[args.ref][entry_point]["cold_start_seconds"]
+            after = report["current"][entry_point]["cold_start_seconds"]
+            print(f"{entry_point:<34} {args.ref}: {before:8.3f}s  current: {after:8.3f}s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if args.check_budgets:
+        budgets = load_budgets()
+        over_budget = {
+            entry_point: violations for entry_point, result in report["current"].items()
+            if (violations := check_budget(result, budgets[entry_point]))
+        }
+        for entry_point, violations in over_budget.items():
+            print(f"{entry_point} is over budget: {', '.join(violations)}", file=sys.stderr)
+        if over_budget:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+パイプライン全体のスループット・レイテンシのベンチマーク。
+
+tools/gcp_fakes のフェイククライアントと合成組織の上で、各 Function のエントリポイントをそのまま呼び出して計測する。
+- discover_and_dispatch_assets: resources/sec
+- 3つのリソース assessor: resources/sec, bindings/sec
+- assess_principal_centric: principals/sec, ピークRSS
+- assess_all_groups: groups/sec
+- analyze_sod_violations: ルール数ごとのSQL生成 (ルールの正規化・分類・クエリ組み立て) の時間
+
+ベンチマークはそれぞれ新しいプロセスで実行する (モジュールレベルの環境変数の読み込みとピークRSSを分離するため)。
+結果はコミットIDとともにJSONで保存し、--baseline に以前の結果を渡すと指標ごとの変化を表示する。
+Function の依存パッケージ (functions-framework, google-cloud-bigquery など) がインストールされた環境で実行すること。
+
+例:
+    python tools/benchmark_pipeline.py --projects 200 --resources-per-project 50 --groups 2000
+    python tools/benchmark_pipeline.py --latency 0.02 --baseline benchmark-results/pipeline-abc1234.json
+"""
+import argparse
+import base64
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TOOLS_DIR)
+SRC_DIR = os.path.join(REPO_ROOT, 'src')
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+from gcp_fakes import FaultInjector, generate_org, install  # noqa: E402
+from benchmark_sod_engine import generate_rules  # noqa: E402
+
+DEFAULT_OUTPUT_DIR = os.path.join(REPO_ROOT, 'benchmark-results')
+# 計測対象の Function (src 配下のディレクトリ, エントリポイント)
+FUNCTIONS = {
+    "dispatcher": ("dispatcher", "discover_and_dispatch_assets"),
+    "gcs_assessor": ("assessors/resource_centric/gcs_assessor", "assess_gcs_bucket_policy"),
+    "bq_assessor": ("assessors/resource_centric/bq_assessor", "assess_iam_policy_pubsub"),
+    "compute_assessor": ("assessors/resource_centric/compute_assessor", "assess_compute_instance_policy"),
+    "principal_assessor": ("assessors/principal_centric/principal_assessor", "assess_principal_centric"),
+    "group_assessor": ("assessors/group-assessor", "assess_all_groups"),
+    "sod_analyzer": ("analyzers/sod-analyzer", "analyze_sod_violations"),
+}
+RESOURCE_ASSESSOR_KINDS = {
+    "gcs_assessor": "GCS_BUCKET",
+    "bq_assessor": "BIGQUERY_DATASET",
+    "compute_assessor": "COMPUTE_INSTANCE",
+}
+COMMON_ENV = {
+    "GCP_PROJECT": "bench-host",
+    "BQ_PROJECT_ID": "bench-host",
+    "BQ_DATASET_ID": "iam_assessment",
+}
+ORG_PARAMETERS = (
+    "seed", "folders", "projects", "resources_per_project", "bindings_per_resource", "users", "groups",
+    "nesting_depth", "diamond_ratio", "members_per_group", "group_binding_ratio",
+)
+# 値が大きいほど良い指標の接尾辞 (seconds / _mb で終わる指標は小さいほど良い)
+HIGHER_IS_BETTER = ("_per_sec",)
+LOWER_IS_BETTER = ("seconds", "_mb")
+
+
+def _event(payload) -> SimpleNamespace:
+    """Pub/Sub トリガーの CloudEvent と同じ形のオブジェクト"""
+    data = payload if isinstance(payload, str) else json.dumps(payload)
+    return SimpleNamespace(data={"message": {"data": base64.b64encode(data.encode("utf-8")).decode("ascii")}})
+
+
+def _peak_rss_mb() -> float:
+    # Linux の ru_maxrss は KB 単位
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds > 0 else 0.0
+
+
+def _setup(config: dict, query_handler=None):
+    """子プロセスで合成組織を生成し、フェイククライアントを utils.gcp_clients として登録する"""
+    # Function のJSONログは書式化・書き込みのコストを含めて計測し、出力だけ捨てる
+    sys.stdout = open(os.devnull, "w")
+    os.environ.update(COMMON_ENV)
+    org = generate_org(**{key: config[key] for key in ORG_PARAMETERS})
+    faults = FaultInjector(
+        latency=config["latency"], jitter=config["jitter"], quota_error_rate=config["quota_error_rate"], seed=config["seed"]
+    )
+    return org, install(org, faults, query_handler)
+
+
+def _load_function(name: str, env: dict):
+    """Function のモジュールを環境変数を設定してから読み込み、(エントリポイント, インポート秒数) を返す"""
+    os.environ.update(env)
+    directory, entry_point = FUNCTIONS[name]
+    spec = importlib.util.spec_from_file_location(f"bench_{name}", os.path.join(SRC_DIR, directory, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    started = time.perf_counter()
+    spec.loader.exec_module(module)
+    return getattr(module, entry_point), time.perf_counter() - started
+
+
+def _api_stats(clients) -> dict:
+    return {"api_calls": dict(sorted(clients.faults.calls.items())), "quota_errors": clients.faults.quota_errors}
+
+
+def bench_dispatcher(config: dict) -> dict:
+    org, clients = _setup(config)
+    entry_point, import_seconds = _load_function("dispatcher", {
+        "ASSESSMENT_SCOPES": json.dumps([org.org_name]),
+        "ASSESSOR_TOPIC_NAMES": json.dumps({"bq-assessor": "bq", "gcs-assessor": "gcs", "compute-assessor": "compute"}),
+    })
+    started = time.perf_counter()
+    entry_point(_event("{}"))
+    seconds = time.perf_counter() - started
+    dispatched = len(clients.publisher_client.messages)
+    return {
+        "import_seconds": round(import_seconds, 4), "seconds": round(seconds, 3),
+        "resources": dispatched, "resources_per_sec": _rate(dispatched, seconds), **_api_stats(clients),
+    }
+
+
+def bench_resource_assessor(name: str, config: dict) -> dict:
+    org, clients = _setup(config)
+    entry_point, import_seconds = _load_function(name, {"DESTINATION_TABLE_ID": "unified_access"})
+    resources = [r for r in org.resources if r["kind"] == RESOURCE_ASSESSOR_KINDS[name]]
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    events = [
+        _event({"scope": org.org_name, "resource_name": r["name"], "assessment_timestamp": timestamp}) for r in resources
+    ]
+    errors = 0
+    started = time.perf_counter()
+    for event in events:
+        try:
+            entry_point(event)
+        except Exception:
+            errors += 1
+    seconds = time.perf_counter() - started
+    bindings = sum(len(members) for r in resources for members in r["bindings"].values())
+    return {
+        "import_seconds": round(import_seconds, 4), "seconds": round(seconds, 3),
+        "resources": len(resources), "bindings": bindings, "errors": errors,
+        "rows_written": len(clients.bigquery_client.rows("unified_access")),
+        "resources_per_sec": _rate(len(resources), seconds), "bindings_per_sec": _rate(bindings, seconds),
+        **_api_stats(clients),
+    }
+
+
+def bench_principal_assessor(config: dict) -> dict:
+    org, clients = _setup(config)
+    entry_point, import_seconds = _load_function("principal_assessor", {
+        "DESTINATION_TABLE_ID": "principal_access_list", "ACCESS_FACTS_TABLE_ID": "access_facts",
+    })
+    rss_before = _peak_rss_mb()
+    started = time.perf_counter()
+    entry_point(_event([org.org_name]))
+    seconds = time.perf_counter() - started
+    principals = len({row["principal_email"] for row in clients.bigquery_client.rows("principal_access_list")})
+    return {
+        "import_seconds": round(import_seconds, 4), "seconds": round(seconds, 3),
+        "principals": principals, "principals_per_sec": _rate(principals, seconds),
+        "access_facts": len(clients.bigquery_client.rows("access_facts")),
+        "peak_rss_mb": _peak_rss_mb(), "peak_rss_growth_mb": round(_peak_rss_mb() - rss_before, 1),
+        **_api_stats(clients),
+    }
+
+
+def bench_group_assessor(config: dict) -> dict:
+    org, clients = _setup(config)
+    entry_point, import_seconds = _load_function("group_assessor", {
+        "GSUITE_CUSTOMER_ID": "C0bench", "DESTINATION_TABLE_ID": "group_memberships",
+        "TRANSITIVE_TABLE_ID": "group_transitive_members", "SYNC_MODE": "FULL",
+    })
+    started = time.perf_counter()
+    entry_point(_event("{}"))
+    seconds = time.perf_counter() - started
+    return {
+        "import_seconds": round(import_seconds, 4), "seconds": round(seconds, 3),
+        "groups": len(org.groups), "groups_per_sec": _rate(len(org.groups), seconds),
+        "membership_rows": len(clients.bigquery_client.rows("group_memberships")),
+        "transitive_rows": len(clients.bigquery_client.rows("group_transitive_members")),
+        "peak_rss_mb": _peak_rss_mb(), **_api_stats(clients),
+    }
+
+
+def bench_sod_analyzer(config: dict, rule_count: int) -> dict:
+    _, clients = _setup(config)
+    rules = generate_rules(rule_count, config["sod_roles"], config["seed"])
+    # ルールの正規化はモジュールの読み込み時に行われるため、インポート時間に含まれる
+    entry_point, import_seconds = _load_function("sod_analyzer", {
+        "SOURCE_TABLE_ID": "principal_access_list", "ACCESS_FACTS_TABLE_ID": "access_facts",
+        "DESTINATION_TABLE_ID": "sod_violations", "SOD_RULES_JSON": json.dumps(rules),
+    })
+    # snapshot_id を指定してスナップショットの解決クエリを省き、SQL生成とジョブ投入のみを計測する
+    started = time.perf_counter()
+    entry_point(_event({"snapshot_id": "2026-01-01T00:00:00+00:00"}))
+    seconds = time.perf_counter() - started
+    return {
+        "rules": rule_count, "import_seconds": round(import_seconds, 4), "sql_generation_seconds": round(seconds, 4),
+        "sql_chars": max((len(q) for q in clients.bigquery_client.queries), default=0),
+    }
+
+
+def _run_isolated(function, *args) -> dict:
+    """ベンチマークを新しいプロセスで実行する"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def run_benchmarks(config: dict, only: list = None) -> dict:
+    selected = set(only or ("dispatcher", *RESOURCE_ASSESSOR_KINDS, "principal_assessor", "group_assessor", "sod_analyzer"))
+    results = {}
+    if "dispatcher" in selected:
+        results["dispatcher"] = _run_isolated(bench_dispatcher, config)
+    for name in RESOURCE_ASSESSOR_KINDS:
+        if name in selected:
+            results[name] = _run_isolated(bench_resource_assessor, name, config)
+    if "principal_assessor" in selected:
+        results["principal_assessor"] = _run_isolated(bench_principal_assessor, config)
+    if "group_assessor" in selected:
+        results["group_assessor"] = _run_isolated(bench_group_assessor, config)
+    if "sod_analyzer" in selected:
+        for rule_count in config["sod_rules"]:
+            results[f"sod_analyzer.rules_{rule_count}"] = _run_isolated(bench_sod_analyzer, config, rule_count)
+    return results
+
+
+def _git_revision() -> dict:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def compare_results(current: dict, baseline: dict, threshold: float = 0.1) -> list:
+    """
+    ベンチマークごと・指標ごとに前回の結果と比較し、[{benchmark, metric, baseline, current, change, regression}] を返す。
+    change は前回比の変化率。threshold を超えて悪化した指標は regression とする。
+    """
+    comparisons = []
+    for benchmark, metrics in current.get("results", {}).items():
+        previous = baseline.get("results", {}).get(benchmark, {})
+        for metric, value in metrics.items():
+            higher_is_better = metric.endswith(HIGHER_IS_BETTER)
+            if not (higher_is_better or metric.endswith(LOWER_IS_BETTER)):
+                continue
+            before = previous.get(metric)
+            if not isinstance(before, (int, float)) or not before:
+                continue
+            change = (value - before) / before
+            worse = -change if higher_is_better else change
+            comparisons.append({
+                "benchmark": benchmark, "metric": metric, "baseline": before, "current": value,
+                "change": round(change, 4), "regression": worse > threshold,
+            })
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline functions against offline GCP fakes.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--folders", type=int, default=10)
+    parser.add_argument("--projects", type=int, default=50)
+    parser.add_argument("--resources-per-project", type=int, default=30)
+    parser.add_argument("--bindings-per-resource", type=int, default=4)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=500)
+    parser.add_argument("--nesting-depth", type=int, default=4)
+    parser.add_argument("--diamond-ratio", type=float, default=0.1)
+    parser.add_argument("--members-per-group", type=int, default=20)
+    parser.add_argument("--group-binding-ratio", type=float, default=0.3)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency (0..jitter seconds)")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="probability of an injected ResourceExhausted")
+    parser.add_argument("--sod-rules", default="100,1000,5000", help="comma separated rule counts for the SoD benchmark")
+    parser.add_argument("--sod-roles", type=int, default=500, help="size of the role vocabulary used by the SoD rules")
+    parser.add_argument("--only", help="comma separated benchmarks to run (e.g. dispatcher,gcs_assessor)")
+    parser.add_argument("--output", help="result JSON path (default: benchmark-results/pipeline-<commit>.json)")
+    parser.add_argument("--baseline", help="previous result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change treated as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in ORG_PARAMETERS}
+    config.update({
+        "latency": args.latency, "jitter": args.jitter, "quota_error_rate": args.quota_error_rate,
+        "sod_rules": [int(n) for n in args.sod_rules.split(",") if n], "sod_roles": args.sod_roles,
+    })
+    revision = _git_revision()
+    report = {
+        **revision,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": run_benchmarks(config, args.only.split(",") if args.only else None),
+    }
+
+    output = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"pipeline-{(revision['commit'] or 'unknown')[:7]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            comparisons = compare_results(report, json.load(f), args.threshold)
+        for c in comparisons:
+            marker = "REGRESSION" if c["regression"] else ""
+            print(f"{c['benchmark']:<32} {c['metric']:<24} {c['baseline']:>12} -> {c['current']:>12} ({c['change']:+.1%}) {marker}",
+                  file=sys.stderr)
+        if args.fail_on_regression and any(c["regression"] for c in comparisons):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+ローカルSoDエンジン (src/utils/sod_engine.py) のベンチマーク。
+
+合成データ (または --snapshot で指定したエクスポート) に対してルールを評価し、処理時間をJSONで出力する。
+--bq-source を指定すると、同じルールで sod-analyzer と同じSQL (utils.sql_helpers.sod_violations_sql) を
+BigQuery上で実行し、実行時間・スキャン量・違反件数をローカルエンジンの結果と並べて出力する。
+
+例:
+    python tools/benchmark_sod_engine.py --principals 50000 --rules 2000
+    python tools/benchmark_sod_engine.py --rules-file rules.json --bq-source my-proj.iam_assessment.access_facts
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.sod_engine import SodEngine, load_snapshot_file, load_snapshot_from_bigquery  # noqa: E402
+from utils.sod_rules import normalize_sod_rules, classify_sod_rules  # noqa: E402
+
+
+def generate_snapshot(principals: int, roles: int, grants_per_principal: int, seed: int) -> list:
+    """プリンシパルごとにランダムなロールを割り当てた合成スナップショットを生成する"""
+    rng = random.Random(seed)
+    role_names = [f"roles/custom.role{i}" for i in range(roles)]
+    grants = []
+    for p in range(principals):
+        for role in rng.sample(role_names, min(grants_per_principal, roles)):
+            grants.append({
+                "principal_email": f"user{p}@example.com",
+                "principal_type": "USER",
+                "resource_name": f"//cloudresourcemanager.googleapis.com/projects/p{rng.randrange(100)}",
+                "role": role,
+            })
+    return grants
+
+
+def generate_rules(count: int, roles: int, seed: int) -> list:
+    """role1/role2 にそれぞれ1〜3個のロールを持つ合成ルールを生成する"""
+    rng = random.Random(seed + 1)
+    role_names = [f"roles/custom.role{i}" for i in range(roles)]
+    return [{
+        "rule_id": f"BENCH-{i}",
+        "description": "synthetic rule",
+        "role1": rng.sample(role_names, rng.randint(1, 3)),
+        "role2": rng.sample(role_names, rng.randint(1, 3)),
+    } for i in range(count)]
+
+
+def run_sql_path(bq_source: str, rules: list) -> dict:
+    """sod-analyzer と同じクエリをBigQueryで実行し、結果を保存せずに計測する"""
+    from google.cloud import bigquery
+    from utils.gcp_clients import bigquery_client
+    from utils.sql_helpers import sod_violations_sql
+
+    rule_rows, _ = classify_sod_rules(rules, workspace_data_available=False)
+    job_config = bigquery.QueryJobConfig(
+        use_query_cache=False,
+        query_parameters=[bigquery.ScalarQueryParameter("sod_rules", "STRING", json.dumps(rule_rows))]
+    )
+    started = time.perf_counter()
+    job = bigquery_client.query(sod_violations_sql(f"`{bq_source}`"), job_config=job_config)
+    violations = sum(1 for row in job.result() if row["principal_email"])
+    return {
+        "seconds": round(time.perf_counter() - started, 3),
+        "violations": violations,
+        "total_bytes_processed": job.total_bytes_processed,
+        "slot_millis": job.slot_millis,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the in-process SoD engine against the SQL path.")
+    parser.add_argument("--principals", type=int, default=10000)
+    parser.add_argument("--roles", type=int, default=500, help="size of the synthetic role vocabulary")
+    parser.add_argument("--grants-per-principal", type=int, default=8)
+    parser.add_argument("--rules", type=int, default=1000, help="number of synthetic rules")
+    parser.add_argument("--rules-file", help="JSON file with SoD rules (same format as SOD_RULES_JSON)")
+    parser.add_argument("--snapshot", help="local snapshot file exported from principal_access_list / access_facts")
+    parser.add_argument("--bq-source", help="project.dataset.table of access_facts to load and to run the SQL path against")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.rules_file:
+        with open(args.rules_file, encoding="utf-8") as f:
+            raw_rules = json.load(f)
+    else:
+        raw_rules = generate_rules(args.rules, args.roles, args.seed)
+    rules = normalize_sod_rules(raw_rules)
+
+    started = time.perf_counter()
+    if args.bq_source:
+        grants, workspace_roles = load_snapshot_from_bigquery(f"`{args.bq_source}`")
+    elif args.snapshot:
+        grants, workspace_roles = load_snapshot_file(args.snapshot)
+    else:
+        grants, workspace_roles = generate_snapshot(args.principals, args.roles, args.grants_per_principal, args.seed), None
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    engine = SodEngine(grants, workspace_roles)
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    rows = engine.evaluate(rules)
+    evaluate_seconds = time.perf_counter() - started
+
+    result = {
+        "principals": len(engine.principals),
+        "role_vocabulary": engine.role_count,
+        "grants": len(grants),
+        "rules": len(rules),
+        "engine": {
+            "load_seconds": round(load_seconds, 3),
+            "encode_seconds": round(encode_seconds, 3),
+            "evaluate_seconds": round(evaluate_seconds, 3),
+            "violations": sum(1 for row in rows if row["principal_email"]),
+        },
+    }
+    if args.bq_source:
+        result["sql"] = run_sql_path(args.bq_source, rules)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+GCPクライアントのオフライン代替 (フェイク) と合成組織の生成器。ベンチマークとローカルでの性能検証に使う。
+
+install() は utils.gcp_clients と同じ名前 (bigquery_client, BigQueryClientClass など) を持つモジュールを
+sys.modules に登録する。関数のモジュールは utils.gcp_clients から直接インポートするため、install() は
+関数のモジュールをインポートする前に呼び出すこと。
+
+例:
+    sys.path.insert(0, "src")
+    from gcp_fakes import generate_org, FaultInjector, installed
+
+    org = generate_org(seed=1, projects=100, resources_per_project=50)
+    with installed(org, faults=FaultInjector(latency=0.02, quota_error_rate=0.01)) as clients:
+        from assessors.gcs_assessor.main import assess_gcs_bucket
+        ...
+        clients.bigquery_client.rows("unified_access")
+"""
+import contextlib
+import sys
+import types
+
+from .clients import (
+    FaultInjector,
+    FakeAssetServiceClient,
+    FakeIdentityGroupsServiceClient,
+    FakeStorageClient,
+    FakeComputeInstancesClient,
+    FakeBigQueryClient,
+    FakePublisherClient,
+    FakeRecommenderClient,
+)
+from .synthetic_org import SyntheticOrg, generate_org
+
+GCP_CLIENTS_MODULE = "utils.gcp_clients"
+
+
+def build_clients_module(org: SyntheticOrg, faults: FaultInjector = None, query_handler=None) -> types.ModuleType:
+    """utils.gcp_clients と同じ名前のインスタンスとクラスを持つモジュールを作る (クラスは共有インスタンスを返す)"""
+    faults = faults or FaultInjector()
+    module = types.ModuleType(GCP_CLIENTS_MODULE)
+    instances = {
+        "bigquery_client": ("BigQueryClientClass", FakeBigQueryClient(org, faults, query_handler)),
+        "storage_client": ("StorageClientClass", FakeStorageClient(org, faults)),
+        "compute_client": ("ComputeInstancesClientClass", FakeComputeInstancesClient(org, faults)),
+        "asset_client": ("AssetServiceClientClass", FakeAssetServiceClient(org, faults)),
+        "publisher_client": ("PublisherClientClass", FakePublisherClient(faults)),
+        "identity_client": ("IdentityGroupsServiceClientClass", FakeIdentityGroupsServiceClient(org, faults)),
+        "recommender_client": ("RecommenderClientClass", FakeRecommenderClient(org, faults)),
+    }
+    for instance_name, (class_name, instance) in instances.items():
+        setattr(module, instance_name, instance)
+        # bq_assessor などはクラスから動的に初期化するため、同じインスタンスを返して書き込みを1か所に集める
+        setattr(module, class_name, lambda *args, _instance=instance, **kwargs: _instance)
+    module.faults = faults
+    module.org = org
+    module.__all__ = [name for pair in instances.items() for name in (pair[0], pair[1][0])]
+    return module
+
+
+def install(org: SyntheticOrg, faults: FaultInjector = None, query_handler=None) -> types.ModuleType:
+    """フェイクのクライアントモジュールを utils.gcp_clients として登録し、そのモジュールを返す"""
+    module = build_clients_module(org, faults, query_handler)
+    sys.modules[GCP_CLIENTS_MODULE] = module
+    utils_package = sys.modules.get("utils")
+    if utils_package is not None:
+        utils_package.gcp_clients = module
+    return module
+
+
+@contextlib.contextmanager
+def installed(org: SyntheticOrg, faults: FaultInjector = None, query_handler=None):
+    """
+    install() したうえで、終了時に sys.modules を元に戻す。
+    ブロック内でインポートした utils.* と関数のモジュールも取り除き、フェイクへの参照を残さない。
+    """
+    saved = dict(sys.modules)
+    utils_package = sys.modules.get("utils")
+    saved_attribute = getattr(utils_package, "gcp_clients", None)
+    try:
+        yield install(org, faults, query_handler)
+    finally:
+        for name in list(sys.modules):
+            if name not in saved:
+                del sys.modules[name]
+        sys.modules.update(saved)
+        if utils_package is not None:
+            if saved_attribute is None:
+                utils_package.__dict__.pop("gcp_clients", None)
+            else:
+                utils_package.gcp_clients = saved_attribute
+
+
+__all__ = [
+    "FaultInjector",
+    "FakeAssetServiceClient",
+    "FakeIdentityGroupsServiceClient",
+    "FakeStorageClient",
+    "FakeComputeInstancesClient",
+    "FakeBigQueryClient",
+    "FakePublisherClient",
+    "FakeRecommenderClient",
+    "SyntheticOrg",
+    "generate_org",
+    "build_clients_module",
+    "install",
+    "installed",
+]
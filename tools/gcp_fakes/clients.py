@@ -0,0 +1,414 @@
+"""
+utils.gcp_clients が公開するクライアント (asset, identity, storage, compute, bigquery, pubsub, recommender) のフェイク実装。
+SyntheticOrg のデータから応答し、FaultInjector で呼び出しごとの遅延とクォータエラーを注入できる。
+各クライアントは関数が実際に使うメソッドのみを実装する。
+"""
+import datetime
+import itertools
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions as api_exceptions
+
+
+class FaultInjector:
+    """
+    フェイクの呼び出しごとに遅延 (latency + 0〜jitter 秒) を入れ、quota_error_rate の確率で ResourceExhausted を送出する。
+    methods を指定すると、その名前 ("storage.get_iam_policy" など) の呼び出しにのみ適用する。
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, quota_error_rate: float = 0.0, seed: int = 0,
+                 methods=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.methods = set(methods) if methods else None
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock() # overpermission-analyzer などはスレッドから呼び出す
+        self.calls = {}
+        self.quota_errors = 0
+
+    def __call__(self, method: str):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.methods is not None and method not in self.methods:
+                return
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self.quota_error_rate and self._rng.random() < self.quota_error_rate
+            if fail:
+                self.quota_errors += 1
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise api_exceptions.ResourceExhausted(f"Quota exceeded for {method} (injected)")
+
+
+NO_FAULTS = FaultInjector()
+
+
+def _bindings_list(bindings: dict) -> list:
+    return [SimpleNamespace(role=role, members=list(members)) for role, members in bindings.items()]
+
+
+def _all_nodes(org):
+    """組織・フォルダ・プロジェクトとリソースを (name, asset_type, ancestors, bindings, project_number) で列挙する"""
+    for short, container in org.containers.items():
+        project_number = short.split("/", 1)[1] if short.startswith("projects/") else None
+        yield container["name"], container["asset_type"], container["ancestors"], container["bindings"], project_number
+    for resource in org.resources:
+        yield resource["name"], resource["asset_type"], resource["ancestors"], resource["bindings"], resource["ancestors"][0].split("/", 1)[1]
+
+
+class FakeAssetServiceClient:
+    def __init__(self, org, faults: FaultInjector = NO_FAULTS):
+        self.org = org
+        self.faults = faults
+
+    def _pager(self, method, items, items_field, request):
+        return FakePager(
+            lambda page_token: _list_page(items, items_field, request.get("page_size"), page_token),
+            items_field, self.faults, f"asset.{method}", request.get("page_token")
+        )
+
+    def search_all_resources(self, request=None, scope=None, asset_types=None, timeout=None, **kwargs):
+        self.faults("asset.search_all_resources")
+        request = request or {}
+        scope = request.get("scope", scope)
+        asset_types = set(request.get("asset_types", asset_types) or ())
+        results = []
+        for name, asset_type, ancestors, _, project_number in _all_nodes(self.org):
+            if asset_types and asset_type not in asset_types:
+                continue
+            if not self.org.in_scope(ancestors, scope):
+                continue
+            results.append(SimpleNamespace(
+                name=name, asset_type=asset_type,
+                project=f"projects/{project_number}" if project_number else "",
+                folders=[a for a in ancestors if a.startswith("folders/")],
+                organization=self.org.org_name,
+            ))
+        return self._pager("search_all_resources", results, "results", request)
+
+    def search_all_iam_policies(self, scope=None, request=None, timeout=None, **kwargs):
+        self.faults("asset.search_all_iam_policies")
+        request = request or {}
+        scope = request.get("scope", scope)
+        results = [
+            SimpleNamespace(resource=name, policy=SimpleNamespace(bindings=_bindings_list(bindings)))
+            for name, _, ancestors, bindings, _ in _all_nodes(self.org)
+            if bindings and self.org.in_scope(ancestors, scope)
+        ]
+        return self._pager("search_all_iam_policies", results, "results", request)
+
+    def list_assets(self, request=None, parent=None, timeout=None, **kwargs):
+        self.faults("asset.list_assets")
+        request = request or {}
+        parent = request.get("parent", parent)
+        assets = [
+            SimpleNamespace(name=name, asset_type=asset_type, ancestors=list(ancestors))
+            for name, asset_type, ancestors, _, _ in _all_nodes(self.org)
+            if self.org.in_scope(ancestors, parent)
+        ]
+        return self._pager("list_assets", assets, "assets", request)
+
+
+class FakeIdentityGroupsServiceClient:
+    def __init__(self, org, faults: FaultInjector = NO_FAULTS):
+        self.org = org
+        self.faults = faults
+
+    def search_groups(self, parent=None, request=None, timeout=None, **kwargs):
+        self.faults("identity.search_groups")
+        return [SimpleNamespace(name=f"groups/{email}", group_key=SimpleNamespace(id=email)) for email in self.org.groups]
+
+    def lookup_group_name(self, group_key=None, request=None, timeout=None, **kwargs):
+        self.faults("identity.lookup_group_name")
+        email = (group_key or (request or {}).get("group_key") or {})["id"]
+        if email not in self.org.groups:
+            raise api_exceptions.NotFound(f"Group {email} not found")
+        return SimpleNamespace(name=f"groups/{email}")
+
+    def list_memberships(self, parent=None, view=None, request=None, timeout=None, **kwargs):
+        self.faults("identity.list_memberships")
+        email = parent.split("/", 1)[1]
+        if email not in self.org.groups:
+            raise api_exceptions.NotFound(f"Group {email} not found")
+        return [
+            # type_: 1 = USER (サービスアカウントを含む), 2 = GROUP
+            SimpleNamespace(preferred_member_key=SimpleNamespace(id=member_email), type_=2 if member_type == "GROUP" else 1)
+            for member_email, member_type in self.org.groups[email]
+        ]
+
+
+class FakeStoragePolicy:
+    def __init__(self, bindings: dict, etag: str):
+        self.bindings = {role: set(members) for role, members in bindings.items()}
+        self.etag = etag
+
+
+class FakeBucket:
+    def __init__(self, name, resource, faults):
+        self.name = name
+        self._resource = resource
+        self._faults = faults
+
+    def get_iam_policy(self, requested_policy_version=None, timeout=None, **kwargs):
+        self._faults("storage.get_iam_policy")
+        if self._resource is None:
+            raise api_exceptions.NotFound(f"Bucket {self.name} not found")
+        return FakeStoragePolicy(self._resource["bindings"], self._resource["etag"])
+
+
+class FakeStorageClient:
+    def __init__(self, org, faults: FaultInjector = NO_FAULTS):
+        self.faults = faults
+        self._buckets = {r["bucket"]: r for r in org.resources if r["kind"] == "GCS_BUCKET"}
+
+    def bucket(self, bucket_name):
+        return FakeBucket(bucket_name, self._buckets.get(bucket_name), self.faults)
+
+
+class FakeComputeInstancesClient:
+    def __init__(self, org, faults: FaultInjector = NO_FAULTS):
+        self.faults = faults
+        self._instances = {
+            (r["project_id"], r["zone"], r["instance"]): r for r in org.resources if r["kind"] == "COMPUTE_INSTANCE"
+        }
+
+    def get_iam_policy(self, project=None, zone=None, resource=None, request=None, timeout=None, **kwargs):
+        self.faults("compute.get_iam_policy")
+        instance = self._instances.get((project, zone, resource))
+        if instance is None:
+            raise api_exceptions.NotFound(f"Instance {project}/{zone}/{resource} not found")
+        return SimpleNamespace(bindings=_bindings_list(instance["bindings"]), etag=instance["etag"])
+
+
+# --- BigQuery ---
+
+class FakeQueryJob:
+    """クエリ・DML・ロードジョブのフェイク。常に完了済み"""
+    _ids = itertools.count(1)
+
+    def __init__(self, rows=None, affected_rows=None, total_bytes_processed=0, error=None):
+        self.job_id = f"fake-job-{next(self._ids)}"
+        self._rows = rows or []
+        self.num_dml_affected_rows = affected_rows
+        self.output_rows = len(self._rows)
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_processed
+        self.slot_millis = 0
+        self.cache_hit = False
+        self._error = error
+
+    def result(self, *args, **kwargs):
+        if self._error:
+            raise self._error
+        return list(self._rows)
+
+    def done(self, *args, **kwargs):
+        return True
+
+    def exception(self, *args, **kwargs):
+        return self._error
+
+    def cancel(self):
+        return True
+
+
+class FakeTableRef:
+    def __init__(self, project, dataset_id, table_id):
+        self.project, self.dataset_id, self.table_id = project, dataset_id, table_id
+
+    def __str__(self):
+        return f"{self.project}.{self.dataset_id}.{self.table_id}"
+
+
+class FakeDatasetRef:
+    def __init__(self, project, dataset_id):
+        self.project, self.dataset_id = project, dataset_id
+
+    def table(self, table_id):
+        return FakeTableRef(self.project, self.dataset_id, table_id)
+
+
+class FakeBigQueryClient:
+    """
+    テーブルはメモリ上の行のリストとして保持する。SQLは実行できないため、query_handler(sql, job_config) が
+    返す行 (dict のリスト) または DML の影響行数 (int) を結果として使う (未指定なら空の結果)。
+    宛先テーブル付きのクエリは、その結果を write_disposition に従って宛先テーブルに書き込む。
+    assessor が評価するデータセット (get_dataset) は SyntheticOrg から作る。
+    """
+
+    def __init__(self, org=None, faults: FaultInjector = NO_FAULTS, query_handler=None, project="fake-project"):
+        self.project = project
+        self.faults = faults
+        self.query_handler = query_handler
+        self.tables = {}
+        self.queries = []
+        self._lock = threading.Lock()
+        self._datasets = {}
+        for r in (org.resources if org else ()):
+            if r["kind"] == "BIGQUERY_DATASET":
+                self._datasets[f"{r['project_id']}.{r['dataset_id']}"] = r
+
+    def _key(self, table) -> str:
+        key = str(table).replace(":", ".").strip("`")
+        return key if key.count(".") == 2 else f"{self.project}.{key}"
+
+    def _write(self, table, rows, write_disposition=None):
+        with self._lock:
+            key = self._key(table)
+            if write_disposition == "WRITE_TRUNCATE" or key not in self.tables:
+                self.tables[key] = []
+            self.tables[key].extend(dict(row) for row in rows)
+
+    def rows(self, table_id: str) -> list:
+        """テーブルIDの末尾 (例: unified_access) が一致するテーブルの行"""
+        return [row for key, rows in self.tables.items() if key.split(".")[-1] == table_id for row in rows]
+
+    def dataset(self, dataset_id, project=None):
+        return FakeDatasetRef(project or self.project, dataset_id)
+
+    def query(self, query, job_config=None, **kwargs):
+        self.faults("bigquery.query")
+        self.queries.append(query)
+        if getattr(job_config, "dry_run", False):
+            return FakeQueryJob()
+        result = self.query_handler(query, job_config) if self.query_handler else None
+        if isinstance(result, int):
+            return FakeQueryJob(affected_rows=result)
+        rows = result or []
+        destination = getattr(job_config, "destination", None)
+        if destination is not None:
+            self._write(destination, rows, getattr(job_config, "write_disposition", None))
+        return FakeQueryJob(rows=rows, affected_rows=0)
+
+    def insert_rows_json(self, table, json_rows, **kwargs):
+        self.faults("bigquery.insert_rows_json")
+        self._write(table, json_rows)
+        return []
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, **kwargs):
+        self.faults("bigquery.load_table_from_json")
+        rows = list(json_rows)
+        self._write(destination, rows, getattr(job_config, "write_disposition", None))
+        return FakeQueryJob(rows=rows)
+
+    def copy_table(self, sources, destination, job_config=None, **kwargs):
+        self.faults("bigquery.copy_table")
+        rows = list(self.tables.get(self._key(sources), []))
+        self._write(destination, rows, getattr(job_config, "write_disposition", None))
+        return FakeQueryJob()
+
+    def get_table(self, table, **kwargs):
+        self.faults("bigquery.get_table")
+        rows = self.tables.get(self._key(table), [])
+        return SimpleNamespace(modified=datetime.datetime.now(datetime.timezone.utc), num_rows=len(rows), streaming_buffer=None)
+
+    def get_dataset(self, dataset_ref, timeout=None, **kwargs):
+        self.faults("bigquery.get_dataset")
+        dataset_id = str(dataset_ref)
+        resource = self._datasets.get(dataset_id) or self._datasets.get(f"{self.project}.{dataset_id}")
+        if resource is None:
+            raise api_exceptions.NotFound(f"Dataset {dataset_id} not found")
+        entries = []
+        for role, members in resource["bindings"].items():
+            for member in members:
+                member_type, member_id = member.split(":", 1)
+                # 実際のAPIと同じく、ユーザーとサービスアカウントは userByEmail、グループは groupByEmail
+                entity_type = "groupByEmail" if member_type == "group" else "userByEmail"
+                entries.append(SimpleNamespace(entity_type=entity_type, entity_id=member_id, role=role))
+        return SimpleNamespace(dataset_id=resource["dataset_id"], project=resource["project_id"],
+                               access_entries=entries, etag=resource["etag"])
+
+
+class FakePublisherClient:
+    def __init__(self, faults: FaultInjector = NO_FAULTS):
+        self.faults = faults
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, **attributes):
+        self.faults("pubsub.publish")
+        with self._lock:
+            self.messages.append({"topic": topic, "data": data, "attributes": attributes})
+            message_id = str(len(self.messages))
+        return SimpleNamespace(result=lambda timeout=None: message_id)
+
+
+def _list_page(items: list, items_field: str, page_size, page_token) -> SimpleNamespace:
+    """items の page_token (開始位置) から page_size 件を、一覧系 API のレスポンスの形で返す"""
+    start = int(page_token or 0)
+    end = start + (page_size or len(items) or 1)
+    return SimpleNamespace(**{items_field: items[start:end]}, next_page_token=str(end) if end < len(items) else "")
+
+
+class FakePager:
+    """
+    一覧系 API (list_recommendations, search_all_resources など) の戻り値。
+    イテレートすると残りの全ページの要素を、pages はページごとのレスポンスを返す。
+    実際の pager と同様に、2ページ目以降の取得も1回の呼び出しとして FaultInjector を通す。
+    """
+
+    def __init__(self, fetch_page, items_field, faults, method, page_token=None):
+        self._fetch_page, self._items_field = fetch_page, items_field
+        self._faults, self._method, self._page_token = faults, method, page_token
+
+    @property
+    def pages(self):
+        page_token = self._page_token
+        while True:
+            page = self._fetch_page(page_token)
+            yield page
+            page_token = page.next_page_token
+            if not page_token:
+                return
+            self._faults(self._method)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from getattr(page, self._items_field)
+
+
+class FakeRecommenderClient:
+    def __init__(self, org, faults: FaultInjector = NO_FAULTS):
+        self.org = org
+        self.faults = faults
+
+    def _page(self, parent, page_size, page_token):
+        # parent: projects/<番号またはID>/locations/<location>/recommenders/<id>
+        project = self.org.project(parent.split("/")[1])
+        if project is None:
+            raise api_exceptions.PermissionDenied(f"Recommender API is not enabled for {parent}")
+        items = self.org.recommendations.get(project["number"], [])
+        page = _list_page(items, "recommendations", page_size, page_token)
+        page.recommendations = [self._recommendation(r) for r in page.recommendations]
+        return page
+
+    @staticmethod
+    def _recommendation(rec):
+        operations = []
+        if rec["recommended_role"]:
+            operations.append(SimpleNamespace(action="replace", path="/bindings/*/role",
+                                              value=SimpleNamespace(string_value=rec["recommended_role"])))
+        return SimpleNamespace(
+            content=SimpleNamespace(
+                overview={"member": rec["member"], "resource": rec["resource"], "role": rec["role"]},
+                operations=operations,
+            ),
+            recommender_subtype=rec["subtype"],
+        )
+
+    def list_recommendations(self, request=None, parent=None, timeout=None, **kwargs):
+        self.faults("recommender.list_recommendations")
+        request = request or {}
+        parent, page_size = request.get("parent", parent), request.get("page_size")
+        return FakePager(
+            lambda page_token: self._page(parent, page_size, page_token),
+            "recommendations", self.faults, "recommender.list_recommendations", request.get("page_token")
+        )
@@ -0,0 +1,193 @@
+"""
+ベンチマーク用の合成組織 (組織 → フォルダ → プロジェクト → リソース、IAMバインディング、ネストしたグループ) を生成する。
+同じ seed からは常に同じ組織が生成される。
+"""
+import hashlib
+import random
+
+RESOURCE_KINDS = ("GCS_BUCKET", "BIGQUERY_DATASET", "COMPUTE_INSTANCE")
+ASSET_TYPES = {
+    "GCS_BUCKET": "storage.googleapis.com/Bucket",
+    "BIGQUERY_DATASET": "bigquery.googleapis.com/Dataset",
+    "COMPUTE_INSTANCE": "compute.googleapis.com/Instance",
+    "PROJECT": "cloudresourcemanager.googleapis.com/Project",
+    "FOLDER": "cloudresourcemanager.googleapis.com/Folder",
+    "ORGANIZATION": "cloudresourcemanager.googleapis.com/Organization",
+}
+RESOURCE_ROLES = {
+    "GCS_BUCKET": ["roles/storage.objectViewer", "roles/storage.objectAdmin", "roles/storage.admin"],
+    "BIGQUERY_DATASET": ["READER", "WRITER", "OWNER"],
+    "COMPUTE_INSTANCE": ["roles/compute.instanceAdmin.v1", "roles/compute.osLogin", "roles/iam.serviceAccountUser"],
+}
+CONTAINER_ROLES = ["roles/viewer", "roles/editor", "roles/owner", "roles/iam.securityReviewer", "roles/resourcemanager.projectIamAdmin"]
+ZONES = ["asia-northeast1-a", "asia-northeast1-b", "us-central1-a"]
+CRM = "//cloudresourcemanager.googleapis.com/"
+
+
+def _etag(value) -> str:
+    return hashlib.sha1(repr(value).encode("utf-8")).hexdigest()[:16]
+
+
+class SyntheticOrg:
+    """
+    generate_org が返す合成組織。各フェイククライアントはこのデータを読み取って応答する。
+
+    - containers: 組織・フォルダ・プロジェクト {short_name: {"name", "asset_type", "ancestors", "bindings"}}
+    - projects: [{"project_id", "number", "folder"}]
+    - resources: [{"kind", "asset_type", "name", "project_id", "ancestors", "bindings", "etag", ...}]
+    - groups: {group_email: [(member_email, member_type), ...]} (member_type は USER / SERVICE_ACCOUNT / GROUP)
+    - recommendations: {project_number: [{"member", "resource", "role", "recommended_role", "subtype"}]}
+    """
+
+    def __init__(self, org_id: str):
+        self.org_id = org_id
+        self.org_name = f"organizations/{org_id}"
+        self.containers = {}
+        self.projects = []
+        self.resources = []
+        self.groups = {}
+        self.users = []
+        self.recommendations = {}
+
+    def project(self, key: str) -> dict:
+        """プロジェクトID・番号・projects/<ID または番号> のいずれかからプロジェクトを返す"""
+        key = key.split("/", 1)[1] if key.startswith("projects/") else key
+        for project in self.projects:
+            if key in (project["project_id"], project["number"]):
+                return project
+        return None
+
+    def in_scope(self, ancestors: list, scope: str) -> bool:
+        """ancestors (自身に近い順、短い名前) を持つノードが scope 配下にあるか"""
+        if scope.startswith("projects/"):
+            project = self.project(scope)
+            return bool(project) and f"projects/{project['number']}" in ancestors
+        return scope in ancestors
+
+    def stats(self) -> dict:
+        return {
+            "folders": sum(1 for k in self.containers if k.startswith("folders/")),
+            "projects": len(self.projects),
+            "resources": len(self.resources),
+            "bindings": sum(len(m) for r in self.resources for m in r["bindings"].values())
+                        + sum(len(m) for c in self.containers.values() for m in c["bindings"].values()),
+            "groups": len(self.groups),
+            "group_edges": sum(len(edges) for edges in self.groups.values()),
+            "users": len(self.users),
+        }
+
+
+def _generate_groups(rng: random.Random, org: SyntheticOrg, groups: int, nesting_depth: int,
+                     diamond_ratio: float, members_per_group: int):
+    """
+    グループを nesting_depth 段に分け、各段のグループを1つ上の段のグループのメンバーにする。
+    diamond_ratio の割合のグループは上の段の2つのグループに属する (ダイヤモンド型のネスト)。
+    """
+    levels = [[] for _ in range(max(1, nesting_depth))]
+    for i in range(groups):
+        email = f"group{i}@example.com"
+        levels[i % len(levels)].append(email)
+        org.groups[email] = []
+
+    for depth in range(1, len(levels)):
+        parents = levels[depth - 1]
+        if not parents:
+            break
+        for email in levels[depth]:
+            chosen = [rng.choice(parents)]
+            if len(parents) > 1 and rng.random() < diamond_ratio:
+                chosen.append(rng.choice([p for p in parents if p != chosen[0]]))
+            for parent in chosen:
+                org.groups[parent].append((email, "GROUP"))
+
+    for email in org.groups:
+        for user in rng.sample(org.users, min(members_per_group, len(org.users))):
+            org.groups[email].append((user, "USER"))
+
+
+def _member(rng: random.Random, org: SyntheticOrg, project: dict, group_ratio: float) -> str:
+    roll = rng.random()
+    if org.groups and roll < group_ratio:
+        return f"group:{rng.choice(list(org.groups))}"
+    if roll < group_ratio + 0.1:
+        return f"serviceAccount:sa{rng.randrange(3)}@{project['project_id']}.iam.gserviceaccount.com"
+    return f"user:{rng.choice(org.users)}"
+
+
+def _bindings(rng: random.Random, org: SyntheticOrg, project: dict, roles: list, count: int, group_ratio: float) -> dict:
+    bindings = {}
+    for _ in range(count):
+        bindings.setdefault(rng.choice(roles), set()).add(_member(rng, org, project, group_ratio))
+    return {role: sorted(members) for role, members in bindings.items()}
+
+
+def generate_org(seed: int = 0, folders: int = 5, projects: int = 20, resources_per_project: int = 10,
+                 bindings_per_resource: int = 4, users: int = 500, groups: int = 50, nesting_depth: int = 3,
+                 diamond_ratio: float = 0.1, members_per_group: int = 10, group_binding_ratio: float = 0.3,
+                 recommendations_per_project: int = 5, org_id: str = "100000000001") -> SyntheticOrg:
+    """
+    合成組織を生成する。プロジェクトはフォルダに順番に割り当て、リソースの種類は GCS / BigQuery / Compute を巡回する。
+    group_binding_ratio はバインディングのメンバーがグループになる割合。
+    """
+    rng = random.Random(seed)
+    org = SyntheticOrg(org_id)
+    org.users = [f"user{i}@example.com" for i in range(users)]
+    _generate_groups(rng, org, groups, nesting_depth, diamond_ratio, members_per_group)
+
+    org_ancestors = [org.org_name]
+    org.containers[org.org_name] = {
+        "name": CRM + org.org_name, "asset_type": ASSET_TYPES["ORGANIZATION"], "ancestors": org_ancestors,
+        "bindings": {"roles/owner": [f"user:{org.users[0]}"], "roles/organization.admin": [f"user:{org.users[0]}"]},
+    }
+    folder_names = []
+    for i in range(max(1, folders)):
+        short = f"folders/{200000 + i}"
+        folder_names.append(short)
+        org.containers[short] = {
+            "name": CRM + short, "asset_type": ASSET_TYPES["FOLDER"], "ancestors": [short, *org_ancestors],
+            "bindings": {"roles/editor": [f"group:{rng.choice(list(org.groups))}"]} if org.groups else {},
+        }
+
+    for p in range(projects):
+        folder = folder_names[p % len(folder_names)]
+        project = {"project_id": f"synthetic-proj-{p}", "number": str(300000 + p), "folder": folder}
+        org.projects.append(project)
+        project_short = f"projects/{project['number']}"
+        ancestors = [project_short, *org.containers[folder]["ancestors"]]
+        org.containers[project_short] = {
+            "name": f"{CRM}projects/{project['project_id']}", "asset_type": ASSET_TYPES["PROJECT"], "ancestors": ancestors,
+            "bindings": _bindings(rng, org, project, CONTAINER_ROLES, bindings_per_resource, group_binding_ratio),
+        }
+
+        for r in range(resources_per_project):
+            kind = RESOURCE_KINDS[r % len(RESOURCE_KINDS)]
+            bindings = _bindings(rng, org, project, RESOURCE_ROLES[kind], bindings_per_resource, group_binding_ratio)
+            resource = {
+                "kind": kind, "asset_type": ASSET_TYPES[kind], "project_id": project["project_id"],
+                "ancestors": ancestors, "bindings": bindings, "etag": _etag((kind, p, r, bindings)),
+            }
+            if kind == "GCS_BUCKET":
+                resource["bucket"] = f"{project['project_id']}-bucket-{r}"
+                resource["name"] = f"//storage.googleapis.com/{resource['bucket']}"
+            elif kind == "BIGQUERY_DATASET":
+                resource["dataset_id"] = f"dataset_{r}"
+                resource["name"] = f"//bigquery.googleapis.com/projects/{project['project_id']}/datasets/{resource['dataset_id']}"
+            else:
+                resource["zone"] = ZONES[r % len(ZONES)]
+                resource["instance"] = f"vm-{r}"
+                resource["name"] = (
+                    f"//compute.googleapis.com/projects/{project['project_id']}/zones/{resource['zone']}/instances/vm-{r}"
+                )
+            org.resources.append(resource)
+
+        org.recommendations[project["number"]] = []
+        for _ in range(recommendations_per_project):
+            recommended_role = rng.choice(["roles/viewer", None])
+            org.recommendations[project["number"]].append({
+                "member": f"user:{rng.choice(org.users)}",
+                "resource": f"{CRM}projects/{project['project_id']}",
+                "role": "roles/editor",
+                "recommended_role": recommended_role,
+                "subtype": "REPLACE_ROLE" if recommended_role else "REMOVE_ROLE",
+            })
+    return org